@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import yaml
+from os import environ
+
+current_directory = os.path.dirname(os.path.abspath(__file__))
+current_directory = os.path.dirname(current_directory)
+sys.path.insert(0, current_directory)
+from mlreco.main_funcs import process_config
+from mlreco.serving import InferenceServer
+
+# python3 bin/serve.py config.cfg [host:port | /path/to/unix/socket]
+# Clients connect with mlreco.serving.SocketClient(address, authkey)
+
+def main():
+    cfg_file = sys.argv[1]
+    if not os.path.isfile(cfg_file):
+        cfg_file = os.path.join(current_directory, 'config', sys.argv[1])
+    if not os.path.isfile(cfg_file):
+        print(sys.argv[1], 'not found...')
+        sys.exit(1)
+
+    cfg = yaml.load(open(cfg_file, 'r'), Loader=yaml.Loader)
+
+    if environ.get('CUDA_VISIBLE_DEVICES') is not None and cfg['trainval']['gpus'] == '-1':
+        cfg['trainval']['gpus'] = os.getenv('CUDA_VISIBLE_DEVICES')
+
+    serving_cfg = cfg.get('serving', {}) or {}
+    address = sys.argv[2] if len(sys.argv) > 2 else serving_cfg.get('address', 'localhost:0')
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        address = (host, int(port))
+    authkey = serving_cfg.get('authkey', None)
+    report_interval = float(serving_cfg.get('report_interval', 60))
+
+    process_config(cfg)
+    server = InferenceServer(cfg)
+    print('Serving on', server.listen(address, authkey=authkey.encode() if authkey is not None else None))
+    try:
+        while True:
+            time.sleep(report_interval)
+            stats = server.stats()
+            print('%(num_events)d events in %(num_batches)d batches, %(throughput).2f events/s, '
+                  'latency p50 %(latency_p50).3f s p90 %(latency_p90).3f s p99 %(latency_p99).3f s' % stats)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,6 @@
 import os
 import sys
 import yaml
-import numpy as np
 
 current_directory = os.path.dirname(os.path.abspath(__file__))
 current_directory = os.path.dirname(current_directory)
@@ -28,22 +27,13 @@ def main():
 
     cfg = yaml.load(open(cfg_file, 'r'), Loader=yaml.Loader)
 
+    # All the checkpoints of the folder in one run, the data is read once.
+    # Logs and outputs of each one go to log_dir/<checkpoint name>
+    cfg['trainval']['model_path'] = os.path.join(ckpt_dir, '*.ckpt')
+    cfg['trainval'].setdefault('checkpoint_sweep', 'data')
+
     process_config(cfg)
-    log_dir = cfg['training']['log_dir']
-    
-    # loop over configuration files
-    wfiles = np.array([w for w in os.listdir(ckpt_dir) if w.endswith('.ckpt')])
-    wfiles = np.sort(wfiles)
-    for wfile in wfiles:
-        print(wfile)
-        filename, file_extension = os.path.splitext(wfile)
-        # set weight file
-        cfg['training']['model_path'] = ckpt_dir + '/' + wfile
-        # set output log
-        cfg['training']['log_dir'] = log_dir + '/' + filename
-        
-        # run inference
-        inference(cfg)
+    inference(cfg)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,7 +1,8 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
-from torch.utils.data import DataLoader
+import torch
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 
 
 def loader_handmade(name, minibatch_size,
@@ -57,6 +58,20 @@ def loader_factory(cfg,event_list=None):
         sam_cfg = cfg['iotool']['sampler']
         sam_cfg['minibatch_size']=cfg['iotool']['minibatch_size']
         sampler = getattr(mlreco.iotools.samplers,sam_cfg['name']).create(ds,sam_cfg)
+
+    # Distributed run: each process reads its own shard of the dataset
+    from mlreco.utils.distributed import get_rank, get_world_size
+    if get_world_size() > 1:
+        if sampler is None:
+            if shuffle:
+                # Same permutation on every process, new one every epoch
+                generator = torch.Generator()
+                generator.manual_seed(int(cfg.get('trainval', {}).get('seed', 0)))
+                sampler = RandomSampler(ds, generator=generator)
+            else:
+                sampler = SequentialSampler(ds)
+        sampler = mlreco.iotools.samplers.ShardedSampler(sampler, minibatch_size, get_rank(), get_world_size())
+        shuffle = False
     if collate_fn is not None:
         collate_fn = getattr(mlreco.iotools.collates,collate_fn)
         loader = DataLoader(ds,
@@ -51,3 +51,33 @@ class SequentialBatchSampler(AbstractBatchSampler):
 
 
         
+
+
+class ShardedSampler(Sampler):
+    """
+    Splits the indices of a sampler between the processes of a distributed
+    run. Indices are dealt in chunks of minibatch_size (so that the
+    sequences of RandomSequenceSampler are kept together): chunk i goes to
+    rank i % world_size. The wrapped sampler must produce the same sequence
+    on every process (same seed).
+    """
+    def __init__(self, sampler, minibatch_size, rank, world_size):
+        self._sampler = sampler
+        self._minibatch_size = int(minibatch_size)
+        self._rank = int(rank)
+        self._world_size = int(world_size)
+
+    def __iter__(self):
+        chunk_size = self._minibatch_size * self._world_size
+        offset = self._rank * self._minibatch_size
+        chunk = []
+        for idx in self._sampler:
+            chunk.append(idx)
+            if len(chunk) == chunk_size:
+                for i in chunk[offset:offset+self._minibatch_size]:
+                    yield i
+                chunk = []
+
+    def __len__(self):
+        num_chunks = len(self._sampler) // (self._minibatch_size * self._world_size)
+        return num_chunks * self._minibatch_size
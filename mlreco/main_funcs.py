@@ -2,6 +2,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import os
+import copy
 import time
 import datetime
 import glob
@@ -13,9 +14,10 @@ import itertools
 from mlreco.trainval import trainval
 from mlreco.iotools.factories import loader_factory
 from mlreco.utils import utils
+from mlreco.utils import distributed
 #from mlreco import analysis
 #from mlreco.output_formatters import output
-import mlreco.post_processing as post_processing
+from mlreco.post_processing.executor import PostProcessingExecutor
 
 class Handlers:
     cfg          = None
@@ -26,6 +28,9 @@ class Handlers:
     train_logger = None
     watch        = None
     iteration    = 0
+    tsum         = 0.
+    max_memory   = 0.
+    post_processor = None
 
     def keys(self):
         return list(self.__dict__.keys())
@@ -38,11 +43,31 @@ def cycle(data_io):
 
 
 def train(cfg):
+    """
+    Runs training, in one process per device if trainval.distributed is set
+    """
+    if cfg['trainval'].get('distributed', False):
+        distributed.launch(_train, cfg)
+    else:
+        _train(cfg)
+
+
+def inference(cfg):
+    """
+    Runs inference, in one process per device if trainval.distributed is set
+    """
+    if cfg['trainval'].get('distributed', False):
+        distributed.launch(_inference, cfg)
+    else:
+        _inference(cfg)
+
+
+def _train(cfg):
     handlers = prepare(cfg)
     train_loop(cfg, handlers)
 
 
-def inference(cfg):
+def _inference(cfg):
     handlers = prepare(cfg)
     inference_loop(cfg, handlers)
 
@@ -79,6 +104,9 @@ def process_config(cfg):
         num_gpus = 1
         if 'trainval' in cfg:
             num_gpus = max(1,len(cfg['trainval']['gpus']))
+            # CPU processes of a distributed run share the batch like GPUs
+            if cfg['trainval'].get('distributed', False):
+                num_gpus = distributed.num_processes(cfg)
         if cfg['iotool']['batch_size'] < 0:
             cfg['iotool']['batch_size'] = int(cfg['iotool']['minibatch_size'] * num_gpus)
         if cfg['iotool']['minibatch_size'] < 0:
@@ -98,6 +126,9 @@ def process_config(cfg):
 
 
 def make_directories(cfg, loaded_iteration, handlers=None):
+    # Only the first process of a distributed run writes weights and logs
+    if not distributed.is_main_process():
+        return
     # Weight save directory
     if 'trainval' in cfg:
         if cfg['trainval']['weight_prefix']:
@@ -161,6 +192,15 @@ def prepare(cfg):
 
         make_directories(cfg, loaded_iteration, handlers=handlers)
 
+    # Post-processing, optionally in worker processes. Every process
+    # post-processes the events of its shard, see distributed.rank_dir
+    if 'post_processing' in cfg:
+        trainval_cfg = cfg.get('trainval', {})
+        handlers.post_processor = PostProcessingExecutor(cfg,
+                                                         num_workers=int(trainval_cfg.get('post_processing_workers', 0)),
+                                                         max_queue=trainval_cfg.get('post_processing_queue', None),
+                                                         dry_run=trainval_cfg.get('post_processing_dry_run', False))
+
     return handlers
 
 
@@ -196,17 +236,20 @@ def log(handlers, tstamp_iteration, #tspent_io, tspent_iteration,
         # Keys of format %s_count are special and used as counters
         # e.g. for PPN when there are no particle labels in event
         #if 'analysis_keys' not in cfg['model'] or key not in cfg['model']['analysis_keys']:
-        if len(res[key]) == 0:
-            continue
-        if isinstance(res[key][0], float) or isinstance(res[key][0], int):
+        # Network outputs are skipped without copying them to host
+        if res.is_scalar(key):
             if "count" not in key:
                 res_dict[key] = np.mean([np.array(t).mean() for t in res[key]])
             else:
                 res_dict[key] = np.sum(np.sum([np.array(t).sum() for t in res[key]]))
 
-    mem = 0.
+    # Peak memory during this iteration and since the start
+    mem = mem_step = 0.
     if torch.cuda.is_available():
-        mem = utils.round_decimals(torch.cuda.max_memory_allocated()/1.e9, 3)
+        mem_step = utils.round_decimals(torch.cuda.max_memory_allocated()/1.e9, 3)
+        torch.cuda.reset_peak_memory_stats()
+        handlers.max_memory = max(handlers.max_memory, mem_step)
+        mem = handlers.max_memory
 
     # Organize time info
     t_iter  = handlers.watch.time('iteration')
@@ -222,11 +265,13 @@ def log(handlers, tstamp_iteration, #tspent_io, tspent_iteration,
         handlers.csv_logger.record(('iter', 'first_id', 'epoch', 'titer', 'tsumiter'),
                                    (handlers.iteration, first_id, epoch, t_iter, tsum))
         handlers.csv_logger.record(('tio', 'tsumio'), (t_io,tsum_map['io']))
-        handlers.csv_logger.record(('mem', ), (mem, ))
+        handlers.csv_logger.record(('mem', 'mem_step'), (mem, mem_step))
 
         if cfg['trainval']['train']:
             handlers.csv_logger.record(('ttrain', 'tsave', 'tsumtrain', 'tsumsave'),
                                        (t_net, t_save, tsum_map['train'], tsum_map['save']))
+            handlers.csv_logger.record(('tbackward', 'tsumbackward'),
+                                       (handlers.trainer.tspent['backward'], tsum_map['backward']))
         else:
             handlers.csv_logger.record(('tforward', 'tsumforward'), (t_net, tsum_map['forward']))
 
@@ -236,7 +281,7 @@ def log(handlers, tstamp_iteration, #tspent_io, tspent_iteration,
         handlers.csv_logger.write()
 
     # Report (stdout)
-    if report_step:
+    if report_step and distributed.is_main_process():
         acc   = utils.round_decimals(np.mean(res.get('accuracy',-1)), 4)
         loss  = utils.round_decimals(np.mean(res.get('loss',    -1)), 4)
         tfrac = utils.round_decimals(t_net/t_iter*100., 2)
@@ -260,6 +305,11 @@ def train_loop(cfg, handlers):
     """
     Trainval loop. With optional minibatching as determined by the parameters
     cfg['iotool']['batch_size'] vs cfg['iotool']['minibatch_size'].
+    Post-processing runs in cfg['trainval']['post_processing_workers']
+    worker processes if set, with at most cfg['trainval']['post_processing_queue']
+    iterations pending (see PostProcessingExecutor). With
+    cfg['trainval']['post_processing_dry_run'], outputs are not written and
+    the throughput of each post-processor is printed instead.
     """
     tsum = 0.
     while handlers.iteration < cfg['trainval']['iterations']:
@@ -279,10 +329,9 @@ def train_loop(cfg, handlers):
             handlers.trainer.save_state(handlers.iteration)
 
         # Store output if requested
-        if 'post_processing' in cfg:
-            for processor_name,processor_cfg in cfg['post_processing'].items():
-                processor = getattr(post_processing,str(processor_name))
-                processor(cfg,data_blob,result_blob,cfg['trainval']['log_dir'],handlers.iteration)
+        if handlers.post_processor is not None:
+            handlers.post_processor.submit(data_blob, result_blob, distributed.rank_dir(cfg['trainval']['log_dir']),
+                                           handlers.iteration)
 
         handlers.watch.stop('iteration')
         tsum += handlers.watch.time('iteration')
@@ -299,10 +348,122 @@ def train_loop(cfg, handlers):
         handlers.iteration += 1
 
     # Finalize
+    if handlers.post_processor is not None:
+        handlers.post_processor.close()
     if handlers.csv_logger:
         handlers.csv_logger.close()
 
 
+class RecordingIterator(object):
+    """
+    Iterates over data_iter and appends what it yields to records, to go
+    over the same minibatches again with iter(records)
+    """
+    def __init__(self, data_iter, records):
+        self._data_iter = data_iter
+        self._records = records
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        minibatch = next(self._data_iter)
+        self._records.append(minibatch)
+        return minibatch
+
+
+def inference_step(cfg, handlers, data_iter, log_dir):
+    """
+    Runs one inference iteration on the minibatches of data_iter,
+    post-processes (outputs in log_dir, see distributed.rank_dir) and logs it
+    """
+    epoch = handlers.iteration / float(len(handlers.data_io))
+    tstamp_iteration = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
+    handlers.watch.start('iteration')
+
+    # Run inference
+    data_blob, result_blob = handlers.trainer.forward(data_iter)
+
+    # Store output if requested
+    if handlers.post_processor is not None:
+        handlers.post_processor.submit(data_blob, result_blob, distributed.rank_dir(log_dir), handlers.iteration)
+
+    handlers.watch.stop('iteration')
+    handlers.tsum += handlers.watch.time('iteration')
+
+    log(handlers, tstamp_iteration,
+        handlers.tsum, result_blob, cfg, epoch, data_blob['index'][0])
+
+    handlers.iteration += 1
+
+
+def checkpoint_handlers(cfg, handlers, weight, loaded_iteration):
+    """
+    Copy of handlers for one checkpoint of a sweep: its iterations are
+    counted from 0 and logged to log_dir/<checkpoint name>, where its
+    post-processing outputs go as well
+    """
+    ckpt_handlers = copy.copy(handlers)
+    ckpt_handlers.iteration = 0
+    ckpt_handlers.tsum = 0.
+    ckpt_handlers.csv_logger = None
+    ckpt_handlers.log_dir = os.path.join(cfg['trainval']['log_dir'], os.path.splitext(os.path.basename(weight))[0])
+    if distributed.is_main_process():
+        if not os.path.exists(ckpt_handlers.log_dir):
+            os.makedirs(ckpt_handlers.log_dir)
+        ckpt_handlers.csv_logger = utils.CSVData('%s/inference_log-%07d.csv' % (ckpt_handlers.log_dir, loaded_iteration))
+    return ckpt_handlers
+
+
+def checkpoint_sweep_loop(cfg, handlers, weights):
+    """
+    Runs cfg['trainval']['iterations'] inference iterations for each weight
+    file, reading and collating each minibatch only once:
+
+    - `data`: the minibatches read for the first checkpoint are kept in
+      memory, the next checkpoints are loaded one after the other and run
+      on the same minibatches.
+    - `weights`: the weights of all the checkpoints are held in memory
+      (on the device), each minibatch is run through all of them and then
+      dropped.
+
+    The metrics and post-processing outputs of each checkpoint go to
+    log_dir/<checkpoint name> (see checkpoint_handlers).
+    """
+    mode = cfg['trainval']['checkpoint_sweep']
+    if mode not in ('data', 'weights'):
+        raise ValueError('trainval.checkpoint_sweep must be data or weights, got %s' % mode)
+    trainer = handlers.trainer
+    iterations = cfg['trainval']['iterations']
+    checkpoints = []
+    if mode == 'data':
+        cache = []
+        for weight in weights:
+            ckpt_handlers = checkpoint_handlers(cfg, handlers, weight, trainer.restore(weight))
+            checkpoints.append(ckpt_handlers)
+            for iteration in range(iterations):
+                if iteration == len(cache):
+                    cache.append([])
+                    data_iter = RecordingIterator(handlers.data_io_iter, cache[iteration])
+                else:
+                    data_iter = iter(cache[iteration])
+                inference_step(cfg, ckpt_handlers, data_iter, ckpt_handlers.log_dir)
+    else:
+        states = []
+        for weight in weights:
+            checkpoints.append(checkpoint_handlers(cfg, handlers, weight, trainer.restore(weight)))
+            states.append(trainer.get_weights())
+        for iteration in range(iterations):
+            records = []
+            for index, (ckpt_handlers, state) in enumerate(zip(checkpoints, states)):
+                trainer.set_weights(state)
+                data_iter = RecordingIterator(handlers.data_io_iter, records) if index == 0 else iter(records)
+                inference_step(cfg, ckpt_handlers, data_iter, ckpt_handlers.log_dir)
+    for ckpt_handlers in checkpoints:
+        if ckpt_handlers.csv_logger:
+            ckpt_handlers.csv_logger.close()
+
+
 def inference_loop(cfg, handlers):
     """
     Inference loop. Loops over weight files specified in
@@ -310,46 +471,30 @@ def inference_loop(cfg, handlers):
     runs the inference cfg['trainval']['iterations'] times.
     Note: Accuracy/loss will be per batch in the CSV log file, not per event.
     Write an analysis function to do per-event analysis (TODO).
+    Post-processing is run as in train_loop.
+
+    With cfg['trainval']['checkpoint_sweep'] (`data` or `weights`), the
+    data is read once for all the weight files, see checkpoint_sweep_loop.
     """
-    tsum = 0.
     # Metrics for each event
     # global_metrics = {}
-    weights = glob.glob(cfg['trainval']['model_path'])
+    weights = sorted(glob.glob(cfg['trainval']['model_path']))
     # if len(weights) > 0:
     print("Loading weights: ", weights)
-    for weight in weights:
-        cfg['trainval']['model_path'] = weight
-        _ = handlers.trainer.initialize()
-        handlers.iteration = 0
-        while handlers.iteration < cfg['trainval']['iterations']:
-
-            epoch = handlers.iteration / float(len(handlers.data_io))
-            tstamp_iteration = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
-            handlers.watch.start('iteration')
-
-            checkpt_step = cfg['trainval']['checkpoint_step'] and \
-                           cfg['trainval']['weight_prefix'] and \
-                           ((handlers.iteration+1) % cfg['trainval']['checkpoint_step'] == 0)
-
-            # Run inference
-            data_blob, result_blob = handlers.trainer.forward(handlers.data_io_iter)
-
-            # Store output if requested
-            if 'post_processing' in cfg:
-                for processor_name,processor_cfg in cfg['post_processing'].items():
-                    processor = getattr(post_processing,str(processor_name))
-                    processor(cfg,data_blob,result_blob,cfg['trainval']['log_dir'],handlers.iteration)
-
-            handlers.watch.stop('iteration')
-            tsum += handlers.watch.time('iteration')
-
-            log(handlers, tstamp_iteration,
-                tsum, result_blob, cfg, epoch, data_blob['index'][0])
-
-            handlers.iteration += 1
+    if cfg['trainval'].get('checkpoint_sweep', None) and len(weights):
+        checkpoint_sweep_loop(cfg, handlers, weights)
+    else:
+        for weight in weights:
+            cfg['trainval']['model_path'] = weight
+            handlers.trainer.restore(weight)
+            handlers.iteration = 0
+            while handlers.iteration < cfg['trainval']['iterations']:
+                inference_step(cfg, handlers, handlers.data_io_iter, cfg['trainval']['log_dir'])
 
     # Metrics
     # TODO
     # Finalize
+    if handlers.post_processor is not None:
+        handlers.post_processor.close()
     if handlers.csv_logger:
         handlers.csv_logger.close()
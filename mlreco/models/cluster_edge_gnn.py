@@ -13,7 +13,7 @@ from mlreco.utils.gnn.network import complete_graph
 from mlreco.utils.gnn.compton import filter_compton
 from mlreco.utils.gnn.data import cluster_vtx_features, cluster_edge_features, edge_assignment, cluster_vtx_features_old
 from mlreco.utils.gnn.evaluation import secondary_matching_vox_efficiency, secondary_matching_vox_efficiency3
-from mlreco.utils.gnn.evaluation import DBSCAN_cluster_metrics2, assign_clusters_UF
+from mlreco.utils.gnn.evaluation import DBSCAN_cluster_metrics2, assign_clusters_UF, MetricsSchedule
 from mlreco.utils.groups import process_group_data
 from .gnn import edge_model_construct
 
@@ -30,6 +30,7 @@ class EdgeModel(torch.nn.Module):
                 model_cfg:
                     <dictionary of arguments to pass to model>
                 remove_compton: <True/False to remove compton clusters> (default True)
+                metrics_step: <compute clustering metrics in the loss every n steps, 0 to skip> (default 1)
     """
     def __init__(self, cfg):
         super(EdgeModel, self).__init__()
@@ -110,6 +111,8 @@ class EdgeChannelLoss(torch.nn.Module):
         self.remove_compton = self.model_config.get('remove_compton', True)
         self.compton_thresh = self.model_config.get('compton_thresh', 30)
         
+        self.metrics_schedule = MetricsSchedule(self.model_config.get('metrics_step', 1))
+        
         self.reduction = self.model_config.get('reduction', 'mean')
         self.loss = self.model_config.get('loss', 'CE')
         
@@ -137,6 +140,7 @@ class EdgeChannelLoss(torch.nn.Module):
         total_loss, total_acc = 0., 0.
         ari, ami, sbd, pur, eff = 0., 0., 0., 0., 0.
         ngpus = len(clusters)
+        compute_metrics = not self.training or self.metrics_schedule()
         for i in range(ngpus):
             edge_pred = out['edge_pred'][i]
             data0 = clusters[i]
@@ -155,8 +159,8 @@ class EdgeChannelLoss(torch.nn.Module):
             if self.remove_compton:
                 selection = filter_compton(clusts, self.compton_thresh) # non-compton looking clusters
                 if not len(selection):
-                    ttotal_loss += self.lossfn(edge_pred, edge_pred)
-                    totalacc += 1.
+                    total_loss += self.lossfn(edge_pred, edge_pred)
+                    total_acc += 1.
                     continue
 
                 clusts = clusts[selection]
@@ -169,9 +173,9 @@ class EdgeChannelLoss(torch.nn.Module):
             batch = get_cluster_batch(data0, clusts)
             edge_index = complete_graph(batch, device=device)
 
-            if not edge_index.shape[0]:
+            if not edge_index.shape[1]:
                 total_loss += self.lossfn(edge_pred, edge_pred)
-                totalacc += 1.
+                total_acc += 1.
                 continue
                 
             group = get_cluster_label(data_grp, clusts)
@@ -182,10 +186,17 @@ class EdgeChannelLoss(torch.nn.Module):
             edge_assn = edge_assn.view(-1)
 
             # total loss on batch
-            total_loss = self.lossfn(edge_pred, edge_assn)
+            total_loss += self.lossfn(edge_pred, edge_assn)
+
+            edge_ct += edge_index.shape[1]
+            if not compute_metrics:
+                continue
+
+            # fraction of correctly classified edges
+            total_acc += float(torch.sum(torch.argmax(edge_pred, dim=1) == edge_assn)) / len(edge_assn)
 
             # compute assigned clusters
-            fe = edge_pred[1,:] - edge_pred[0,:]
+            fe = edge_pred[:,1] - edge_pred[:,0]
             cs = assign_clusters_UF(edge_index, fe, len(clusts), thresh=0.0)
 
             ari0, ami0, sbd0, pur0, eff0 = DBSCAN_cluster_metrics2(
@@ -198,16 +209,18 @@ class EdgeChannelLoss(torch.nn.Module):
             sbd += sbd0
             pur += pur0
             eff += eff0
-
-            edge_ct += edge_index.shape[1]
         
-        return {
-            'ARI': ari/ngpus,
-            'AMI': ami/ngpus,
-            'SBD': sbd/ngpus,
-            'purity': pur/ngpus,
-            'efficiency': eff/ngpus,
-            'accuracy': total_acc/ngpus,
+        res = {
             'loss': total_loss/ngpus,
             'edge_count': edge_ct
         }
+        if compute_metrics:
+            res.update({
+                'ARI': ari/ngpus,
+                'AMI': ami/ngpus,
+                'SBD': sbd/ngpus,
+                'purity': pur/ngpus,
+                'efficiency': eff/ngpus,
+                'accuracy': total_acc/ngpus
+            })
+        return res
@@ -9,7 +9,7 @@ from mlreco.utils.gnn.primary import assign_primaries, analyze_primaries
 from mlreco.utils.gnn.network import primary_bipartite_incidence
 from mlreco.utils.gnn.compton import filter_compton
 from mlreco.utils.gnn.data import cluster_vtx_features, cluster_edge_features, edge_assignment
-from mlreco.utils.gnn.evaluation import secondary_matching_vox_efficiency3, DBSCAN_cluster_metrics
+from mlreco.utils.gnn.evaluation import secondary_matching_vox_efficiency3, DBSCAN_cluster_metrics, MetricsSchedule
 from .gnn import edge_model_construct
 
 class EdgeModel(torch.nn.Module):
@@ -28,6 +28,7 @@ class EdgeModel(torch.nn.Module):
                 compton_threshold: Minimum number of voxels
                 balance_classes: <True/False for loss computation> (default False)
                 loss: 'CE' or 'MM' (default 'CE')
+                metrics_step: compute accuracy/clustering metrics every n steps, 0 to skip (default 1)
     """
     def __init__(self, cfg):
         super(EdgeModel, self).__init__()
@@ -133,6 +134,7 @@ class EdgeChannelLoss(torch.nn.Module):
         self.reduction = self.model_config.get('reduction', 'mean')
         self.loss = self.model_config.get('loss', 'CE')
         self.balance_classes = self.model_config.get('balance_classes', False)
+        self.metrics_schedule = MetricsSchedule(self.model_config.get('metrics_step', 1))
 
         if self.loss == 'CE':
             self.lossfn = torch.nn.CrossEntropyLoss(reduction=self.reduction)
@@ -155,6 +157,7 @@ class EdgeChannelLoss(torch.nn.Module):
         total_loss, total_acc, total_primary_fdr, total_primary_acc = 0., 0., 0., 0.
         ari, ami, sbd, pur, eff = 0., 0., 0., 0., 0.
         ngpus = len(clusters)
+        compute_metrics = not self.training or self.metrics_schedule()
         for i in range(len(clusters)):
 
             # Get the necessary data products
@@ -192,6 +195,10 @@ class EdgeChannelLoss(torch.nn.Module):
             # Increment the loss, balance classes if requested (TODO)
             total_loss += self.lossfn(edge_pred, edge_assn)
 
+            edge_ct += edge_index.shape[1]
+            if not compute_metrics:
+                continue
+
             # Compute accuracy of assignment
             total_acc += torch.tensor(
                 secondary_matching_vox_efficiency3(
@@ -218,18 +225,20 @@ class EdgeChannelLoss(torch.nn.Module):
             pur += pur0
             eff += eff0
 
-            edge_ct += edge_index.shape[1]
-
-        return {
+        res = {
             'primary_fdr': total_primary_fdr/ngpus,
             'primary_acc': total_primary_acc/ngpus,
-            'ARI': ari/ngpus,
-            'AMI': ami/ngpus,
-            'SBD': sbd/ngpus,
-            'purity': pur/ngpus,
-            'efficiency': eff/ngpus,
-            'accuracy': total_acc/ngpus,
             'loss': total_loss/ngpus,
             'edge_count': edge_ct
         }
+        if compute_metrics:
+            res.update({
+                'ARI': ari/ngpus,
+                'AMI': ami/ngpus,
+                'SBD': sbd/ngpus,
+                'purity': pur/ngpus,
+                'efficiency': eff/ngpus,
+                'accuracy': total_acc/ngpus
+            })
+        return res
 
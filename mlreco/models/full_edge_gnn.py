@@ -118,9 +118,9 @@ class FullEdgeChannelLoss(torch.nn.Module):
         
         print('edge_assn shape', edge_assn.cpu().numpy().flatten().shape)
         print('pred_inds shape', pred_inds.cpu().detach().numpy().flatten().shape)
-        max_node = int(torch.max(edge_index[0]))
-        node_truth = edge_labels_to_node_labels(None, edge_index[0].cpu().numpy().T, edge_assn.cpu().numpy().flatten(), node_len=max_node)
-        node_preds = edge_labels_to_node_labels(None, edge_index[0].cpu().numpy().T, pred_inds.cpu().detach().numpy().flatten(), node_len=max_node)
+        num_nodes = int(torch.max(edge_index[0])) + 1
+        node_truth = edge_labels_to_node_labels(None, edge_index[0].cpu().numpy().T, edge_assn.cpu().numpy().flatten(), node_len=num_nodes)
+        node_preds = edge_labels_to_node_labels(None, edge_index[0].cpu().numpy().T, pred_inds.cpu().detach().numpy().flatten(), node_len=num_nodes)
         sbd = SBD(node_preds, node_truth)
         
         return {
@@ -6,12 +6,13 @@ import torch
 import numpy as np
 from torch.nn import Sequential as Seq, Linear as Lin, ReLU, Sigmoid, LeakyReLU, Dropout, BatchNorm1d
 from torch_geometric.nn import MetaLayer, GATConv
+from torch_scatter import scatter_max
 from mlreco.utils.gnn.cluster import get_cluster_batch, get_cluster_label, form_clusters_new
 from mlreco.utils.gnn.primary import assign_primaries, analyze_primaries
-from mlreco.utils.gnn.network import primary_bipartite_incidence
+from mlreco.utils.gnn.network import complete_graph
 from mlreco.utils.gnn.compton import filter_compton
-from mlreco.utils.gnn.data import cluster_vtx_features, cluster_edge_features, edge_assignment, cluster_vtx_features_old
-from mlreco.utils.gnn.evaluation import secondary_matching_vox_efficiency2
+from mlreco.utils.gnn.data import cluster_vtx_features, cluster_edge_features, edge_assignment, cluster_vtx_features_old, EdgeFeatureCache
+from mlreco.utils.gnn.evaluation import secondary_matching_vox_efficiency2, MetricsSchedule
 from mlreco.utils.gnn.evaluation import DBSCAN_cluster_metrics2
 from mlreco.utils.groups import process_group_data
 from .gnn import edge_model_construct
@@ -25,6 +26,7 @@ class IterativeEdgeModel(torch.nn.Module):
         modules:
             iter_gnn:
                 edge_model: <config for edge gnn model>
+                metrics_step: <compute evaluation metrics in the loss every n steps, 0 to skip> (default 1)
     """
     def __init__(self, cfg):
         super(IterativeEdgeModel, self).__init__()
@@ -55,25 +57,25 @@ class IterativeEdgeModel(torch.nn.Module):
             
     
     @staticmethod
-    def assign_clusters(edge_index, edge_pred, others, matched, thresh=0.5):
+    def assign_clusters(edge_index, edge_pred, matched, thresh=0.5):
         """
         assigns clusters that have not been assigned to clusters that have been assigned
         
-        assume 2-channel output to edge_pred
+        assume edge_pred is a score per edge (e.g. difference of the 2 output channels),
+        edges go from assigned clusters to unassigned clusters.
+        For each target, the best incoming edge is found with a single scatter-max
+        over the edge targets. The target joins the group of the edge source
+        if the score of this edge is above threshold.
         """
-        found_match = False
-        for i in others:
-            inds = edge_index[1,:] == i
-            if sum(inds) == 0:
-                continue
-            indmax = torch.argmax(edge_pred[inds])
-            ei = np.where(inds.cpu().detach().numpy())[0][indmax]
-            if edge_pred[ei] > thresh:
-                found_match = True
-                # we make an assignment
-                j = edge_index[0, ei]
-                matched[i] = matched[j]
-        return matched, found_match
+        edge_pred = edge_pred.detach()
+        best, argbest = scatter_max(edge_pred, edge_index[1], dim=0, dim_size=len(matched))
+        # only consider nodes that are the target of at least one edge
+        targets = torch.unique(edge_index[1])
+        sel = best[targets] > thresh
+        targets, argbest = targets[sel], argbest[targets][sel]
+        matched = matched.clone()
+        matched[targets] = matched[edge_index[0, argbest]]
+        return matched, len(targets) > 0
         
         
     def forward(self, data):
@@ -89,6 +91,8 @@ class IterativeEdgeModel(torch.nn.Module):
                 n_iter    : number of iterations taken
             each list is of length k, where k is the number of times the iterative network is applied
         """
+        device = data[0].device
+
         # need to form graph, then pass through GNN
         clusts = form_clusters_new(data[0])
         
@@ -105,16 +109,23 @@ class IterativeEdgeModel(torch.nn.Module):
             clusts = clusts[selection]
         
 
-        #others = np.array([(i not in primaries) for i in range(n)])
         batch = get_cluster_batch(data[0], clusts)
         # get x batch
-        xbatch = torch.tensor(batch).cuda()
+        xbatch = torch.tensor(batch).to(device)
         
         primaries = assign_primaries(data[1], clusts, data[0], max_dist=self.pmd)
         # keep track of who is matched. -1 is not matched
-        matched = np.repeat(-1, len(clusts))
-        matched[primaries] = primaries
-        # print(matched)
+        matched = -torch.ones(len(clusts), dtype=torch.long, device=device)
+        matched[primaries] = torch.tensor(primaries, dtype=torch.long, device=device)
+
+        # Node features do not change between iterations: compute them once.
+        # Each iteration selects the primary/secondary bipartite subset of the
+        # pairs of clusters in the same batch, their edge features are only
+        # computed the first time one of their edges is selected (sources are
+        # primaries or clusters assigned in a previous iteration).
+        x = cluster_vtx_features(data[0], clusts, device=device)
+        edge_features = EdgeFeatureCache(data[0], clusts, complete_graph(batch, cuda=False), device=device)
+        full_index = edge_features.edge_index()
         
         edges = []
         edge_pred = []
@@ -122,60 +133,37 @@ class IterativeEdgeModel(torch.nn.Module):
         counter = 0
         found_match = True
         
-        while (-1 in matched) and (counter < self.maxiter) and found_match:
+        while (matched == -1).any() and (counter < self.maxiter) and found_match:
             # continue until either:
             # 1. everything is matched
             # 2. we have exceeded the max number of iterations
             # 3. we didn't find any matches
-            
-            #print('iter ', counter)
             counter = counter + 1
             
-            # get matched indices
-            assigned = np.where(matched >  -1)[0]
-            # print(assigned)
-            others   = np.where(matched == -1)[0]
-            
-            edge_index = primary_bipartite_incidence(batch, assigned, cuda=True)
+            # edges from assigned clusters to unassigned clusters
+            assigned = matched > -1
+            edge_ids = torch.nonzero(assigned[full_index[0]] & ~assigned[full_index[1]]).flatten()
+            edge_index = full_index[:, edge_ids]
             # check if there are any edges to predict
             # also batch norm will fail on only 1 edge, so break if this is the case
             if edge_index.shape[1] < 2:
                 counter -= 1
                 break
             
-            # obtain vertex features
-            x = cluster_vtx_features(data[0], clusts, cuda=True)
-            # obtain edge features
-            e = cluster_edge_features(data[0], clusts, edge_index, cuda=True)
-            # print(x.shape)
-            # print(torch.max(edge_index))
-            # print(torch.min(edge_index))
+            e = edge_features(edge_ids)
         
-            out = self.edge_predictor(x, edge_index, e, xbatch)
+            out = self.edge_predictor(x, edge_index, e, xbatch)['edge_pred'][0]
             
             # predictions for this edge set.
-            edge_pred.append(out[0][0])
+            edge_pred.append(out)
             edges.append(edge_index)
-            
-            #print(out[0][0].shape)
 
             matched, found_match = self.assign_clusters(edge_index,
-                                                        out[0][0][:,1] - out[0][0][:,0],
-                                                        others,
+                                                        out[:,1] - out[:,0],
                                                         matched,
                                                         self.thresh)
 
-            
-            # print(edges)
-            # print(edge_pred)
-
-        #print('num iterations: ', counter)
-
-        matched = torch.tensor(matched)
-        counter = torch.tensor([counter])            
-        if data[0].is_cuda:
-            matched = matched.cuda()
-            counter = counter.cuda()
+        counter = torch.tensor([counter], device=device)
 
         return {'edges':[edges],
                 'edge_pred':[edge_pred],
@@ -193,6 +181,7 @@ class IterEdgeChannelLoss(torch.nn.Module):
         self.remove_compton = self.model_config.get('remove_compton', True)
         self.compton_thresh = self.model_config.get('compton_thresh', 30)
         self.pmd = self.model_config.get('primary_max_dist')
+        self.metrics_schedule = MetricsSchedule(self.model_config.get('metrics_step', 1))
         
         self.reduction = self.model_config.get('reduction', 'mean')
         self.loss = self.model_config.get('loss', 'CE')
@@ -223,6 +212,7 @@ class IterEdgeChannelLoss(torch.nn.Module):
         total_loss, total_acc, total_primary_fdr, total_primary_acc, total_iter = 0., 0., 0., 0., 0
         total_ari, total_ami, total_sbd, total_pur, total_eff = 0., 0., 0., 0., 0.
         ngpus = len(clusters)
+        compute_metrics = not self.training or self.metrics_schedule()
         for i in range(ngpus):
             data0 = clusters[i]
             data1 = groups[i]
@@ -271,6 +261,9 @@ class IterEdgeChannelLoss(torch.nn.Module):
 
                 total_loss += self.lossfn(edge_pred, edge_assn)
 
+            if not compute_metrics:
+                continue
+
             # compute accuracy of assignment
             total_acc += secondary_matching_vox_efficiency2(
                     out[2][i],
@@ -292,18 +285,22 @@ class IterEdgeChannelLoss(torch.nn.Module):
             total_pur += pur
             total_eff += eff
 
-        return {
+        res = {
             'primary_fdr': total_primary_fdr/ngpus,
             'primary_acc': total_primary_acc/ngpus,
-            'ARI': ari/ngpus,
-            'AMI': ami/ngpus,
-            'SBD': sbd/ngpus,
-            'purity': pur/ngpus,
-            'efficiency': eff/ngpus,
-            'accuracy': total_acc/ngpus,
             'loss': total_loss/ngpus,
             'n_iter': total_iter
         }
+        if compute_metrics:
+            res.update({
+                'ARI': total_ari/ngpus,
+                'AMI': total_ami/ngpus,
+                'SBD': total_sbd/ngpus,
+                'purity': total_pur/ngpus,
+                'efficiency': total_eff/ngpus,
+                'accuracy': total_acc/ngpus
+            })
+        return res
 
 
 class IterEdgeLabelLoss(torch.nn.Module):
@@ -324,6 +321,7 @@ class IterEdgeLabelLoss(torch.nn.Module):
         self.remove_compton = self.model_config.get('remove_compton', True)
 
         self.balance = self.model_config.get('balance_classes', True)
+        self.metrics_schedule = MetricsSchedule(self.model_config.get('metrics_step', 1))
         
             
     @staticmethod
@@ -362,6 +360,7 @@ class IterEdgeLabelLoss(torch.nn.Module):
         """
         total_loss, total_acc, total_primary_fdr, total_primary_acc, total_iter = 0., 0., 0., 0., 0
         ngpus = len(clusters)
+        compute_metrics = not self.training or self.metrics_schedule()
         for i in range(ngpus):
             data0 = clusters[i]
             data1 = groups[i]
@@ -417,6 +416,9 @@ class IterEdgeLabelLoss(torch.nn.Module):
 
                 total_loss += self.lossfn(edge_pred, edge_assn)
 
+            if not compute_metrics:
+                continue
+
             # compute accuracy of assignment
             # need to multiply by batch size to be accurate
             #total_acc = (np.max(batch) + 1) * torch.tensor(secondary_matching_vox_efficiency(edge_index, edge_assn, edge_pred, primaries, clusts, len(clusts)))
@@ -430,10 +432,12 @@ class IterEdgeLabelLoss(torch.nn.Module):
                 )
             )
 
-        return {
+        res = {
             'primary_fdr': total_primary_fdr/ngpus,
             'primary_acc': total_primary_acc/ngpus,
-            'accuracy': total_acc/ngpus,
             'loss': total_loss/ngpus,
             'n_iter': total_iter
         }
+        if compute_metrics:
+            res['accuracy'] = total_acc/ngpus
+        return res
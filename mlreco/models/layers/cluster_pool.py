@@ -3,6 +3,7 @@ from __future__ import print_function
 import torch
 import torch.nn as nn
 import numpy as np
+from torch_scatter import scatter_max, scatter_add, scatter_mean
 
 
 class ClusterPool(nn.Module):
@@ -18,35 +19,72 @@ class ClusterPool(nn.Module):
     forward method:
         inputs:
             features tensor (e.g. from scn sparse tensor)
-            list of clusters
+            clusters, either
+                - flat tensor of cluster id for each row of features (-1 = no cluster)
+                - list of clusters (index arrays, or objects with an inds attribute)
+            batch ids for each row of features (optional, with flat cluster ids only)
+                cluster ids are then assumed to be local to each batch
         output:
             pytorch tensor of size # clusters x # features
-            
+            rows are ordered as the clusters in the list, or by (batch id, cluster id)
+            for a flat cluster index (see ClusterPool.flat_index to get those ids)
+
+    All the clusters are pooled at once with a single scatter reduction.
     """
     def __init__(self, pooltype='max', p=2):
         super(ClusterPool, self).__init__()
         self.pooltype = pooltype
         self.p = p
-        
-    def forward(self, features, cs):
-        # TODO - handle batches in SCN tensors
-        
-        pools = []
-        for c in cs:
-            # step 1 - find coordinates indices
-            inds = c.inds
-            # step 2 - use pooling over coords
-            # TODO - add softmax function
-            if self.pooltype == 'max':
-                pools.append(torch.max(features[inds], 0)[0])
-            elif self.pooltype == 'sum':
-                pools.append(torch.sum(features[inds], 0))
-            elif self.pooltype == 'average':
-                pools.append(torch.mean(features[inds], 0))
-            elif self.pooltype == 'pnorm':
-                pools.append(torch.norm(features[inds], p=self.p, dim=0))
-            else:
-                print("bad pooltype!")
-                return None
-        # return pools stacked as a torch tensor
-        return torch.stack(pools)
\ No newline at end of file
+
+    @staticmethod
+    def flat_index(clusts, batch=None):
+        """
+        Turns per-row cluster ids (and batch ids) into a dense cluster index
+        inputs:
+            clusts - (N) tensor of cluster ids, negative ids are ignored
+            batch  - (N) tensor of batch ids (optional)
+        outputs:
+            rows  - (M) indices of the rows that belong to a cluster
+            index - (M) dense cluster index of those rows, between 0 and C
+            ids   - (C, 2) tensor of (batch id, cluster id) of each cluster
+        """
+        clusts = clusts.long()
+        if batch is None:
+            batch = torch.zeros_like(clusts)
+        batch = batch.long()
+        rows = torch.nonzero(clusts > -1).flatten()
+        clusts, batch = clusts[rows], batch[rows]
+        # pack (batch, cluster) pairs into a single key
+        shift = int(clusts.max()) + 1 if len(clusts) else 1
+        keys, index = torch.unique(batch * shift + clusts, sorted=True, return_inverse=True)
+        ids = torch.stack((keys // shift, keys % shift), dim=1)
+        return rows, index, ids
+
+    def forward(self, features, cs, batch=None):
+        if isinstance(cs, torch.Tensor):
+            rows, index, ids = self.flat_index(cs.to(features.device), None if batch is None else batch.to(features.device))
+            n = len(ids)
+        else:
+            # list of clusters, possibly overlapping: gather all the rows once
+            inds = [torch.as_tensor(c.inds if hasattr(c, 'inds') else c, dtype=torch.long) for c in cs]
+            sizes = torch.tensor([len(c) for c in inds], dtype=torch.long)
+            n = len(inds)
+            rows = torch.cat(inds).to(features.device) if n else torch.zeros(0, dtype=torch.long, device=features.device)
+            index = torch.arange(n).repeat_interleave(sizes).to(features.device)
+
+        x = features[rows]
+        # TODO - add softmax function
+        if self.pooltype == 'max':
+            return scatter_max(x, index, dim=0, dim_size=n)[0]
+        elif self.pooltype == 'sum':
+            return scatter_add(x, index, dim=0, dim_size=n)
+        elif self.pooltype == 'average':
+            return scatter_mean(x, index, dim=0, dim_size=n)
+        elif self.pooltype == 'pnorm':
+            s = scatter_add(x.abs().pow(self.p), index, dim=0, dim_size=n)
+            # zero norm has zero (sub)gradient, as for torch.norm
+            nonzero = s > 0
+            return torch.where(nonzero, s, torch.ones_like(s)).pow(1./self.p) * nonzero.to(s.dtype)
+        else:
+            print("bad pooltype!")
+            return None
@@ -3,7 +3,38 @@ from __future__ import division
 from __future__ import print_function
 import torch
 import sparseconvnet as scn
-import numpy as np
+from torch_scatter import scatter_max
+
+
+def coordinate_keys(*coords):
+    """
+    Packs rows of integer coordinates (e.g. x, y, z, batch id) into int64 keys.
+    All the sets of coordinates given share the same encoding, so that their
+    keys can be compared. Keys are ordered lexicographically (first column first).
+    """
+    coords = [c.long() for c in coords]
+    nonempty = [c for c in coords if len(c)]
+    if not nonempty:
+        return [c.new_zeros(len(c)) for c in coords]
+    low = min(int(c.min()) for c in nonempty)
+    size = max(int(c.max()) for c in nonempty) - low + 1
+    keys = []
+    for c in coords:
+        k = c.new_zeros(len(c))
+        for d in range(c.shape[1]):
+            k = k * size + (c[:, d] - low)
+        keys.append(k)
+    return keys
+
+
+def find_keys(keys, sorted_keys):
+    """
+    Index of each key in sorted_keys, and whether it was found there
+    """
+    if not len(sorted_keys):
+        return torch.zeros_like(keys), torch.zeros(len(keys), dtype=torch.bool, device=keys.device)
+    index = torch.searchsorted(sorted_keys, keys).clamp(max=len(sorted_keys)-1)
+    return index, sorted_keys[index] == keys
 
 
 class AddLabels(torch.nn.Module):
@@ -16,13 +47,11 @@ class AddLabels(torch.nn.Module):
         output.spatial_size = attention.spatial_size
         output.features = attention.features.new().resize_(1).expand_as(attention.features).fill_(1.0)
         output.features = output.features * attention.features
-        positions = attention.get_spatial_locations()
-        if torch.cuda.is_available():
-            positions = positions.cuda()
-        # print(positions.max(), label.max())
-        for l in label:
-            index = (positions == l).all(dim=1)
-            output.features[index] = 1.0
+        # Set all the locations that hold a label to 1
+        positions = attention.get_spatial_locations().to(output.features.device)
+        position_keys, label_keys = coordinate_keys(positions, label.to(output.features.device))
+        _, found = find_keys(position_keys, torch.sort(label_keys)[0])
+        output.features[found] = 1.0
         return output
 
     def input_spatial_size(self, out_size):
@@ -80,31 +109,21 @@ class GhostMask(torch.nn.Module):
         output = scn.SparseConvNetTensor()
         output.metadata = feature_map.metadata
         output.spatial_size = feature_map.spatial_size
-        # First downsample the ghost mask
-        # scale_coords, unique_indices = np.unique(np.concatenate([np.floor(coords[:, :-1]/2**factor), coords[:, -1:]], axis=1), axis=0, return_index=True)
-        # perm2 = np.lexsort((scale_coords[:, 0], scale_coords[:, 1], scale_coords[:, 2], scale_coords[:, 3]))
-        # scale_ghost_mask = ghost_mask[unique_indices][perm2]
-
-        # Append to each coordinate its value in ghost mask
-        coords = np.concatenate([coords, ghost_mask[:, None].cpu().numpy()], axis=1)
-        # Downsample the spatial coordinates, preserving batch id and ghost mask value
-        scale_coords, unique_indices = np.unique(np.concatenate([np.floor(coords[:, :self._data_dim]/2**factor), coords[:, self._data_dim:]], axis=1), axis=0, return_index=True)
-        # Re-order: put nonghost points first
-        keep = np.concatenate([np.where(scale_coords[:, -1] == 1)[0], np.where(scale_coords[:, -1] == 0)[0]], axis=0)
-        # Eliminate duplicates. This will keep the first occurrence of each position.
-        # Hence if it contains at least one nonghost point, it is kept.
-        scale_coords2, unique_indices2 = np.unique(scale_coords[keep][:, :self._data_dim+1], axis=0, return_index=True)
-        # Now do lexsort to match with ppn1_coords below.
-        perm2 = np.lexsort((scale_coords2[:, 0], scale_coords2[:, 1], scale_coords2[:, 2], scale_coords2[:, 3]))
-        # Combine everything for a new ghost mask.
-        scale_ghost_mask = ghost_mask[unique_indices][keep][unique_indices2][perm2]
-
-        # Now order the feature map and multiply with ghost mask
-        ppn1_coords = feature_map.get_spatial_locations()
-        perm = np.lexsort((ppn1_coords[:, 0], ppn1_coords[:, 1], ppn1_coords[:, 2], ppn1_coords[:, 3]))
-        # Reverse permutation
-        inv_perm = np.argsort(perm)
-        new_ghost_mask = scale_ghost_mask[:, None][inv_perm].float()
+        device = feature_map.features.device
+        ghost_mask = ghost_mask.to(device)
+        coords = torch.as_tensor(coords).to(device)
+        # Downsample the spatial coordinates, preserving batch id
+        scale_coords = torch.cat([torch.floor(coords[:, :self._data_dim].double()/2**factor).long(),
+                                  coords[:, self._data_dim:].long()], dim=1)
+        # A downsampled position is kept (nonghost) if it contains at least one nonghost point
+        ppn1_coords = feature_map.get_spatial_locations().to(device)
+        scale_keys, ppn1_keys = coordinate_keys(scale_coords, ppn1_coords)
+        scale_keys, inverse = torch.unique(scale_keys, return_inverse=True)
+        scale_ghost_mask = scatter_max(ghost_mask, inverse, dim=0, dim_size=len(scale_keys))[0]
+
+        # Now match the feature map locations and multiply with ghost mask
+        index, found = find_keys(ppn1_keys, scale_keys)
+        new_ghost_mask = (scale_ghost_mask[index] * found)[:, None].float()
         output.features = feature_map.features * new_ghost_mask
         return output, new_ghost_mask
         #return feature_map, new_ghost_mask.new().resize_(1).expand_as(new_ghost_mask).fill_(1.0)
@@ -3,6 +3,7 @@ from __future__ import division
 from __future__ import print_function
 import torch
 from mlreco.models.layers.extract_feature_map import Selection, Multiply, AddLabels, GhostMask
+from mlreco.utils.pairwise import MAX_MEMORY, nearest
 import numpy as np
 
 
@@ -224,6 +225,8 @@ class PPNLoss(torch.nn.modules.loss._Loss):
         In addition to above, also sample randomly negatives in the neighborhood of positives.
     sampling_factor: int, optional
         How many samples to draw from negatives (for both `random_sampling_negatives` and `near_sampling` options).
+    max_distance_memory: int, optional
+        Memory budget (in bytes) of one chunk of pairwise distances, see `mlreco.utils.pairwise`.
     """
     def __init__(self, cfg, reduction='sum'):
         super(PPNLoss, self).__init__(reduction=reduction)
@@ -249,11 +252,7 @@ class PPNLoss(torch.nn.modules.loss._Loss):
         self._ppn2_size = self._cfg.get('ppn2_size', -1)
         self._spatial_size = self._cfg.get('spatial_size', 512)
         self.ppn1_stride, self.ppn2_stride = define_ppn12(self._ppn1_size, self._ppn2_size, self._spatial_size, self._num_strides)
-
-    def distances(self, v1, v2):
-        v1_2 = v1.unsqueeze(1).expand(v1.size(0), v2.size(0), v1.size(1)).double()
-        v2_2 = v2.unsqueeze(0).expand(v1.size(0), v2.size(0), v1.size(1)).double()
-        return torch.sqrt(torch.pow(v2_2 - v1_2, 2).sum(2))
+        self._max_memory = self._cfg.get('max_distance_memory', MAX_MEMORY)
 
     def forward(self, result, label, particles):
         """
@@ -355,9 +354,8 @@ class PPNLoss(torch.nn.modules.loss._Loss):
                             continue
 
                     # Segmentation loss (predict positives)
-                    d = self.distances(event_label, event_pixel_pred)
-                    d_true = self.distances(event_label, event_data)
-                    positives = (d_true < self._true_distance_ppn3).any(dim=0)  # FIXME can be empty
+                    d_true, _ = nearest(event_data.double(), event_label.double(), max_memory=self._max_memory)
+                    positives = d_true < self._true_distance_ppn3  # FIXME can be empty
                     num_positives = positives.long().sum()
                     # if num_positives == 0:
                     #     print('num positives = 0')
@@ -370,7 +368,7 @@ class PPNLoss(torch.nn.modules.loss._Loss):
                         index[neg_index] = True
 
                         if self._near_sampling:
-                            near_positives = (d_true < self._true_distance_ppn3*2).any(dim=0) & (~positives)
+                            near_positives = (d_true < self._true_distance_ppn3*2) & (~positives)
                             near_sample_index = torch.randperm(near_positives.long().sum())[:self._sampling_factor*max(num_positives, 1)]
                             near_index = torch.nonzero(near_positives.long())[near_sample_index]
                             index[near_index] = True
@@ -395,10 +393,10 @@ class PPNLoss(torch.nn.modules.loss._Loss):
                     # print(event_label.size())
                     event_label_ppn1 = torch.floor(event_label/float(2**self.ppn1_stride))
                     event_label_ppn2 = torch.floor(event_label/float(2**self.ppn2_stride))
-                    d_true_ppn1 = self.distances(event_label_ppn1, event_ppn1_data)
-                    d_true_ppn2 = self.distances(event_label_ppn2, event_ppn2_data)
-                    positives_ppn1 = (d_true_ppn1 < self._true_distance_ppn1).any(dim=0)
-                    positives_ppn2 = (d_true_ppn2 < self._true_distance_ppn2).any(dim=0)
+                    d_true_ppn1, _ = nearest(event_ppn1_data.double(), event_label_ppn1.double(), max_memory=self._max_memory)
+                    d_true_ppn2, _ = nearest(event_ppn2_data.double(), event_label_ppn2.double(), max_memory=self._max_memory)
+                    positives_ppn1 = d_true_ppn1 < self._true_distance_ppn1
+                    positives_ppn2 = d_true_ppn2 < self._true_distance_ppn2
 
                     num_positives_ppn1 = positives_ppn1.long().sum()
                     num_negatives_ppn1 = positives_ppn1.nelement() - num_positives_ppn1
@@ -416,8 +414,11 @@ class PPNLoss(torch.nn.modules.loss._Loss):
                     # print(d_true_ppn1[~(d_true_ppn1 < self._true_distance).any(dim=1)].min(dim=1))
                     # print(event_ppn1_data[positives_ppn1.byte()]*16.0)
                     num_labels += event_label.size(0)
-                    num_discarded_labels_ppn1 += (~(d_true_ppn1 < self._true_distance_ppn1).any(dim=1)).sum().item()
-                    num_discarded_labels_ppn2 += (~(d_true_ppn2 < self._true_distance_ppn2).any(dim=1)).sum().item()
+                    # labels without any pixel within the true distance
+                    d_label_ppn1, _ = nearest(event_label_ppn1.double(), event_ppn1_data.double(), max_memory=self._max_memory)
+                    d_label_ppn2, _ = nearest(event_label_ppn2.double(), event_ppn2_data.double(), max_memory=self._max_memory)
+                    num_discarded_labels_ppn1 += (~(d_label_ppn1 < self._true_distance_ppn1)).sum().item()
+                    num_discarded_labels_ppn2 += (~(d_label_ppn2 < self._true_distance_ppn2)).sum().item()
 
                     if self._random_sample_negatives:
                         neg_sample_index = torch.randperm(num_negatives_ppn1)[:self._sampling_factor*max(num_positives_ppn1, 1)]
@@ -427,7 +428,7 @@ class PPNLoss(torch.nn.modules.loss._Loss):
                         index[neg_index] = True
 
                         if self._near_sampling:
-                            near_positives_ppn1 = (d_true_ppn1 < self._true_distance_ppn1*2).any(dim=0) & (~positives_ppn1)
+                            near_positives_ppn1 = (d_true_ppn1 < self._true_distance_ppn1*2) & (~positives_ppn1)
                             near_sample_index = torch.randperm(near_positives_ppn1.long().sum())[:20*max(num_positives_ppn1, 1)]
                             near_index = torch.nonzero(near_positives_ppn1.long())[near_sample_index]
                             index[near_index] = True
@@ -440,7 +441,7 @@ class PPNLoss(torch.nn.modules.loss._Loss):
                         index[neg_index] = True
 
                         if self._near_sampling:
-                            near_positives_ppn2 = (d_true_ppn2 < self._true_distance_ppn2*2).any(dim=0) & (~positives_ppn2)
+                            near_positives_ppn2 = (d_true_ppn2 < self._true_distance_ppn2*2) & (~positives_ppn2)
                             near_sample_index2 = torch.randperm(near_positives_ppn2.long().sum())[:self._sampling_factor*max(num_positives_ppn2, 1)]
                             near_index = torch.nonzero(near_positives_ppn2.long())[near_sample_index2]
                             index[near_index] = True
@@ -472,14 +473,13 @@ class PPNLoss(torch.nn.modules.loss._Loss):
                     # Distance loss
                     # positives = (d_true[:, event_mask] < 5).any(dim=0)
                     # distances_positives = d[:, event_mask][:, positives]
-                    distances_positives = d[:, positives]
-                    if distances_positives.shape[1] > 0:
-                        d2, _ = torch.min(distances_positives, dim=0)
+                    if positives.any():
+                        d2, closest = nearest(event_pixel_pred[positives].double(), event_label.double(), max_memory=self._max_memory)
                         loss_seg += d2.mean()
                         total_distance += d2.mean()
 
                         # Loss for point type
-                        labels = event_types_label[torch.argmin(distances_positives, dim=0)]
+                        labels = event_types_label[closest]
                         loss_type = torch.mean(self.cross_entropy(event_types[positives].double(), labels.long()))
 
                         # Accuracy for point type
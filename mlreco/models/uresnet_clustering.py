@@ -3,6 +3,8 @@ from __future__ import division
 from __future__ import print_function
 import torch
 import numpy as np
+from torch_scatter import scatter_mean
+from mlreco.utils.pairwise import MAX_MEMORY, nearest, radius_count
 
 
 class UResNet(torch.nn.Module):
@@ -233,6 +235,9 @@ class SegmentationLoss(torch.nn.modules.loss._Loss):
         Radius at which we compute neighbors density. List of float
     target_density_intercluster: float or list
     target_density_intracluster: float or list
+    max_distance_memory: int
+        Memory budget (in bytes) of one chunk of pairwise distances, see
+        `mlreco.utils.pairwise`.
     """
     INPUT_SCHEMA = [
         ["parse_sparse3d_scn_scales", (int,), [(3, 1)]*5],
@@ -292,6 +297,8 @@ class SegmentationLoss(torch.nn.modules.loss._Loss):
         if isinstance(self._target_densityB, list) and len(self._target_densityB) != len(self._radius):
             raise Exception("Expected list of size %d, got list of size %d for target densityB parameter." % (len(self._radius), len(self._target_densityB)))
 
+        self._max_memory = self._cfg.get('max_distance_memory', MAX_MEMORY)
+
     def distances(self, v1, v2):
         """
         Simple method to compute distances from points in v1 to points in v2.
@@ -300,22 +307,6 @@ class SegmentationLoss(torch.nn.modules.loss._Loss):
         v2_2 = v2.unsqueeze(0).expand(v1.size(0), v2.size(0), v1.size(1))
         return torch.sqrt(torch.pow(v2_2 - v1_2, 2).sum(2) + 0.000000001)
 
-    def distances2(self, points):
-        """
-        Uses BLAS/LAPACK operations to efficiently compute pairwise distances.
-        """
-        M = points
-        transpose  = M.permute([0, 2, 1])
-        zeros = torch.zeros(1, 1, 1)
-        if torch.cuda.is_available():
-            zeros = zeros.cuda()
-        inner_prod = torch.baddbmm(zeros, M, transpose, alpha=-2.0, beta=0.0)
-        squared    = torch.sum(torch.mul(M, M), dim=-1, keepdim=True)
-        squared_tranpose = squared.permute([0, 2, 1])
-        inner_prod += squared
-        inner_prod += squared_tranpose
-        return inner_prod
-
     def forward(self, result, label, cluster_label):
         """
         result[0], label and weight are lists of size #gpus = batch_size.
@@ -347,9 +338,6 @@ class SegmentationLoss(torch.nn.modules.loss._Loss):
 
         for i in range(len(label)):
             max_depth = len(cluster_label[i])
-            # for j, feature_map in enumerate(segmentation[3][i]):
-            #     hypercoordinates = feature_map.features
-            #     self.distances2(hypercoordinates)
             for b in batch_ids[i].unique():
                 batch_index = batch_ids[i] == b
 
@@ -396,34 +384,25 @@ class SegmentationLoss(torch.nn.modules.loss._Loss):
                     # Density estimate loss
                     if self._density_estimate and j > 0:
                         density_estimate = result['density_feature'][i][j-1][batch_index][perm]
-                        clusters_id = clusters_labels.unique()
-                        lossA_estimate, lossA_target, lossB_estimate, lossB_target = 0., 0., 0., 0.
-                        total_densityA = [0.] * len(self._radius)
-                        total_densityB = [0.] * len(self._radius)
-                        distances = self.distances2(hypercoordinates[None,...][..., :3]).squeeze(0)
-                        for c in clusters_id:
-                            cluster_idx = (clusters_labels == c).squeeze(1)
-                            cluster = hypercoordinates[cluster_idx]
-                            estimate = density_estimate[cluster_idx]
-                            for k, r in enumerate(self._radius):
-                                # d = (self.distances(cluster, hypercoordinates) < r)
-                                d = (distances[cluster_idx, :] < r)
-                                # d = self.radius(cluster, hypercoordinates, r)
-                                densityA = d[:, cluster_idx].sum(dim=1)
-                                densityB = d[:, ~cluster_idx].sum(dim=1)
-                                # total = (densityA + densityB).float()
-                                densityA = densityA.float() #/ total
-                                densityB = densityB.float() #/ total
-                                total_densityA[k] += densityA.mean()
-                                total_densityB[k] += densityB.mean()
-                                lossA_estimate += torch.pow(estimate[:, 0] - densityA, 2) .mean()
-                                lossB_estimate += torch.pow(estimate[:, 1] - densityB, 2).mean()
-                                lossA_target += torch.pow(torch.clamp(self._target_densityA[k] - densityA, min=0), 2).mean()
-                                lossB_target += torch.pow(torch.clamp(densityB - self._target_densityB[k], min=0), 2).mean()
-                                # print("densityA", j, c, densityA.mean())
-                                #print(torch.clamp(self._target_densityA - densityA, min=0))
-                                #print("densityB", densityB)
-                                #print(torch.clamp(densityB - self._target_densityB, min=0))
+                        clusters_id, cluster_index = clusters_labels.squeeze(1).unique(return_inverse=True)
+                        # Number of points of the same cluster (A) and of other clusters (B)
+                        # within each radius. Note: radii apply to squared distances.
+                        points = hypercoordinates[..., :3]
+                        estimate = density_estimate
+                        targetA = points.new_tensor(self._target_densityA)
+                        targetB = points.new_tensor(self._target_densityB)
+                        densityA, densityB = radius_count(points, points, [r ** 0.5 for r in self._radius],
+                                                          x_label=cluster_index, y_label=cluster_index,
+                                                          max_memory=self._max_memory)
+                        densityA, densityB = densityA.float(), densityB.float()  # (N, len(radius))
+                        # Average in each cluster, then sum over clusters and radii
+                        cluster_mean = lambda x: scatter_mean(x, cluster_index, dim=0, dim_size=clusters_id.size(0)).sum(dim=0)
+                        total_densityA = cluster_mean(densityA)
+                        total_densityB = cluster_mean(densityB)
+                        lossA_estimate = cluster_mean(torch.pow(estimate[:, :1] - densityA, 2)).sum()
+                        lossB_estimate = cluster_mean(torch.pow(estimate[:, 1:2] - densityB, 2)).sum()
+                        lossA_target = cluster_mean(torch.pow(torch.clamp(targetA - densityA, min=0), 2)).sum()
+                        lossB_target = cluster_mean(torch.pow(torch.clamp(densityB - targetB, min=0), 2)).sum()
 
                         lossA_estimate /= clusters_id.size(0) * len(self._radius)
                         lossA_target /= clusters_id.size(0) * len(self._radius)
@@ -436,10 +415,8 @@ class SegmentationLoss(torch.nn.modules.loss._Loss):
                         density_lossA_target += lossA_target
                         density_lossB_target += lossB_target
                         for k in range(len(self._radius)):
-                            total_densityA[k] /= clusters_id.size(0) * len(self._radius)
-                            density_accA[k] += total_densityA[k]
-                            total_densityB[k] /= clusters_id.size(0) * len(self._radius)
-                            density_accB[k] += total_densityB[k]
+                            density_accA[k] += total_densityA[k] / (clusters_id.size(0) * len(self._radius))
+                            density_accB[k] += total_densityB[k] / (clusters_id.size(0) * len(self._radius))
                         # print(density_lossA_estimate, density_lossA_target, density_lossB_estimate, density_lossB_target)
 
                     # Loop over semantic classes
@@ -482,13 +459,13 @@ class SegmentationLoss(torch.nn.modules.loss._Loss):
                             # Now compute real cluster loss
                             for x, cluster in enumerate(hyperclusters):
                                 # Assign each point to a predicted centroid
-                                predicted_assignments = torch.argmin(self.distances(cluster, means), dim=1)
+                                _, predicted_assignments = nearest(cluster, means, max_memory=self._max_memory)
                                 # Distance to this centroid in real space
                                 real_distance_loss += torch.mean(torch.pow(torch.norm(realmeans[predicted_assignments] - realclusters[x], dim=1), 2))
                             real_distance_loss /= C
                             # compute accuracy based on this heuristic cluster
                             # prediction assignments
-                            predicted_assignments = torch.argmin(self.distances(hypercoordinates[class_index], means), dim=1)
+                            _, predicted_assignments = nearest(hypercoordinates[class_index], means, max_memory=self._max_memory)
                             predicted_assignments = clusters_id[predicted_assignments]
                             accuracy[j][class_] += predicted_assignments.eq_(clusters_labels[class_index].squeeze(1)).sum().item() / float(predicted_assignments.nelement())
                         # 2. Define inter-cluster loss
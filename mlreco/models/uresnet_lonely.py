@@ -203,11 +203,6 @@ class SegmentationLoss(torch.nn.modules.loss._Loss):
         self._weight_loss = self._cfg.get('weight_loss', False)
         self.cross_entropy = torch.nn.CrossEntropyLoss(reduction='none')
 
-    def distances(self, v1, v2):
-        v1_2 = v1.unsqueeze(1).expand(v1.size(0), v2.size(0), v1.size(1)).double()
-        v2_2 = v2.unsqueeze(0).expand(v1.size(0), v2.size(0), v1.size(1)).double()
-        return torch.sqrt(torch.pow(v2_2 - v1_2, 2).sum(2))
-
     def forward(self, result, label):
         """
         result[0], label and weight are lists of size #gpus = batch_size.
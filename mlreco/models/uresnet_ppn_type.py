@@ -2,7 +2,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import torch
+from torch_scatter import scatter_mean
 from mlreco.models.layers.extract_feature_map import Selection, Multiply, AddLabels
+from mlreco.utils.pairwise import nearest
+from mlreco.utils.ppn import events_with_particles
 
 
 class PPNUResNet(torch.nn.Module):
@@ -233,10 +236,23 @@ class SegmentationLoss(torch.nn.modules.loss._Loss):
         self._num_strides = self._cfg.get('num_strides', 5)
         self.cross_entropy = torch.nn.CrossEntropyLoss(reduction='none')
 
-    def distances(self, v1, v2):
-        v1_2 = v1.unsqueeze(1).expand(v1.size(0), v2.size(0), v1.size(1)).double()
-        v2_2 = v2.unsqueeze(0).expand(v1.size(0), v2.size(0), v1.size(1)).double()
-        return torch.sqrt(torch.pow(v2_2 - v1_2, 2).sum(2))
+    def ppn_loss(self, ppn, mask, events, valid, gt, gt_batch):
+        """
+        Cross-entropy loss and accuracy of PPN1 or PPN2 scores, summed over
+        the mean of each valid event. A pixel is positive if it contains a
+        true point (gt, already downsampled to the PPN layer resolution).
+        """
+        ppn_batch = ppn[:, -3].contiguous()
+        index = torch.searchsorted(events.to(ppn_batch.dtype), ppn_batch).clamp(max=len(events)-1)
+        select = mask & (events[index].to(ppn_batch.dtype) == ppn_batch) & valid[index]
+        ppn, index = ppn[select], index[select]
+        d_true, _ = nearest(ppn[:, :-3].double(), gt.double(), ppn[:, -3], gt_batch)
+        positives = (d_true == 0).long()
+        loss = self.cross_entropy(ppn[:, -2:].double(), positives)
+        acc = (torch.argmax(ppn[:, -2:], dim=-1) == positives).float()
+        loss = scatter_mean(loss, index, dim=0, dim_size=len(events)).sum()
+        acc = scatter_mean(acc, index, dim=0, dim_size=len(events)).sum().item()
+        return loss, acc
 
     def forward(self, result, label, particles, weight=None):
         """
@@ -244,15 +260,16 @@ class SegmentationLoss(torch.nn.modules.loss._Loss):
         result has only 1 element because UResNet returns only 1 element.
         label[0] has shape (N, 1) where N is #pts across minibatch_size events.
         weight can be None.
+
+        Losses and accuracies are computed once over the minibatch of each
+        gpu, then averaged in each event.
         """
         assert len(result['points']) == len(label)
         assert len(particles) == len(label)
         if weight is not None:
             assert len(label) == len(weight)
-        batch_ids = [d[:, -2] for d in label]
         total_loss = 0.
         total_acc = 0.
-        total_count = 0.
         ppn_count = 0.
         total_distance, total_class = 0., 0.
         total_loss_ppn1, total_loss_ppn2 = 0., 0.
@@ -261,116 +278,92 @@ class SegmentationLoss(torch.nn.modules.loss._Loss):
         total_acc_type, total_loss_type = 0., 0.
         data_dim = self._data_dim
         for i in range(len(label)):
+            batch_ids = label[i][:, -2]
+            events, event_index = torch.unique(batch_ids, return_inverse=True)
+            num_events = len(events)
+
+            # Loss for semantic segmentation
+            segmentation = result['segmentation'][i]  # (N, num_classes)
+            seg_label = label[i][:, -1].long()  # (N,)
+            loss_seg = self.cross_entropy(segmentation, seg_label)
+            if weight is not None:
+                loss_seg = loss_seg * torch.squeeze(weight[i], dim=-1).float()
+            uresnet_loss += scatter_mean(loss_seg, event_index, dim=0, dim_size=num_events).sum()
+
+            # Accuracy for semantic segmentation
+            predicted_labels = torch.argmax(segmentation, dim=-1)
+            acc = (predicted_labels == seg_label).float()
+            uresnet_acc += scatter_mean(acc, event_index, dim=0, dim_size=num_events).sum().item()
+
+            # PPN stuff
             event_particles = particles[i]
-            for b in batch_ids[i].unique():
-                batch_index = batch_ids[i] == b
-                event_data = label[i][batch_index][:, :data_dim]  # (N, 3)
-                ppn1_batch_index = result['ppn1'][i][:, -3] == b.float()
-                ppn2_batch_index = result['ppn2'][i][:, -3] == b.float()
-                event_ppn1_data = result['ppn1'][i][ppn1_batch_index][:, :-3]  # (N1, 3)
-                event_ppn2_data = result['ppn2'][i][ppn2_batch_index][:, :-3]  # (N2, 3)
-                anchors = (event_data + 0.5).float()
-
-                event_pixel_pred = result['points'][i][batch_index][:, :data_dim] + anchors # (N, 3)
-                event_scores = result['points'][i][batch_index][:, data_dim:(data_dim+2)]  # (N, 2)
-                event_types = result['points'][i][batch_index][:, (data_dim+2):]  # (N, num_classes)
-                event_ppn1_scores = result['ppn1'][i][ppn1_batch_index][:, -2:]  # (N1, 2)
-                event_ppn2_scores = result['ppn2'][i][ppn2_batch_index][:, -2:]  # (N2, 2)
-
-                event_segmentation = result['segmentation'][i][batch_index]  # (N, num_classes)
-                event_label = label[i][batch_index][:, -1][:, None]  # (N, 1)
-
-                # Loss for semantic segmentation
-                event_label = torch.squeeze(event_label, dim=-1).long()
-                loss_seg = self.cross_entropy(event_segmentation, event_label)
-                if weight is not None:
-                    event_weight = weight[i][batch_index]
-                    event_weight = torch.squeeze(event_weight, dim=-1).float()
-                    uresnet_loss += torch.mean(loss_seg * event_weight)
-                else:
-                    uresnet_loss += torch.mean(loss_seg)
-                total_count += 1
-
-                # Accuracy for semantic segmentation
-                predicted_labels = torch.argmax(event_segmentation, dim=-1)
-                acc = (predicted_labels == event_label).sum().item() / float(predicted_labels.nelement())
-                uresnet_acc += acc
-
-                # PPN stuff
-                event_label = event_particles[event_particles[:, -2] == b][:, :-2]  # (N_gt, 3)
-                event_types_label = event_particles[event_particles[:, -2] == b][:, -1]
-                if event_label.size(0) > 0:
-                    # Mask: only consider pixels that were selected
-                    # N_mask is the number of pixels selected
-                    event_mask = result['mask_ppn2'][i][batch_index]
-                    event_mask = (~(event_mask == 0)).any(dim=1)  # (N,)
-                    # event_label = event_label[event_mask]
-                    # event_segmentation = event_segmentation[event_mask]
-                    event_pixel_pred = event_pixel_pred[event_mask]
-                    event_scores = event_scores[event_mask]
-                    event_types = event_types[event_mask]  # (N_mask, N_classes)
-                    event_data = event_data[event_mask]
-                    # Mask for PPN2
-                    event_ppn2_mask = (~(result['mask_ppn1'][i][ppn2_batch_index] == 0)).any(dim=1)
-                    event_ppn2_data = event_ppn2_data[event_ppn2_mask]
-                    event_ppn2_scores = event_ppn2_scores[event_ppn2_mask]
-
-                    # Segmentation loss (predict positives)
-                    d = self.distances(event_label, event_pixel_pred) # (N_gt, N_mask)
-                    d_true = self.distances(event_label, event_data) # (N_gt, N_mask)
-                    positives = (d_true < 5).any(dim=0)  # (N_mask,) FIXME can be empty
-                    if positives.shape[0] == 0:
-                        continue
-                    loss_seg = torch.mean(self.cross_entropy(event_scores.double(), positives.long()))
-                    total_class += loss_seg
-
-                    # Accuracy for scores
-                    predicted_labels = torch.argmax(event_scores, dim=-1)
-                    acc = (predicted_labels == positives.long()).sum().item() / float(predicted_labels.nelement())
-
-                    # Loss ppn1 & ppn2 (predict positives)
-                    event_label_ppn1 = torch.floor(event_label/(2**(self._num_strides-1)))
-                    event_label_ppn2 = torch.floor(event_label/(2**(int(self._num_strides/2))))
-                    d_true_ppn1 = self.distances(event_label_ppn1, event_ppn1_data)
-                    d_true_ppn2 = self.distances(event_label_ppn2, event_ppn2_data)
-                    positives_ppn1 = (d_true_ppn1 == 0).any(dim=0)
-                    positives_ppn2 = (d_true_ppn2 == 0).any(dim=0)
-                    loss_seg_ppn1 = torch.mean(self.cross_entropy(event_ppn1_scores.double(), positives_ppn1.long()))
-                    loss_seg_ppn2 = torch.mean(self.cross_entropy(event_ppn2_scores.double(), positives_ppn2.long()))
-                    predicted_labels_ppn1 = torch.argmax(event_ppn1_scores, dim=-1)
-                    predicted_labels_ppn2 = torch.argmax(event_ppn2_scores, dim=-1)
-                    acc_ppn1 = (predicted_labels_ppn1 == positives_ppn1.long()).sum().item() / float(predicted_labels_ppn1.nelement())
-                    acc_ppn2 = (predicted_labels_ppn2 == positives_ppn2.long()).sum().item() / float(predicted_labels_ppn2.nelement())
-                    # Distance loss
-                    # positives = (d_true[:, event_mask] < 5).any(dim=0)
-                    # distances_positives = d[:, event_mask][:, positives]
-                    distances_positives = d[:, positives]  # (N_gt, N_select)
-                    if distances_positives.shape[1] > 0:
-                        d2, _ = torch.min(distances_positives, dim=0)
-                        loss_seg += d2.mean()
-                        total_distance += d2.mean()
-
-                        # Loss for point type
-                        labels = event_types_label[torch.argmin(distances_positives, dim=0)]
-                        loss_type = torch.mean(self.cross_entropy(event_types[positives].double(), labels.long()))
-
-                        # Accuracy for point type
-                        predicted_types = torch.argmax(event_types[positives], dim=-1)
-                        acc_type = (predicted_types == labels.long()).sum().item() / float(predicted_types.nelement())
-                        # Disable type prediction for now
-                        total_acc_type += acc_type
-                        total_loss_type += loss_type
-                        total_loss += loss_type.float()
-
-                    total_loss_ppn1 += loss_seg_ppn1
-                    total_loss_ppn2 += loss_seg_ppn2
-                    total_acc_ppn1 += acc_ppn1
-                    total_acc_ppn2 += acc_ppn2
-                    total_loss += (loss_seg + loss_seg_ppn1 + loss_seg_ppn2).float()
-                    total_acc += acc
-                    ppn_count += 1
-                else:
-                    print("No particles!")
+            gt_batch = event_particles[:, -2]
+            gt = event_particles[:, :-2]  # (N_gt, 3)
+            gt_types = event_particles[:, -1]  # (N_gt,)
+            has_particles = events_with_particles(events, gt_batch)
+
+            # Mask: only consider pixels that were selected
+            # N_mask is the number of pixels selected
+            mask = (~(result['mask_ppn2'][i] == 0)).any(dim=1) & has_particles[event_index]  # (N,)
+            valid = torch.bincount(event_index[mask], minlength=num_events) > 0
+            if not valid.any():
+                continue
+            ppn_count += valid.sum().item()
+            event_index = event_index[mask]
+            event_batch = batch_ids[mask]
+            event_data = label[i][mask][:, :data_dim]  # (N_mask, 3)
+            anchors = (event_data + 0.5).float()
+            event_pixel_pred = result['points'][i][mask][:, :data_dim] + anchors  # (N_mask, 3)
+            event_scores = result['points'][i][mask][:, data_dim:(data_dim+2)]  # (N_mask, 2)
+            event_types = result['points'][i][mask][:, (data_dim+2):]  # (N_mask, N_classes)
+
+            # Segmentation loss (predict positives)
+            d, closest = nearest(event_pixel_pred.double(), gt.double(), event_batch, gt_batch)  # (N_mask,)
+            d_true, _ = nearest(event_data.double(), gt.double(), event_batch, gt_batch)  # (N_mask,)
+            positives = d_true < 5  # (N_mask,)
+            loss_seg = scatter_mean(self.cross_entropy(event_scores.double(), positives.long()),
+                                    event_index, dim=0, dim_size=num_events).sum()
+            total_class += loss_seg
+
+            # Accuracy for scores
+            predicted_labels = torch.argmax(event_scores, dim=-1)
+            acc = scatter_mean((predicted_labels == positives.long()).float(),
+                               event_index, dim=0, dim_size=num_events).sum().item()
+
+            # Loss ppn1 & ppn2 (predict positives)
+            # Mask for PPN2: only consider pixels selected by PPN1
+            gt_ppn1 = torch.floor(gt/(2**(self._num_strides-1)))
+            gt_ppn2 = torch.floor(gt/(2**(int(self._num_strides/2))))
+            mask_ppn1 = torch.ones(len(result['ppn1'][i]), dtype=torch.bool, device=mask.device)
+            mask_ppn2 = (~(result['mask_ppn1'][i] == 0)).any(dim=1)
+            loss_seg_ppn1, acc_ppn1 = self.ppn_loss(result['ppn1'][i], mask_ppn1, events, valid, gt_ppn1, gt_batch)
+            loss_seg_ppn2, acc_ppn2 = self.ppn_loss(result['ppn2'][i], mask_ppn2, events, valid, gt_ppn2, gt_batch)
+
+            # Distance loss
+            positive_index = event_index[positives]
+            distance = scatter_mean(d[positives], positive_index, dim=0, dim_size=num_events).sum()
+            loss_seg += distance
+            total_distance += distance
+
+            # Loss for point type, the label is the type of the closest true point
+            labels = gt_types[closest[positives]].long()
+            loss_type = scatter_mean(self.cross_entropy(event_types[positives].double(), labels),
+                                     positive_index, dim=0, dim_size=num_events).sum()
+
+            # Accuracy for point type
+            predicted_types = torch.argmax(event_types[positives], dim=-1)
+            acc_type = scatter_mean((predicted_types == labels).float(),
+                                    positive_index, dim=0, dim_size=num_events).sum().item()
+            total_acc_type += acc_type
+            total_loss_type += loss_type
+            total_loss += loss_type.float()
+
+            total_loss_ppn1 += loss_seg_ppn1
+            total_loss_ppn2 += loss_seg_ppn2
+            total_acc_ppn1 += acc_ppn1
+            total_acc_ppn2 += acc_ppn2
+            total_loss += (loss_seg + loss_seg_ppn1 + loss_seg_ppn2).float()
+            total_acc += acc
 
         results = {
             'accuracy': uresnet_acc,
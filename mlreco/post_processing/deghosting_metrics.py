@@ -1,6 +1,97 @@
 import numpy as np
 import os
-from mlreco.utils import utils
+from mlreco.utils import open_writer
+from mlreco.utils.confusion import ConfusionMatrix, safe_divide
+
+# Semantic label of ghost points
+GHOST_LABEL = 5
+
+
+def deghosting_metrics_table(confusion, deghosting_type, num_classes, pcluster_counts=None):
+    """
+    Columns of the deghosting_metrics table, one row per event of confusion
+    (without the idx column), in the order of the legacy CSV files.
+
+    Parameters
+    ----------
+    confusion: ConfusionMatrix
+        True semantic labels (ghost points included) against predicted
+        classes. For the 5+2 architecture, the predicted class is
+        segmentation + num_classes * ghost prediction (1 = ghost).
+    deghosting_type: str
+        '5+2', '6' or '2'
+    num_classes: int
+        Number of semantic classes of the segmentation output.
+    pcluster_counts: np.ndarray, optional
+        Shape (E, num_classes). Number of points of each class in the
+        original (pcluster) labels, 5+2 only.
+    """
+    counts = confusion.counts
+    true_counts = confusion.true_counts()
+    num_ghost_points = true_counts[:, GHOST_LABEL]
+    num_nonghost_points = true_counts[:, :GHOST_LABEL].sum(axis=1)
+    columns = {'num_ghost_points': num_ghost_points, 'num_nonghost_points': num_nonghost_points}
+
+    if deghosting_type == '5+2':
+        # counts[e, t, g, p]: true class t, predicted ghost g (0 = non ghost, 1 = ghost), class p
+        counts = counts.reshape(len(confusion), confusion.num_truth, 2, num_classes)
+        nonghost = counts[:, :, 0, :]
+        # Fraction of ghost points predicted as ghost points
+        columns['ghost2ghost'] = safe_divide(counts[:, GHOST_LABEL, 1].sum(axis=1), num_ghost_points)
+        # Fraction of true non-ghost points predicted as true non-ghost points
+        columns['nonghost2nonghost'] = safe_divide(nonghost[:, :GHOST_LABEL].sum(axis=(1, 2)), num_nonghost_points)
+        # Fraction of points whose ghost prediction is correct
+        ghost_correct = counts[:, GHOST_LABEL, 1].sum(axis=1) + nonghost.sum(axis=(1, 2)) - nonghost[:, GHOST_LABEL].sum(axis=1)
+        columns['ghost_acc'] = safe_divide(ghost_correct, confusion.total())
+        # Accuracy for 5 types, global (ghost prediction ignored)
+        class_counts = counts.sum(axis=2)
+        correct = np.diagonal(class_counts, axis1=1, axis2=2)
+        columns['uresnet_acc'] = safe_divide(correct[:, :GHOST_LABEL].sum(axis=1), num_nonghost_points)
+        # Confusion matrix of the pixels predicted as nonghost
+        for c in range(num_classes):
+            for c2 in range(num_classes):
+                columns['confusion_%d_%d' % (c, c2)] = nonghost[:, c, c2]
+        per_class = [
+            # Fraction of pixels in this class predicted correctly
+            ('acc_class%d', safe_divide(correct, true_counts[:, :num_classes])),
+            # Pixels in sparse3d_semantics_reco
+            ('num_true_pix_class%d', true_counts[:, :num_classes]),
+            # Pixels in sparse3d_semantics_reco predicted as nonghost
+            ('num_true_deghost_pix_class%d', nonghost[:, :num_classes].sum(axis=2)),
+            # Pixels in original pcluster
+            ('num_original_pix_class%d', pcluster_counts),
+            # Pixels in predictions + nonghost
+            ('num_pred_pix_class%d', nonghost.sum(axis=1)),
+            # Pixels in predictions that are correctly classified
+            ('num_pred_pix_true_class%d', correct),
+            # Pixels in this class (wrongly) predicted as ghost
+            ('ghost_false_positives_class%d', counts[:, :num_classes, 1].sum(axis=2)),
+            # Pixels in this class (correctly) predicted as nonghost
+            ('ghost_true_positives_class%d', nonghost[:, :num_classes].sum(axis=2)),
+        ]
+        for name, values in per_class:
+            if values is None:
+                continue
+            for c in range(num_classes):
+                columns[name % c] = values[:, c]
+
+    elif deghosting_type == '6':
+        columns['ghost2ghost'] = safe_divide(counts[:, GHOST_LABEL, GHOST_LABEL], num_ghost_points)
+        columns['nonghost2nonghost'] = safe_divide(counts[:, :GHOST_LABEL, :GHOST_LABEL].sum(axis=(1, 2)), num_nonghost_points)
+        # 6 types confusion matrix: fraction of points of class c, predicted as c2
+        fractions = confusion.fractions()
+        for c in range(num_classes):
+            for c2 in range(num_classes):
+                columns['confusion_%d_%d' % (c, c2)] = fractions[:, c, c2]
+
+    elif deghosting_type == '2':
+        columns['ghost2ghost'] = safe_divide(counts[:, GHOST_LABEL, 1], num_ghost_points)
+        columns['nonghost2nonghost'] = safe_divide(counts[:, :GHOST_LABEL, 0].sum(axis=1), num_nonghost_points)
+
+    else:
+        raise ValueError('Invalid "deghosting_type" config parameter value: %s' % deghosting_type)
+    return columns
+
 
 def deghosting_metrics(cfg, data_blob, res, logdir, iteration):#, idx):
     """
@@ -25,120 +116,49 @@ def deghosting_metrics(cfg, data_blob, res, logdir, iteration):#, idx):
     Requires the following input keys:
     - `input_data`
     - `segment_label`
-    Assumes no minibatching
 
     Output
     ------
-    Writes to a CSV file `deghosting_metrics-*`
+    Writes to a CSV file `deghosting_metrics-*`, one row per event. The
+    confusion matrices of all the events are counted at once (see
+    mlreco.utils.confusion).
     """
 
     method_cfg = cfg['post_processing']['deghosting_metrics']
+    output_format = 'csv' if method_cfg is None else method_cfg.get('output_format', 'csv')
 
-    csv_logger = utils.CSVData(os.path.join(logdir,"deghosting_metrics-iter-%.07d.csv" % iteration))
-    for data_idx, tree_idx in enumerate(data_blob['index']):
+    deghosting_type = method_cfg['method']
+    assert(deghosting_type in ['5+2','6','2'])
 
-        deghosting_type = method_cfg['method']
-        assert(deghosting_type in ['5+2','6','2'])
+    index = data_blob['index']
+    if not len(index): return
 
-        pcluster = None
+    labels = [data_blob['segment_label'][data_idx][:, -1] for data_idx in range(len(index))]
+    predictions = [np.argmax(res['segmentation'][data_idx], axis=1) for data_idx in range(len(index))]
+    num_classes = res['segmentation'][0].shape[1]
+    num_pred = num_classes
+    pcluster_counts = None
+    if deghosting_type == '5+2':
+        # Predicted class and ghost prediction (0 = non ghost, 1 = ghost) in one
+        predictions = [p + num_classes * np.argmax(res['ghost'][data_idx], axis=1) for data_idx, p in enumerate(predictions)]
+        num_pred = 2 * num_classes
         if 'pcluster' in data_blob:
-            pcluster = data_blob['pcluster'][data_idx][:, -1]
-        label = data_blob['segment_label'][data_idx][:,-1]
-        segmentation = res['segmentation'][data_idx]  # (N, 5)
-        predictions  = np.argmax(segmentation, axis=1)
-
-        num_classes = segmentation.shape[1]
-        num_ghost_points = np.count_nonzero(label == 5)
-        num_nonghost_points = np.count_nonzero(label < 5)
-
-        csv_logger.record(('num_ghost_points', 'num_nonghost_points', 'idx'),
-                          (num_ghost_points, num_nonghost_points, tree_idx))
-
-        if deghosting_type == '5+2':
-            # Accuracy for ghost prediction for 5+2
-            ghost_predictions = np.argmax(res['ghost'][data_idx], axis=1)
-            mask = ghost_predictions == 0
-            # 0 = non ghost, 1 = ghost
-            # Fraction of true points predicted correctly
-            ghost_acc = ((ghost_predictions == 1) == (label == 5)).sum() / float(label.shape[0])
-            # Fraction of ghost points predicted as ghost points
-            ghost2ghost = (ghost_predictions[label == 5] == 1).sum() / float(num_ghost_points)
-            # Fraction of true non-ghost points predicted as true non-ghost points
-            nonghost2nonghost = (ghost_predictions[label < 5] == 0).sum() / float(num_nonghost_points)
-            csv_logger.record(("ghost2ghost", "nonghost2nonghost"),
-                              (ghost2ghost, nonghost2nonghost))
-
-            # Accuracy for 5 types, global
-            uresnet_acc = (label[label < 5] == predictions[label < 5]).sum() / float(np.count_nonzero(label < 5))
-            csv_logger.record(('ghost_acc', 'uresnet_acc'),
-                              (ghost_acc, uresnet_acc))
-            # Class-wise nonzero accuracy for 5 types, based on true mask
-            acc, num_true_pix, num_pred_pix = [], [], []
-            num_pred_pix_true = []
-            num_true_deghost_pix, num_original_pix = [], []
-            ghost_false_positives, ghost_true_positives = [], []
-            for c in range(num_classes):
-                class_mask = label == c
-                class_predictions = predictions[class_mask]
-                # Fraction of pixels in this class predicted correctly
-                acc.append((class_predictions == c).sum() / float(class_predictions.shape[0]))
-                # Pixel counts
-                # Pixels in sparse3d_semantics_reco
-                num_true_pix.append(np.count_nonzero(class_mask))
-                # Pixels in sparse3d_semantics_reco predicted as nonghost
-                num_true_deghost_pix.append(np.count_nonzero(class_mask & mask))
-                # Pixels in original pcluster
-                if pcluster is not None:
-                    num_original_pix.append(np.count_nonzero(pcluster == c))
-                # Pixels in predictions + nonghost
-                num_pred_pix.append(np.count_nonzero(predictions[mask] == c))
-                # Pixels in predictions + nonghost that are correctly classified
-                num_pred_pix_true.append(np.count_nonzero(class_predictions == c))
-                # Fraction of pixels in this class (wrongly) predicted as ghost
-                ghost_false_positives.append(np.count_nonzero(ghost_predictions[class_mask] == 1))
-                # Fraction of pixels in this class (correctly) predicted as nonghost
-                ghost_true_positives.append(np.count_nonzero(ghost_predictions[class_mask] == 0))
-                # confusion matrix
-                # pixels predicted as nonghost + should be in class c, but predicted as c2
-                for c2 in range(num_classes):
-                    csv_logger.record(('confusion_%d_%d' % (c, c2),),
-                                      (((class_predictions == c2) & (ghost_predictions[class_mask] == 0)).sum(),))
-            csv_logger.record(['acc_class%d' % c for c in range(num_classes)],
-                              acc)
-            csv_logger.record(['num_true_pix_class%d' % c for c in range(num_classes)],
-                              num_true_pix)
-            csv_logger.record(['num_true_deghost_pix_class%d' % c for c in range(num_classes)],
-                              num_true_deghost_pix)
-            if pcluster is not None:
-                csv_logger.record(['num_original_pix_class%d' % c for c in range(num_classes)],
-                                  num_original_pix)
-            csv_logger.record(['num_pred_pix_class%d' % c for c in range(num_classes)],
-                              num_pred_pix)
-            csv_logger.record(['num_pred_pix_true_class%d' % c for c in range(num_classes)],
-                              num_pred_pix_true)
-            csv_logger.record(['ghost_false_positives_class%d' % c for c in range(num_classes)],
-                              ghost_false_positives)
-            csv_logger.record(['ghost_true_positives_class%d' % c for c in range(num_classes)],
-                              ghost_true_positives)
-
-        elif deghosting_type == '6':
-            ghost2ghost = (predictions[label == 5] == 5).sum() / float(num_ghost_points)
-            nonghost2nonghost = (predictions[label < 5] < 5).sum() / float(num_nonghost_points)
-            csv_logger.record(("ghost2ghost", "nonghost2nonghost"),
-                              (ghost2ghost, nonghost2nonghost))
-            # 6 types confusion matrix
-            for c in range(num_classes):
-                for c2 in range(num_classes):
-                    # Fraction of points of class c, predicted as c2
-                    x = (predictions[label == c] == c2).sum() / float(np.count_nonzero(label == c))
-                    csv_logger.record(('confusion_%d_%d' % (c, c2),), (x,))
-        elif deghosting_type == '2':
-            ghost2ghost = (predictions[label == 5] == 1).sum() / float(num_ghost_points)
-            nonghost2nonghost = (predictions[label < 5] == 0).sum() / float(num_nonghost_points)
-            csv_logger.record(("ghost2ghost", "nonghost2nonghost"),
-                              (ghost2ghost, nonghost2nonghost))
-        else:
-            print('Invalid "deghosting_type" config parameter value:',deghosting_type)
-            raise ValueError
-        csv_logger.write()
+            pcluster = [data_blob['pcluster'][data_idx][:, -1] for data_idx in range(len(index))]
+            event = np.repeat(np.arange(len(index)), [len(p) for p in pcluster])
+            pcluster = np.concatenate(pcluster)
+            valid = (pcluster >= 0) & (pcluster < num_classes) & (pcluster == np.floor(pcluster))
+            pcluster_counts = np.bincount(event[valid] * num_classes + pcluster[valid].astype(np.int64),
+                                          minlength=len(index) * num_classes).reshape(len(index), num_classes)
+    num_truth = max([num_classes, GHOST_LABEL + 1] + [int(l.max()) + 1 for l in labels if len(l)])
+    confusion = ConfusionMatrix.from_events(labels, predictions, num_truth, num_pred)
+
+    columns = deghosting_metrics_table(confusion, deghosting_type, num_classes, pcluster_counts)
+    # Column order of the legacy files
+    names = list(columns.keys())
+    names.insert(2, 'idx')
+    columns['idx'] = np.asarray(index)
+    csv_logger = open_writer(os.path.join(logdir,"deghosting_metrics-iter-%.07d.csv" % iteration), output_format)
+    csv_logger.write_arrays(**{name: columns[name] for name in names})
     csv_logger.close()
+
+deghosting_metrics.result_keys = ('segmentation', 'ghost')
@@ -0,0 +1,178 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import collections
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from mlreco.utils import columnar
+
+
+# Pools of event_map, by number of workers
+_EVENT_POOLS = {}
+
+
+def result_keys(processors, res):
+    """
+    Keys of res read by at least one of processors, in the order of res.
+
+    Post-processing functions declare the keys they read in a result_keys
+    attribute, set next to their definition. Functions without it are
+    given all the keys.
+    """
+    keys = set()
+    for processor in processors:
+        if not hasattr(processor, 'result_keys'):
+            return list(res)
+        keys.update(processor.result_keys)
+    return [key for key in res if key in keys]
+
+
+def event_map(function, events, num_workers=0):
+    """
+    Applies function to each element of events, in a pool of num_workers
+    worker processes (or inline if num_workers is 0). Returns the results
+    in order.
+
+    Pools are created on first use and kept for the next iterations, as
+    starting workers costs more than the work of one iteration. function
+    must be importable by the workers.
+    """
+    if num_workers <= 0:
+        return [function(*event) for event in events]
+    if num_workers not in _EVENT_POOLS:
+        _EVENT_POOLS[num_workers] = ProcessPoolExecutor(max_workers=num_workers,
+                                                        mp_context=multiprocessing.get_context('spawn'))
+    futures = [_EVENT_POOLS[num_workers].submit(function, *event) for event in events]
+    return [future.result() for future in futures]
+
+
+def shutdown_event_pools(wait=True):
+    """
+    Stops the workers of the pools created by event_map, the next call
+    starts new ones
+    """
+    while len(_EVENT_POOLS):
+        _, pool = _EVENT_POOLS.popitem()
+        pool.shutdown(wait=wait)
+
+
+def run_post_processing(processors, cfg, data_blob, res, logdir, iteration, dry_run=False):
+    """
+    Runs post-processing functions one after the other on one iteration.
+
+    With dry_run, the outputs are formatted but not written (see
+    mlreco.utils.columnar.dry_run), and the throughput of each function is
+    printed. Returns a list of (name, rows, bytes, seconds), one per
+    function, in that case.
+    """
+    if not dry_run:
+        for processor in processors:
+            processor(cfg, data_blob, res, logdir, iteration)
+        return
+    stats = []
+    for processor in processors:
+        with columnar.dry_run() as writers:
+            start = time.time()
+            processor(cfg, data_blob, res, logdir, iteration)
+            seconds = time.time() - start
+        name = getattr(processor, '__name__', str(processor))
+        num_rows = sum([writer.num_rows for writer in writers])
+        num_bytes = sum([writer.num_bytes for writer in writers])
+        print('Post-processing %s iteration %d: %d rows, %d bytes in %.3f s (%.0f rows/s, %.2f MB/s)'
+              % (name, iteration, num_rows, num_bytes, seconds,
+                 num_rows / max(seconds, 1e-9), num_bytes / max(seconds, 1e-9) / 1e6))
+        stats.append((name, num_rows, num_bytes, seconds))
+    return stats
+
+
+class PostProcessingExecutor(object):
+    """
+    Runs the post-processing functions listed in cfg['post_processing'] on
+    the output of each iteration.
+
+    With num_workers > 0, iterations are handed to a pool of worker
+    processes and the training/inference loop carries on with the next
+    iteration. At most max_queue iterations are pending: submit blocks
+    until the oldest one is done when the queue is full. Iterations are
+    completed in the order they were submitted, and an exception raised
+    by a post-processing function is raised again in the main process
+    (at the latest by flush). With num_workers = 0 (default), the
+    functions run synchronously in submit.
+
+    Note that the results are copied to host (and to the workers) before
+    being submitted, only the keys read by the post-processors are (see
+    result_keys). Functions other than the ones listed in
+    the configuration can be given with processors, they must be importable
+    by the workers.
+
+    With dry_run, outputs are not written and the throughput of each
+    function is printed instead (see run_post_processing).
+    """
+    def __init__(self, cfg, num_workers=0, max_queue=None, processors=None, dry_run=False):
+        import mlreco.post_processing as post_processing
+        self._cfg = cfg
+        self._dry_run = bool(dry_run)
+        if processors is None:
+            processors = [getattr(post_processing, str(name)) for name in cfg.get('post_processing', {})]
+        self._processors = processors
+        self._pending = collections.deque()
+        self._max_queue = max(1, 2 * num_workers if max_queue is None else int(max_queue))
+        self._pool = None
+        if num_workers > 0 and len(self._processors):
+            # Workers do not use the GPU, spawn them rather than fork a process holding a CUDA context
+            self._pool = ProcessPoolExecutor(max_workers=num_workers,
+                                             mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, data_blob, res, logdir, iteration):
+        """
+        Post-processes one iteration
+        """
+        if not len(self._processors):
+            return
+        if self._pool is None:
+            run_post_processing(self._processors, self._cfg, data_blob, res, logdir, iteration, self._dry_run)
+            return
+
+        # Back-pressure: wait for the oldest iteration if the queue is full
+        while len(self._pending) >= self._max_queue:
+            self._wait()
+        res = {key: res[key] for key in result_keys(self._processors, res)}
+        self._pending.append(self._pool.submit(run_post_processing, self._processors, self._cfg,
+                                               dict(data_blob), res, logdir, iteration, self._dry_run))
+        # Collect finished iterations (and their errors) in order
+        while len(self._pending) and self._pending[0].done():
+            self._wait()
+
+    def _wait(self):
+        future = self._pending.popleft()
+        try:
+            future.result()
+        except Exception:
+            self.close(cancel=True)
+            raise
+
+    def flush(self):
+        """
+        Waits for all the pending iterations
+        """
+        while len(self._pending):
+            self._wait()
+
+    def close(self, cancel=False):
+        """
+        Flushes (unless cancel) and stops the workers, as well as the
+        pools used by the post-processing functions (see event_map)
+        """
+        if self._pool is None:
+            shutdown_event_pools(wait=not cancel)
+            return
+        if cancel:
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+        else:
+            self.flush()
+        self._pool.shutdown(wait=True)
+        self._pool = None
+        shutdown_event_pools(wait=not cancel)
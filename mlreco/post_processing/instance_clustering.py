@@ -1,10 +1,10 @@
 import os
 import numpy as np
-from mlreco.utils import utils
-from sklearn.cluster import DBSCAN
 from sklearn.manifold import TSNE
-from sklearn import metrics
-from mlreco.utils import CSVData
+from mlreco.utils import open_writer
+from mlreco.utils.embedding import pca, radius_clusters
+from mlreco.utils.metrics import Contingency
+from mlreco.post_processing.executor import event_map
 
 def instance_clustering(cfg, data_blob, res, logdir, iteration):
     """
@@ -31,92 +31,71 @@ def instance_clustering(cfg, data_blob, res, logdir, iteration):
     - `segment_label` UResNet 5 classes label
     - `cluster_label`
 
+    Configuration
+    -------------
+    projection: str, optional
+        'pca' (principal axes of the embedding of each class, cheap) or
+        'tsne' (slow) to store a projection of the embeddings. Default: no
+        projection, or 'tsne' if compute_tsne is set.
+    projection_dim: int, optional
+        Dimension of the projection (default tsne_dim, or 2), the first 3
+        components are stored (x, y, and z if projection_dim > 2).
+    num_workers: int, optional
+        Number of worker processes to process the events of a batch in
+        parallel (default 0, no worker).
+
     Output
     ------
     Writes 2 CSV files:
     - `instance_clustering-*` with the clustering predictions (point type 0 =
-    event data, point type 1 = predictions, point type 2 = T-SNE visualizations)
+    event data, point type 1 = predictions, point type 2 = projections of the
+    embeddings)
     - `instance_clustering_metrics-*` with some event-wise metrics such as AMI and ARI.
     """
 
     method_cfg = cfg['post_processing']['instance_clustering']
-    model_cfg  = cfg['model']['modules']['uresnet_clustering']
+    if method_cfg is None:
+        method_cfg = {}
+    output_format = method_cfg.get('output_format', 'csv')
+    projection = method_cfg.get('projection', 'tsne' if method_cfg.get('compute_tsne', False) else None)
+    assert(projection in [None, 'pca', 'tsne'])
+    projection_dim = int(method_cfg.get('projection_dim', method_cfg.get('tsne_dim', 2)))
+    num_workers = int(method_cfg.get('num_workers', 0))
 
-    tsne = TSNE(n_components = 2 if method_cfg is None else method_cfg.get('tsne_dim',2))
-    compute_tsne = False if method_cfg is None else method_cfg.get('compute_tsne',False)
-    
     store_per_iteration = True
-    if method_cfg is not None and method_cfg.get('store_method',None) is not None:
+    if method_cfg.get('store_method',None) is not None:
         assert(method_cfg['store_method'] in ['per-iteration','per-event'])
         store_per_iteration = method_cfg['store_method'] == 'per-iteration'
-    fout_cluster,fout_metric=None,None
+    fout_cluster,fout_metrics=None,None
     if store_per_iteration:
-        fout_cluster=CSVData(os.path.join(logdir, 'instance-clustering-iter-%07d.csv' % iteration))
-        fout_metrics=CSVData(os.path.join(logdir, 'instance-clustering-metrics-iter-%07d.csv' % iteration))
+        fout_cluster=open_writer(os.path.join(logdir, 'instance-clustering-iter-%07d.csv' % iteration), output_format)
+        fout_metrics=open_writer(os.path.join(logdir, 'instance-clustering-metrics-iter-%07d.csv' % iteration), output_format)
 
     model_cfg = cfg['model']['modules']['uresnet_clustering']
     data_dim = model_cfg.get('data_dim', 3)
     depth = model_cfg.get('num_strides', 5)
     num_classes = model_cfg.get('num_classes', 5)
 
-    # Loop over batch index
-    for batch_index, event_data in enumerate(data_blob['input_data']):
-        
+    # Process the events of the batch, in parallel if num_workers > 0
+    events = [(batch_index, data_blob['index'][batch_index],
+               data_blob['input_data'][batch_index], res['segmentation'][batch_index],
+               data_blob['segment_label'][batch_index], data_blob['cluster_label'][batch_index],
+               res['cluster_feature'][batch_index], data_dim, depth, num_classes, projection, projection_dim)
+              for batch_index in range(len(data_blob['input_data']))]
+    results = event_map(instance_clustering_event, events, num_workers=num_workers)
+
+    # Record in CSV everything
+    for batch_index, (cluster_rows, metric_rows) in enumerate(results):
         event_index = data_blob['index'][batch_index]
-        
+
         if not store_per_iteration:
-            fout_cluster=CSVData(os.path.join(logdir, 'instance-clustering-iter-%07d.csv' % event_index))
-            fout_metrics=CSVData(os.path.join(logdir, 'instance-clustering-metrics-iter-%07d.csv' % event_index))
-            
-        event_segmentation = res['segmentation'][batch_index]
-        event_label = data_blob['segment_label'][batch_index]
-        event_cluster_label = data_blob['cluster_label'][batch_index]
-        max_depth = len(event_cluster_label)
-        for d, event_feature_map in enumerate(res['cluster_feature'][batch_index]):
-            coords = event_feature_map[:, :data_dim]
-            perm = np.lexsort((coords[:, 2], coords[:, 1], coords[:, 0]))
-            coords = coords[perm]
-            class_label = event_label[-(d+1+max_depth-depth)]
-            cluster_count = 0
-            for class_ in range(num_classes):
-                class_index = class_label[:, -1] == class_
-                if np.count_nonzero(class_index) == 0:
-                    continue
-                clusters_label = event_cluster_label[-(d+1+max_depth-depth)][class_index]
-                embedding = event_feature_map[perm][class_index]
-                # DBSCAN in high dimension embedding
-                predicted_clusters = DBSCAN(eps=20, min_samples=1).fit(embedding).labels_
-                predicted_clusters += cluster_count  # To avoid overlapping id
-                cluster_count += len(np.unique(predicted_clusters))
-
-                # Cluster similarity metrics
-                ARI = metrics.adjusted_rand_score(clusters_label[:, -1], predicted_clusters)
-                AMI = metrics.adjusted_mutual_info_score(clusters_label[:, -1], predicted_clusters)
-                fout_metrics.record(('class', 'batch_id', 'AMI', 'ARI', 'idx'),
-                                    (class_, batch_index, AMI, ARI, event_index))
-                fout_metrics.write()
-
-                for i, point in enumerate(clusters_label):
-                    fout_cluster.record(('type', 'x', 'y', 'z', 'batch_id', 'value', 'predicted_class', 'true_class', 'true_cluster_id', 'predicted_cluster_id', 'idx'),
-                                        (1, point[0], point[1], point[2], batch_index, d, -1, class_label[class_index][i, -1], clusters_label[i, -1], predicted_clusters[i], event_index))
-                    fout_cluster.write()
-                # TSNE to visualize embedding
-                if compute_tsne and embedding.shape[0] > 1:
-                    new_embedding = tsne.fit_transform(embedding)
-                    for i, point in enumerate(new_embedding):
-                        fout_cluster.record(('type', 'x', 'y', 'z', 'batch_id', 'value', 'predicted_class', 'true_class', 'true_cluster_id', 'predicted_cluster_id', 'idx'),
-                                            (2, point[0], point[1], -1, batch_index, d, -1, class_label[class_index][i, -1], clusters_label[i, -1], predicted_clusters[i], event_index))
-                        fout_cluster.write()
-
-        # Record in CSV everything
-        perm = np.lexsort((event_data[:, 2], event_data[:, 1], event_data[:, 0]))
-        event_data = event_data[perm]
-        event_segmentation = event_segmentation[perm]
-        # Point in data and semantic class predictions/true information
-        for i, point in enumerate(event_data):
-            fout_cluster.record(('type', 'x', 'y', 'z', 'batch_id', 'value', 'predicted_class', 'true_class', 'true_cluster_id', 'predicted_cluster_id', 'idx'),
-                                (0, point[0], point[1], point[2], batch_index, point[4], np.argmax(event_segmentation[i]), event_label[0][:,-1][i], -1, -1, event_index))
-            fout_cluster.write()
+            fout_cluster=open_writer(os.path.join(logdir, 'instance-clustering-event-%07d.csv' % event_index), output_format)
+            fout_metrics=open_writer(os.path.join(logdir, 'instance-clustering-metrics-event-%07d.csv' % event_index), output_format)
+
+        for rows in metric_rows:
+            fout_metrics.write_arrays(**rows)
+        for rows in cluster_rows:
+            fout_cluster.write_arrays(**rows)
 
         if not store_per_iteration:
             fout_cluster.close()
@@ -125,3 +104,79 @@ def instance_clustering(cfg, data_blob, res, logdir, iteration):
         fout_cluster.close()
         fout_metrics.close()
 
+instance_clustering.result_keys = ('segmentation', 'cluster_feature')
+
+
+def instance_clustering_event(batch_index, event_index, event_data, event_segmentation, event_label, event_cluster_label, feature_maps,
+                              data_dim=3, depth=5, num_classes=5, projection=None, projection_dim=2, epsilon=20):
+    """
+    Clusters the embedding of each depth and class of one event.
+
+    The points of all the classes of a depth are clustered at once, see
+    mlreco.utils.embedding.radius_clusters, and so are the metrics.
+
+    Returns
+    -------
+    list of dict
+        Blocks of rows of the clustering output file, by column.
+    list of dict
+        Blocks of rows of the metrics output file.
+    """
+    cluster_rows, metric_rows = [], []
+    max_depth = len(event_cluster_label)
+    for d, event_feature_map in enumerate(feature_maps):
+        coords = event_feature_map[:, :data_dim]
+        perm = np.lexsort((coords[:, 2], coords[:, 1], coords[:, 0]))
+        class_label = event_label[-(d+1+max_depth-depth)][:, -1]
+        clusters_label = event_cluster_label[-(d+1+max_depth-depth)]
+        # Points of each class, class by class
+        index = np.where(np.isin(class_label, np.arange(num_classes)))[0]
+        index = index[np.argsort(class_label[index], kind='stable')]
+        if not len(index):
+            continue
+        classes = class_label[index]
+        true_clusters = clusters_label[index, -1]
+        embedding = event_feature_map[perm][index]
+
+        # DBSCAN in high dimension embedding, cluster ids do not overlap between classes
+        predicted_clusters = radius_clusters(embedding, epsilon, groups=classes)
+
+        # Cluster similarity metrics
+        table = Contingency(predicted_clusters, true_clusters, classes)
+        metric_rows.append({'class': table.events, 'batch_id': batch_index,
+                            'AMI': table.ami(), 'ARI': table.ari(), 'idx': event_index})
+
+        rows = dict(type=np.ones(len(index)), x=clusters_label[index, 0], y=clusters_label[index, 1],
+                    z=clusters_label[index, 2], batch_id=batch_index, value=d, predicted_class=-1,
+                    true_class=classes, true_cluster_id=true_clusters, predicted_cluster_id=predicted_clusters,
+                    idx=event_index)
+        if projection is not None:
+            # Projection to visualize embedding, after the points of each
+            # class (classes with a single point are not projected)
+            if projection == 'pca':
+                new_embedding = pca(embedding, projection_dim, groups=classes)
+            else:
+                new_embedding = np.zeros((len(index), projection_dim))
+                for class_ in np.unique(classes):
+                    class_index = np.where(classes == class_)[0]
+                    if len(class_index) > 1:
+                        new_embedding[class_index] = TSNE(n_components=projection_dim).fit_transform(embedding[class_index])
+            _, class_inverse, class_counts = np.unique(classes, return_inverse=True, return_counts=True)
+            keep = np.where(class_counts[class_inverse] > 1)[0]
+            rows = {key: np.broadcast_to(value, (len(index),)) for key, value in rows.items()}
+            projected = {key: value[keep] for key, value in rows.items()}
+            projected.update(type=np.full(len(keep), 2.), x=new_embedding[keep, 0], y=new_embedding[keep, 1],
+                             z=new_embedding[keep, 2] if projection_dim > 2 else np.full(len(keep), -1.))
+            order = np.argsort(np.concatenate((2 * classes, 2 * classes[keep] + 1)), kind='stable')
+            rows = {key: np.concatenate((rows[key], projected[key]))[order] for key in rows}
+        cluster_rows.append(rows)
+
+    # Point in data and semantic class predictions/true information
+    perm = np.lexsort((event_data[:, 2], event_data[:, 1], event_data[:, 0]))
+    event_data = event_data[perm]
+    cluster_rows.append(dict(type=0, x=event_data[:, 0], y=event_data[:, 1], z=event_data[:, 2],
+                             batch_id=batch_index, value=event_data[:, 4],
+                             predicted_class=np.argmax(event_segmentation[perm], axis=1),
+                             true_class=event_label[0][:, -1], true_cluster_id=-1, predicted_cluster_id=-1,
+                             idx=event_index))
+    return cluster_rows, metric_rows
@@ -1,8 +1,8 @@
 import numpy as np
 import os
-from sklearn.cluster import DBSCAN
-from scipy.spatial.distance import cdist
-from mlreco.utils import CSVData
+from mlreco.utils import open_writer
+from mlreco.utils.dbscan import dbscan_labels
+from mlreco.utils.michel import VoxelIndex, NeighbourGraph, is_at_edge, voxel_keys
 
 def michel_reconstruction(cfg, data_blob, res, logdir, iteration):
     """
@@ -42,6 +42,7 @@ def michel_reconstruction(cfg, data_blob, res, logdir, iteration):
     - `michel_reconstruction2-*`
     """
     method_cfg = cfg['post_processing']['michel_reconstruction']
+    output_format = 'csv' if method_cfg is None else method_cfg.get('output_format', 'csv')
 
     # Create output CSV
     store_per_iteration = True
@@ -51,8 +52,8 @@ def michel_reconstruction(cfg, data_blob, res, logdir, iteration):
 
     fout_reco,fout_true=None,None
     if store_per_iteration:
-        fout_reco=CSVData(os.path.join(logdir, 'michel-reconstruction-reco-iter-%07d.csv' % iteration))
-        fout_true=CSVData(os.path.join(logdir, 'michel-reconstruction-true-iter-%07d.csv' % iteration))
+        fout_reco=open_writer(os.path.join(logdir, 'michel-reconstruction-reco-iter-%07d.csv' % iteration), output_format)
+        fout_true=open_writer(os.path.join(logdir, 'michel-reconstruction-true-iter-%07d.csv' % iteration), output_format)
 
     # Loop over events
     for batch_id,data in enumerate(data_blob['input_data']):
@@ -60,172 +61,14 @@ def michel_reconstruction(cfg, data_blob, res, logdir, iteration):
         event_idx = data_blob['index'          ][batch_id]
 
         if not store_per_iteration:
-            fout_reco=CSVData(os.path.join(logdir, 'michel-reconstruction-reco-event-%07d.csv' % event_idx))
-            fout_true=CSVData(os.path.join(logdir, 'michel-reconstruction-true-event-%07d.csv' % event_idx))
-
-        # from input/labels
-        label       = data_blob['segment_label'  ][batch_id][:,-1]
-        label_raw   = data_blob['sparse3d_pcluster_semantics'][batch_id]
-        clusters    = data_blob['clusters_label' ][batch_id]
-        particles   = data_blob['particles_label'][batch_id]
-        true_ghost_mask = label < 5
-        data_masked     = data[true_ghost_mask]
-        label_masked    = label[true_ghost_mask]
-
-        one_pixel = 5#2.8284271247461903
-
-        # Retrieve semantic labels corresponding to clusters
-        clusters_semantics = np.zeros((clusters.shape[0]))-1
-        for cluster_id in np.unique(clusters[:, -2]):
-            cluster_idx = clusters[:, -2] == cluster_id
-            coords = clusters[cluster_idx][:, :3]
-            d = cdist(coords, label_raw[:, :3])
-            semantic_id = np.bincount(label_raw[d.argmin(axis=1)[d.min(axis=1)<one_pixel]][:, -1].astype(int)).argmax()
-            clusters_semantics[cluster_idx] = semantic_id
-
-        # Find cluster id for semantics_reco
-        # clusters_new = np.ones((label_masked.shape[0],))*-1
-        # clusters_E = np.ones((label_masked.shape[0],))
-        # for cluster_id in np.unique(clusters[:, -2]):
-        #     cluster_idx = clusters[:, -2] == cluster_id
-        #     coords = clusters[cluster_idx][:, :3]
-        #     d = cdist(coords, data_masked[:, :3])
-        #     overlap_idx = d.argmin(axis=0)[d.min(axis=0)<one_pixel]
-        #     clusters_new[overlap_idx] = np.bincount(clusters[cluster_idx][d.argmin(axis=0)[d.min(axis=0)<one_pixel]][:, -2].astype(int)).argmax()
-        #     clusters_E[overlap_idx] = clusters[cluster_idx][overlap_idx][:, -1]
-        #     #clusters_new[overlap_idx][:, :3] = data_masked[overlap_idx][:, :3]
-        # print('clusters new', np.unique(clusters_new, return_counts=True))
-
-        # from network output
-        segmentation = res['segmentation'][batch_id]
-        predictions  = np.argmax(segmentation,axis=1)
-        ghost_mask   = (np.argmax(res['ghost'][batch_id],axis=1) == 0)
-
-        data_pred    = data[ghost_mask]  # coords
-        label_pred   = label[ghost_mask]  # labels
-        predictions  = (np.argmax(segmentation,axis=1))[ghost_mask]
-        segmentation = segmentation[ghost_mask]
-
-        Michel_label = 2
-        MIP_label = 1
-
-        # 0. Retrieve coordinates of true and predicted Michels
-        # MIP_coords = data[(label == 1).reshape((-1,)), ...][:, :3]
-        # Michel_coords = data[(label == 4).reshape((-1,)), ...][:, :3]
-        # Michel_particles = particles[particles[:, 4] == Michel_label]
-        MIP_coords = data[label == MIP_label][:, :3]
-        # Michel_coords = data[label == Michel_label][:, :3]
-        Michel_coords = clusters[clusters_semantics == Michel_label][:, :3]
-        if Michel_coords.shape[0] == 0:  # FIXME
-            continue
-        MIP_coords_pred = data_pred[(predictions == MIP_label).reshape((-1,)), ...][:, :3]
-        Michel_coords_pred = data_pred[(predictions == Michel_label).reshape((-1,)), ...][:, :3]
-
-        # 1. Find true particle information matching the true Michel cluster
-        # Michel_true_clusters = DBSCAN(eps=one_pixel, min_samples=5).fit(Michel_coords).labels_
-        # Michel_true_clusters = [Michel_coords[Michel_coords[:, -2] == gid] for gid in np.unique(Michel_coords[:, -2])]
-        #print(clusters.shape, label.shape)
-        Michel_true_clusters = clusters[clusters_semantics == Michel_label][:, -2].astype(np.int64)
-        # Michel_start = Michel_particles[:, :3]
-        for cluster in np.unique(Michel_true_clusters):
-            # print("True", np.count_nonzero(Michel_true_clusters == cluster))
-            # TODO sum_pix
-            fout_true.record(('batch_id', 'iteration', 'event_idx', 'num_pix', 'sum_pix'),
-                             (batch_id, iteration, event_idx,
-                              np.count_nonzero(Michel_true_clusters == cluster),
-                              clusters[clusters_semantics == Michel_label][Michel_true_clusters == cluster][:, -1].sum()))
-            fout_true.write()
-        # e.g. deposited energy, creation energy
-        # TODO retrieve particles information
-        # if Michel_coords.shape[0] > 0:
-        #     Michel_clusters_id = np.unique(Michel_true_clusters[Michel_true_clusters>-1])
-        #     for Michel_id in Michel_clusters_id:
-        #         current_index = Michel_true_clusters == Michel_id
-        #         distances = cdist(Michel_coords[current_index], MIP_coords)
-        #         is_attached = np.min(distances) < 2.8284271247461903
-        #         # Match to MC Michel
-        #         distances2 = cdist(Michel_coords[current_index], Michel_start)
-        #         closest_mc = np.argmin(distances2, axis=1)
-        #         closest_mc_id = closest_mc[np.bincount(closest_mc).argmax()]
-
-        # TODO how do we count events where there are no predictions but true?
-        if MIP_coords_pred.shape[0] == 0 or Michel_coords_pred.shape[0] == 0:
-            continue
-        # print("Also predicted!")
-        # 2. Compute true and predicted clusters
-        MIP_clusters = DBSCAN(eps=one_pixel, min_samples=10).fit(MIP_coords_pred).labels_
-        Michel_pred_clusters = DBSCAN(eps=one_pixel, min_samples=5).fit(Michel_coords_pred).labels_
-        Michel_pred_clusters_id = np.unique(Michel_pred_clusters[Michel_pred_clusters>-1])
-        # print(len(Michel_pred_clusters_id))
-        # Loop over predicted Michel clusters
-        for Michel_id in Michel_pred_clusters_id:
-            current_index = Michel_pred_clusters == Michel_id
-            # 3. Check whether predicted Michel is attached to a predicted MIP
-            # and at the edge of the predicted MIP
-            distances = cdist(Michel_coords_pred[current_index], MIP_coords_pred[MIP_clusters>-1])
-            # is_attached = np.min(distances) < 2.8284271247461903
-            is_attached = np.min(distances) < 5
-            is_edge = False  # default
-            # print("Min distance:", np.min(distances))
-            if is_attached:
-                Michel_min, MIP_min = np.unravel_index(np.argmin(distances), distances.shape)
-                MIP_id = MIP_clusters[MIP_clusters>-1][MIP_min]
-                MIP_min_coords = MIP_coords_pred[MIP_clusters>-1][MIP_min]
-                MIP_cluster_coords = MIP_coords_pred[MIP_clusters==MIP_id]
-                ablated_cluster = MIP_cluster_coords[np.linalg.norm(MIP_cluster_coords-MIP_min_coords, axis=1)>15.0]
-                if ablated_cluster.shape[0] > 0:
-                    new_cluster = DBSCAN(eps=one_pixel, min_samples=5).fit(ablated_cluster).labels_
-                    is_edge = len(np.unique(new_cluster[new_cluster>-1])) == MIP_label
-                else:
-                    is_edge = True
-            # print(is_attached, is_edge)
-
-            michel_pred_num_pix_true, michel_pred_sum_pix_true = -1, -1
-            michel_true_num_pix, michel_true_sum_pix = -1, -1
-            michel_true_energy = -1
-            if is_attached and is_edge and Michel_coords.shape[0] > 0:
-                # Distance from current Michel pred cluster to all true points
-                distances = cdist(Michel_coords_pred[current_index], Michel_coords)
-                closest_clusters = Michel_true_clusters[np.argmin(distances, axis=1)]
-                closest_clusters_final = closest_clusters[(closest_clusters > -1) & (np.min(distances, axis=1)<one_pixel)]
-                if len(closest_clusters_final) > 0:
-                    # print(closest_clusters_final, np.bincount(closest_clusters_final), np.bincount(closest_clusters_final).argmax())
-                    # cluster id of closest true Michel cluster
-                    # we take the one that has most overlap
-                    # closest_true_id = closest_clusters_final[np.bincount(closest_clusters_final).argmax()]
-                    closest_true_id = np.bincount(closest_clusters_final).argmax()
-                    overlap_pixels_index = (closest_clusters == closest_true_id) & (np.min(distances, axis=1)<one_pixel)
-                    if closest_true_id > -1:
-                        closest_true_index = label_pred[predictions==Michel_label][current_index]==Michel_label
-                        # Intersection
-                        michel_pred_num_pix_true = 0
-                        michel_pred_sum_pix_true = 0.
-                        for v in data_pred[(predictions==Michel_label).reshape((-1,)), ...][current_index]:
-                            count = int(np.any(np.all(v[:3] == Michel_coords[Michel_true_clusters == closest_true_id], axis=1)))
-                            michel_pred_num_pix_true += count
-                            if count > 0:
-                                michel_pred_sum_pix_true += v[-1]
-
-                        michel_true_num_pix = np.count_nonzero(Michel_true_clusters == closest_true_id)
-                        michel_true_sum_pix = clusters[clusters_semantics == Michel_label][Michel_true_clusters == closest_true_id][:, -1].sum()
-                        # Register true energy
-                        # Match to MC Michel
-                        # distances2 = cdist(Michel_coords[Michel_true_clusters == closest_true_id], Michel_start)
-                        # closest_mc = np.argmin(distances2, axis=1)
-                        # closest_mc_id = closest_mc[np.bincount(closest_mc).argmax()]
-                        # michel_true_energy = Michel_particles[closest_mc_id, 7]
-                        michel_true_energy = particles[closest_true_id].energy_init()
-                        #print('michel true energy', particles[closest_true_id].energy_init(), particles[closest_true_id].pdg_code(), particles[closest_true_id].energy_deposit())
-            # Record every predicted Michel cluster in CSV
-            fout_reco.record(('batch_id', 'iteration', 'event_idx', 'pred_num_pix', 'pred_sum_pix',
-                              'pred_num_pix_true', 'pred_sum_pix_true',
-                              'true_num_pix', 'true_sum_pix',
-                              'is_attached', 'is_edge', 'michel_true_energy'),
-                             (batch_id, iteration, event_idx, np.count_nonzero(current_index),
-                              data_pred[(predictions==Michel_label).reshape((-1,)), ...][current_index][:, -1].sum(),
-                              michel_pred_num_pix_true, michel_pred_sum_pix_true, michel_true_num_pix, michel_true_sum_pix,
-                              is_attached, is_edge, michel_true_energy))
-            fout_reco.write()
+            fout_reco=open_writer(os.path.join(logdir, 'michel-reconstruction-reco-event-%07d.csv' % event_idx), output_format)
+            fout_true=open_writer(os.path.join(logdir, 'michel-reconstruction-true-event-%07d.csv' % event_idx), output_format)
+
+        true_rows, reco_rows = michel_reconstruction_event(data_blob, res, batch_id)
+        if true_rows is not None:
+            fout_true.write_arrays(batch_id=batch_id, iteration=iteration, event_idx=event_idx, **true_rows)
+        if reco_rows is not None:
+            fout_reco.write_arrays(batch_id=batch_id, iteration=iteration, event_idx=event_idx, **reco_rows)
 
         if not store_per_iteration:
             fout_reco.close()
@@ -234,3 +77,133 @@ def michel_reconstruction(cfg, data_blob, res, logdir, iteration):
     if store_per_iteration:
         fout_reco.close()
         fout_true.close()
+
+michel_reconstruction.result_keys = ('segmentation', 'ghost')
+
+
+def michel_reconstruction_event(data_blob, res, batch_id):
+    """
+    Michel reconstruction of one event of the batch.
+
+    Each voxel set (true labels, true Michel voxels, predicted MIP voxels)
+    gets one spatial index, queried for all the voxels at once, and DBSCAN
+    of the ablated MIP clusters reuses the neighbour graph of the predicted
+    MIP voxels (see mlreco.utils.michel).
+
+    Returns
+    -------
+    dict
+        Columns of the rows of true Michel clusters, None if there is no
+        true Michel.
+    dict
+        Columns of the rows of predicted Michel clusters, None if there is
+        no predicted MIP or Michel.
+    """
+    data        = data_blob['input_data'     ][batch_id]
+    label       = data_blob['segment_label'  ][batch_id][:,-1]
+    label_raw   = data_blob['sparse3d_pcluster_semantics'][batch_id]
+    clusters    = data_blob['clusters_label' ][batch_id]
+    particles   = data_blob['particles_label'][batch_id]
+
+    one_pixel = 5#2.8284271247461903
+
+    # Retrieve semantic labels corresponding to clusters: most frequent label
+    # of the closest labelled voxels (within one_pixel) of each cluster
+    cluster_ids, cluster_index = np.unique(clusters[:, -2], return_inverse=True)
+    d, closest = VoxelIndex(label_raw[:, :3]).nearest(clusters[:, :3])
+    matched = d < one_pixel
+    semantics = label_raw[closest[matched], -1].astype(np.int64)
+    clusters_semantics = -np.ones(len(clusters))
+    if len(semantics):
+        num_semantics = semantics.max() + 1
+        counts = np.bincount(cluster_index[matched] * num_semantics + semantics,
+                             minlength=len(cluster_ids) * num_semantics).reshape(-1, num_semantics)
+        clusters_semantics = np.where(counts.any(axis=1), counts.argmax(axis=1), -1)[cluster_index]
+
+    # from network output
+    segmentation = res['segmentation'][batch_id]
+    ghost_mask   = (np.argmax(res['ghost'][batch_id],axis=1) == 0)
+
+    data_pred    = data[ghost_mask]  # coords
+    predictions  = (np.argmax(segmentation,axis=1))[ghost_mask]
+
+    Michel_label = 2
+    MIP_label = 1
+
+    # 0. Retrieve coordinates of true and predicted Michels
+    Michel_true = clusters[clusters_semantics == Michel_label]
+    Michel_coords = Michel_true[:, :3]
+    if Michel_coords.shape[0] == 0:  # FIXME
+        return None, None
+    MIP_coords_pred = data_pred[predictions == MIP_label][:, :3]
+    Michel_pred = data_pred[predictions == Michel_label]
+    Michel_coords_pred = Michel_pred[:, :3]
+
+    # 1. Find true particle information matching the true Michel cluster
+    Michel_true_clusters = Michel_true[:, -2].astype(np.int64)
+    true_ids, true_index = np.unique(Michel_true_clusters, return_inverse=True)
+    true_num_pix = np.bincount(true_index)
+    # Sum in the original voxel order, as a masked sum
+    order = np.argsort(true_index, kind='stable')
+    true_sum_pix = np.array([v.sum() for v in np.split(Michel_true[order, -1], np.cumsum(true_num_pix)[:-1])])
+    true_rows = dict(num_pix=true_num_pix, sum_pix=true_sum_pix)
+
+    # TODO how do we count events where there are no predictions but true?
+    if MIP_coords_pred.shape[0] == 0 or Michel_coords_pred.shape[0] == 0:
+        return true_rows, None
+
+    # 2. Compute true and predicted clusters
+    MIP_graph = NeighbourGraph(MIP_coords_pred, one_pixel)
+    MIP_clusters = MIP_graph.dbscan(10)
+    Michel_pred_clusters = dbscan_labels(Michel_coords_pred, one_pixel, 5)
+    Michel_pred_clusters_id = np.unique(Michel_pred_clusters[Michel_pred_clusters>-1])
+    if not len(Michel_pred_clusters_id):
+        return true_rows, None
+
+    # Closest clustered MIP voxel and closest true Michel voxel of each
+    # predicted Michel voxel
+    MIP_labelled = np.where(MIP_clusters > -1)[0]
+    MIP_distances, MIP_closest = VoxelIndex(MIP_coords_pred[MIP_labelled]).nearest(Michel_coords_pred)
+    true_distances, true_closest = VoxelIndex(Michel_coords).nearest(Michel_coords_pred)
+    Michel_keys, true_keys = voxel_keys(Michel_coords_pred, Michel_coords)
+
+    # Loop over predicted Michel clusters
+    num_clusters = len(Michel_pred_clusters_id)
+    columns = ['pred_num_pix', 'pred_sum_pix', 'pred_num_pix_true', 'pred_sum_pix_true',
+               'true_num_pix', 'true_sum_pix', 'is_attached', 'is_edge', 'michel_true_energy']
+    reco_rows = {key: np.full(num_clusters, -1.) for key in columns}
+    for row, Michel_id in enumerate(Michel_pred_clusters_id):
+        current_index = np.where(Michel_pred_clusters == Michel_id)[0]
+        reco_rows['pred_num_pix'][row] = len(current_index)
+        reco_rows['pred_sum_pix'][row] = Michel_pred[current_index, -1].sum()
+        # 3. Check whether predicted Michel is attached to a predicted MIP
+        # and at the edge of the predicted MIP
+        Michel_min = np.argmin(MIP_distances[current_index])
+        # is_attached = np.min(distances) < 2.8284271247461903
+        is_attached = MIP_distances[current_index[Michel_min]] < 5
+        is_edge = False  # default
+        if is_attached:
+            MIP_min = MIP_labelled[MIP_closest[current_index[Michel_min]]]
+            is_edge = is_at_edge(MIP_graph, np.where(MIP_clusters == MIP_clusters[MIP_min])[0],
+                                 MIP_coords_pred[MIP_min], radius=15.0)
+        reco_rows['is_attached'][row] = is_attached
+        reco_rows['is_edge'][row] = is_edge
+
+        if is_attached and is_edge:
+            # Closest true Michel cluster: the one that has most overlap
+            close = true_distances[current_index] < one_pixel
+            closest_clusters_final = Michel_true_clusters[true_closest[current_index[close]]]
+            closest_clusters_final = closest_clusters_final[closest_clusters_final > -1]
+            if len(closest_clusters_final) > 0:
+                closest_true_id = np.bincount(closest_clusters_final).argmax()
+                # Intersection
+                overlap = np.isin(Michel_keys[current_index], true_keys[Michel_true_clusters == closest_true_id])
+                reco_rows['pred_num_pix_true'][row] = np.count_nonzero(overlap)
+                reco_rows['pred_sum_pix_true'][row] = Michel_pred[current_index[overlap], -1].sum()
+                true_row = np.searchsorted(true_ids, closest_true_id)
+                reco_rows['true_num_pix'][row] = true_num_pix[true_row]
+                reco_rows['true_sum_pix'][row] = true_sum_pix[true_row]
+                # Register true energy
+                reco_rows['michel_true_energy'][row] = particles[closest_true_id].energy_init()
+
+    return true_rows, reco_rows
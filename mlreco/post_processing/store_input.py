@@ -1,17 +1,19 @@
 import os
-from mlreco.utils import CSVData
+import numpy as np
+from mlreco.utils import open_writer
 
 
-def get_coords(row, data_dim, tree_index):
+def get_coords(points, data_dim):
+    """
+    Coordinate column names and columns of an (N, >= data_dim) array
+    """
     if data_dim == 2:
-        coords_labels = ('idx', 'x', 'y')
-        coords = (tree_index, row[0], row[1])
+        coords_labels = ('x', 'y')
     elif data_dim == 3:
-        coords_labels = ('idx', 'x', 'y', 'z')
-        coords = (tree_index, row[0], row[1], row[2])
+        coords_labels = ('x', 'y', 'z')
     else:
         raise Exception("data_dim must be 2 or 3, got %d" % data_dim)
-    return coords_labels, coords
+    return coords_labels, tuple(points[:, i] for i in range(data_dim))
 
 
 def store_input(cfg, data_blob, res, logdir, iteration):
@@ -29,8 +31,11 @@ def store_input(cfg, data_blob, res, logdir, iteration):
     cluster3d_mcst_true: str, optional
     store_method: str, optional
         Can be `per-iteration` or `per-event`
+    output_format: str, optional
+        Can be `csv` (default) or `npz`, see mlreco.utils.open_writer
     """
     method_cfg = cfg['post_processing']['store_input']
+    output_format = 'csv' if method_cfg is None else method_cfg.get('output_format', 'csv')
 
     if (method_cfg is not None and not method_cfg.get('input_data', 'input_data') in data_blob) or (method_cfg is None and 'input_data' not in data_blob): return
 
@@ -50,52 +55,44 @@ def store_input(cfg, data_blob, res, logdir, iteration):
         store_per_iteration = method_cfg['store_method'] == 'per-iteration'
     fout=None
     if store_per_iteration:
-        fout=CSVData(os.path.join(logdir, 'input-iter-%07d.csv' % iteration))
+        fout=open_writer(os.path.join(logdir, 'input-iter-%07d.csv' % iteration), output_format)
 
     if input_dat is None: return
 
     for data_index,tree_index in enumerate(index):
 
         if not store_per_iteration:
-            fout=CSVData(os.path.join(logdir, 'input-event-%07d.csv' % tree_index))
+            fout=open_writer(os.path.join(logdir, 'input-event-%07d.csv' % tree_index), output_format)
 
         mask = input_dat[data_index][:,-1] > threshold
 
-
+        # Rows of this event, one (points, type, values) block per output type
+        blocks = []
         # type 0 = input data
-        for row in input_dat[data_index][mask]:
-            coords_labels, coords = get_coords(row, data_dim, tree_index)
-            fout.record(coords_labels + ('type','value'), coords + (0,row[data_dim+1]))
-            fout.write()
-
+        blocks.append((input_dat[data_index][mask], 0, input_dat[data_index][mask][:, data_dim+1]))
         # type 1 = Labels for PPN
         if label_ppn is not None:
-            for row in label_ppn[data_index]:
-                fout.record(('idx','x','y','z','type','value'),(tree_index,row[0],row[1],row[2],1,row[4]))
-                fout.write()
+            blocks.append((label_ppn[data_index], 1, label_ppn[data_index][:, 4]))
         # 2 = UResNet labels
         if label_seg is not None:
-            for row in label_seg[data_index][mask]:
-                coords_labels, coords = get_coords(row, data_dim, tree_index)
-                fout.record(coords_labels + ('type','value'),coords + (2,row[data_dim+1]))
-                fout.write()
+            blocks.append((label_seg[data_index][mask], 2, label_seg[data_index][mask][:, data_dim+1]))
         # type 15 = group id, 16 = semantic labels, 17 = energy
         if label_cls is not None:
-            for row in label_cls[data_index]:
-                fout.record(('idx','x','y','z','type','value'),(tree_index,row[0],row[1],row[2],15,row[5]))
-                fout.write()
-            for row in label_cls[data_index]:
-                fout.record(('idx','x','y','z','type','value'),(tree_index,row[0],row[1],row[2],16,row[6]))
-                fout.write()
-            for row in label_cls[data_index]:
-                fout.record(('idx','x','y','z','type','value'),(tree_index,row[0],row[1],row[2],17,row[4]))
-                fout.write()
+            blocks.append((label_cls[data_index], 15, label_cls[data_index][:, 5]))
+            blocks.append((label_cls[data_index], 16, label_cls[data_index][:, 6]))
+            blocks.append((label_cls[data_index], 17, label_cls[data_index][:, 4]))
         # type 18 = cluster3d_mcst_true
         if label_mcst is not None:
-            for row in label_mcst[data_index]:
-                fout.record(('idx','x','y','z','type','value'),(tree_index,row[0],row[1],row[2],19,row[4]))
-                fout.write()
+            blocks.append((label_mcst[data_index], 19, label_mcst[data_index][:, 4]))
+
+        coords_labels, coords = get_coords(np.concatenate([b[0][:, :data_dim] for b in blocks]), data_dim)
+        columns = dict(zip(('idx',) + coords_labels, (tree_index,) + coords))
+        columns['type']  = np.concatenate([np.full(len(b[0]), b[1]) for b in blocks])
+        columns['value'] = np.concatenate([b[2] for b in blocks])
+        fout.write_arrays(**columns)
 
         if not store_per_iteration: fout.close()
 
     if store_per_iteration: fout.close()
+
+store_input.result_keys = ()
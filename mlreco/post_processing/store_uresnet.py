@@ -1,13 +1,25 @@
 import numpy as np
 import scipy
 import os
-from mlreco.utils import CSVData
+from mlreco.utils import open_writer
 
 def store_uresnet(cfg, data_blob, res, logdir, iteration):
+    """
+    Store UResNet predictions (type 4), one row per voxel.
+
+    Configuration
+    -------------
+    input_data: str, optional
+    store_method: str, optional
+        Can be `per-iteration` or `per-event`
+    output_format: str, optional
+        Can be `csv` (default) or `npz`, see mlreco.utils.open_writer
+    """
     # UResNet prediction
     if not 'segmentation' in res: return
 
     method_cfg = cfg['post_processing']['store_uresnet']
+    output_format = 'csv' if method_cfg is None else method_cfg.get('output_format', 'csv')
 
     index        = data_blob['index']
     segment_data = res['segmentation']
@@ -19,20 +31,20 @@ def store_uresnet(cfg, data_blob, res, logdir, iteration):
         store_per_iteration = method_cfg['store_method'] == 'per-iteration'
     fout=None
     if store_per_iteration:
-        fout=CSVData(os.path.join(logdir, 'uresnet-segmentation-iter-%07d.csv' % iteration))
+        fout=open_writer(os.path.join(logdir, 'uresnet-segmentation-iter-%07d.csv' % iteration), output_format)
 
     for data_idx, tree_idx in enumerate(index):
 
         if not store_per_iteration:
-            fout=CSVData(os.path.join(logdir, 'uresnet-segmentation-event-%07d.csv' % tree_idx))
+            fout=open_writer(os.path.join(logdir, 'uresnet-segmentation-event-%07d.csv' % tree_idx), output_format)
 
-        predictions = np.argmax(segment[data_idx],axis=1)
-        for row in predictions:
-            event = input_data[i]
-            fout.record(('idx','x', 'y', 'z', 'type', 'value'),
-                        (idx,event[0], event[1], event[2], 4, row))
-            fout.write()
+        predictions = np.argmax(segment_data[data_idx],axis=1)
+        if len(predictions):
+            voxels = input_data[data_idx]
+            fout.write_arrays(idx=tree_idx, x=voxels[:, 0], y=voxels[:, 1], z=voxels[:, 2], type=4, value=predictions)
 
         if not store_per_iteration: fout.close()
 
     if store_per_iteration: fout.close()
+
+store_uresnet.result_keys = ('segmentation',)
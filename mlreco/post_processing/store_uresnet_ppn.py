@@ -1,8 +1,33 @@
-from mlreco.utils import CSVData
+from mlreco.utils import open_writer
 import numpy as np
 import scipy
 import os
+from scipy.spatial import cKDTree
 from mlreco.utils.ppn import uresnet_ppn_type_point_selector
+from mlreco.utils.nms import nms
+
+
+def ppn_type_filter(positions, ppn_types, voxels, uresnet_types, num_classes, type_threshold):
+    """
+    Mask of the PPN points closer than type_threshold to a voxel whose
+    predicted semantic class is the predicted type of the point, for types
+    below num_classes. Nearest voxels are found in a single KD-tree, where
+    the class is an extra coordinate scaled beyond the event extent.
+    """
+    mask = np.zeros(len(positions), dtype=bool)
+    ppn_index = np.flatnonzero(ppn_types < num_classes)
+    uresnet_index = np.flatnonzero(uresnet_types < num_classes)
+    if not len(ppn_index) or not len(uresnet_index):
+        return mask
+    lo = np.minimum(positions.min(axis=0), voxels.min(axis=0))
+    hi = np.maximum(positions.max(axis=0), voxels.max(axis=0))
+    scale = 2. * np.linalg.norm(hi - lo) + type_threshold + 1.
+    tree = cKDTree(np.column_stack((voxels[uresnet_index], scale * uresnet_types[uresnet_index])),
+                   balanced_tree=False, compact_nodes=False)
+    d, _ = tree.query(np.column_stack((positions[ppn_index], scale * ppn_types[ppn_index])),
+                      distance_upper_bound=type_threshold)
+    mask[ppn_index[d < type_threshold]] = True
+    return mask
 
 
 def store_uresnet_ppn(cfg, data_blob, res, logdir, iteration,
@@ -12,14 +37,25 @@ def store_uresnet_ppn(cfg, data_blob, res, logdir, iteration,
                       type_threshold=2,
                       **kwargs):
     """
+    Store PPN points (raw, after NMS, score threshold and masking, types 3
+    and 5 to 13), PPN1/PPN2 points (types 8 and 9), UResNet and ghost
+    predictions (types 4 and 14) and the points of
+    uresnet_ppn_type_point_selector (type 14).
+
+    Each type of each event is assembled as a block of columns and
+    written at once.
+
     Configuration
     -------------
     input_data: str, optional
     store_method: str, optional
+    output_format: str, optional
+        `csv` (default) or `npz`, see mlreco.utils.open_writer
     threshold, size: NMS parameters
     score_threshold: to filter based on score only (no NMS)
     """
     method_cfg = cfg['post_processing']['store_uresnet_ppn']
+    output_format = 'csv' if method_cfg is None else method_cfg.get('output_format', 'csv')
 
     if (method_cfg is not None and not method_cfg.get('input_data', 'input_data') in data_blob) or (method_cfg is None and 'input_data' not in data_blob): return
     if not 'points' in res: return
@@ -42,197 +78,89 @@ def store_uresnet_ppn(cfg, data_blob, res, logdir, iteration,
         store_per_iteration = method_cfg['store_method'] == 'per-iteration'
     fout=None
     if store_per_iteration:
-        fout=CSVData(os.path.join(logdir, 'uresnet-ppn-iter-%07d.csv' % iteration))
+        fout=open_writer(os.path.join(logdir, 'uresnet-ppn-iter-%07d.csv' % iteration), output_format)
 
     for data_idx, tree_idx in enumerate(index):
 
         if not store_per_iteration:
-            fout=CSVData(os.path.join(logdir, 'uresnet-ppn-event-%07d.csv' % tree_idx))
+            fout=open_writer(os.path.join(logdir, 'uresnet-ppn-event-%07d.csv' % tree_idx), output_format)
+
+        voxels = input_dat[data_idx]
+        # Rows of this event, one (coordinates, type, values) block per output type
+        blocks = []
 
         if output_pts is not None:
-            scores = scipy.special.softmax(output_pts[data_idx][:, 3:5], axis=1)
+            points = output_pts[data_idx]
+            scores = scipy.special.softmax(points[:, 3:5], axis=1)
+            positions = voxels[:, :3] + 0.5 + points[:, :3]
+            # Value of a point: predicted type if any, else score
+            if points.shape[1] > 5:
+                values = np.argmax(scipy.special.softmax(points[:, 5:], axis=1), axis=1)
+            else:
+                values = scores[:, 1]
+            def ppn_block(select, point_type):
+                blocks.append((positions[select], point_type, values[select]))
 
             # type 3 = raw PPN predictions
-            for row_idx, row in enumerate(output_pts[data_idx]):
-                event = input_dat[data_idx][row_idx]
-                if len(row) > 5:  # Includes prediction of point type
-                    value = np.argmax(scipy.special.softmax(row[5:]))
-                else:
-                    value = scores[row_idx, 1]
-                fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                            (tree_idx, event[0] + 0.5 + row[0], event[1] + 0.5 + row[1], event[2] + 0.5 + row[2], 3, value))
-                fout.write()
-
+            ppn_block(slice(None), 3)
             # type 5 = PPN predictions after NMS
-            keep = nms_numpy(output_pts[data_idx][:,:3], scores[:, 1], nms_score_threshold, window_size)
-            events = input_dat[data_idx][keep]
-            for row_idx, row in enumerate(output_pts[data_idx][keep]):
-                event = events[row_idx]
-                if len(row) > 5:
-                    value = np.argmax(scipy.special.softmax(row[5:]))
-                else:
-                    value = scores[keep][row_idx, 1]
-                fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                            (tree_idx, event[0] + 0.5 + row[0], event[1] + 0.5 + row[1], event[2] + 0.5 + row[2], 5, value))
-                fout.write()
-
+            ppn_block(nms(positions, scores[:, 1], nms_score_threshold, window_size), 5)
             # 6 = PPN predictions after score thresholding
-            keep = scores[:,1] > score_threshold
-            events = input_dat[data_idx][keep]
-            for row_idx,row in enumerate(output_pts[data_idx][keep]):
-                event = events[row_idx]
-                if len(row) > 5:
-                    value = np.argmax(scipy.special.softmax(row[5:]))
-                else:
-                    value = scores[keep][row_idx, 1]
-                fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                            (tree_idx, event[0] + 0.5 + row[0], event[1] + 0.5 + row[1], event[2] + 0.5 + row[2], 6, value))
-                fout.write()
-
+            ppn_block(scores[:, 1] > score_threshold, 6)
             # type 7 = PPN predictions after masking
             mask = (~(output_mask[data_idx] == 0)).any(axis=1)
-            events = input_dat[data_idx][mask]
-            for row_idx, row in enumerate(output_pts[data_idx][mask]):
-                event = events[row_idx]
-                if len(row) > 5:
-                    value = np.argmax(scipy.special.softmax(row[5:]))
-                else:
-                    value = scores[mask][i, 1]
-                fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                            (tree_idx, event[0] + 0.5 + row[0], event[1] + 0.5 + row[1], event[2] + 0.5 + row[2], 7, value))
-                fout.write()
-
-
+            ppn_block(mask, 7)
             # type 10 = masking + score threshold
-            mask = ((~(output_mask[data_idx] == 0)).any(axis=1)) & (scores[:, 1] > score_threshold)
-            events = input_dat[data_idx][mask]
-            for row_idx, row in enumerate(output_pts[data_idx][mask]):
-                event = events[row_idx]
-                if len(row) > 5:
-                    value = np.argmax(scipy.special.softmax(row[5:]))
-                else:
-                    value = scores[mask][i, 1]
-                fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                            (tree_idx, event[0] + 0.5 + row[0], event[1] + 0.5 + row[1], event[2] + 0.5 + row[2], 10, value))
-                fout.write()
-
+            mask &= scores[:, 1] > score_threshold
+            ppn_block(mask, 10)
             # type 11 = masking + score threshold + NMS
-            mask = ((~(output_mask[data_idx] == 0)).any(axis=1)) & (scores[:, 1] > score_threshold)
-            keep = nms_numpy(output_pts[data_idx][mask][:, :3], scores[mask][:, 1], nms_score_threshold, window_size)
-            events = input_dat[data_idx][mask][keep]
-            for row_idx, row in enumerate(output_pts[data_idx][mask][keep]):
-                event = events[row_idx]
-                if len(row) > 5:
-                    value = np.argmax(scipy.special.softmax(row[5:]))
-                else:
-                    value = scores[mask][keep][i, 1]
-                fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                            (tree_idx, event[0] + 0.5 + row[0], event[1] + 0.5 + row[1], event[2] + 0.5 + row[2], 11, value))
-                fout.write()
-
-
-            # Store PPN1 and PPN2 output
-            scores_ppn1 = scipy.special.softmax(output_ppn1[data_idx][:, -2:], axis=1)
-            scores_ppn2 = scipy.special.softmax(output_ppn2[data_idx][:, -2:], axis=1)
-            keep_ppn1 = scores_ppn1[:, 1] > 0.5
-            keep_ppn2 = scores_ppn2[:, 1] > 0.5
-            # 8 = PPN1
-            for i, row in enumerate(scores_ppn1[keep_ppn1]):
-                event = output_ppn1[data_idx][keep_ppn1][i, :3]
-                fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                            (tree_idx, event[0] + 0.5, event[1] + 0.5, event[2] + 0.5, 8, scores_ppn1[keep_ppn1][i, 1]))
-                fout.write()
-            # 9 = PPN2
-            for i, row in enumerate(scores_ppn2[keep_ppn2]):
-                event = output_ppn2[data_idx][keep_ppn2][i, :3]
-                fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                            (tree_idx, event[0] + 0.5, event[1] + 0.5, event[2] + 0.5, 9, scores_ppn2[keep_ppn2][i, 1]))
-                fout.write()
+            selected = np.flatnonzero(mask)
+            ppn_block(selected[nms(positions[selected], scores[selected, 1], nms_score_threshold, window_size)], 11)
+
+            # Store PPN1 (type 8) and PPN2 (type 9) output
+            for output_ppn, point_type in ((output_ppn1, 8), (output_ppn2, 9)):
+                if output_ppn is None:
+                    continue
+                scores_ppn = scipy.special.softmax(output_ppn[data_idx][:, -2:], axis=1)
+                keep_ppn = scores_ppn[:, 1] > 0.5
+                blocks.append((output_ppn[data_idx][keep_ppn, :3] + 0.5, point_type, scores_ppn[keep_ppn, 1]))
 
         if output_seg is not None:
-            predictions = np.argmax(output_seg[data_idx],axis=1)
-            for row_idx,row in enumerate(predictions):
-                event = input_dat[data_idx][row_idx]
-                fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                            (tree_idx, event[0], event[1], event[2], 4, row))
-                fout.write()
+            blocks.append((voxels[:, :3], 4, np.argmax(output_seg[data_idx], axis=1)))
 
         if output_ghost is not None:
-            predictions = np.argmax(output_ghost[data_idx],axis=1)
-            for row_idx,row in enumerate(predictions):
-                event = input_dat[data_idx][row_idx]
-                fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                            (tree_idx, event[0], event[1], event[2], 14, row))
-                fout.write()
+            blocks.append((voxels[:, :3], 14, np.argmax(output_ghost[data_idx], axis=1)))
 
-        if output_seg is not None and output_pts is not None and len(output_pts[0][0]) > 5:
+        if output_seg is not None and output_pts is not None and points.shape[1] > 5:
 
             # 12 = masking + score threshold + filter PPN points of type X within N pixels of type X
             # 13 = masking + score threshold + filter PPN points of type X within N pixels of type X + NMS
-            mask = ((~(output_mask[data_idx] == 0)).any(axis=1)) & (scores[:, 1] > score_threshold)
-            uresnet_predictions = np.argmax(output_seg[data_idx][mask], axis=1)
             num_classes = output_seg[data_idx].shape[1]
-            ppn_type_predictions = np.argmax(scipy.special.softmax(output_pts[data_idx][mask][:, 5:], axis=1), axis=1)
+            uresnet_types = np.argmax(output_seg[data_idx][selected], axis=1)
+            ppn_types = values[selected]
+            close = selected[ppn_type_filter(points[selected, :3] + voxels[selected, :3] + 0.5, ppn_types,
+                                             voxels[selected, :3], uresnet_types, num_classes, type_threshold)]
+            # NMS of all the types at once, the types never suppress each other
+            keep = close[nms(positions[close], scores[close, 1], nms_score_threshold, window_size, batch=values[close])]
+            keep = keep[np.argsort(values[keep], kind='stable')]
             for c in range(num_classes):
-                uresnet_points = uresnet_predictions == c
-                ppn_points = ppn_type_predictions == c
-                if ppn_points.shape[0] > 0 and uresnet_points.shape[0] > 0:
-                    d = scipy.spatial.distance.cdist(output_pts[data_idx][mask][ppn_points][:, :3] + input_dat[data_idx][mask][ppn_points][:, :3] + 0.5, input_dat[data_idx][mask][uresnet_points][:, :3])
-                    ppn_mask = (d < type_threshold).any(axis=1)
-                    for i, row in enumerate(output_pts[data_idx][mask][ppn_points][ppn_mask]):
-                        event = input_dat[data_idx][mask][ppn_points][ppn_mask][i]
-                        if len(row) > 5:
-                            value = np.argmax(scipy.special.softmax(row[5:]))
-                        else:
-                            value = scores[mask][ppn_points][ppn_mask][i, 1]
-                        fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                                    (tree_idx, event[0] + 0.5 + row[0], event[1] + 0.5 + row[1], event[2] + 0.5 + row[2], 12, value))
-                        fout.write()
-                    keep = nms_numpy(output_pts[data_idx][mask][ppn_points][ppn_mask][:, :3], scores[mask][ppn_points][ppn_mask][:, 1], nms_score_threshold, window_size)
-                    for i, row in enumerate(output_pts[data_idx][mask][ppn_points][ppn_mask][keep]):
-                        event = input_dat[data_idx][mask][ppn_points][ppn_mask][keep][i]
-                        if len(row) > 5:
-                            value = np.argmax(scipy.special.softmax(row[5:]))
-                        else:
-                            value = scores[mask][ppn_points][ppn_mask][keep][i, 1]
-                        fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                                    (tree_idx, event[0] + 0.5 + row[0], event[1] + 0.5 + row[1], event[2] + 0.5 + row[2], 13, value))
-                        fout.write()
+                ppn_block(close[values[close] == c], 12)
+                ppn_block(keep[values[keep] == c], 13)
             # 14
             pts = uresnet_ppn_type_point_selector(data_blob['input_data'][data_idx], res, entry=data_idx, score_threshold=ppn_score_threshold, type_threshold=ppn_type_threshold)
-            for i, row in enumerate(pts):
-                fout.record(('idx', 'x', 'y', 'z', 'type', 'value'),
-                            (tree_idx, row[0], row[1], row[2], 14, row[-1]))
-                fout.write()
+            blocks.append((pts[:, :3], 14, pts[:, -1]))
+
+        blocks = [b for b in blocks if len(b[0])]
+        if len(blocks):
+            coords = np.concatenate([b[0] for b in blocks])
+            fout.write_arrays(idx=tree_idx, x=coords[:, 0], y=coords[:, 1], z=coords[:, 2],
+                              type=np.concatenate([np.full(len(b[0]), b[1]) for b in blocks]),
+                              value=np.concatenate([b[2] for b in blocks]))
+
         if not store_per_iteration:
             fout.close()
 
     if store_per_iteration:
         fout.close()
 
-def nms_numpy(im_proposals, im_scores, threshold, size):
-    dim = im_proposals.shape[-1]
-    coords = []
-    for d in range(dim):
-        coords.append(im_proposals[:, d] - size)
-    for d in range(dim):
-        coords.append(im_proposals[:, d] + size)
-    coords = np.array(coords)
-
-    areas = np.ones_like(coords[0])
-    areas = np.prod(coords[dim:] - coords[0:dim] + 1, axis=0)
-
-    order = im_scores.argsort()[::-1]
-    keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(i)
-        xx = np.maximum(coords[:dim, i][:, np.newaxis], coords[:dim, order[1:]])
-        yy = np.minimum(coords[dim:, i][:, np.newaxis], coords[dim:, order[1:]])
-        w = np.maximum(0.0, yy - xx + 1)
-        inter = np.prod(w, axis=0)
-        ovr = inter / (areas[i] + areas[order[1:]] - inter)
-        inds = np.where(ovr <= threshold)[0]
-        order = order[inds + 1]
-
-    return keep
+store_uresnet_ppn.result_keys = ('points', 'segmentation', 'ppn1', 'ppn2', 'mask_ppn2', 'ghost')
@@ -1,13 +1,47 @@
 import numpy as np
-import scipy
 import os
-from mlreco.utils import CSVData
+from mlreco.utils import open_writer
+from mlreco.utils.confusion import ConfusionMatrix
+
+
+def uresnet_metrics_table(confusion, num_classes):
+    """
+    Columns of the uresnet_metrics table, one row per event of confusion
+    (without the idx column).
+    """
+    fractions = confusion.fractions()
+    columns = {'acc': confusion.accuracy()}
+    for c1 in range(num_classes):
+        for c2 in range(num_classes):
+            columns['confusion_%d_%d' % (c1, c2)] = fractions[:, c1, c2]
+    for c1 in range(num_classes):
+        for c2 in range(num_classes):
+            columns['num_pix_%d_%d' % (c1, c2)] = confusion.counts[:, c1, c2]
+    return columns
+
 
 def uresnet_metrics(cfg, data_blob, res, logdir, iteration):
+    """
+    Semantic segmentation accuracy and confusion matrix of each event.
+
+    The confusion matrices of all the events of the minibatch are counted
+    at once (see mlreco.utils.confusion), and written as one row per event.
+
+    Configuration
+    -------------
+    segment_label: str, optional
+    num_classes: int, optional
+        Default: 5.
+    store_method: str, optional
+        Can be `per-iteration` or `per-event`
+    output_format: str, optional
+        Can be `csv` (default) or `npz`, see mlreco.utils.open_writer
+    """
     # UResNet prediction
-    if not 'segmentation' in res: return
+    if not 'segmentation' in res or not len(data_blob['index']): return
 
     method_cfg = cfg['post_processing']['uresnet_metrics']
+    output_format = 'csv' if method_cfg is None else method_cfg.get('output_format', 'csv')
 
     index        = data_blob['index']
     segment_data = res['segmentation']
@@ -19,31 +53,25 @@ def uresnet_metrics(cfg, data_blob, res, logdir, iteration):
     if method_cfg is not None and method_cfg.get('store_method',None) is not None:
         assert(method_cfg['store_method'] in ['per-iteration','per-event'])
         store_per_iteration = method_cfg['store_method'] == 'per-iteration'
-    fout=None
+
+    labels = [segment_label[data_idx][:, -1] for data_idx in range(len(index))]
+    predictions = [np.argmax(segment_data[data_idx], axis=1) for data_idx in range(len(index))]
+    num_truth = max([num_classes] + [int(l.max()) + 1 for l in labels if len(l)])
+    num_pred = max([num_classes] + [segment_data[data_idx].shape[1] for data_idx in range(len(index))])
+    confusion = ConfusionMatrix.from_events(labels, predictions, num_truth, num_pred)
+
+    columns = {'idx': np.asarray(index)}
+    columns.update(uresnet_metrics_table(confusion, num_classes))
+
     if store_per_iteration:
-        fout=CSVData(os.path.join(logdir, 'uresnet-metrics-iter-%07d.csv' % iteration))
+        fout = open_writer(os.path.join(logdir, 'uresnet-metrics-iter-%07d.csv' % iteration), output_format)
+        fout.write_arrays(**columns)
+        fout.close()
+        return
 
     for data_idx, tree_idx in enumerate(index):
+        fout = open_writer(os.path.join(logdir, 'uresnet-metrics-event-%07d.csv' % tree_idx), output_format)
+        fout.write_arrays(**{key: value[data_idx:data_idx+1] for key, value in columns.items()})
+        fout.close()
 
-        if not store_per_iteration:
-            fout=CSVData(os.path.join(logdir, 'uresnet-metrics-event-%07d.csv' % tree_idx))
-
-        predictions = np.argmax(segment_data[data_idx],axis=1)
-        label = segment_label[data_idx][:, -1]
-        
-        acc = (predictions == label).sum() / float(len(label))
-        class_acc = []
-        pix = []
-        for c1 in range(num_classes):
-            for c2 in range(num_classes):
-                class_mask = label == c1
-                class_acc.append((predictions[class_mask] == c2).sum() / float(np.count_nonzero(class_mask)))
-                pix.append(np.count_nonzero((label == c1) & (predictions == c2)))
-        fout.record(('idx', 'acc') + tuple(['confusion_%d_%d' % (c1, c2) for c1 in range(num_classes) for c2 in range(num_classes)]) + tuple(['num_pix_%d_%d' % (c1, c2) for c1 in range(num_classes) for c2 in range(num_classes)]),
-                    (tree_idx, acc) + tuple(class_acc) + tuple(pix))
-        fout.write()
-        
-
-        if not store_per_iteration: fout.close()
-
-    if store_per_iteration: fout.close()
+uresnet_metrics.result_keys = ('segmentation',)
@@ -0,0 +1,448 @@
+"""
+Streaming inference
+
+InferenceServer loads a model once (trainval.initialize) and runs it on
+events as they arrive, instead of iterating over a LArCV file list for a
+fixed number of iterations:
+
+- Events are either parsed arrays (a dictionary of parser outputs, as one
+  entry of LArCVDataset) or entry numbers of the configured iotool dataset.
+- Requests are queued and grouped in micro-batches: a batch is run as soon
+  as it holds max_batch_size events, or max_latency seconds after its first
+  event arrived, whichever comes first.
+- Each batch is collated with the iotool collate function and goes through
+  trainval.forward and the selected post-processors (see
+  mlreco.post_processing.executor). The results of each event are sent back
+  to its requester as soon as its batch is done.
+
+Clients submit events and get futures or stream results back in order:
+LocalClient talks to a server in the same process (tests, notebooks),
+SocketClient to a server listening on a local socket (InferenceServer.listen,
+bin/serve.py). InferenceServer.stats reports throughput and latency
+percentiles.
+
+Configuration, in the `serving` block (all optional):
+
+max_batch_size: int
+    Largest micro-batch, default iotool.minibatch_size.
+max_latency: float
+    Longest time (s) the first event of a batch waits for more events,
+    default 0.05.
+post_processing: list
+    Names of the post-processors (of the `post_processing` block) to run
+    on each batch, default all of them.
+output_keys: list
+    Result keys sent back to the clients, default all of them.
+
+The model must be run with an unwrapper (trainval.unwrapper): each client
+gets the entries of its own event for the outputs split by event, and the
+entries of its micro-batch for the others (e.g. losses).
+compute_loss: bool
+    Whether to compute the loss (events must then hold the loss inputs),
+    default False.
+address, authkey, report_interval:
+    Socket address (host:port or unix socket path), connection key and
+    interval (s) between statistics reports of bin/serve.py.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import collections
+import copy
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client
+import numpy as np
+from mlreco.utils.unwrap import is_event_output
+
+# Number of recent events kept for latency percentiles
+LATENCY_WINDOW = 10000
+
+
+Request = collections.namedtuple('Request', ('event', 'future', 'arrival'))
+
+
+def serving_config(cfg):
+    """
+    Copy of a full configuration set up for serving: inference only, one
+    micro-batch per forward on a single device (micro-batches are small),
+    loss disabled unless serving.compute_loss.
+    """
+    cfg = copy.deepcopy(cfg)
+    serving_cfg = cfg.setdefault('serving', {}) or {}
+    cfg['serving'] = serving_cfg
+    iotool_cfg = cfg.setdefault('iotool', {})
+    max_batch_size = int(serving_cfg.get('max_batch_size', max(1, iotool_cfg.get('minibatch_size', 1) or 1)))
+    serving_cfg['max_batch_size'] = max_batch_size
+    iotool_cfg['batch_size'] = iotool_cfg['minibatch_size'] = max_batch_size
+    trainval_cfg = cfg.setdefault('trainval', {})
+    trainval_cfg['train'] = False
+    trainval_cfg['gpus'] = list(trainval_cfg.get('gpus', []))[:1]
+    trainval_cfg['distributed'] = False
+    if not serving_cfg.get('compute_loss', False):
+        cfg.setdefault('model', {})['loss_input'] = []
+    return cfg
+
+
+class InferenceServer(object):
+    """
+    Runs a model on micro-batches of events submitted by clients.
+
+    Parameters
+    ----------
+    cfg: dict
+        Full configuration (after process_config), see serving_config and
+        the module documentation for the `serving` block.
+    trainer: object, optional
+        Object with a trainval.forward method, by default a trainval
+        instance built from cfg and initialized once.
+    processors: list, optional
+        Post-processing functions, by default the ones named in
+        serving.post_processing.
+    logdir: str, optional
+        Output directory of the post-processors, default trainval.log_dir.
+    """
+    def __init__(self, cfg, trainer=None, processors=None, logdir=None):
+        self._cfg = serving_config(cfg)
+        serving_cfg = self._cfg['serving']
+        self.max_batch_size = serving_cfg['max_batch_size']
+        self.max_latency = float(serving_cfg.get('max_latency', 0.05))
+        self._output_keys = serving_cfg.get('output_keys', None)
+        if self._cfg['trainval'].get('unwrapper', None) is None:
+            raise ValueError('InferenceServer needs trainval.unwrapper to send each client the outputs of its event')
+
+        if trainer is None:
+            from mlreco.trainval import trainval
+            trainer = trainval(self._cfg)
+            trainer.initialize()
+        self._trainer = trainer
+
+        collate_fn = self._cfg['iotool'].get('collate_fn', None)
+        if collate_fn is not None:
+            import mlreco.iotools.collates
+            self._collate = getattr(mlreco.iotools.collates, collate_fn)
+        else:
+            from torch.utils.data import default_collate
+            self._collate = default_collate
+        self._dataset = None
+
+        if processors is None:
+            import mlreco.post_processing as post_processing
+            names = serving_cfg.get('post_processing', list(self._cfg.get('post_processing', {}) or {}))
+            processors = [getattr(post_processing, str(name)) for name in names]
+        self._post_processor = None
+        if len(processors):
+            from mlreco.post_processing.executor import PostProcessingExecutor
+            self._post_processor = PostProcessingExecutor(self._cfg, processors=processors)
+        self._logdir = logdir if logdir is not None else self._cfg['trainval'].get('log_dir', '.')
+
+        # Statistics
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._num_events = 0
+        self._num_batches = 0
+        self._first_arrival = None
+        self._last_done = None
+        self._event_counter = itertools.count()
+
+        self._queue = queue.Queue()
+        self._listener = None
+        self._connections = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='InferenceServer', daemon=True)
+        self._thread.start()
+
+    def submit(self, event):
+        """
+        Queues one event (dictionary of parsed arrays, or entry number of
+        the iotool dataset). Returns a concurrent.futures.Future of its
+        results, a dictionary of result keys.
+        """
+        future = Future()
+        now = time.time()
+        # Under the lock, so that no request is queued after close's None
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('InferenceServer is closed')
+            if self._first_arrival is None:
+                self._first_arrival = now
+            self._queue.put(Request(event, future, now))
+        return future
+
+    def stats(self):
+        """
+        Throughput and latency (from submission to results) of the events
+        processed so far, latency percentiles over the last LATENCY_WINDOW
+        events.
+        """
+        with self._lock:
+            latencies = np.array(self._latencies)
+            num_events, num_batches = self._num_events, self._num_batches
+            elapsed = (self._last_done - self._first_arrival) if num_events else 0.
+        stats = {
+            'num_events': num_events,
+            'num_batches': num_batches,
+            'mean_batch_size': num_events / num_batches if num_batches else 0.,
+            'throughput': num_events / elapsed if elapsed > 0 else 0.,
+        }
+        for name, q in (('latency_p50', 50), ('latency_p90', 90), ('latency_p99', 99)):
+            stats[name] = float(np.percentile(latencies, q)) if len(latencies) else 0.
+        stats['latency_mean'] = float(latencies.mean()) if len(latencies) else 0.
+        return stats
+
+    def listen(self, address=('localhost', 0), authkey=None):
+        """
+        Accepts SocketClient connections on a local socket (a (host, port)
+        tuple, port 0 for any free port, or a unix socket path). Returns
+        the address to connect to.
+        """
+        self._listener = Listener(address, authkey=authkey)
+        thread = threading.Thread(target=self._accept, name='InferenceServer-listener', daemon=True)
+        thread.start()
+        return self._listener.address
+
+    def close(self):
+        """
+        Processes the queued events, then stops the server
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        for connection in self._connections:
+            connection.close()
+        if self._post_processor is not None:
+            self._post_processor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self):
+        # Forms micro-batches: up to max_batch_size events, without making
+        # the first one wait more than max_latency
+        stop = False
+        while not stop:
+            request = self._queue.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = request.arrival + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                try:
+                    request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+            self._process(batch)
+
+    def _load(self, event):
+        # Parsed arrays, or entry of the configured dataset
+        if isinstance(event, dict):
+            event = dict(event)
+        else:
+            if self._dataset is None:
+                from mlreco.iotools.factories import dataset_factory
+                self._dataset = dataset_factory(self._cfg)
+            event = self._dataset[int(event)]
+        if 'index' not in event:
+            event['index'] = next(self._event_counter)
+        return event
+
+    def _process(self, batch):
+        # Events which cannot be loaded only fail their own request
+        events, requests = [], []
+        for request in batch:
+            try:
+                events.append(self._load(request.event))
+            except Exception as e:
+                request.future.set_exception(e)
+                continue
+            requests.append(request)
+        batch = requests
+        if not len(batch):
+            return
+        try:
+            minibatch = self._collate(events)
+            data_blob, res = self._trainer.forward(iter([minibatch]))
+            if self._post_processor is not None:
+                self._post_processor.submit(data_blob, res, self._logdir, self._num_batches)
+            results = [self._event_results(res, i, len(batch)) for i in range(len(batch))]
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        done = time.time()
+        with self._lock:
+            self._num_events += len(batch)
+            self._num_batches += 1
+            self._last_done = done
+            self._latencies.extend([done - request.arrival for request in batch])
+        for request, result in zip(batch, results):
+            request.future.set_result(result)
+
+    def _event_results(self, res, index, batch_size):
+        # Entry of the event for the outputs split by the unwrapper, entries
+        # of the micro-batch for the others
+        keys = [key for key in res if self._output_keys is None or key in self._output_keys]
+        results = {}
+        for key in keys:
+            values = res[key]
+            if not is_event_output(values):
+                results[key] = values
+                continue
+            if len(values) != batch_size:
+                raise ValueError('Output %s has %d entries for %d events' % (key, len(values), batch_size))
+            results[key] = values[index]
+        return results
+
+    def _accept(self):
+        while True:
+            try:
+                connection = self._listener.accept()
+            except (OSError, AttributeError):
+                break
+            self._connections.append(connection)
+            thread = threading.Thread(target=self._serve, args=(connection,), daemon=True)
+            thread.start()
+
+    def _serve(self, connection):
+        # Messages are (request id, event) or None to close, replies are
+        # (request id, error, results). The connection is closed once every
+        # request received on it has been replied to.
+        pending = set()
+        condition = threading.Condition()
+        def reply(request_id, future):
+            error = future.exception()
+            message = (request_id, repr(error), None) if error is not None else (request_id, None, future.result())
+            with condition:
+                try:
+                    connection.send(message)
+                except (OSError, EOFError):
+                    pass
+                pending.discard(request_id)
+                condition.notify_all()
+        while True:
+            try:
+                message = connection.recv()
+            except (OSError, EOFError):
+                break
+            if message is None:
+                # Client is closing, no more requests
+                break
+            request_id, event = message
+            try:
+                future = self.submit(event)
+            except RuntimeError as e:
+                future = Future()
+                future.set_exception(e)
+            with condition:
+                pending.add(request_id)
+            future.add_done_callback(lambda f, request_id=request_id: reply(request_id, f))
+        with condition:
+            while len(pending):
+                condition.wait()
+            connection.close()
+
+
+class _Client(object):
+    """
+    Streaming helpers on top of submit
+    """
+    def infer(self, event, timeout=None):
+        """
+        Results of one event
+        """
+        return self.submit(event).result(timeout=timeout)
+
+    def stream(self, events, timeout=None):
+        """
+        Submits events as they come and yields their results in order.
+        Events are submitted ahead, so that the server can batch them.
+        """
+        futures = collections.deque()
+        for event in events:
+            futures.append(self.submit(event))
+            while len(futures) and futures[0].done():
+                yield futures.popleft().result()
+        while len(futures):
+            yield futures.popleft().result(timeout=timeout)
+
+
+class LocalClient(_Client):
+    """
+    Client of an InferenceServer of the same process
+    """
+    def __init__(self, server):
+        self._server = server
+
+    def submit(self, event):
+        return self._server.submit(event)
+
+    def close(self):
+        pass
+
+
+class SocketClient(_Client):
+    """
+    Client of an InferenceServer listening on a local socket, see
+    InferenceServer.listen.
+    """
+    def __init__(self, address, authkey=None):
+        self._connection = Client(address, authkey=authkey)
+        self._futures = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+
+    def submit(self, event):
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._futures[request_id] = future
+        with self._send_lock:
+            self._connection.send((request_id, event))
+        return future
+
+    def close(self):
+        """
+        Closes the connection, once the pending results are received
+        """
+        with self._send_lock:
+            self._connection.send(None)
+        self._thread.join()
+        self._connection.close()
+
+    def _receive(self):
+        while True:
+            try:
+                request_id, error, results = self._connection.recv()
+            except (OSError, EOFError):
+                break
+            with self._lock:
+                future = self._futures.pop(request_id)
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(results)
+        # Connection closed: fail the pending requests
+        with self._lock:
+            for future in self._futures.values():
+                future.set_exception(ConnectionError('InferenceServer connection closed'))
+            self._futures.clear()
@@ -2,24 +2,54 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 import warnings
+import contextlib
 import torch
 import time
 import os
+import glob
 import mlreco.utils as utils
 from mlreco.models import construct
 from mlreco.utils.data_parallel import DataParallel
+from mlreco.utils import distributed, checkpoint
 import numpy as np
-from mlreco.utils.utils import to_numpy
-import re
+from mlreco.utils.utils import detach, ResultBlob
 
 
 class trainval(object):
     """
     Groups all relevant functions for forward/backward of a network.
+
+    Gradients of the batch_size / (minibatch_size * len(gpus)) forward passes
+    of one training iteration are accumulated: backward runs right after
+    each minibatch with the loss scaled by the number of forward passes, so
+    that only one minibatch graph is kept in memory at a time. Relevant
+    trainval configuration parameters:
+
+    accumulate_gradients: bool, optional
+        If False, losses of all the minibatches are kept and averaged before
+        a single backward (legacy behavior). Default True.
+    mixed_precision: bool, optional
+        Run forward and loss under torch.autocast, and scale the
+        loss with a GradScaler. Only meant for models whose operations all
+        support half precision (e.g. dense heads and GNNs), GPU only.
+        Default False.
+
+    If torch.distributed is initialized (see mlreco.utils.distributed and
+    trainval.distributed), the network is wrapped in
+    DistributedDataParallel instead of DataParallel: this process only runs
+    its share of the batch_size / minibatch_size minibatches, gradients are
+    averaged across processes during the last backward of the iteration and
+    scalar results are gathered from all processes. Gradients are always
+    accumulated in this mode.
+
+    find_unused_parameters: bool, optional
+        Passed to DistributedDataParallel, needed if some parameters of the
+        model do not contribute to the loss. Default False.
     """
     def __init__(self, cfg):
         self._watch = utils.stopwatch()
         self.tspent_sum = {}
+        self.tspent = {}
         self._model_config = cfg['model']
         self._trainval_config = cfg['trainval']
         self._iotool_config = cfg['iotool']
@@ -35,6 +65,21 @@ class trainval(object):
         self._model_name = self._model_config.get('name', '')
         self._learning_rate = self._trainval_config.get('learning_rate') # deprecate to move to optimizer args
         self._model_path = self._trainval_config.get('model_path', '')
+        self._mmap_checkpoints = self._trainval_config.get('mmap_checkpoints', True)
+        self._chain_snapshot = self._trainval_config.get('chain_snapshot', None)
+        self._key_maps = {}
+        self._accumulate_gradients = self._trainval_config.get('accumulate_gradients', True)
+        self._mixed_precision = self._trainval_config.get('mixed_precision', False)
+        if self._mixed_precision and not len(self._gpus):
+            warnings.warn("Mixed precision is only supported on GPU, disabling it.")
+            self._mixed_precision = False
+        self._num_forward = 1
+        self._distributed = distributed.is_distributed()
+        self._world_size = distributed.get_world_size()
+        self._find_unused_parameters = self._trainval_config.get('find_unused_parameters', False)
+        if self._distributed and not self._accumulate_gradients:
+            warnings.warn("Gradients are always accumulated in distributed mode.")
+            self._accumulate_gradients = True
 
         # optimizer
         optim_cfg = self._trainval_config.get('optimizer')
@@ -68,29 +113,49 @@ class trainval(object):
             self._lr_scheduler = None
 
     def backward(self):
-        total_loss = 0.0
-        for loss in self._loss:
-            total_loss += loss
-        total_loss /= len(self._loss)
-        self._loss = []  # Reset loss accumulator
+        """
+        Updates the weights with the gradients accumulated since the last
+        call to zero_grad (in train_step). If gradients are not accumulated
+        during forward, runs backward once on the average loss first.
+        """
+        if not self._accumulate_gradients:
+            total_loss = 0.0
+            for loss in self._loss:
+                total_loss += loss
+            total_loss /= len(self._loss)
+            self._loss = []  # Reset loss accumulator
+            self._backward(total_loss)
 
-        self._optimizer.zero_grad()  # Reset gradients accumulation
-        total_loss.backward()
         # torch.nn.utils.clip_grad_norm_(self._net.parameters(), 1.0)
-        self._optimizer.step()
+        self._scaler.step(self._optimizer)
+        self._scaler.update()
         # note that scheduler is stepped every iteration, not every epoch
         if self._scheduler is not None:
             self._scheduler.step()
 
+    def _backward(self, loss):
+        """
+        Backward pass, gradients are added to the current ones
+        """
+        self._watch.start('backward')
+        self._scaler.scale(loss).backward()
+        self._watch.stop('backward')
+        self.tspent['backward'] += self._watch.time('backward')
+        self.tspent_sum['backward'] += self._watch.time('backward')
+
     def save_state(self, iteration):
         self._watch.start('save')
-        if len(self._weight_prefix) > 0:
+        # Weights are identical on all the processes, only the first one saves
+        if len(self._weight_prefix) > 0 and distributed.is_main_process():
             filename = '%s-%d.ckpt' % (self._weight_prefix, iteration)
-            torch.save({
+            state = {
                 'global_step': iteration,
                 'state_dict': self._net.state_dict(),
                 'optimizer': self._optimizer.state_dict()
-            }, filename)
+            }
+            if self._mixed_precision:
+                state['scaler'] = self._scaler.state_dict()
+            torch.save(state, filename)
         self._watch.stop('save')
 
 
@@ -170,8 +235,10 @@ class trainval(object):
 
         self._watch.start('train')
         self._loss = []  # Initialize loss accumulator
+        self.tspent['backward'] = 0.
+        self._optimizer.zero_grad()  # Reset gradients accumulation
         data_blob,res_combined = self.forward(data_iter)
-        # Run backward once for all the previous forward
+        # Update the weights once for all the previous forward
         self.backward()
         self._watch.stop('train')
         self.tspent_sum['train'] += self._watch.time('train')
@@ -182,12 +249,15 @@ class trainval(object):
         """
         Run forward for
         flags.BATCH_SIZE / (flags.MINIBATCH_SIZE * len(flags.GPUS)) times
+        Returns the input data and a ResultBlob of the results, network
+        outputs are only copied to host when they are read.
         """
         self._watch.start('train')
         self._watch.start('forward')
-        res_combined  = {}
+        res_combined  = ResultBlob()
         data_combined = {}
-        num_forward = int(self._batch_size / (self._minibatch_size * max(1,len(self._gpus))))
+        num_forward = int(self._batch_size / (self._minibatch_size * max(1,len(self._gpus)) * self._world_size))
+        self._num_forward = num_forward
 
         for idx in range(num_forward):
             self._watch.start('io')
@@ -196,7 +266,10 @@ class trainval(object):
             self._watch.stop('io')
             self.tspent_sum['io'] += self._watch.time('io')
 
-            res = self._forward(input_train, input_loss)
+            # Only synchronize gradients across processes on the last backward
+            sync = not self._distributed or not self._train or idx == num_forward - 1
+            with contextlib.nullcontext() if sync else self._net.no_sync():
+                res = self._forward(input_train, input_loss)
 
             # here, contruct the unwrapped input and output
             # should call a single function that returns a list which can be "extended" in res_combined and data_combined.
@@ -215,16 +288,15 @@ class trainval(object):
                 if 'index' in input_data:
                     input_data['index'] = input_data['index'][0]
 
-            for key in res.keys():
-                if key not in res_combined:
-                    res_combined[key] = []
-                res_combined[key].extend(res[key])
+            res_combined.extend(res)
 
             for key in input_data.keys():
                 if key not in data_combined:
                     data_combined[key] = []
                 data_combined[key].extend(input_data[key])
 
+        res_combined = distributed.reduce_metrics(res_combined)
+
         self._watch.stop('forward')
         return data_combined, res_combined
 
@@ -254,24 +326,30 @@ class trainval(object):
 
             self._watch.start('forward')
 
-            if not torch.cuda.is_available():
+            if not torch.cuda.is_available() or self._distributed:
                 train_blob = train_blob[0]
 
-            result = self._net(train_blob)
-
-            if not torch.cuda.is_available():
-                train_blob = [train_blob]
+            loss_acc = {}
+            with torch.autocast('cuda', enabled=self._mixed_precision):
+                result = self._net(train_blob)
 
-            # Compute the loss
-            if len(self._loss_keys):
-                loss_acc = self._criterion(result, *tuple(loss_blob))
+                # Compute the loss (none in pure inference, e.g. serving)
+                if len(self._loss_keys):
+                    loss_acc = self._criterion(result, *tuple(loss_blob))
 
-                if self._train:
-                    self._loss.append(loss_acc['loss'])
+            if not torch.cuda.is_available() or self._distributed:
+                train_blob = [train_blob]
 
             self._watch.stop('forward')
             self.tspent_sum['forward'] += self._watch.time('forward')
 
+            # Backward right away to free this minibatch graph
+            if len(self._loss_keys) and self._train:
+                if self._accumulate_gradients:
+                    self._backward(loss_acc['loss'] / self._num_forward)
+                else:
+                    self._loss.append(loss_acc['loss'])
+
             # Record results
             res = {}
             for label in loss_acc:
@@ -285,33 +363,45 @@ class trainval(object):
                 if len(output_keys) and not key in output_keys: continue
                 if len(result[key]) == 0:
                     continue
-                if isinstance(result[key][0], list):
-                    res[key] = [[to_numpy(s) for s in x] for x in result[key]]
-                else:
-                    res[key] = [to_numpy(s) for s in result[key]]
+                # Converted to numpy only when read, see ResultBlob
+                res[key] = [detach(s) for s in result[key]]
             return res
 
     def initialize(self):
         # To use DataParallel all the inputs must be on devices[0] first
         model = None
 
+        start = time.time()
         model,criterion = construct(self._model_name)
         self._criterion = criterion(self._model_config).cuda() if len(self._gpus) else criterion(self._model_config)
 
 
         self.tspent_sum['forward'] = self.tspent_sum['train'] = self.tspent_sum['io'] = self.tspent_sum['save'] = 0.
-
-        self._net = DataParallel(model(self._model_config),
-                                      device_ids=self._gpus)
+        self.tspent_sum['backward'] = self.tspent['backward'] = 0.
+
+        if self._distributed:
+            # One device per process, the module must be on it before wrapping
+            net = model(self._model_config)
+            if len(self._gpus):
+                net = net.cuda()
+            self._net = torch.nn.parallel.DistributedDataParallel(net,
+                                                                  device_ids=self._gpus if len(self._gpus) else None,
+                                                                  find_unused_parameters=self._find_unused_parameters)
+        else:
+            self._net = DataParallel(model(self._model_config),
+                                          device_ids=self._gpus)
 
         if self._train:
             self._net.train().cuda() if len(self._gpus) else self._net.train()
         else:
             self._net.eval().cuda() if len(self._gpus) else self._net.eval()
+        # Losses may skip some work on training steps (e.g. metrics_step)
+        self._criterion.train(self._train)
 
 
         optim_class = eval('torch.optim.' + self._optim)
         self._optimizer = optim_class(self._net.parameters(), **self._optim_args)
+        self._scaler = torch.amp.GradScaler('cuda', enabled=self._mixed_precision)
 
         # learning rate scheduler
         if self._lr_scheduler is not None:
@@ -323,45 +413,114 @@ class trainval(object):
 
         self._softmax = torch.nn.Softmax(dim=1 if 'sparse' in self._model_name else 0)
 
+        # Weight names of the new network
+        self._key_maps = {}
+        self.tspent['construct'] = time.time() - start
+        print('Network constructed in %.3f s' % self.tspent['construct'])
+
+        return self.restore()
+
+    def restore(self, model_path=None):
+        """
+        Loads the weights of model_path (trainval.model_path by default, the
+        first match if it is a glob pattern) and of the modules with their
+        own model_path into the network, without constructing it again.
+        Returns the iteration to start from.
+
+        Checkpoints are memory-mapped (trainval.mmap_checkpoints, default
+        True) and the renaming of the weights of each module is computed
+        once per network, see mlreco.utils.checkpoint. If
+        trainval.chain_snapshot is set, the weights restored from the
+        configured checkpoints are saved to that file, and restored from it
+        in a single read as long as the checkpoints do not change.
+        """
+        start = time.time()
         iteration = 0
         model_paths = []
-        if self._model_path and self._model_path != '':
-            model_paths.append(('', self._model_path))
+        default_path = model_path is None
+        model_path = self._model_path if model_path is None else model_path
+        if model_path and not os.path.isfile(model_path) and len(glob.glob(model_path)):
+            model_path = sorted(glob.glob(model_path))[0]
+        if model_path and model_path != '':
+            model_paths.append(('', model_path))
         for module in self._model_config['modules']:
             if 'model_path' in self._model_config['modules'][module] and self._model_config['modules'][module]['model_path'] != '':
                 model_paths.append((module, self._model_config['modules'][module]['model_path']))
 
-        if model_paths:
-            for module, model_path in model_paths:
-                if not os.path.isfile(model_path):
-                    raise ValueError('File not found: %s for module %s\n' % (model_path, module))
+        for module, model_path in model_paths:
+            if not os.path.isfile(model_path):
+                raise ValueError('File not found: %s for module %s\n' % (model_path, module))
+        if not model_paths:
+            return iteration
+
+        snapshot_path = self._chain_snapshot if default_path else None
+        snapshot, sources = None, None
+        if snapshot_path:
+            sources = checkpoint.checkpoint_sources(model_paths)
+            snapshot = checkpoint.load_chain_snapshot(snapshot_path, sources, mmap=self._mmap_checkpoints,
+                                                      train=self._train)
+        if snapshot is not None:
+            print('Restoring weights from chain snapshot %s...' % snapshot_path)
+            model_paths = [('', snapshot_path)]
+
+        names = self._net.state_dict().keys()
+        restored, root = {}, None
+        for module, model_path in model_paths:
+            if snapshot is None:
                 print('Restoring weights from %s...' % model_path)
-                with open(model_path, 'rb') as f:
-                    checkpoint = torch.load(f, map_location='cpu')
-                    # Edit checkpoint variable names
-                    for name in self._net.state_dict():
-                        other_name = re.sub(module + '.', '', name)
-                        # print(module, name, other_name, other_name in checkpoint['state_dict'])
-                        if other_name in checkpoint['state_dict']:
-                            checkpoint['state_dict'][name] = checkpoint['state_dict'].pop(other_name)
-
-                    bad_keys = self._net.load_state_dict(checkpoint['state_dict'], strict=False)
-
-                    if len(bad_keys.unexpected_keys) > 0:
-                        print("INCOMPATIBLE KEYS!")
-                        print(bad_keys.unexpected_keys)
-                        print("make sure your module is named ", module)
-
-                    # FIXME only restore optimizer for whole model?
-                    # To restore it partially we need to implement our own
-                    # version of optimizer.load_state_dict.
-                    if self._train and module == '':
-                        # This overwrites the learning rate, so reset the learning rate
-                        self._optimizer.load_state_dict(checkpoint['optimizer'])
-                        for g in self._optimizer.param_groups:
-                            g['lr'] = self._learning_rate
-                    if module == '':  # Root model sets iteration
-                        iteration = checkpoint['global_step'] + 1
-                print('Done.')
-
+            checkpoint_dict = snapshot if snapshot is not None else checkpoint.load_checkpoint(model_path, mmap=self._mmap_checkpoints)
+            # Edit checkpoint variable names
+            if module not in self._key_maps:
+                self._key_maps[module] = checkpoint.module_key_map(names, module)
+            state_dict = checkpoint.remap_state_dict(checkpoint_dict['state_dict'], self._key_maps[module])
+
+            unexpected_keys = [name for name in state_dict if name not in names]
+            restored.update((name, value) for name, value in state_dict.items() if name in names)
+
+            if len(unexpected_keys) > 0:
+                print("INCOMPATIBLE KEYS!")
+                print(unexpected_keys)
+                print("make sure your module is named ", module)
+
+            # FIXME only restore optimizer for whole model?
+            # To restore it partially we need to implement our own
+            # version of optimizer.load_state_dict.
+            if self._train and module == '' and 'optimizer' in checkpoint_dict:
+                # This overwrites the learning rate, so reset the learning rate
+                self._optimizer.load_state_dict(checkpoint_dict['optimizer'])
+                for g in self._optimizer.param_groups:
+                    g['lr'] = self._learning_rate
+                if self._mixed_precision and 'scaler' in checkpoint_dict:
+                    self._scaler.load_state_dict(checkpoint_dict['scaler'])
+            if module == '':
+                root = checkpoint_dict
+            if module == '' and 'global_step' in checkpoint_dict:  # Root model sets iteration
+                iteration = checkpoint_dict['global_step'] + 1
+            print('Done.')
+
+        # All the modules at once, later checkpoints take precedence
+        self._net.load_state_dict(restored, strict=False)
+
+        if snapshot_path and snapshot is None and distributed.is_main_process():
+            checkpoint.save_chain_snapshot(snapshot_path, restored, sources,
+                                           global_step=root.get('global_step') if root is not None else None,
+                                           optimizer=root.get('optimizer') if root is not None and self._train else None,
+                                           scaler=root.get('scaler') if root is not None and self._train else None,
+                                           train=self._train)
+            print('Saved chain snapshot %s' % snapshot_path)
+
+        self.tspent['restore'] = time.time() - start
+        print('Restored %d weights from %d file(s) in %.3f s' % (len(restored), len(model_paths), self.tspent['restore']))
         return iteration
+
+    def get_weights(self):
+        """
+        Copy of the network weights (on their device), see set_weights
+        """
+        return {name: value.detach().clone() for name, value in self._net.state_dict().items()}
+
+    def set_weights(self, weights):
+        """
+        Loads weights returned by get_weights into the network
+        """
+        self._net.load_state_dict(weights)
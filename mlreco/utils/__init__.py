@@ -1,2 +1,3 @@
 from .unwrap import unwrap_2d_scn, unwrap_3d_scn
 from .utils import *
+from .columnar import ColumnarData, open_writer
@@ -2,14 +2,7 @@ import numpy as np
 from mlreco.utils.gnn.compton import filter_compton
 from mlreco.utils.gnn.cluster import form_clusters_new
 from mlreco.utils.gnn.cluster import get_cluster_features
-
-def find_parent(parent, i):
-    """
-    find parent of index i
-    """
-    if i != parent[i]:
-        parent[i] = find_parent(parent, parent[i])
-    return parent[i]
+from mlreco.utils.union_find import UnionFind
 
 
 def merge_diagram(f, edges):
@@ -25,14 +18,14 @@ def merge_diagram(f, edges):
     death = np.empty(n)
     death.fill(np.inf) # fill with deaths
     sortperm = np.argsort(fe)
-    parent = np.arange(n)
+    uf = UnionFind(n)
     elist = []
     for ei in sortperm:
         # get nodes
         i, j = edges[ei]
         fij = fe[ei]
-        pi = find_parent(parent, i)
-        pj = find_parent(parent, j)
+        pi = uf.find(i)
+        pj = uf.find(j)
         if pi == pj:
             # nothing to do
             continue
@@ -42,13 +35,13 @@ def merge_diagram(f, edges):
             # component with j merges
             death[pj] = fij
             # merge components
-            parent[pj] = pi
+            uf.link(pi, pj)
             elist.append([i,j])
         else:
             # bj <= bi
             death[pi] = fij
             # merge components
-            parent[pi] = pj
+            uf.link(pj, pi)
             elist.append([i,j])
     return birth, death, elist
 
@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import torch
+
+
+def load_checkpoint(path, mmap=True):
+    """
+    torch.load of a checkpoint on cpu. If mmap, the tensors are memory-mapped
+    from the file (zip format of torch >= 2.1) rather than read at once:
+    only the pages of the tensors that are copied into the network are read.
+    Falls back to a full read for older torch versions and legacy files.
+    """
+    if mmap:
+        try:
+            return torch.load(path, map_location='cpu', mmap=True)
+        except (TypeError, RuntimeError):
+            pass
+    with open(path, 'rb') as f:
+        return torch.load(f, map_location='cpu')
+
+
+def module_key_map(names, module):
+    """
+    Maps the names of the weights of a module saved on its own (e.g.
+    `module.encoder.weight`) to their names in the network (e.g.
+    `module.uresnet.encoder.weight`), by removing the first occurrence of
+    the `module` components from the network names. Nested modules are
+    given with dots (e.g. `uresnet.ppn`). The root module ('') maps
+    nothing.
+
+    Parameters
+    ----------
+    names: iterable of str
+        Names of the network state dict
+    module: str
+        Name of the module in the network
+
+    Returns
+    -------
+    dict
+        Checkpoint name -> network name, for the names that differ
+    """
+    key_map = {}
+    if module == '':
+        return key_map
+    module_parts = module.split('.')
+    size = len(module_parts)
+    for name in names:
+        parts = name.split('.')
+        for i in range(len(parts) - size + 1):
+            if parts[i:i+size] == module_parts:
+                key_map.setdefault('.'.join(parts[:i] + parts[i+size:]), name)
+                break
+    return key_map
+
+
+def remap_state_dict(state_dict, key_map):
+    """
+    Renames the weights of a checkpoint with a module_key_map. Names which
+    are not in key_map are kept as they are, renamed weights take precedence.
+    """
+    state = {name: value for name, value in state_dict.items() if name not in key_map}
+    for name, value in state_dict.items():
+        if name in key_map:
+            state[key_map[name]] = value
+    return state
+
+
+def checkpoint_sources(model_paths):
+    """
+    Identifies the checkpoint files of a chain: (module, path, size,
+    modification time) of each one
+    """
+    sources = []
+    for module, path in model_paths:
+        stat = os.stat(path)
+        sources.append([module, os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return sources
+
+
+def save_chain_snapshot(path, state_dict, sources, global_step=None, optimizer=None, scaler=None, train=False):
+    """
+    Consolidated checkpoint of a chain: the weights restored from all the
+    module checkpoints of sources, under their network names, so that they
+    are restored with a single read (see load_chain_snapshot). With train,
+    the snapshot holds the optimizer (and scaler) state of the root
+    checkpoint, if any. The file is replaced atomically.
+    """
+    snapshot = {'chain_snapshot': sources, 'state_dict': state_dict, 'train': bool(train)}
+    if global_step is not None:
+        snapshot['global_step'] = global_step
+    if optimizer is not None:
+        snapshot['optimizer'] = optimizer
+    if scaler is not None:
+        snapshot['scaler'] = scaler
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    torch.save(snapshot, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_chain_snapshot(path, sources, mmap=True, train=False):
+    """
+    Chain snapshot of path, or None if it does not exist or was made from
+    other checkpoint files than sources (or older versions of them). For
+    training (train), a snapshot made for inference (without the optimizer
+    state of the root checkpoint) is not used either.
+    """
+    if not os.path.isfile(path):
+        return None
+    snapshot = load_checkpoint(path, mmap=mmap)
+    if [list(source) for source in snapshot.get('chain_snapshot', [])] != [list(source) for source in sources]:
+        return None
+    if train and not snapshot.get('train', False):
+        return None
+    return snapshot
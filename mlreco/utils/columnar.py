@@ -0,0 +1,242 @@
+"""
+Columnar output files
+
+ColumnarData has the same record/write API as CSVData, plus write_arrays
+to write whole columns at once. Rows are buffered as numpy arrays and
+written by chunks to a compressed .npz file (a zip archive with one .npy
+entry per column and per chunk, named chunk%06d/<column>). Files can be
+read back with read_columnar and converted to the legacy CSV format with
+columnar_to_csv (or python -m mlreco.utils.columnar file.npz [...]).
+
+Writers opened in a dry_run context format and compress their rows as
+usual but discard the bytes, counting rows and bytes, to measure the
+throughput of the post-processors without touching the disk.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import contextlib
+import os
+import sys
+import zipfile
+import numpy as np
+from .utils import CSVData
+
+# Default number of rows buffered before a chunk is written
+CHUNK_SIZE = 2**20
+
+# Output formats of open_writer
+OUTPUT_FORMATS = ('csv', 'npz')
+
+# Writers opened in each active dry_run context
+_DRY_RUN = []
+
+
+class CountingSink(object):
+    """
+    Write-only file object that counts the bytes written and discards them
+    """
+    def __init__(self, name):
+        self.name = name
+        self.num_bytes = 0
+
+    def write(self, data):
+        # Text is ASCII (CSV), one byte per character
+        self.num_bytes += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ColumnarData(object):
+    """
+    Columnar replacement of CSVData, writes compressed numpy chunks.
+    All the rows must have the same columns, given by the first write.
+    """
+    def __init__(self, fout, chunk_size=CHUNK_SIZE, sink=None):
+        self.name  = fout
+        self._chunk_size = int(chunk_size)
+        self._sink = sink  # File object to write to instead of fout
+        self._zip  = None
+        self._keys = None
+        self._dict = {}
+        self._rows = None    # Pending rows of write, one list per column
+        self._blocks = []    # Pending column blocks, dictionaries of arrays
+        self._num_rows = 0   # Number of pending rows (rows and blocks)
+        self._num_chunks = 0
+        self.num_rows = 0
+
+    def record(self, keys, vals):
+        for i, key in enumerate(keys):
+            self._dict[key] = vals[i]
+
+    def write(self):
+        """
+        Appends one row with the currently recorded values
+        """
+        if self._keys is None:
+            self._set_keys(list(self._dict.keys()))
+        if self._rows is None:
+            self._rows = [[] for _ in self._keys]
+        for column, key in zip(self._rows, self._keys):
+            column.append(self._dict[key])
+        self._num_rows += 1
+        self.num_rows += 1
+        if self._num_rows >= self._chunk_size:
+            self.flush()
+
+    def write_arrays(self, **columns):
+        """
+        Appends a block of rows, given as one array (or scalar, repeated
+        for all the rows) per column
+        """
+        if self._keys is None:
+            self._set_keys(list(columns.keys()))
+        if set(columns.keys()) != set(self._keys):
+            raise ValueError('%s has columns %s, got %s' % (self.name, self._keys, list(columns.keys())))
+        arrays = {key: np.asarray(value) for key, value in columns.items()}
+        num_rows = max([len(a) for a in arrays.values() if a.ndim > 0] or [1])
+        for key, a in arrays.items():
+            if a.ndim == 0:
+                arrays[key] = np.full(num_rows, a)
+            elif len(a) != num_rows:
+                raise ValueError('Column %s has %d rows, expected %d' % (key, len(a), num_rows))
+        self._pending_rows()
+        self._blocks.append(arrays)
+        self._num_rows += num_rows
+        self.num_rows += num_rows
+        if self._num_rows >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending rows as one chunk
+        """
+        self._pending_rows()
+        if not self._num_rows:
+            return
+        if self._zip is None:
+            # Fastest deflate level, most of the size gain comes from the binary format
+            self._zip = zipfile.ZipFile(self.name if self._sink is None else self._sink, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1, allowZip64=True)
+        for key in self._keys:
+            column = np.concatenate([block[key] for block in self._blocks])
+            with self._zip.open('chunk%06d/%s.npy' % (self._num_chunks, key), 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, column, allow_pickle=False)
+        self._blocks = []
+        self._num_rows = 0
+        self._num_chunks += 1
+
+    def close(self):
+        self.flush()
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    @property
+    def num_bytes(self):
+        """
+        Number of bytes written so far (complete once closed)
+        """
+        if self._sink is not None:
+            return self._sink.num_bytes
+        return os.path.getsize(self.name) if self._num_chunks and os.path.exists(self.name) else 0
+
+    def _set_keys(self, keys):
+        if '/' in ''.join(keys):
+            raise ValueError('Column names cannot contain "/": %s' % keys)
+        self._keys = keys
+
+    def _pending_rows(self):
+        # Turns the rows of write into a block, to keep the order of rows
+        if self._rows is not None and len(self._rows[0]):
+            self._blocks.append({key: np.asarray(column) for key, column in zip(self._keys, self._rows)})
+        self._rows = None
+
+
+def open_writer(path, output_format='csv'):
+    """
+    Opens a post-processing output file.
+
+    Parameters
+    ----------
+    path: str
+        Output file name, its extension is replaced by the one of the format.
+    output_format: str, optional
+        'csv' (CSVData, default) or 'npz' (ColumnarData).
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format %s, expected one of %s' % (output_format, OUTPUT_FORMATS))
+    path = '%s.%s' % (os.path.splitext(path)[0], output_format)
+    sink = CountingSink(path) if len(_DRY_RUN) else None
+    if output_format == 'npz':
+        writer = ColumnarData(path, sink=sink)
+    else:
+        writer = CSVData(path, sink=sink)
+    if len(_DRY_RUN):
+        _DRY_RUN[-1].append(writer)
+    return writer
+
+
+@contextlib.contextmanager
+def dry_run():
+    """
+    Context in which open_writer returns writers that discard their
+    output (see CountingSink). Yields the list of the writers opened, whose
+    num_rows and num_bytes give the volume that would have been written.
+    """
+    writers = []
+    _DRY_RUN.append(writers)
+    try:
+        yield writers
+    finally:
+        _DRY_RUN.pop()
+
+
+def iter_chunks(path):
+    """
+    Yields the chunks of a ColumnarData file, as dictionaries of arrays
+    """
+    with np.load(path, allow_pickle=False) as f:
+        chunks = {}
+        for name in f.files:
+            chunk, key = name.split('/', 1)
+            chunks.setdefault(chunk, []).append(key)
+        for chunk in sorted(chunks):
+            yield {key: f['%s/%s' % (chunk, key)] for key in chunks[chunk]}
+
+
+def read_columnar(path):
+    """
+    Reads a whole ColumnarData file, returns a dictionary of arrays
+    """
+    columns = {}
+    for chunk in iter_chunks(path):
+        for key, value in chunk.items():
+            columns.setdefault(key, []).append(value)
+    return {key: np.concatenate(value) for key, value in columns.items()}
+
+
+def columnar_to_csv(path, csv_path=None):
+    """
+    Converts a ColumnarData file to CSV, formatted as CSVData does.
+    Returns the name of the CSV file.
+    """
+    if csv_path is None:
+        csv_path = os.path.splitext(path)[0] + '.csv'
+    with open(csv_path, 'w') as fout:
+        header = False
+        for chunk in iter_chunks(path):
+            if not header:
+                fout.write(','.join(chunk.keys()) + '\n')
+                header = True
+            np.savetxt(fout, np.column_stack(list(chunk.values())), fmt='%f', delimiter=',')
+    return csv_path
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:]:
+        print(columnar_to_csv(name))
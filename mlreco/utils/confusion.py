@@ -0,0 +1,134 @@
+"""
+Confusion matrices of semantic predictions
+
+The segmentation metrics (accuracy, per-class fractions, ghost fractions,
+pixel counts) of a whole minibatch are all sums of cells of one confusion
+matrix per event. ConfusionMatrix counts the (event, true class, predicted
+class) triplets of all the points with a single np.bincount; the metrics of
+all the events are then derived from the (num_events, num_truth, num_pred)
+table, one value per event.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+
+
+def _num_labels(labels, num_labels):
+    if num_labels is not None:
+        return int(num_labels)
+    return int(labels.max()) + 1 if len(labels) else 0
+
+
+def safe_divide(a, b):
+    """
+    a / b elementwise, nan (or inf) where b is 0 without warnings
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.true_divide(a, b)
+
+
+class ConfusionMatrix(object):
+    """
+    Confusion matrices of many events, counts[e, t, p] is the number of
+    points of event e with true class t predicted as class p.
+
+    Parameters
+    ----------
+    truth: array_like
+        Shape (N,). True class of each point, in [0, num_truth).
+    pred: array_like
+        Shape (N,). Predicted class of each point, in [0, num_pred).
+    event: array_like, optional
+        Shape (N,). Event of each point, in [0, num_events). All the points
+        are in one event by default.
+    num_events, num_truth, num_pred: int, optional
+        Size of the table, from the largest values by default.
+    """
+    def __init__(self, truth, pred, event=None, num_events=None, num_truth=None, num_pred=None):
+        truth = np.asarray(truth).astype(np.int64).reshape(-1)
+        pred = np.asarray(pred).astype(np.int64).reshape(-1)
+        event = np.zeros(len(truth), dtype=np.int64) if event is None else np.asarray(event).astype(np.int64).reshape(-1)
+        num_events = _num_labels(event, num_events)
+        num_truth = _num_labels(truth, num_truth)
+        num_pred = _num_labels(pred, num_pred)
+        for name, values, n in (('event', event, num_events), ('truth', truth, num_truth), ('pred', pred, num_pred)):
+            if len(values) and (values.min() < 0 or values.max() >= n):
+                raise ValueError('%s values must be in [0, %d), got [%d, %d]' % (name, n, values.min(), values.max()))
+        key = (event * num_truth + truth) * num_pred + pred
+        size = num_events * num_truth * num_pred
+        self.counts = np.bincount(key, minlength=size).reshape(num_events, num_truth, num_pred)
+
+    @classmethod
+    def from_events(cls, truth, pred, num_truth=None, num_pred=None):
+        """
+        Confusion matrices from lists of per-event arrays of true and
+        predicted classes, one event per element.
+        """
+        lengths = [len(t) for t in truth]
+        event = np.repeat(np.arange(len(truth)), lengths)
+        concat = lambda arrays: np.concatenate([np.reshape(a, -1) for a in arrays]) if len(arrays) else np.empty(0)
+        return cls(concat(truth), concat(pred), event, len(truth), num_truth, num_pred)
+
+    def __len__(self):
+        return self.counts.shape[0]
+
+    @property
+    def num_truth(self):
+        return self.counts.shape[1]
+
+    @property
+    def num_pred(self):
+        return self.counts.shape[2]
+
+    def event(self, index):
+        """
+        Confusion matrix of one event, shape (num_truth, num_pred)
+        """
+        return self.counts[index]
+
+    def total(self):
+        """
+        Number of points of each event, shape (E,)
+        """
+        return self.counts.sum(axis=(1, 2))
+
+    def true_counts(self):
+        """
+        Number of points of each true class, shape (E, num_truth)
+        """
+        return self.counts.sum(axis=2)
+
+    def pred_counts(self):
+        """
+        Number of points predicted as each class, shape (E, num_pred)
+        """
+        return self.counts.sum(axis=1)
+
+    def correct(self):
+        """
+        Number of points of each class predicted as their class, shape
+        (E, min(num_truth, num_pred))
+        """
+        return np.diagonal(self.counts, axis1=1, axis2=2)
+
+    def accuracy(self):
+        """
+        Fraction of the points predicted as their true class, shape (E,)
+        """
+        return safe_divide(self.correct().sum(axis=1), self.total())
+
+    def class_accuracy(self):
+        """
+        Fraction of the points of each true class predicted as that class,
+        shape (E, min(num_truth, num_pred)), nan for absent classes
+        """
+        n = self.correct().shape[1]
+        return safe_divide(self.correct(), self.true_counts()[:, :n])
+
+    def fractions(self):
+        """
+        Fraction of the points of each true class predicted as each class
+        (rows normalized), shape (E, num_truth, num_pred)
+        """
+        return safe_divide(self.counts, self.true_counts()[:, :, None])
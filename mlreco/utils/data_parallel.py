@@ -43,7 +43,7 @@ class DataParallel(torch.nn.parallel.DataParallel):
         for i, device in enumerate(device_ids):
             input_i = inputs[0][i]
             final_inputs += scatter([input_i], [device], self.dim) if inputs else []
-        final_kwargs = scatter(kwargs, device_ids, self.moduledim) if kwargs else []
+        final_kwargs = scatter(kwargs, device_ids, self.dim) if kwargs else []
         if len(final_inputs) < len(final_kwargs):
             final_inputs.extend([() for _ in range(len(final_kwargs) - len(final_inputs))])
         elif len(final_kwargs) < len(final_inputs):
@@ -60,3 +60,64 @@ def dbscan_groups(voxels, groups, types, epsilon = 1.01, minpts = 3, typemin=2,
         cls_idx = [ selection[np.where(res.labels_ == i)[0]] for i in range(np.max(res.labels_)+1) ]
         clusts.extend(cls_idx)
     return np.array(clusts)
+
+
+def dbscan_labels(voxels, epsilon = 1.01, minpts = 3, groups = None):
+    """
+    DBSCAN labels of voxels, run independently on each group in one pass.
+    Neighbours are found with a spatial hash (mlreco.utils.grid), clusters
+    are the connected components of core voxels, and border voxels go to
+    the cluster of the lowest core voxel, as in sklearn.cluster.DBSCAN.
+    input:
+        voxels : (N,3) array of voxel locations
+        epsilon : (optional) DBSCAN radius (default = 1.01)
+        minpts : (optional) DBSCAN min pts, including the voxel itself (default = 3)
+        groups : (optional) (N,) vector of integer voxel groups
+    output:
+        labels : (N,) cluster label of each voxel, -1 for noise. Clusters
+                 are numbered in order of their first core voxel, such that
+                 labels within a group are ordered as sklearn's.
+    """
+    from mlreco.utils.grid import radius_pairs
+    i, j = radius_pairs(np.asarray(voxels), epsilon, x_batch=groups)
+    return dbscan_pairs(len(voxels), i, j, minpts)
+
+
+def dbscan_pairs(n, i, j, minpts = 3):
+    """
+    DBSCAN labels from precomputed neighbour pairs, e.g. to cluster several
+    subsets of a voxel set without new neighbour searches.
+    input:
+        n : number of voxels
+        i, j : (E,) vectors of neighbour pairs (voxels closer than the DBSCAN
+               radius), each pair given once and without (i, i)
+        minpts : (optional) DBSCAN min pts, including the voxel itself (default = 3)
+    output:
+        labels : (n,) cluster label of each voxel, -1 for noise, numbered
+                 in order of the first core voxel of each cluster
+    """
+    from mlreco.utils.union_find import connected_components
+    labels = -np.ones(n, dtype=np.int64)
+    if not n:
+        return labels
+    core = 1 + np.bincount(i, minlength=n) + np.bincount(j, minlength=n) >= minpts
+    if not core.any():
+        return labels
+
+    # Clusters of core voxels, numbered by their lowest voxel
+    linked = core[i] & core[j]
+    components = connected_components(np.column_stack((i[linked], j[linked])), n)
+    first = np.full(components.max() + 1, n)
+    np.minimum.at(first, components[core], np.where(core)[0])
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    labels[core] = rank[components[core]]
+
+    # Border voxels
+    border = np.concatenate((j[core[i] & ~core[j]], i[core[j] & ~core[i]]))
+    seed = np.concatenate((labels[i[core[i] & ~core[j]]], labels[j[core[j] & ~core[i]]]))
+    best = np.full(n, n)
+    np.minimum.at(best, border, seed)
+    labels[best < n] = best[best < n]
+    return labels
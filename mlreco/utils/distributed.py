@@ -0,0 +1,165 @@
+"""
+Helpers for multi-process (DistributedDataParallel) training
+
+One process is started per device (or `num_processes` processes on CPU
+with the gloo backend). Each process reads its own shard of the data,
+runs forward/backward on its minibatches and gradients are averaged across
+processes during backward. All the helpers below fall back to the single
+process behavior if torch.distributed is not initialized.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def rank_dir(log_dir):
+    """
+    Output directory of this process for the files that every process
+    writes (e.g. post-processing outputs of the events of its shard):
+    log_dir with a single process, log_dir/rank<rank> otherwise. The
+    directory is created if needed.
+    """
+    if get_world_size() < 2:
+        return log_dir
+    log_dir = os.path.join(log_dir, 'rank%d' % get_rank())
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    return log_dir
+
+
+def num_processes(cfg):
+    """
+    Number of processes to start for a trainval configuration: one per GPU,
+    or trainval.num_processes on CPU.
+    """
+    trainval_cfg = cfg['trainval']
+    if len(trainval_cfg.get('gpus', [])):
+        return len(trainval_cfg['gpus'])
+    return int(trainval_cfg.get('num_processes', 1))
+
+
+def setup(cfg, rank, world_size, local_rank=None):
+    """
+    Initializes the process group of this process and restricts the
+    configuration to its own device.
+
+    Relevant trainval configuration parameters:
+
+    backend: str, optional
+        'nccl' (default on GPU) or 'gloo' (default and only choice on CPU).
+    master_addr, master_port: optional
+        Rendez-vous address, default localhost:29500. Ignored if the
+        MASTER_ADDR/MASTER_PORT environment variables are already set
+        (e.g. by torchrun).
+    """
+    trainval_cfg = cfg['trainval']
+    gpus = trainval_cfg.get('gpus', [])
+    backend = trainval_cfg.get('backend', 'nccl' if len(gpus) else 'gloo')
+    os.environ.setdefault('MASTER_ADDR', str(trainval_cfg.get('master_addr', 'localhost')))
+    os.environ.setdefault('MASTER_PORT', str(trainval_cfg.get('master_port', 29500)))
+    if len(gpus):
+        device = gpus[rank if local_rank is None else local_rank]
+        trainval_cfg['gpus'] = [device]
+        torch.cuda.set_device(device)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def cleanup():
+    if is_distributed():
+        dist.barrier()
+        dist.destroy_process_group()
+
+
+def launch(fn, cfg):
+    """
+    Runs fn(cfg) in one process per device. If the processes were already
+    started by an external launcher (RANK and WORLD_SIZE environment
+    variables set, e.g. torchrun), only sets up the current one.
+    """
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        _worker(int(os.environ.get('LOCAL_RANK', os.environ['RANK'])), fn, cfg,
+                int(os.environ['WORLD_SIZE']), int(os.environ['RANK']))
+        return
+    world_size = num_processes(cfg)
+    torch.multiprocessing.spawn(_worker, args=(fn, cfg, world_size), nprocs=world_size, join=True)
+
+
+def _worker(local_rank, fn, cfg, world_size, rank=None):
+    setup(cfg, local_rank if rank is None else rank, world_size, local_rank)
+    try:
+        fn(cfg)
+    finally:
+        cleanup()
+
+
+def reduce_metrics(res):
+    """
+    Gathers the scalar entries (losses, accuracies, counters) of a result
+    dictionary from all processes, such that each of them holds the values
+    of every minibatch of the iteration, in rank order. Other entries (e.g.
+    network outputs) are left to the local process.
+
+    Processes may report different scalar keys, or different numbers of
+    entries (e.g. a metric skipped on some steps, an uneven last shard):
+    the keys and lengths are exchanged first, and each key then holds the
+    entries of the processes which reported it.
+
+    Parameters
+    ----------
+    res: ResultBlob
+        Results of trainval.forward, each value is a list with one entry
+        per minibatch.
+
+    Returns
+    -------
+    ResultBlob
+    """
+    if not is_distributed() or get_world_size() < 2:
+        return res
+    lengths = {key: len(res.raw(key)) for key in res if res.is_scalar(key)}
+    all_lengths = [None] * get_world_size()
+    dist.all_gather_object(all_lengths, lengths)
+    keys = sorted(set().union(*all_lengths))
+    if not len(keys):
+        return res
+    # Same layout on every process: entries of each key, padded with nan
+    sizes = [max(rank_lengths.get(key, 0) for rank_lengths in all_lengths) for key in keys]
+    values = []
+    for key, size in zip(keys, sizes):
+        key_values = [float(v) for v in res[key]] if key in lengths else []
+        values.extend(key_values + [float('nan')] * (size - len(key_values)))
+    device = torch.device('cuda', torch.cuda.current_device()) \
+        if dist.get_backend() == 'nccl' else torch.device('cpu')
+    values = torch.tensor(values, dtype=torch.float64, device=device)
+    gathered = [torch.empty_like(values) for _ in range(get_world_size())]
+    dist.all_gather(gathered, values)
+    gathered = [g.tolist() for g in gathered]
+    offsets = np.cumsum([0] + sizes)
+    for i, key in enumerate(keys):
+        row = []
+        for rank_values, rank_lengths in zip(gathered, all_lengths):
+            row.extend(rank_values[offsets[i]:offsets[i] + rank_lengths.get(key, 0)])
+        if key in lengths and all(isinstance(v, int) for v in res[key]):
+            row = [int(v) for v in row]
+        res[key] = row
+    return res
@@ -0,0 +1,221 @@
+"""
+Clustering and projection of embeddings
+
+radius_clusters groups points of a (high dimensional) embedding space that
+are linked by a chain of neighbours closer than a radius, as DBSCAN with
+min_samples=1 does. Points are first gathered around leaders, so that
+dense clusters cost one distance per point rather than one per pair of
+points, and neighbours are found with one KD-tree per group. Clusters are
+the connected components of the resulting graph.
+
+pca computes the principal axes of many groups of points (e.g. the classes
+of an event) at once, as a cheap alternative to TSNE to look at
+embeddings.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+from scipy.spatial import cKDTree
+from sklearn.neighbors import NearestNeighbors
+from mlreco.utils.union_find import connected_components
+
+# Dimension above which neighbours are found by brute force
+BRUTE_FORCE_DIM = 15
+
+
+def principal_axes(x, dim, groups=None):
+    """
+    Principal axes of each group of points.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        Shape (N, D). Points.
+    dim: int
+        Number of axes.
+    groups: np.ndarray, optional
+        Shape (N,). Integer group of each point, all the points by default.
+
+    Returns
+    -------
+    np.ndarray
+        Shape (G, D). Mean of each group, in order of group id.
+    np.ndarray
+        Shape (G, dim, D). Orthonormal axes of each group, by decreasing
+        variance.
+    np.ndarray
+        Shape (N,). Index of the group of each point.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if groups is None:
+        groups = np.zeros(len(x), dtype=np.int64)
+    _, index = np.unique(groups, return_inverse=True)
+    index = index.reshape(-1)
+    num_groups = index.max() + 1 if len(index) else 0
+    counts = np.bincount(index, minlength=num_groups).astype(np.float64)
+    means = np.stack([np.bincount(index, weights=x[:, k], minlength=num_groups) for k in range(x.shape[1])], axis=1)
+    means /= counts[:, None]
+    # Covariance of each group, then all the eigen decompositions at once
+    centered = x - means[index]
+    covariances = np.zeros((num_groups, x.shape[1], x.shape[1]))
+    order = np.argsort(index, kind='stable')
+    for g, block in enumerate(np.split(centered[order], np.cumsum(counts.astype(np.int64))[:-1])):
+        covariances[g] = block.T @ block
+    _, vectors = np.linalg.eigh(covariances)
+    axes = np.swapaxes(vectors[:, :, ::-1][:, :, :dim], 1, 2)
+    return means, axes, index
+
+
+def pca(x, dim=2, groups=None):
+    """
+    Projection of each group of points onto its principal axes.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        Shape (N, D). Points.
+    dim: int, optional
+        Dimension of the projection (default 2).
+    groups: np.ndarray, optional
+        Shape (N,). Integer group of each point, all the points by default.
+
+    Returns
+    -------
+    np.ndarray
+        Shape (N, dim). Coordinates along the principal axes of the group
+        of each point, zero padded if dim > D.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    projection = np.zeros((len(x), dim))
+    if not len(x):
+        return projection
+    means, axes, index = principal_axes(x, min(dim, x.shape[1]), groups)
+    projection[:, :axes.shape[1]] = np.einsum('nkd,nd->nk', axes[index], x - means[index])
+    return projection
+
+
+def radius_clusters(x, radius, groups=None, index_dim=3, max_rounds=8, sparse_fraction=0.25):
+    """
+    Clusters of points linked by neighbours within radius (in the same
+    group), i.e. sklearn.cluster.DBSCAN(eps=radius, min_samples=1) labels
+    of each group.
+
+    Points are first gathered around leaders: the first point of each
+    cell of a grid (on the principal axes of the points, cells of side
+    radius), for the points within radius of it, and so on
+    with the points left (at most max_rounds times, each point left is then
+    its own leader). Points of a leader are in its cluster. Leaders closer
+    than radius are linked, leaders further than 3 * radius cannot be, and
+    only for the leaders in between are the points of both compared. If
+    there are more than sparse_fraction * N leaders, all the neighbour
+    pairs are searched instead.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        Shape (N, D). Points.
+    radius: float
+    groups: np.ndarray, optional
+        Shape (N,). Integer group of each point, all the points by default.
+    index_dim: int, optional
+        Number of principal axes of the leader grid (default 3).
+
+    Returns
+    -------
+    np.ndarray
+        Shape (N,). Cluster of each point, numbered in order of their first
+        point over all the groups.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    if not n:
+        return np.empty(0, dtype=np.int64)
+    batch = np.zeros(n, dtype=np.int64) if groups is None else np.unique(groups, return_inverse=True)[1].reshape(-1)
+
+    # Leaders, from cells of the projection of the points on their
+    # principal axes
+    means, axes, _ = principal_axes(x, min(index_dim, x.shape[1]))
+    projection = (x - means[0]) @ axes[0].T
+    cell_size = radius if radius > 0 else 1.
+    _, cells = np.unique(np.column_stack((batch, np.floor(projection / cell_size))), axis=0, return_inverse=True)
+    cells = cells.reshape(-1)
+    leaders = np.arange(n)
+    remaining = np.arange(n)
+    for _ in range(max_rounds):
+        if not len(remaining):
+            break
+        _, first, inverse = np.unique(cells[remaining], return_index=True, return_inverse=True)
+        candidates = remaining[first[inverse.reshape(-1)]]
+        covered = np.linalg.norm(x[remaining] - x[candidates], axis=1) <= radius
+        leaders[remaining[covered]] = candidates[covered]
+        remaining = remaining[~covered]
+    edges = [np.column_stack((np.arange(n), leaders))]
+    ids = np.unique(leaders)
+    if len(ids) > sparse_fraction * n:
+        # Sparse points, leaders do not save much
+        i, j = _pairs(x, radius, batch)
+        roots = _first_points(np.column_stack((i, j)), n)
+        return np.cumsum(roots == np.arange(n))[roots] - 1
+
+    # Links between leaders
+    a, b = _pairs(x[ids], 3 * radius, batch[ids])
+    d = np.linalg.norm(x[ids[a]] - x[ids[b]], axis=1)
+    edges.append(np.column_stack((ids[a], ids[b]))[d <= radius])
+    ambiguous = d > radius
+    if ambiguous.any():
+        # Leaders not linked yet: compare their points within 2 * radius of
+        # the other leader
+        roots = _first_points(np.concatenate(edges), n)
+        ambiguous &= roots[ids[a]] != roots[ids[b]]
+        a, b = ids[a[ambiguous]], ids[b[ambiguous]]
+        order = np.argsort(leaders, kind='stable')
+        starts = np.searchsorted(leaders[order], np.arange(n))
+        counts = np.bincount(leaders, minlength=n)
+        boundary = []
+        for own, other in ((a, b), (b, a)):
+            members = order[_ragged_arange(starts[own], counts[own])]
+            near = np.linalg.norm(x[members] - x[np.repeat(other, counts[own])], axis=1) <= 2 * radius
+            boundary.append(members[near])
+        boundary = np.unique(np.concatenate(boundary))
+        i, j = _pairs(x[boundary], radius, batch[boundary])
+        i, j = boundary[i], boundary[j]
+        select = leaders[i] != leaders[j]
+        edges.append(np.column_stack((i[select], j[select])))
+
+    # Clusters numbered by their first point
+    roots = _first_points(np.concatenate(edges), n)
+    return np.cumsum(roots == np.arange(n))[roots] - 1
+
+
+def _pairs(x, radius, groups):
+    # Pairs of points within radius in the same group: one KD-tree per
+    # group, or brute force in high dimension (as sklearn does)
+    rows = [np.empty((0, 2), dtype=np.int64)]
+    order = np.argsort(groups, kind='stable')
+    for index in np.split(order, np.flatnonzero(np.diff(groups[order])) + 1):
+        if len(index) < 2:
+            continue
+        if x.shape[1] > BRUTE_FORCE_DIM:
+            graph = NearestNeighbors(radius=radius, algorithm='brute').fit(x[index]).radius_neighbors_graph().tocoo()
+            pairs = np.column_stack((graph.row, graph.col))[graph.row < graph.col]
+        else:
+            tree = cKDTree(x[index], balanced_tree=False, compact_nodes=False)
+            pairs = tree.query_pairs(radius, output_type='ndarray')
+        rows.append(index[pairs])
+    pairs = np.concatenate(rows)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def _ragged_arange(starts, lengths):
+    # Concatenation of np.arange(s, s+l) for each (s, l) in zip(starts, lengths)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(np.sum(lengths))
+
+
+def _first_points(edges, n):
+    # First point of the connected component of each point
+    labels = connected_components(edges, n)
+    first = np.full(labels.max() + 1, n)
+    np.minimum.at(first, labels, np.arange(n))
+    return first[labels]
@@ -113,13 +113,67 @@ def cluster_edge_features(data, clusts, edge_index, cuda=True, device=None):
     """
     if isinstance(data, torch.Tensor):
         data = data.cpu().detach().numpy()
-    e = torch.tensor([cluster_edge_feature(data, clusts[edge_index[0,k]], clusts[edge_index[1,k]]) for k in range(edge_index.shape[1])], dtype=torch.float, requires_grad=False)
+    e = torch.tensor(np.array([cluster_edge_feature(data, clusts[edge_index[0,k]], clusts[edge_index[1,k]]) for k in range(edge_index.shape[1])]), dtype=torch.float, requires_grad=False)
     if not device is None:
         e = e.to(device)
     elif cuda:
         e = e.cuda()
     return e
 
+def flip_edge_features(e):
+    """
+    Features of the reversed edges (j, i) given the features of the
+    edges (i, j) as returned by cluster_edge_features:
+    closest points are swapped, displacement changes sign
+    """
+    return torch.cat((e[:,3:6], e[:,0:3], -e[:,6:9], e[:,9:]), dim=1)
+
+
+class EdgeFeatureCache(object):
+    """
+    Cluster edge features of a fixed set of pairs (i, j), computed the first
+    time an edge of the pair is requested in either direction. Edge k of
+    edge_index() is the pair k if k < len(pairs), else the pair
+    k - len(pairs) reversed, whose features come from flip_edge_features.
+    """
+    def __init__(self, data, clusts, pairs, device=None):
+        if isinstance(data, torch.Tensor):
+            data = data.cpu().detach().numpy()
+        self._data = data
+        self._clusts = clusts
+        self._pairs = pairs.cpu()
+        self._device = device
+        self._features = None
+        self._computed = torch.zeros(self._pairs.shape[1], dtype=torch.bool)
+
+    def edge_index(self):
+        """
+        Incidence of the edges in both directions
+        """
+        index = torch.cat((self._pairs, self._pairs.flip(0)), dim=1)
+        return index.to(self._device) if self._device is not None else index
+
+    def __call__(self, edge_ids):
+        """
+        Features of the edges edge_ids of edge_index()
+        """
+        edge_ids = edge_ids.cpu()
+        num_pairs = self._pairs.shape[1]
+        pair_ids = edge_ids % num_pairs
+        missing = torch.unique(pair_ids[~self._computed[pair_ids]])
+        if len(missing):
+            e = cluster_edge_features(self._data, self._clusts, self._pairs[:, missing], cuda=False)
+            if self._features is None:
+                self._features = torch.zeros((num_pairs, e.shape[1]), dtype=e.dtype)
+            self._features[missing] = e
+            self._computed[missing] = True
+        if self._features is None:
+            return torch.empty((0, 0), dtype=torch.float, device=self._device)
+        e = self._features[pair_ids]
+        e = torch.where((edge_ids >= num_pairs).view(-1, 1), flip_edge_features(e), e)
+        return e.to(self._device) if self._device is not None else e
+
+
 def edge_feature(data, i, j):
     """
     12-dimensional edge feature based on displacement between two voxels
@@ -158,9 +212,9 @@ def edge_assignment(edge_index, batches, groups, cuda=True, dtype=torch.float, b
         batches = batches.cpu().detach().numpy()
     if isinstance(groups, torch.Tensor):
         groups = groups.cpu().detach().numpy()
-    edge_assn = torch.tensor([np.logical_and(
+    edge_assn = torch.tensor(np.array([np.logical_and(
         batches[edge_index[0,k]] == batches[edge_index[1,k]],
-        groups[edge_index[0,k]] == groups[edge_index[1,k]]) for k in range(edge_index.shape[1])], 
+        groups[edge_index[0,k]] == groups[edge_index[1,k]]) for k in range(edge_index.shape[1])], dtype=bool),
                              dtype=dtype, requires_grad=False)
     if binary:
         # transform to -1,+1 instead of 0,1
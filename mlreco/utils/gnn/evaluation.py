@@ -1,137 +1,184 @@
 # utility to evaluate the network accuracy
 import numpy as np
 import torch
-from mlreco.utils.metrics import SBD, AMI, ARI, purity_efficiency
+from mlreco.utils.metrics import clustering_metrics
+from mlreco.utils.union_find import connected_components
+
+
+class MetricsSchedule(object):
+    """
+    Decides on which training calls of a loss the evaluation metrics are
+    computed, so that they do not slow down every training step. Losses
+    only consult it in training mode (metrics are always computed in
+    evaluation), and leave the metrics out of their output when skipped.
+    step = 1 : every call (default), step = k : every k-th call, step <= 0 : never
+
+    for use in config (loss module section):
+        metrics_step: <int>
+    """
+    def __init__(self, step=1):
+        self.step = step
+        self.calls = 0
+
+    def __call__(self):
+        run = self.step > 0 and self.calls % self.step == 0
+        self.calls += 1
+        return run
+
+
+def to_numpy(x):
+    """
+    torch tensor or array_like to numpy array
+    """
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def scatter_argmax(values, index, n):
+    """
+    for each of n targets, index of the largest value among the entries with that target
+    (first one in case of a tie), -1 if the target has no entry
+    """
+    argmax = -np.ones(n, dtype=np.int64)
+    if not len(values):
+        return argmax
+    # sort by target then decreasing value, keep the first entry of each target
+    order = np.lexsort((-values, index))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = index[order][1:] != index[order][:-1]
+    argmax[index[order[first]]] = order[first]
+    return argmax
+
+
+def cluster_sizes(clusters):
+    """
+    number of voxels in each cluster
+    """
+    return np.array([len(c) for c in clusters], dtype=np.int64)
+
+
+def secondaries(primaries, n):
+    """
+    indices of the nodes which are not primaries
+    """
+    return np.setdiff1d(np.arange(n), np.asarray(primaries, dtype=np.int64))
 
 
 def assign_clusters(edge_index, edge_label, primaries, others, n):
     """
     assigns each node to a cluster represented by the primary node
+    each node of others is assigned to the source of its incoming edge with the
+    highest label, or -1 if it has no incoming edge
     """
+    edge_index = to_numpy(edge_index).astype(np.int64)
+    edge_label = to_numpy(edge_label).reshape(-1)
+    others = np.asarray(others, dtype=np.int64)
     clust = np.zeros(n)
-    for i in primaries:
-        clust[i] = i
-    for i in others:
-        inds = edge_index[1,:] == i
-        if sum(inds) == 0:
-            clust[i] = -1
-            continue
-        indmax = torch.argmax(edge_label[inds])
-        clust[i] = edge_index[0,inds][indmax].item()
+    clust[np.asarray(primaries, dtype=np.int64)] = primaries
+    best = scatter_argmax(edge_label, edge_index[1], n)[others]
+    clust[others] = np.where(best > -1, edge_index[0, best], -1)
     return clust
 
 
 def assign_clusters_UF(edge_index, edge_wt, n, thresh=0.0):
     """
     assigns clusters using Union Find on edges
+    nodes connected by edges with weight above thresh are in the same cluster
     """
-    from topologylayer.functional.persistence import getClustsUF_raw
-    
-    edges = edge_index.detach().cpu().numpy()
-    edges = edges.T # transpose
-    edges = edges.flatten()
-    
-    val = edge_wt.detach().cpu().numpy()
-    
-    cs = getClustsUF_raw(edges, val, n, thresh)
-    un, cinds = np.unique(cs, return_inverse=True)
-    return cinds
+    edges = to_numpy(edge_index).T # transpose
+    val = to_numpy(edge_wt)
+    return connected_components(edges, n, weights=val, thresh=thresh)
 
 
-def secondary_matching_vox_efficiency(edge_index, true_labels, pred_labels, primaries, clusters, n):
+def _voxel_efficiency(correct, others, sizes, batch=None):
+    """
+    fraction of the voxels of others that belong to correct nodes,
+    one value per event (sorted batch id) if batch is provided,
+    nan for the events without any node in others
+    """
+    if batch is None:
+        return np.sum(sizes[others] * correct) * 1.0 / np.sum(sizes[others])
+    events, ev = np.unique(batch, return_inverse=True)
+    ev = ev.reshape(-1)[others]
+    correct_sizes = np.bincount(ev, weights=sizes[others] * correct, minlength=len(events))
+    total_sizes = np.bincount(ev, weights=sizes[others], minlength=len(events))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return correct_sizes / total_sizes
+
+
+def secondary_matching_vox_efficiency(edge_index, true_labels, pred_labels, primaries, clusters, n, batch=None):
     """
     fraction of secondary voxels that are correctly assigned
+    per event if the batch id of each cluster is provided
     """
-    # mask = np.array([(i not in primaries) for i in range(n)])
-    # others = np.arange(n)[mask]
-    others = np.array([i for i in range(n) if i not in primaries])
+    others = secondaries(primaries, n)
     true_nodes = assign_clusters(edge_index, true_labels, primaries, others, n)
     pred_nodes = assign_clusters(edge_index, pred_labels, primaries, others, n)
-    tot_vox = np.sum([len(clusters[i]) for i in others])
-    int_vox = np.sum([len(clusters[i]) for i in others if true_nodes[i] == pred_nodes[i]])
-    return int_vox * 1.0 / tot_vox
+    correct = true_nodes[others] == pred_nodes[others]
+    return _voxel_efficiency(correct, others, cluster_sizes(clusters), batch)
 
 
-def secondary_matching_vox_efficiency2(matched, group, primaries, clusters):
+def secondary_matching_vox_efficiency2(matched, group, primaries, clusters, batch=None):
     """
     fraction of secondary voxels that are correctly assigned
     uses matched array
+    per event if the batch id of each cluster is provided
     """
-    n = len(matched)
-    others = np.array([i for i in range(n) if i not in primaries])
-    others_matched = np.array([i for i in others if matched[i] > -1])
-    tot_vox = np.sum([len(clusters[i]) for i in others])
-    int_vox = np.sum([len(clusters[i]) for i in others_matched if  group[i] == group[matched[i]]])
-    return int_vox * 1.0 / tot_vox
+    matched = to_numpy(matched).astype(np.int64)
+    group = to_numpy(group)
+    others = secondaries(primaries, len(matched))
+    m = matched[others]
+    correct = (m > -1) & (group[others] == group[np.maximum(m, 0)])
+    return _voxel_efficiency(correct, others, cluster_sizes(clusters), batch)
 
 
-def secondary_matching_vox_efficiency3(edge_index, true_labels, pred_labels, primaries, clusters, n):
+def secondary_matching_vox_efficiency3(edge_index, true_labels, pred_labels, primaries, clusters, n, batch=None):
     """
     fraction of secondary voxels that are correctly assigned
     pred_labels is N x C
+    per event if the batch id of each cluster is provided
     """
-    # mask = np.array([(i not in primaries) for i in range(n)])
-    # others = np.arange(n)[mask]
-    others = np.array([i for i in range(n) if i not in primaries])
-    true_nodes = assign_clusters(edge_index, true_labels, primaries, others, n)
-    pred_labels = torch.argmax(pred_labels, 1) # get argmax predicted
-    pred_nodes = assign_clusters(edge_index, pred_labels, primaries, others, n)
-    tot_vox = np.sum([len(clusters[i]) for i in others])
-    int_vox = np.sum([len(clusters[i]) for i in others if true_nodes[i] == pred_nodes[i]])
-    return int_vox * 1.0 / tot_vox
+    pred_labels = np.argmax(to_numpy(pred_labels), axis=1) # get argmax predicted
+    return secondary_matching_vox_efficiency(edge_index, true_labels, pred_labels, primaries, clusters, n, batch)
 
 
 def primary_assign_vox_efficiency(true_nodes, pred_nodes, clusters):
     """
     fraction of secondary voxels that are correctly assigned
     """
-    tot_vox = np.sum([len(c) for c in clusters])
-    int_vox = np.sum([len(clusters[i]) for i in range(len(clusters)) if np.sign(true_nodes[i].detach().cpu().numpy()) == np.sign(pred_nodes[i].detach().cpu().numpy())])
-    return int_vox * 1.0 / tot_vox
+    sizes = cluster_sizes(clusters)
+    correct = np.sign(to_numpy(true_nodes)) == np.sign(to_numpy(pred_nodes))
+    return np.sum(sizes[correct]) * 1.0 / np.sum(sizes)
 
 
 def cluster_to_voxel_label(label, clusters):
     """
     turn an array of labels on clusters to an array of labels on voxels
     """
-    nvoxels = np.sum([len(c) for c in clusters])
-    vlabel = np.empty(nvoxels, dtype=np.int)
-    stptr = 0
-    for i, c in enumerate(clusters):
-        endptr = stptr + len(c)
-        vlabel[stptr:endptr] = label[i]
-        stptr = endptr
-    return vlabel
+    return np.repeat(to_numpy(label), cluster_sizes(clusters))
 
 
-def DBSCAN_cluster_metrics(edge_index, true_labels, pred_labels, primaries, clusters, n):
+def DBSCAN_cluster_metrics(edge_index, true_labels, pred_labels, primaries, clusters, n, batch=None):
     """
     return ARI, AMI, SBD, purity, efficiency
     of matching
+    per event if the batch id of each cluster is provided
     """
-    others = np.array([i for i in range(n) if i not in primaries])
+    others = secondaries(primaries, n)
     true_nodes = assign_clusters(edge_index, true_labels, primaries, others, n)
-    pred_labels = torch.argmax(pred_labels, 1) # get argmax predicted
+    pred_labels = np.argmax(to_numpy(pred_labels), axis=1) # get argmax predicted
     pred_nodes = assign_clusters(edge_index, pred_labels, primaries, others, n)
-    pred_vox = cluster_to_voxel_label(pred_nodes, clusters)
-    true_vox = cluster_to_voxel_label(true_nodes, clusters)
-    ari = ARI(pred_vox, true_vox)
-    ami = AMI(pred_vox, true_vox)
-    sbd = SBD(pred_vox, true_vox)
-    pur, eff = purity_efficiency(pred_vox, true_vox)
-    return ari, ami, sbd, pur, eff
+    return DBSCAN_cluster_metrics2(pred_nodes, clusters, true_nodes, batch)
 
 
-def DBSCAN_cluster_metrics2(matched, clusters, group):
+def DBSCAN_cluster_metrics2(matched, clusters, group, batch=None):
     """
     return ARI, AMI, SBD, purity, efficiency
     of matching.  Use matched array
+    per event if the batch id of each cluster is provided
     """
     pred_vox = cluster_to_voxel_label(matched, clusters)
     true_vox = cluster_to_voxel_label(group, clusters)
-    ari = ARI(pred_vox, true_vox)
-    ami = AMI(pred_vox, true_vox)
-    sbd = SBD(pred_vox, true_vox)
-    pur, eff = purity_efficiency(pred_vox, true_vox)
-    return ari, ami, sbd, pur, eff
-    
+    vox_batch = None if batch is None else cluster_to_voxel_label(batch, clusters)
+    return clustering_metrics(pred_vox, true_vox, vox_batch)
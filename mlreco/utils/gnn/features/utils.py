@@ -1,6 +1,7 @@
 import itertools
 import numpy as np
 from scipy.spatial import Delaunay
+from mlreco.utils.union_find import connected_components
 
 def node_labels_to_edge_labels(edges, node_labels):
     label_starts = node_labels[edges[:, 0]]
@@ -9,26 +10,29 @@ def node_labels_to_edge_labels(edges, node_labels):
     edge_labels[np.where(label_starts != label_ends)] = 0
     return edge_labels
 
-def find_parent(parent, i):
-    if i != parent[i]:
-        parent[i] = find_parent(parent, parent[i])
-    return parent[i]
-
 # union find
 def edge_labels_to_node_labels(positions, edges, edge_labels, threshold=0.5, node_len=None):
-    print('node_len', node_len)
-    print('max edge label', np.amax(edge_labels))
-    on_edges = edges[np.where(edge_labels > threshold)[0]]
+    """
+    nodes connected by edges with label above threshold share the same node label
+    INPUTS:
+        positions   - node positions, only used for the number of nodes if node_len is None
+        edges       - (E, 2) array of edges (i, j)
+        edge_labels - (E) array of edge labels
+        node_len    - number of nodes
+    OUTPUT:
+        labels - array of connected component labels (between 0 and the number
+                 of components), one per node. There are node_len (or
+                 len(positions)) nodes, or more if edges refer to larger node
+                 indices: every node of edges gets a label.
+    """
+    edges = np.asarray(edges).reshape(-1, 2)
     if node_len is not None:
-        node_labels = np.arange(node_len)
+        n = node_len
     else:
-        node_labels = np.arange(len(positions))
-    for a, b in on_edges:
-        p1 = find_parent(node_labels, a)
-        p2 = find_parent(node_labels, b)
-        if p1 != p2:
-            node_labels[p1] = p2
-    return node_labels
+        n = len(positions)
+    if len(edges):
+        n = max(n, int(np.max(edges)) + 1)
+    return connected_components(edges, n, weights=edge_labels, thresh=threshold)
 
 def node_labels_to_cluster_sizes(node_labels):
     unique, counts = np.unique(node_labels, return_counts=True)
@@ -24,15 +24,23 @@ def primary_bipartite_incidence(batches, primaries, dist=None, max_dist=float('i
 
 def complete_graph(batches, dist=None, max_dist=float('inf'), device=None, cuda=True):
     """
-    incidence matrix of bipartite graph between primary clusters and non-primary clusters
+    incidence matrix of the complete graph between clusters of the same batch
+    edges are (i, j) with i < j, ordered by i then j
     """
-    ret = torch.tensor([[i, j] for i in np.arange(len(batches)) for j in np.arange(len(batches)) if (batches[i] == batches[j] and j > i)], dtype=torch.long, requires_grad=False).t().contiguous().reshape(2,-1)
+    batches = np.asarray(batches)
+    ret = np.empty((2, 0), dtype=np.int64)
+    for b in np.unique(batches):
+        where = np.where(batches == b)[0]
+        i, j = np.triu_indices(len(where), k=1)
+        ret = np.hstack((ret, np.vstack((where[i], where[j]))))
+    ret = ret[:, np.lexsort((ret[1], ret[0]))]
 
     # If requested, remove the edges above a certain length threshold
     if max_dist < float('inf'):
-        dists = np.array([dist[i, j] for i in np.arange(len(batches)) for j in np.arange(len(batches)) if (batches[i] == batches[j] and j > i)])
+        dists = dist[ret[0], ret[1]]
         ret = ret[:,np.where(dists < max_dist)[0]]
 
+    ret = torch.tensor(ret, dtype=torch.long, requires_grad=False)
     if not device is None:
         ret = ret.to(device)
     elif cuda:
@@ -6,6 +6,7 @@ from __future__ import division
 from __future__ import print_function
 import numpy as np
 import scipy as sp
+import torch
 from mlreco.utils.ppn import contains
 from mlreco.utils.gnn.cluster import get_cluster_label, get_cluster_batch
 from mlreco.utils.gnn.compton import filter_compton
@@ -97,14 +98,74 @@ def score_clusters_primary(clusts, data, primary):
     return scores
 
 
+def nearest_clusters(primaries, clusts, data, use_labels=False):
+    """
+    For each EM primary, find the closest cluster that matches batch (and label)
+    INPUTS:
+        primaries - (P, >=5) array of (x, y, z, ..., batch_id, label)
+        clusts    - (C) array of voxel index arrays
+        data      - (N, 5) array of (x, y, z, batch_id, label) voxels
+        use_labels - require the cluster label to match the primary label
+    OUTPUT:
+        inds  - (P) index of the closest cluster in clusts, -1 if none
+        dists - (P) distance from the primary to the closest voxel of that cluster
+    ASSUMES:
+        batch ids and labels are integer valued.
+    Uses a single KD-tree over all the voxels of all the clusters. Voxels are
+    tagged with their batch id (and cluster label) as extra coordinates, scaled
+    beyond the spatial extent of the data, so that the nearest neighbor of a
+    primary is always found in the right batch (and label) if there is one.
+    Ties go to the first cluster in clusts.
+    """
+    from scipy.spatial import cKDTree
+    primaries = np.asarray(primaries)
+    inds  = -np.ones(len(primaries), dtype=np.int64)
+    dists = np.full(len(primaries), np.inf)
+    if not len(primaries) or not len(clusts):
+        return inds, dists
+
+    # flat voxel index -> cluster index
+    sizes = np.array([len(c) for c in clusts])
+    voxels = np.concatenate(clusts).astype(np.int64)
+    vox_clust = np.repeat(np.arange(len(clusts)), sizes)
+
+    # tags: batch id (and label) of each cluster
+    tags  = [get_cluster_batch(data, clusts)]
+    ptags = [primaries[:, -2]]
+    if use_labels:
+        tags.append(get_cluster_label(data, clusts))
+        ptags.append(primaries[:, -1])
+    tags  = np.stack(tags, axis=1)[vox_clust]
+    ptags = np.stack(ptags, axis=1)
+
+    # any tag mismatch puts a point further than any in-batch distance
+    coords  = data[voxels, :3]
+    pcoords = primaries[:, :3]
+    lo = np.minimum(coords.min(axis=0), pcoords.min(axis=0))
+    hi = np.maximum(coords.max(axis=0), pcoords.max(axis=0))
+    scale = 2. * np.linalg.norm(hi - lo) + 1.
+
+    tree = cKDTree(np.hstack((coords, scale * tags)))
+    points = np.hstack((pcoords, scale * ptags))
+    d, vox = tree.query(points)
+    found = np.where(d < scale / 2.)[0]
+    # among clusters at the same distance, the first one (as np.argmin)
+    near = tree.query_ball_point(points[found], d[found] * (1. + 1e-9) + 1e-12)
+    inds[found] = [vox_clust[n].min() for n in near]
+    dists[found] = d[found]
+    return inds, dists
+
+
 def assign_primaries(primaries, clusts, data, use_labels=False, max_dist=None, compton_thresh=0):
     """
     for each EM primary assign closest cluster that matches batch and group
     data should contain groups of voxels
     """
     
-    primaries = primaries.cpu().detach().numpy()
-    data = data.cpu().detach().numpy()
+    if isinstance(primaries, torch.Tensor):
+        primaries = primaries.cpu().detach().numpy()
+    if isinstance(data, torch.Tensor):
+        data = data.cpu().detach().numpy()
     
     #first remove compton-like clusters from list
     selection = filter_compton(clusts, compton_thresh) # non-compton looking clusters
@@ -114,32 +175,13 @@ def assign_primaries(primaries, clusts, data, use_labels=False, max_dist=None, c
     if len(cs2) < 1:
         return []
     
-    if use_labels:
-        labels = get_cluster_label(data, cs2)
-    batches = get_cluster_batch(data, cs2)
-    
-    assn = []
-    for primary in primaries:
-        # get list of indices that match label and batch
-        pbatch = primary[-2]
-        if use_labels:
-            plabel = primary[-1]
-            pselection = np.logical_and(labels == plabel, batches == pbatch)
-        else:
-            pselection = batches == pbatch
-        pinds = np.where(pselection)[0] # indices to compare against
-        if len(pinds) < 1:
-            continue
-        
-        scores = score_clusters_primary(cs2[pinds], data, primary)
-        ind = np.argmin(scores)
-        if max_dist and scores[ind] > max_dist:
-            continue
-        # print(scores[ind])
-        assn.append(selinds[pinds[ind]])
+    inds, dists = nearest_clusters(primaries, cs2, data, use_labels=use_labels)
+    found = inds > -1
+    if max_dist:
+        found &= dists <= max_dist
         
     # assignments may not be unique
-    assn = np.unique(assn)
+    assn = np.unique(selinds[inds[found]])
     return assn
 
 
@@ -147,6 +189,8 @@ def assign_primaries_unique(primaries, clusts, data, use_labels=False):
     """
     for each EM primary assign closest cluster that matches batch and group
     data should contain groups of voxels
+    if several primaries share the same closest cluster, only the closest
+    primary (the first one in case of a tie) keeps it, the others get -1
     """
     #first remove compton-like clusters from list
     cs2 = clusts
@@ -157,39 +201,20 @@ def assign_primaries_unique(primaries, clusts, data, use_labels=False):
     if len(cs2) < 1:
         return []
     
-    labels = get_cluster_label(data, cs2)
-    batches = get_cluster_batch(data, cs2)
-    
+    if isinstance(primaries, torch.Tensor):
+        primaries = primaries.cpu().detach().numpy()
+    if isinstance(data, torch.Tensor):
+        data = data.cpu().detach().numpy()
+
+    inds, dists = nearest_clusters(primaries, cs2, data, use_labels=use_labels)
+
+    # sort by (cluster, distance, primary index), the first of each cluster wins
     assn = -1*np.ones(len(primaries))
-    assn_scores = -1*np.ones(len(primaries))
-    for i in range(len(primaries)):
-        primary = primaries[i]
-        # get list of indices that match label and batch
-        pbatch = primary[-2]
-        if use_labels:
-            plabel = primary[-1]
-            pselection = np.logical_and(labels == plabel, batches == pbatch)
-        else:
-            pselection = batches == pbatch
-        pinds = np.where(pselection)[0] # indices to compare against
-        if len(pinds) < 1:
-            continue
-        
-        scores = score_clusters_primary(cs2[pinds], data, primary)
-        ind = np.argmin(scores)
-        pind = pinds[ind]
-        score = scores[ind]
-        
-        already_assigned = np.where(assn == pind)[0]
-        if len(already_assigned) > 0:
-            current_low = assn_scores[already_assigned][0]
-            if score < current_low:
-                assn_scores[already_assigned] = -1.0
-                assn[already_assigned] = -1.0
-            else:
-                continue
-        assn_scores[i] = score
-        assn[i] = pind
+    found = np.where(inds > -1)[0]
+    order = found[np.lexsort((found, dists[found], inds[found]))]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = inds[order][1:] != inds[order][:-1]
+    assn[order[first]] = inds[order[first]]
     return assn
 
 
@@ -214,12 +239,23 @@ def analyze_primaries(p_est, p_true):
     return fdr, tdr, acc
     
 def get_true_primaries(clust_ids, batch_ids, points):
-    # For each cluster, check that it is in the list of primary points
-    primaries = []
-    for i, idx in enumerate(zip(batch_ids.cpu().numpy(), clust_ids.cpu().numpy())):
-        for p in points:
-            if (np.array(idx) == p[-2:].cpu().numpy()).all():
-                primaries.append(i)
-                break
-
-    return np.array(primaries)
+    """
+    For each cluster, check that its (batch_id, cluster_id) pair
+    is in the list of primary points, return the indices of those that are
+    """
+    if isinstance(clust_ids, torch.Tensor):
+        clust_ids = clust_ids.cpu().numpy()
+    if isinstance(batch_ids, torch.Tensor):
+        batch_ids = batch_ids.cpu().numpy()
+    if isinstance(points, torch.Tensor):
+        points = points.cpu().numpy()
+    points = np.asarray(points)
+    if not len(clust_ids) or not len(points):
+        return np.array([], dtype=np.int64)
+
+    # label each distinct (batch_id, cluster_id) pair, then match labels
+    clust_keys = np.stack((batch_ids, clust_ids), axis=1)
+    point_keys = points[:, -2:]
+    _, keys = np.unique(np.vstack((clust_keys, point_keys)), axis=0, return_inverse=True)
+    keys = keys.reshape(-1)
+    return np.where(np.isin(keys[:len(clust_keys)], keys[len(clust_keys):]))[0]
@@ -0,0 +1,138 @@
+"""
+Spatial hash of point sets
+
+Points are bucketed in a grid of cubic cells, each (batch id, cell) pair
+being packed in a single integer key. The keys of one set are sorted once,
+and the points of the neighbouring cells of each point of another set are
+found with binary searches, one per cell offset. With cells at least as
+large as a search radius, all the pairs of points closer than that radius
+are among these candidates, and the cost scales with the number of
+candidate pairs rather than with the product of the set sizes.
+
+Points of different batch ids (events) are never paired.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import itertools
+import numpy as np
+import torch
+
+
+def _pack(batch, cells, dims):
+    # Single integer key per (batch id, cell)
+    key = batch.clone()
+    for d in range(cells.shape[1]):
+        key = key * dims[d] + cells[:, d]
+    return key
+
+
+def cell_pairs(x, cell_size, y=None, x_batch=None, y_batch=None):
+    """
+    Yields the pairs (i, j) of a point x[i] and a point y[j] with the same
+    batch id, in the same or in adjacent grid cells, one block of pairs per
+    cell offset.
+
+    Parameters
+    ----------
+    x: torch.Tensor
+        Shape (N, D). Point positions.
+    cell_size: float
+        Side of the grid cells.
+    y: torch.Tensor, optional
+        Shape (M, D). Second set of points. By default, pairs of points of
+        x are yielded once, as (i, j) or (j, i), and (i, i) is left out.
+    x_batch, y_batch: torch.Tensor, optional
+        Shapes (N,) and (M,). Integer batch ids.
+
+    Yields
+    ------
+    tuple of torch.Tensor
+        Indices i in x and j in y of the candidate pairs.
+    """
+    self_pairs = y is None
+    if self_pairs:
+        y, y_batch = x, x_batch
+    device = x.device
+    if x_batch is None:
+        x_batch = torch.zeros(len(x), dtype=torch.long, device=device)
+    if y_batch is None:
+        y_batch = torch.zeros(len(y), dtype=torch.long, device=device)
+    if not len(x) or not len(y):
+        return
+
+    x_cells = torch.floor(x / cell_size).long()
+    y_cells = torch.floor(y / cell_size).long()
+    # Leave one empty cell on each side so that offsets do not wrap around
+    origin = torch.min(x_cells.min(dim=0).values, y_cells.min(dim=0).values) - 1
+    x_cells, y_cells = x_cells - origin, y_cells - origin
+    dims = (torch.max(x_cells.max(dim=0).values, y_cells.max(dim=0).values) + 2).tolist()
+    sorted_keys, order = torch.sort(_pack(y_batch.long(), y_cells, dims), stable=True)
+    y_keys, y_counts = torch.unique_consecutive(sorted_keys, return_counts=True)
+    y_starts = torch.cumsum(y_counts, dim=0) - y_counts
+
+    # Packing is linear in the cell coordinates: a cell offset is a constant
+    # key offset. Only the occupied cells of x are looked up, sorted queries
+    # keep the binary searches cache-friendly.
+    x_keys, x_order = torch.sort(_pack(x_batch.long(), x_cells, dims), stable=True)
+    x_keys, x_cell = torch.unique_consecutive(x_keys, return_inverse=True)
+    strides = [int(np.prod(dims[d+1:])) for d in range(len(dims))]
+    for offset in itertools.product((-1, 0, 1), repeat=x.shape[1]):
+        # Pairs of x are symmetric, only look at half of the neighbours
+        if self_pairs and offset < (0,) * x.shape[1]:
+            continue
+        query = x_keys + sum(o * s for o, s in zip(offset, strides))
+        cell = torch.clamp(torch.searchsorted(y_keys, query), max=len(y_keys)-1)
+        found = y_keys[cell] == query
+        counts = torch.where(found, y_counts[cell], torch.zeros_like(cell))[x_cell]
+        total = int(counts.sum())
+        if not total:
+            continue
+        ends = torch.cumsum(counts, dim=0)
+        within = torch.arange(total, device=device) - torch.repeat_interleave(ends - counts, counts)
+        start = y_starts[cell][x_cell]
+        i, j = torch.repeat_interleave(x_order, counts), order[torch.repeat_interleave(start, counts) + within]
+        if self_pairs and not any(offset):
+            i, j = i[i < j], j[i < j]
+        yield i, j
+
+
+def radius_pairs(x, radius, y=None, x_batch=None, y_batch=None, strict=False):
+    """
+    Finds all the pairs (i, j) of points x[i] and y[j] of the same batch id
+    within a euclidean distance radius of each other.
+
+    Parameters
+    ----------
+    x: torch.Tensor or np.ndarray
+        Shape (N, D). Point positions.
+    radius: float
+    y: torch.Tensor or np.ndarray, optional
+        Shape (M, D). Second set of points. By default, pairs of points of
+        x are returned once, as (i, j) or (j, i), and (i, i) is left out.
+    x_batch, y_batch: torch.Tensor or np.ndarray, optional
+        Shapes (N,) and (M,). Integer batch ids.
+    strict: bool, optional
+        Whether to keep distances < radius rather than <= radius.
+
+    Returns
+    -------
+    tuple of torch.Tensor or np.ndarray
+        Indices i and j of the pairs (numpy if x is a numpy array).
+    """
+    as_numpy = isinstance(x, np.ndarray)
+    x, y, x_batch, y_batch = [torch.as_tensor(v) if v is not None else None for v in (x, y, x_batch, y_batch)]
+    x = x.double()
+    y = y.double() if y is not None else None
+    rows, cols = [torch.empty(0, dtype=torch.long, device=x.device)], [torch.empty(0, dtype=torch.long, device=x.device)]
+    # Any cell size works for a zero radius, the pairs are filtered below
+    cell_size = radius if radius > 0 else 1.
+    for i, j in cell_pairs(x, cell_size, y, x_batch, y_batch):
+        d = torch.norm(x[i] - (x if y is None else y)[j], dim=1)
+        select = d < radius if strict else d <= radius
+        rows.append(i[select])
+        cols.append(j[select])
+    rows, cols = torch.cat(rows), torch.cat(cols)
+    if as_numpy:
+        return rows.numpy(), cols.numpy()
+    return rows, cols
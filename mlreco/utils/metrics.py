@@ -1,31 +1,39 @@
 """
 Various metrics used for evaluating clustering
+
+All the metrics are derived from a sparse contingency table (see the
+Contingency class), built in one pass over the labels. Many events can be
+processed at once by providing batch ids, in which case one value per event
+is returned.
 """
 
 import numpy as np
+from scipy.special import gammaln
 
 
 def unique_with_batch(label, bid):
     """
     merge 1D arrays of label and bid into array of new labels for unique (label, bid) pairs
-    
+
     Parameters
     ----------
     label : array_like
         input labels
     bid : array_like
         input batch ids
-    
+
     Returns
     -------
     labels2 : ndarray
         new unique labels
+    cts : ndarray
+        number of entries with each new label
     """
     label = np.array(label)
     bid = np.array(bid)
     lb = np.stack((label, bid))
     _, label2, cts = np.unique(lb, axis=1, return_inverse=True, return_counts=True)
-    return label2, cts
+    return label2.reshape(-1), cts
 
 
 def unique_label(label):
@@ -34,48 +42,259 @@ def unique_label(label):
     """
     label = np.array(label)
     _, label2, cts = np.unique(label, return_inverse=True, return_counts=True)
-    return label2, cts
+    return label2.reshape(-1), cts
 
 
-def ARI(pred, truth, bid=None):
+def _ragged_arange(starts, lengths):
     """
-    Compute the Adjusted Rand Index (ARI) score for two clusterings
+    Concatenation of np.arange(s, s+l) for each (s, l) in zip(starts, lengths)
     """
-    from sklearn.metrics import adjusted_rand_score
-    if bid:
-        pred, = unique_with_batch(pred, bid)
-        truth, = unique_with_batch(truth, bid)
-    return adjusted_rand_score(pred, truth)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(np.sum(lengths))
 
 
-def AMI(pred, truth, bid=None):
+def _segment_max(values, segments, n):
     """
-    Compute the Adjusted Mutual Information (AMI) score for two clusterings
+    Maximum of values in each of n segments, segments must be sorted
     """
-    from sklearn.metrics import adjusted_mutual_info_score
-    if bid:
-        pred, = unique_with_batch(pred, bid)
-        truth, = unique_with_batch(truth, bid)
-    return adjusted_mutual_info_score(pred, truth, average_method='arithmetic')
+    starts = np.flatnonzero(np.r_[True, segments[1:] != segments[:-1]])
+    out = np.zeros(n, dtype=values.dtype)
+    out[segments[starts]] = np.maximum.reduceat(values, starts)
+    return out
 
 
-def BD(data_sum, clusters_sum, clusters_sum_counts, data_fixed, clusters_fixed, clusters_fixed_counts):
+class Contingency(object):
     """
-    Helper function for SBD function.
+    Sparse contingency table between two clusterings, for one or many events.
+
+    Labels are made unique per event, only the non-empty cells of the table
+    are stored (as a count per packed (pred, truth) pair) along with the
+    size of each predicted cluster (row) and each true cluster (column).
+
+    Parameters
+    ----------
+    pred : array_like
+        predicted labels
+    truth : array_like
+        true labels
+    bid : array_like, optional
+        batch id of each entry. If not provided, all entries belong to one event.
+
+    Attributes
+    ----------
+    events : ndarray
+        sorted unique batch ids, each metric returns one value per event
+    cell_row, cell_col, cell_count : ndarray
+        row, column and count of the non-empty cells, sorted by row
+    row_event, row_count : ndarray
+        event and size of each predicted cluster
+    col_event, col_count : ndarray
+        event and size of each true cluster
+    event_count : ndarray
+        number of entries in each event
     """
-    bd = 0
-    for i in range(len(clusters_sum)):
-        c = clusters_sum[i]
-        c_len = clusters_sum_counts[i]
-        unique, counts = np.unique(data_fixed[np.where(data_sum == c)], return_counts=True)
-        best_dice = 0
-        for j in range(len(unique)):
-            dice = 2 * counts[j] / (c_len + clusters_fixed_counts[np.searchsorted(clusters_fixed, unique[j])])
-            if dice > best_dice:
-                best_dice = dice
-        bd += best_dice
-    bd /= len(clusters_sum)
-    return bd
+    def __init__(self, pred, truth, bid=None):
+        pred = np.asarray(pred).reshape(-1)
+        truth = np.asarray(truth).reshape(-1)
+        if bid is None:
+            bid = np.zeros(len(pred), dtype=np.int64)
+        bid = np.asarray(bid).reshape(-1)
+
+        self.events, ev = np.unique(bid, return_inverse=True)
+        ev = ev.reshape(-1)
+        self.n_events = len(self.events)
+        self.event_count = np.bincount(ev, minlength=self.n_events)
+
+        row, self.row_event, self.row_count = self._factorize(pred, ev)
+        col, self.col_event, self.col_count = self._factorize(truth, ev)
+        self.n_rows, self.n_cols = len(self.row_count), len(self.col_count)
+
+        # occupied cells of the table, sorted by row then column
+        cells, self.cell_count = np.unique(row * self.n_cols + col, return_counts=True)
+        self.cell_row = cells // self.n_cols
+        self.cell_col = cells % self.n_cols
+
+    @staticmethod
+    def _factorize(label, ev):
+        """
+        Relabels entries to a global cluster index, unique per (event, label)
+        Returns the index, the event of each cluster and its size.
+        """
+        ulabel, label = np.unique(label, return_inverse=True)
+        nlabel = len(ulabel)
+        keys, inds, counts = np.unique(ev * nlabel + label.reshape(-1), return_inverse=True, return_counts=True)
+        return inds.reshape(-1), keys // nlabel, counts
+
+    def _per_event(self, event, weights):
+        return np.bincount(event, weights=weights, minlength=self.n_events)
+
+    def ari(self):
+        """
+        Adjusted Rand Index (ARI) of each event
+        """
+        comb = lambda n: n * (n - 1) / 2.
+        sum_comb = self._per_event(self.row_event[self.cell_row], comb(self.cell_count))
+        sum_comb_k = self._per_event(self.row_event, comb(self.row_count))
+        sum_comb_c = self._per_event(self.col_event, comb(self.col_count))
+        n_pairs = comb(self.event_count)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prod = sum_comb_k * sum_comb_c / n_pairs
+            mean = (sum_comb_k + sum_comb_c) / 2.
+            ari = (sum_comb - prod) / (mean - prod)
+        # identical trivial clusterings (single cluster, or all singletons)
+        trivial = (n_pairs == 0) | (mean == prod)
+        ari[trivial] = 1.
+        return ari
+
+    def _emi(self):
+        """
+        Expected mutual information of each event under the permutation model,
+        summed over all pairs of (row size, column size) within each event
+        """
+        # unique cluster sizes per event, with multiplicities
+        def sizes(event, count):
+            m = np.max(count) + 1
+            keys, mult = np.unique(event * m + count, return_counts=True)
+            return keys // m, keys % m, mult
+        rev, ra, rmult = sizes(self.row_event, self.row_count)
+        cev, cb, cmult = sizes(self.col_event, self.col_count)
+
+        # all the (row size, column size) pairs within each event
+        cstart = np.searchsorted(cev, np.arange(self.n_events))
+        clen = np.bincount(cev, minlength=self.n_events)[rev]
+        pev = np.repeat(rev, clen)
+        pa = np.repeat(ra, clen).astype(np.float64)
+        pj = _ragged_arange(cstart[rev], clen)
+        pb = cb[pj].astype(np.float64)
+        pw = np.repeat(rmult, clen) * cmult[pj]
+        pN = self.event_count[pev].astype(np.float64)
+
+        # all the possible cell counts for each pair
+        lo = np.maximum(1, pa + pb - pN).astype(np.int64)
+        hi = np.minimum(pa, pb).astype(np.int64)
+        length = hi - lo + 1
+        n = _ragged_arange(lo, length).astype(np.float64)
+        a, b, N = [np.repeat(x, length) for x in (pa, pb, pN)]
+        log_p = gammaln(a + 1) + gammaln(b + 1) + gammaln(N - a + 1) + gammaln(N - b + 1) \
+              - gammaln(N + 1) - gammaln(n + 1) - gammaln(a - n + 1) - gammaln(b - n + 1) \
+              - gammaln(N - a - b + n + 1)
+        term = n / N * (np.log(N) + np.log(n) - np.log(a) - np.log(b)) * np.exp(log_p)
+        return self._per_event(np.repeat(pev, length), term * np.repeat(pw, length))
+
+    def ami(self):
+        """
+        Adjusted Mutual Information (AMI) of each event, arithmetic normalization
+        """
+        N = self.event_count.astype(np.float64)
+        cN = N[self.row_event[self.cell_row]]
+        mi = self._per_event(self.row_event[self.cell_row], self.cell_count / cN * (
+            np.log(cN) + np.log(self.cell_count)
+            - np.log(self.row_count[self.cell_row]) - np.log(self.col_count[self.cell_col])))
+        mi = np.maximum(mi, 0.)
+        rp = self.row_count / N[self.row_event]
+        cp = self.col_count / N[self.col_event]
+        h_pred = -self._per_event(self.row_event, rp * np.log(rp))
+        h_true = -self._per_event(self.col_event, cp * np.log(cp))
+        emi = self._emi()
+        denominator = (h_pred + h_true) / 2. - emi
+        eps = np.finfo(np.float64).eps
+        denominator = np.where(denominator < 0, np.minimum(denominator, -eps), np.maximum(denominator, eps))
+        ami = (mi - emi) / denominator
+        # limit cases: identical clusterings (e.g. single cluster or all singletons)
+        # are a perfect match, a single cluster against several is not
+        n_rows = np.bincount(self.row_event, minlength=self.n_events)
+        n_cols = np.bincount(self.col_event, minlength=self.n_events)
+        ami[(n_rows == 1) ^ (n_cols == 1)] = 0.
+        ami[np.isclose(mi, h_pred) & np.isclose(mi, h_true)] = 1.
+        return ami
+
+    def _best_dice(self):
+        """
+        Best Dice coefficient of each predicted and each true cluster
+        """
+        dice = 2. * self.cell_count / (self.row_count[self.cell_row] + self.col_count[self.cell_col])
+        best_row = _segment_max(dice, self.cell_row, self.n_rows)
+        order = np.argsort(self.cell_col, kind='stable')
+        best_col = _segment_max(dice[order], self.cell_col[order], self.n_cols)
+        return best_row, best_col
+
+    def _mean_rows(self, values):
+        return self._per_event(self.row_event, values) / np.bincount(self.row_event, minlength=self.n_events)
+
+    def _mean_cols(self, values):
+        return self._per_event(self.col_event, values) / np.bincount(self.col_event, minlength=self.n_events)
+
+    def sbd(self):
+        """
+        Symmetric Best Dice (SBD) of each event
+        """
+        best_row, best_col = self._best_dice()
+        return np.minimum(self._mean_rows(best_row), self._mean_cols(best_col))
+
+    def purity(self):
+        """
+        Mean purity of the predicted clusters of each event
+        """
+        best = _segment_max(self.cell_count, self.cell_row, self.n_rows)
+        return self._mean_rows(best / self.row_count)
+
+    def efficiency(self):
+        """
+        Mean efficiency of the true clusters of each event
+        """
+        order = np.argsort(self.cell_col, kind='stable')
+        best = _segment_max(self.cell_count[order], self.cell_col[order], self.n_cols)
+        return self._mean_cols(best / self.col_count)
+
+
+def clustering_metrics(pred, truth, bid=None):
+    """
+    Compute ARI, AMI, SBD, purity and efficiency in one pass
+
+    Parameters
+    ----------
+    pred : array_like
+        predicted labels
+    truth : array_like
+        true labels
+    bid : array_like, optional
+        batch ids. If provided, metrics are computed for each event separately.
+
+    Returns
+    -------
+    ari, ami, sbd, purity, efficiency : float or ndarray
+        scalars if bid is None, otherwise arrays with one value per
+        (sorted) unique batch id
+    """
+    table = Contingency(pred, truth, bid)
+    metrics = (table.ari(), table.ami(), table.sbd(), table.purity(), table.efficiency())
+    if bid is None:
+        return tuple(m[0] for m in metrics)
+    return metrics
+
+
+def _relabel(pred, truth, bid):
+    """
+    Helper for the scalar metrics: makes labels unique across batch ids
+    """
+    if bid is not None:
+        pred, _ = unique_with_batch(pred, bid)
+        truth, _ = unique_with_batch(truth, bid)
+    return Contingency(pred, truth)
+
+
+def ARI(pred, truth, bid=None):
+    """
+    Compute the Adjusted Rand Index (ARI) score for two clusterings
+    """
+    return _relabel(pred, truth, bid).ari()[0]
+
+
+def AMI(pred, truth, bid=None):
+    """
+    Compute the Adjusted Mutual Information (AMI) score for two clusterings
+    """
+    return _relabel(pred, truth, bid).ami()[0]
 
 
 # pred, truth are 1D arrays of labels in the same order
@@ -83,49 +302,31 @@ def SBD(pred, truth, bid=None):
     '''
     Compute the Symmetric Best Dice (SBD) Score for Instance Segmentation.
     '''
-    if bid:
-        pred, = unique_with_batch(pred, bid)
-        truth, = unique_with_batch(truth, bid)
-    pred_clusters, pred_counts = np.unique(pred, return_counts=True)
-    truth_clusters, truth_counts = np.unique(truth, return_counts=True)
-    
-    bd1 = BD(pred, pred_clusters, pred_counts, truth, truth_clusters, truth_counts)
-    bd2 = BD(truth, truth_clusters, truth_counts, pred, pred_clusters, pred_counts)
-    sbd = np.minimum(bd1, bd2)
-
-    return sbd
+    return _relabel(pred, truth, bid).sbd()[0]
 
 
 def contingency_table(a, b, na=None, nb=None):
     """
     build contingency table for a and b
-    assume a and b have labels between 0 and na and 0 and nb respectively
+    assume a and b have labels between 0 and na-1 and 0 and nb-1 respectively
+    na and nb default to the largest label of a and b plus one
     """
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
     if not na:
-        na = np.max(a)
+        na = np.max(a) + 1
     if not nb:
-        nb = np.max(b)
-    table = np.zeros((na, nb), dtype=np.int)
-    for i, j in zip(a,b):
-        table[i,j] += 1
-    return table
+        nb = np.max(b) + 1
+    return np.bincount(a * nb + b, minlength=na * nb).reshape(na, nb)
 
 
 def purity(pred, truth, bid=None):
     """
     cluster purity:
     intersection(pred, truth)/pred
-    number in [0,1] - 1 indicates everything in the cluster is in the same ground-truth cluster 
+    number in [0,1] - 1 indicates everything in the cluster is in the same ground-truth cluster
     """
-    if bid:
-        pred, pcts = unique_with_batch(pred, bid)
-        truth, tcts = unique_with_batch(truth, bid)
-    else:
-        pred, pcts = unique_label(pred)
-        truth, tcts = unique_label(truth)
-    table = contingency_table(pred, truth, len(pcts), len(tcts))
-    purities = table.max(axis=1) / pcts
-    return purities.mean()
+    return _relabel(pred, truth, bid).purity()[0]
 
 
 def efficiency(pred, truth, bid=None):
@@ -134,31 +335,12 @@ def efficiency(pred, truth, bid=None):
     intersection(pred, truth)/truth
     number in [0,1] - 1 indicates everything is found in cluster
     """
-    if bid:
-        pred, pcts = unique_with_batch(pred, bid)
-        truth, tcts = unique_with_batch(truth, bid)
-    else:
-        pred, pcts = unique_label(pred)
-        truth, tcts = unique_label(truth)
-    table = contingency_table(pred, truth, len(pcts), len(tcts))
-    efficiencies = table.max(axis=0) / tcts
-    return efficiencies.mean()
+    return _relabel(pred, truth, bid).efficiency()[0]
+
 
 def purity_efficiency(pred, truth, bid=None):
     """
     function that combines purity and efficiency calculation into one go
     """
-    if bid:
-        pred, pcts = unique_with_batch(pred, bid)
-        truth, tcts = unique_with_batch(truth, bid)
-    else:
-        pred, pcts = unique_label(pred)
-        truth, tcts = unique_label(truth)
-    table = contingency_table(pred, truth, len(pcts), len(tcts))
-    efficiencies = table.max(axis=0) / tcts
-    purities = table.max(axis=1) / pcts
-    return purities.mean(), efficiencies.mean()
-    
-    
-    
-    
+    table = _relabel(pred, truth, bid)
+    return table.purity()[0], table.efficiency()[0]
@@ -0,0 +1,164 @@
+"""
+Neighbourhood queries for Michel electron reconstruction
+
+The Michel reconstruction post-processors match voxel sets many times per
+event (clusters to labels, Michel candidates to MIP tracks, predicted to
+true clusters) and run DBSCAN on many subsets of the MIP voxels. Instead
+of dense distance matrices and repeated DBSCAN fits:
+
+- VoxelIndex wraps one KD-tree per voxel set and event, for nearest and
+  radius queries. Ties are broken as np.argmin would on a distance matrix
+  (lowest index).
+- NeighbourGraph holds the DBSCAN radius graph of a voxel set, built once
+  per event. DBSCAN of any subset is then the connected components of its
+  core voxels (see mlreco.utils.dbscan.dbscan_pairs).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+from mlreco.utils.dbscan import dbscan_pairs
+from mlreco.utils.grid import radius_pairs
+from mlreco.utils.union_find import connected_components
+
+
+class VoxelIndex(object):
+    """
+    KD-tree of a set of voxels, for nearest and radius queries.
+    """
+    def __init__(self, voxels):
+        self.voxels = np.asarray(voxels, dtype=np.float64)
+        self._tree = cKDTree(self.voxels, balanced_tree=False, compact_nodes=False) if len(self.voxels) else None
+
+    def __len__(self):
+        return len(self.voxels)
+
+    def nearest(self, points, upper_bound=np.inf):
+        """
+        Nearest voxel of each point, lowest voxel index in case of a tie.
+
+        Returns
+        -------
+        np.ndarray
+            Distances, inf if there is no voxel within upper_bound.
+        np.ndarray
+            Voxel indices, len(self) if there is no voxel within upper_bound.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, self.voxels.shape[1] if len(self) else 1)
+        if self._tree is None or not len(points):
+            return np.full(len(points), np.inf), np.full(len(points), len(self), dtype=np.int64)
+        d, index = self._tree.query(points, distance_upper_bound=upper_bound)
+        found = np.where(np.isfinite(d))[0]
+        # Look for ties only where there may be one
+        radius = d[found] * (1 + 1e-9) + 1e-9
+        ties = found[self._tree.query_ball_point(points[found], r=radius, return_length=True) > 1]
+        if len(ties):
+            neighbours = self._tree.query_ball_point(points[ties], r=d[ties] * (1 + 1e-9) + 1e-9)
+            index[ties] = [min(n) for n in neighbours]
+        return d, index
+
+    def count_within(self, points, radius):
+        """
+        Number of voxels closer than radius (strictly) to each point
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, self.voxels.shape[1] if len(self) else 1)
+        if self._tree is None:
+            return np.zeros(len(points), dtype=np.int64)
+        return self._tree.query_ball_point(points, r=np.nextafter(radius, 0), return_length=True)
+
+
+class NeighbourGraph(object):
+    """
+    Pairs of voxels within epsilon of each other, computed once, to run
+    DBSCAN (eps=epsilon) on subsets of the voxels.
+    """
+    def __init__(self, voxels, epsilon):
+        self.voxels = np.asarray(voxels, dtype=np.float64)
+        self.epsilon = epsilon
+        i, j = radius_pairs(self.voxels, epsilon)
+        # Pairs sorted by first voxel, with row pointers
+        order = np.argsort(i, kind='stable')
+        self._i, self._j = i[order], j[order]
+        self._indptr = np.concatenate(([0], np.cumsum(np.bincount(i, minlength=len(self.voxels)))))
+
+    def _subgraph(self, index):
+        # Pairs of voxels of the subset index, in local indices of the subset
+        local = np.full(len(self.voxels), -1, dtype=np.int64)
+        local[index] = np.arange(len(index))
+        starts = self._indptr[index]
+        counts = self._indptr[index + 1] - starts
+        ends = np.cumsum(counts)
+        pairs = np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+        i, j = local[self._i[pairs]], local[self._j[pairs]]
+        return i[j > -1], j[j > -1]
+
+    def dbscan(self, min_samples, index=None):
+        """
+        DBSCAN labels of voxels[index] (all the voxels by default), as
+        sklearn.cluster.DBSCAN(eps=epsilon, min_samples=min_samples) gives
+        them.
+        """
+        index = np.arange(len(self.voxels)) if index is None else np.asarray(index, dtype=np.int64)
+        i, j = self._subgraph(index)
+        return dbscan_pairs(len(index), i, j, min_samples)
+
+    def num_clusters(self, min_samples, index=None):
+        """
+        Number of DBSCAN clusters in voxels[index]: connected components of
+        the core voxels, border voxels do not change the count.
+        """
+        index = np.arange(len(self.voxels)) if index is None else np.asarray(index, dtype=np.int64)
+        i, j = self._subgraph(index)
+        core = 1 + np.bincount(i, minlength=len(index)) + np.bincount(j, minlength=len(index)) >= min_samples
+        if not core.any():
+            return 0
+        linked = core[i] & core[j]
+        components = connected_components(np.column_stack((i[linked], j[linked])), len(index))
+        return len(np.unique(components[core]))
+
+
+def find_edges(coords):
+    """
+    Indices of two extreme points of a cluster: the farthest point from the
+    first one, and the farthest point from that one.
+    """
+    point0 = coords[0]
+    i = cdist([point0], coords).argmax(axis=1)[0]
+    point1 = coords[i]
+    j = cdist([point1], coords).argmax(axis=1)[0]
+    return [i, j]
+
+
+def is_at_edge(graph, cluster_index, point_coords, radius=10.0, min_samples=5):
+    """
+    Determines whether the point with coordinates `point_coords` is at the
+    edge of a cluster: removes a disc of radius `radius` around that point,
+    runs DBSCAN on what is left and checks whether there is still only 1
+    cluster.
+
+    Assumes: that DBSCAN run on the cluster will only find 1 cluster.
+
+    graph: NeighbourGraph of the voxels, with the DBSCAN radius
+    cluster_index: np.array (N,) indices of the cluster voxels in graph
+    point_coords: np.array (1, data_dim) or (data_dim,)
+    """
+    cluster_coords = graph.voxels[cluster_index]
+    ablated = cluster_index[np.linalg.norm(cluster_coords - np.reshape(point_coords, (1, -1)), axis=1) > radius]
+    if not len(ablated):
+        return True
+    return graph.num_clusters(min_samples, ablated) == 1
+
+
+def voxel_keys(*voxel_sets):
+    """
+    Integer key of each voxel (equal coordinates, equal keys) for several
+    voxel sets at once, to intersect them with np.isin.
+    """
+    sizes = [len(v) for v in voxel_sets]
+    coords = np.concatenate([np.reshape(v, (len(v), -1)) for v in voxel_sets])
+    if not len(coords):
+        return [np.empty(0, dtype=np.int64) for _ in voxel_sets]
+    _, keys = np.unique(coords, axis=0, return_inverse=True)
+    return np.split(keys.reshape(-1), np.cumsum(sizes)[:-1])
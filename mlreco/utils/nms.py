@@ -0,0 +1,153 @@
+"""
+Batched non-maximum suppression of predicted points
+
+Each point is the center of a box of half side `size`. Going from the
+highest to the lowest score, a point is kept unless its box overlaps
+(intersection over union above `threshold`) the box of a point already
+kept. Two boxes can only overlap if every coordinate of their centers
+differs by less than the window 2 * size + 1, so candidates are bucketed
+in a grid of cells of that side and each point is only compared to the
+points of the neighbouring cells (and of the same batch id), see
+mlreco.utils.grid.
+
+The greedy suppression is resolved in parallel: a point is dropped as soon
+as a higher score neighbour is kept, and kept as soon as all its higher
+score neighbours are dropped. This gives the same result as the sequential
+loop, in a few vectorized passes over the neighbour pairs when overlaps
+are local. Along chains of overlapping points with decreasing scores
+(e.g. a track) each pass only settles the head of the chain, so once a
+pass decides less than MIN_PASS_FRACTION of the undecided points, the
+remaining ones are settled in a single sequential sweep in score order.
+
+nms_torch runs on the device of its inputs, nms is the numpy interface.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+import torch
+from mlreco.utils.grid import cell_pairs
+
+# Smallest fraction of the undecided points a parallel pass must decide,
+# below which the rest is settled sequentially (see _sweep)
+MIN_PASS_FRACTION = 0.25
+
+
+def nms_torch(points, scores, threshold, size, batch=None):
+    """
+    Runs NMS on a set of predicted points, all batch ids at once.
+
+    Parameters
+    ----------
+    points: torch.Tensor
+        Shape (N, data_dim). Predicted point positions.
+    scores: torch.Tensor
+        Shape (N,). Predicted scores.
+    threshold: float
+        Threshold for overlap
+    size: float
+        Half side of square window defined around each point
+    batch: torch.Tensor, optional
+        Shape (N,). Batch ids, points of different batch ids never
+        suppress each other.
+
+    Returns
+    -------
+    torch.Tensor
+        Indices of the points kept, in decreasing score order.
+    """
+    num_points = len(points)
+    device = points.device
+    if not num_points:
+        return torch.empty(0, dtype=torch.long, device=device)
+    points = points.double()
+    batch = torch.zeros(num_points, dtype=torch.long, device=device) if batch is None else batch.long()
+
+    # Priority of each point, ties broken by index (highest first)
+    priority = torch.argsort(scores, stable=True).flip(0)
+    rank = torch.empty_like(priority)
+    rank[priority] = torch.arange(num_points, device=device)
+
+    # Pairs (high, low) of overlapping boxes, high has the higher score
+    window = 2 * size + 1
+    area = float(window)**points.shape[1]
+    lows, highs = [], []
+    for low, high in cell_pairs(points, window, x_batch=batch):
+        swap = rank[high] > rank[low]
+        low, high = torch.where(swap, high, low), torch.where(swap, low, high)
+        inter = torch.clamp(window - torch.abs(points[low] - points[high]), min=0).prod(dim=1)
+        select = inter / (2 * area - inter) > threshold
+        lows.append(low[select])
+        highs.append(high[select])
+    low, high = torch.cat(lows), torch.cat(highs)
+
+    # 0: undecided, 1: kept, 2: suppressed
+    state = torch.zeros(num_points, dtype=torch.long, device=device)
+    num_undecided = num_points
+    while num_undecided:
+        undecided = state == 0
+        suppressed = torch.zeros(num_points, dtype=torch.bool, device=device)
+        suppressed[low[state[high] == 1]] = True
+        state[undecided & suppressed] = 2
+        blocked = torch.zeros(num_points, dtype=torch.bool, device=device)
+        blocked[low[state[high] != 2]] = True
+        state[(state == 0) & ~blocked] = 1
+        previous, num_undecided = num_undecided, int((state == 0).sum())
+        if num_undecided and previous - num_undecided < MIN_PASS_FRACTION * previous:
+            state = _sweep(state, low, high, rank)
+            break
+
+    return priority[state[priority] == 1]
+
+
+def _sweep(state, low, high, rank):
+    """
+    Settles the undecided points (state 0) one at a time in decreasing
+    score order: a point is suppressed if one of its higher score
+    neighbours is kept. Runs on host, in O(points + pairs).
+    """
+    device = state.device
+    state, low, high, rank = [t.cpu().numpy() for t in (state, low, high, rank)]
+    # Higher score neighbours of each undecided point, grouped by point
+    select = state[low] == 0
+    low, high = low[select], high[select]
+    order = np.argsort(low, kind='stable')
+    low, high = low[order], high[order]
+    undecided = np.flatnonzero(state == 0)
+    undecided = undecided[np.argsort(rank[undecided])]
+    starts = np.searchsorted(low, undecided, side='left').tolist()
+    ends = np.searchsorted(low, undecided, side='right').tolist()
+    high = high.tolist()
+    values = state.tolist()
+    for i, start, end in zip(undecided.tolist(), starts, ends):
+        values[i] = 2 if any(values[j] == 1 for j in high[start:end]) else 1
+    return torch.tensor(values, dtype=torch.long, device=device)
+
+
+def nms(points, scores, threshold, size, batch=None):
+    """
+    Numpy interface of nms_torch.
+
+    Parameters
+    ----------
+    points: np.ndarray
+        Shape (N, data_dim). Predicted point positions.
+    scores: np.ndarray
+        Shape (N,). Predicted scores.
+    threshold: float
+        Threshold for overlap
+    size: float
+        Half side of square window defined around each point
+    batch: np.ndarray, optional
+        Shape (N,). Batch ids.
+
+    Returns
+    -------
+    np.ndarray
+        Indices of the points kept, in decreasing score order.
+    """
+    points = torch.as_tensor(np.ascontiguousarray(points, dtype=np.float64))
+    scores = torch.as_tensor(np.ascontiguousarray(scores, dtype=np.float64))
+    if batch is not None:
+        batch = torch.as_tensor(np.ascontiguousarray(batch).astype(np.int64))
+    return nms_torch(points, scores, threshold, size, batch=batch).numpy()
@@ -0,0 +1,141 @@
+"""
+Chunked pairwise-distance kernels
+
+The full (N, M) distance matrix between two point sets is never stored:
+rows are processed in chunks sized to a memory budget, and only the
+reductions needed by the losses are kept (nearest neighbour distance and
+index, number of neighbours within a radius). Each chunk is computed with
+torch.cdist, which uses matrix multiplications for large inputs.
+
+If batch ids are provided, points are only compared to the points of the
+same batch id (one block per event).
+"""
+
+import torch
+
+# Default memory budget for one chunk of the distance matrix, in bytes
+MAX_MEMORY = 2**28
+
+
+def _blocks(n, m, x_batch=None, y_batch=None):
+    """
+    Yields (rows, cols) pairs of index tensors (or slices if no batch ids
+    are given) of the points of x and y that share a batch id.
+    """
+    if x_batch is None or y_batch is None:
+        yield slice(0, n), slice(0, m)
+        return
+    x_batch, x_order = torch.sort(x_batch, stable=True)
+    y_batch, y_order = torch.sort(y_batch.to(x_batch.dtype), stable=True)
+    ids, counts = torch.unique_consecutive(x_batch, return_counts=True)
+    starts = torch.cumsum(counts, 0) - counts
+    y_starts = torch.searchsorted(y_batch, ids)
+    y_ends = torch.searchsorted(y_batch, ids, right=True)
+    for start, count, y_start, y_end in zip(starts.tolist(), counts.tolist(),
+                                            y_starts.tolist(), y_ends.tolist()):
+        if y_end > y_start:
+            yield x_order[start:start+count], y_order[y_start:y_end]
+
+
+def _chunks(rows, n_rows, n_cols, element_size, max_memory):
+    """
+    Splits the rows of a block so that a chunk of n_cols distances
+    per row fits in max_memory bytes
+    """
+    step = max(1, int(max_memory // max(1, n_cols * element_size)))
+    for start in range(0, n_rows, step):
+        if isinstance(rows, slice):
+            yield slice(rows.start + start, rows.start + min(start + step, n_rows))
+        else:
+            yield rows[start:start+step]
+
+
+def nearest(x, y, x_batch=None, y_batch=None, max_memory=MAX_MEMORY):
+    """
+    Nearest point of y for each point of x
+
+    Parameters
+    ----------
+    x: torch.Tensor
+        Shape (N, D). Query points.
+    y: torch.Tensor
+        Shape (M, D). Reference points.
+    x_batch, y_batch: torch.Tensor, optional
+        Shapes (N,) and (M,). Batch ids, points are only matched within
+        the same batch id.
+    max_memory: int, optional
+        Memory budget of one chunk of the distance matrix, in bytes.
+
+    Returns
+    -------
+    dist: torch.Tensor
+        Shape (N,). Distance to the nearest point (inf if there is none),
+        differentiable with respect to x and y.
+    index: torch.Tensor
+        Shape (N,). Index of the nearest point in y (-1 if there is none).
+    """
+    dist = x.new_full((len(x),), float('inf'))
+    index = torch.full((len(x),), -1, dtype=torch.long, device=x.device)
+    if not len(x) or not len(y):
+        return dist, index
+    y = y.to(x.dtype)
+    for rows, cols in _blocks(len(x), len(y), x_batch, y_batch):
+        ys = y[cols]
+        cols = torch.arange(len(y), device=x.device)[cols]
+        n_rows = rows.stop - rows.start if isinstance(rows, slice) else len(rows)
+        for chunk in _chunks(rows, n_rows, len(ys), x.element_size(), max_memory):
+            d = torch.cdist(x[chunk], ys)
+            dist[chunk], closest = torch.min(d, dim=1)
+            index[chunk] = cols[closest]
+    return dist, index
+
+
+def radius_count(x, y, radius, x_batch=None, y_batch=None,
+                 x_label=None, y_label=None, max_memory=MAX_MEMORY):
+    """
+    Number of points of y within radius of each point of x (strictly)
+
+    Parameters
+    ----------
+    x: torch.Tensor
+        Shape (N, D). Query points.
+    y: torch.Tensor
+        Shape (M, D). Reference points.
+    radius: float or list of float
+        Radii (R of them) to count neighbours in.
+    x_batch, y_batch: torch.Tensor, optional
+        Shapes (N,) and (M,). Batch ids, points are only counted within
+        the same batch id.
+    x_label, y_label: torch.Tensor, optional
+        Shapes (N,) and (M,). If provided, neighbours with the same label
+        and with a different label are counted separately.
+    max_memory: int, optional
+        Memory budget of one chunk of the distance matrix, in bytes.
+
+    Returns
+    -------
+    torch.Tensor
+        Shape (N, R). Counts within each radius. If labels are provided,
+        a pair of such tensors (same label, different label) is returned.
+    """
+    radius = torch.tensor(radius if isinstance(radius, (list, tuple)) else [radius],
+                          dtype=x.dtype, device=x.device)
+    use_labels = x_label is not None and y_label is not None
+    count = torch.zeros((len(x), len(radius)), dtype=torch.long, device=x.device)
+    same = torch.zeros_like(count)
+    if not len(x) or not len(y):
+        return (same, count) if use_labels else count
+    with torch.no_grad():
+        x, y = x.detach(), y.detach().to(x.dtype)
+        for rows, cols in _blocks(len(x), len(y), x_batch, y_batch):
+            ys = y[cols]
+            n_rows = rows.stop - rows.start if isinstance(rows, slice) else len(rows)
+            for chunk in _chunks(rows, n_rows, len(ys) * len(radius), x.element_size(), max_memory):
+                within = torch.cdist(x[chunk], ys)[..., None] < radius  # (n, m, R)
+                count[chunk] = within.sum(dim=1)
+                if use_labels:
+                    match = (x_label[chunk][:, None] == y_label[cols][None, :])[..., None]
+                    same[chunk] = (within & match).sum(dim=1)
+    if use_labels:
+        return same, count - same
+    return count
@@ -1,12 +1,29 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import warnings
 import numpy as np
 import scipy
+from scipy.spatial import cKDTree
 from mlreco.utils.dbscan import dbscan_types
+from mlreco.utils.nms import nms
+from mlreco.utils.grid import radius_pairs
+from mlreco.utils.union_find import connected_components
 import torch
 
 
+def events_with_particles(events, particle_batch):
+    """
+    Mask of the events (batch ids) which have at least one true particle
+    point, warns once with the number of events without any
+    """
+    has_particles = (events[:, None] == particle_batch[None, :].to(events.dtype)).any(dim=1)
+    num_missing = int((~has_particles).sum())
+    if num_missing:
+        warnings.warn('PPN loss: %d event(s) without particles' % num_missing)
+    return has_particles
+
+
 def contains(meta, point, point_type="3d"):
     """
     Decides whether a point is contained in the box defined by meta.
@@ -162,52 +179,30 @@ def get_ppn_info(particle_v, meta, point_type="3d", min_voxel_count=7, min_energ
     return np.array(gt_positions)
 
 
-def nms_numpy(im_proposals, im_scores, threshold, size):
+def nms_numpy(im_proposals, im_scores, threshold, size, batch=None):
     """
     Runs NMS algorithm on a list of predicted points and scores.
+    See mlreco.utils.nms for the implementation.
 
     Parameters
     ----------
     im_proposals: np.array
         Shape (N, data_dim). Predicted points.
     im_scores: np.array
-        Shape (N, 2). Predicted scores.
+        Shape (N,). Predicted scores.
     threshold: float
         Threshold for overlap
     size: int
         Half side of square window defined around each point
+    batch: np.array, optional
+        Shape (N,). Batch ids, NMS is applied to each batch id separately.
 
     Returns
     -------
     np.array
-        boolean array of same length as points/scores
+        Indices of the points kept, in decreasing score order.
     """
-    # TODO: looks like this doesn't account for batches
-    dim = im_proposals.shape[-1]
-    coords = []
-    for d in range(dim):
-        coords.append(im_proposals[:, d] - size)
-    for d in range(dim):
-        coords.append(im_proposals[:, d] + size)
-    coords = np.array(coords)
-
-    areas = np.ones_like(coords[0])
-    areas = np.prod(coords[dim:] - coords[0:dim] + 1, axis=0)
-
-    order = im_scores.argsort()[::-1]
-    keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(i)
-        xx = np.maximum(coords[:dim, i][:, np.newaxis], coords[:dim, order[1:]])
-        yy = np.minimum(coords[dim:, i][:, np.newaxis], coords[dim:, order[1:]])
-        w = np.maximum(0.0, yy - xx + 1)
-        inter = np.prod(w, axis=0)
-        ovr = inter / (areas[i] + areas[order[1:]] - inter)
-        inds = np.where(ovr <= threshold)[0]
-        order = order[inds + 1]
-
-    return keep
+    return nms(im_proposals, im_scores, threshold, size, batch=batch)
 
 
 def group_points(ppn_pts, batch, label):
@@ -246,6 +241,14 @@ def uresnet_ppn_type_point_selector(data, out, score_threshold=0.5,
                                     type_threshold=100, entry=0, **kwargs):
     """
     Postprocessing of PPN points.
+
+    Keeps the points selected by the PPN2 mask and the score threshold
+    whose predicted type matches the semantic prediction of a selected
+    voxel within type_threshold, then merges the points of a same type
+    closer than 1.99 into their average. All the batch ids are processed
+    at once: the closest voxel of each point is found in a KD-tree, the
+    pairs of points to merge in a spatial hash (see mlreco.utils.grid).
+
     Parameters
     ----------
     data - 5-types sparse tensor
@@ -260,7 +263,8 @@ def uresnet_ppn_type_point_selector(data, out, score_threshold=0.5,
     # predicted type labels
     # uresnet_predictions = torch.argmax(out['segmentation'][0], -1).cpu().detach().numpy()
     uresnet_predictions = np.argmax(out['segmentation'][entry], -1)
-    scores = scipy.special.softmax(points[:, 3:5], axis=1)
+    # Softmax score of the positive class, for 2 classes
+    scores = scipy.special.expit(points[:, 4] - points[:, 3])
 
     if 'ghost' in out:
         mask_ghost = np.argmax(out['ghost'][entry], axis=1) == 0
@@ -270,39 +274,51 @@ def uresnet_ppn_type_point_selector(data, out, score_threshold=0.5,
         uresnet_predictions = uresnet_predictions[mask_ghost]
         scores = scores[mask_ghost]
 
-    all_points = []
-    all_batch = []
-    all_labels = []
-    batch_ids = event_data[:, 3]
-    for b in np.unique(batch_ids):
-        final_points = []
-        final_scores = []
-        final_labels = []
-        batch_index = batch_ids == b
-        mask = ((~(mask[batch_index] == 0)).any(axis=1)) & (scores[batch_index][:, 1] > score_threshold)
-        num_classes = 5
-        ppn_type_predictions = np.argmax(scipy.special.softmax(points[batch_index][mask][:, 5:], axis=1), axis=1)
-        for c in range(num_classes):
-            uresnet_points = uresnet_predictions[batch_index][mask] == c
-            ppn_points = ppn_type_predictions == c
-            if ppn_points.shape[0] > 0 and uresnet_points.shape[0] > 0:
-                d = scipy.spatial.distance.cdist(points[batch_index][mask][ppn_points][:, :3] + event_data[batch_index][mask][ppn_points][:, :3] + 0.5, event_data[batch_index][mask][uresnet_points][:, :3])
-                ppn_mask = (d < type_threshold).any(axis=1)
-                final_points.append(points[batch_index][mask][ppn_points][ppn_mask][:, :3] + 0.5 + event_data[batch_index][mask][ppn_points][ppn_mask][:, :3])
-                final_scores.append(scores[batch_index][mask][ppn_points][ppn_mask])
-                final_labels.append(ppn_type_predictions[ppn_points][ppn_mask])
-        if len(final_points)>0:
-            final_points = np.concatenate(final_points, axis=0)
-            final_scores = np.concatenate(final_scores, axis=0)
-            final_labels = np.concatenate(final_labels, axis=0)
-            clusts = dbscan_types(final_points, final_labels, epsilon=1.99,  minpts=1, typemin=0, typemax=5)
-            for c in clusts:
-                # append mean of points
-                all_points.append(np.mean(final_points[c], axis=0))
-                all_batch.append(b)
-                all_labels.append(np.mean(final_labels[c]))
-
-    return np.column_stack((all_points, all_batch, all_labels))
+    # Masks are computed once for the whole minibatch
+    num_classes = 5
+    select = ((~(mask == 0)).any(axis=1)) & (scores > score_threshold)
+    voxels = event_data[select, :3]
+    batch_values, batch_ids = np.unique(event_data[select, 3], return_inverse=True)
+    positions = points[select, :3] + 0.5 + voxels
+    ppn_types = np.argmax(points[select, 5:], axis=1)
+    uresnet_types = uresnet_predictions[select]
+
+    # Keep points within type_threshold of a voxel of the same batch id and
+    # predicted class: nearest voxel in a single KD-tree, where the (batch
+    # id, class) tags are extra coordinates scaled beyond the event extent
+    ppn_index = np.where(ppn_types < num_classes)[0]
+    uresnet_index = np.where(uresnet_types < num_classes)[0]
+    if not len(ppn_index) or not len(uresnet_index):
+        return np.empty((0, 5))
+    lo = np.minimum(positions.min(axis=0), voxels.min(axis=0))
+    hi = np.maximum(positions.max(axis=0), voxels.max(axis=0))
+    scale = 2. * np.linalg.norm(hi - lo) + type_threshold + 1.
+    tree = cKDTree(np.column_stack((voxels[uresnet_index], scale * batch_ids[uresnet_index], scale * uresnet_types[uresnet_index])),
+                   balanced_tree=False, compact_nodes=False)
+    d, _ = tree.query(np.column_stack((positions[ppn_index], scale * batch_ids[ppn_index], scale * ppn_types[ppn_index])),
+                      distance_upper_bound=type_threshold)
+    index = ppn_index[d < type_threshold]
+    if not len(index):
+        return np.empty((0, 5))
+    # Same order as a loop over batch ids then classes
+    index = index[np.lexsort((index, ppn_types[index], batch_ids[index]))]
+    positions, batch_ids, ppn_types = positions[index], batch_ids[index], ppn_types[index]
+
+    # Merge points of a same type: connected components of the graph of
+    # points closer than 1.99, ordered by their first point
+    i, j = radius_pairs(positions, 1.99, x_batch=batch_ids * num_classes + ppn_types)
+    labels = connected_components(np.column_stack([i, j]), len(positions))
+    first = np.full(labels.max() + 1, len(positions))
+    np.minimum.at(first, labels, np.arange(len(positions)))
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    labels = rank[labels]
+    first = first[order]
+    counts = np.bincount(labels)
+    means = np.column_stack([np.bincount(labels, weights=positions[:, d]) for d in range(positions.shape[1])]) / counts[:, None]
+
+    return np.column_stack((means, batch_values[batch_ids[first]], ppn_types[first].astype(np.float64)))
 
 
 def uresnet_ppn_point_selector(data, out, nms_score_threshold=0.8, entry=0,
@@ -344,15 +360,18 @@ def uresnet_ppn_point_selector(data, out, nms_score_threshold=0.8, entry=0,
     maskinds = np.where(mask)[0]
     keep = scores[:,1] > score_threshold
 
-    # NMS filter
-    keep2 = nms_numpy(points[mask][keep], scores[keep,1], nms_score_threshold, window_size)
+    data_in = data#.cpu().detach().numpy()
+    voxels = data_in[:,:3]
+
+    # NMS filter, on absolute positions and for all batch ids at once
+    maskinds = maskinds[keep]
+    keep2 = nms(voxels[maskinds] + 0.5 + points[maskinds], scores[keep,1],
+                nms_score_threshold, window_size, batch=data_in[maskinds,3])
 
-    maskinds = maskinds[keep][keep2]
+    maskinds = maskinds[keep2]
     points = points[maskinds]
     labels = pred_labels[maskinds]
 
-    data_in = data#.cpu().detach().numpy()
-    voxels = data_in[:,:3]
     ppn_pts = voxels[maskinds] + 0.5 + points
     batch = data_in[maskinds,3]
     label = pred_labels[maskinds]
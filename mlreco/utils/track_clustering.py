@@ -0,0 +1,207 @@
+"""
+Track clustering on PPN+UResNet output, one event at a time
+
+select_ppn_points picks the PPN points to break tracks at, break_clusters
+breaks the predicted clusters around them and match_clusters matches the
+resulting clusters to the true ones. All the neighbour searches of an
+event go through one spatial index (KD-tree or voxel hash) instead of
+dense distance matrices, so that the functions can run inline during
+inference. They work on numpy arrays of a single event, see the
+track_clustering post-processor for an example.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import numpy as np
+import scipy
+from scipy.spatial import cKDTree
+from mlreco.utils.dbscan import dbscan_labels
+from mlreco.utils.grid import radius_pairs
+
+
+def _tagged_tree(coords, tags, scale):
+    # KD-tree of coordinates and tags scaled beyond the event extent, such
+    # that points with different tags are never neighbours
+    return cKDTree(np.column_stack((coords, scale * tags)), balanced_tree=False, compact_nodes=False)
+
+
+def select_ppn_points(event_data, points, mask, segmentation,
+                      score_threshold=0.6, type_threshold=2, data_dim=3):
+    """
+    Selects the PPN points of an event: PPN2 mask and score threshold, then
+    predicted type matching the semantic prediction of a selected voxel
+    within type_threshold.
+
+    Parameters
+    ----------
+    event_data: np.ndarray
+        Shape (N, >=data_dim). Voxel coordinates.
+    points: np.ndarray
+        Shape (N, >=5). PPN output (offsets, scores, types).
+    mask: np.ndarray
+        Shape (N, 1). PPN2 mask.
+    segmentation: np.ndarray
+        Shape (N, C). Semantic segmentation scores.
+
+    Returns
+    -------
+    np.ndarray
+        Shape (P, data_dim). Positions of the selected points.
+    np.ndarray
+        Shape (P, points.shape[1]). Rows of points for the selected
+        points, with absolute positions. Points are ordered by type.
+    """
+    anchors = event_data[:, :data_dim] + 0.5
+    # Softmax score of the positive class, for 2 classes
+    scores = scipy.special.expit(points[:, data_dim+1] - points[:, data_dim])
+    select = np.where(((~(mask == 0)).any(axis=1)) & (scores > score_threshold))[0]
+    num_classes = segmentation.shape[1]
+    uresnet_types = np.argmax(segmentation[select], axis=1)
+    ppn_types = np.argmax(points[select, 5:], axis=1)
+    positions = points[select, :data_dim] + anchors[select]
+    voxels = event_data[select, :data_dim]
+
+    index = np.where(ppn_types < num_classes)[0]
+    if len(index):
+        scale = 2. * np.linalg.norm(np.ptp(np.concatenate((positions, voxels)), axis=0)) + type_threshold + 1.
+        tree = _tagged_tree(voxels, uresnet_types, scale)
+        d, _ = tree.query(np.column_stack((positions[index], scale * ppn_types[index])),
+                          distance_upper_bound=type_threshold)
+        index = index[d < type_threshold]
+    index = index[np.argsort(ppn_types[index], kind='stable')]
+
+    predicted_points = points[select[index]].copy()
+    predicted_points[:, :data_dim] += anchors[select[index]]
+    return positions[index], predicted_points
+
+
+def break_clusters(clusters, ppn_points, threshold_association=3,
+                   exclusion_radius=5, min_samples=1, data_dim=3):
+    """
+    Breaks predicted clusters at PPN points.
+
+    For each cluster, the voxels within exclusion_radius of a point
+    associated to the cluster (closer than threshold_association to one of
+    its voxels) are masked. DBSCAN tells whether the rest of the cluster
+    should be broken in several clusters, and the masked voxels are then
+    assigned to the cluster of the closest unmasked voxel. Clusters are
+    kept as they are if there is no point at all, and dropped if all their
+    voxels are masked or noise.
+
+    Parameters
+    ----------
+    clusters: np.ndarray
+        Shape (N, >=data_dim+1). Voxel coordinates, cluster id in the last
+        column.
+    ppn_points: np.ndarray
+        Shape (P, data_dim). Point positions.
+    min_samples: int
+        DBSCAN min_samples.
+
+    Returns
+    -------
+    list of np.ndarray
+        Coordinates of the voxels of each cluster, in order of cluster id.
+    """
+    cluster_ids, cluster_index = np.unique(clusters[:, -1], return_inverse=True)
+    coords = clusters[:, :data_dim]
+    if not len(coords):
+        return []
+    if not len(ppn_points):
+        order = np.argsort(cluster_index, kind='stable')
+        return np.split(coords[order], np.cumsum(np.bincount(cluster_index))[:-1])
+
+    # Points associated to each cluster, (point, cluster) pairs as keys
+    num_clusters = len(cluster_ids)
+    p, v = radius_pairs(ppn_points, threshold_association, coords, strict=True)
+    associated = np.unique(p * num_clusters + cluster_index[v])
+    # Mask the voxels around the points associated to their cluster
+    v, p = radius_pairs(coords, exclusion_radius, ppn_points)
+    masked = np.zeros(len(coords), dtype=bool)
+    masked[v[np.isin(p * num_clusters + cluster_index[v], associated)]] = True
+
+    # DBSCAN on the main body of all the clusters at once
+    body = np.where(~masked)[0]
+    labels = -np.ones(len(coords), dtype=np.int64)
+    labels[body] = dbscan_labels(coords[body], exclusion_radius, min_samples, groups=cluster_index[body])
+    noise = ~masked & (labels < 0)
+    labelled = np.where(labels > -1)[0]
+    valid = np.zeros(num_clusters, dtype=bool)
+    valid[cluster_index[labelled]] = True
+
+    # Assign the other voxels to the closest labelled voxel of their cluster
+    # (lowest one in case of a tie)
+    remaining = np.where((labels < 0) & valid[cluster_index])[0]
+    if len(remaining):
+        scale = 2. * np.linalg.norm(np.ptp(coords, axis=0)) + 1.
+        tree = _tagged_tree(coords[labelled], cluster_index[labelled], scale)
+        query = np.column_stack((coords[remaining], scale * cluster_index[remaining]))
+        d, _ = tree.query(query)
+        neighbours = tree.query_ball_point(query, r=d + 1e-6 * (1. + d), return_sorted=False)
+        nearest = np.array([min(n) for n in neighbours], dtype=np.int64)
+        labels[remaining] = labels[labelled[nearest]]
+
+    # New clusters ordered by cluster id then DBSCAN label. Voxels of each
+    # new cluster: unmasked voxels, then masked ones, then noise, in their
+    # original order.
+    kept = np.where(labels > -1)[0]
+    if not len(kept):
+        return []
+    status = np.where(masked, 1, np.where(noise, 2, 0))[kept]
+    kept = kept[np.lexsort((kept, status, labels[kept], cluster_index[kept]))]
+    boundaries = np.where(np.diff(labels[kept]))[0] + 1
+    return np.split(coords[kept], boundaries)
+
+
+def match_clusters(predicted_clusters, true_clusters):
+    """
+    Matches each predicted cluster to the true cluster it overlaps most.
+
+    Voxel coordinates are assumed to be integers: the overlap of two
+    clusters is the number of voxels of the true cluster that are also in
+    the predicted one. All the overlaps come from one contingency table.
+
+    Parameters
+    ----------
+    predicted_clusters: list of np.ndarray
+        Coordinates of the voxels of each predicted cluster.
+    true_clusters: list of np.ndarray
+        Coordinates of the voxels of each true cluster.
+
+    Returns
+    -------
+    np.ndarray
+        Index of the matched true cluster for each predicted cluster, -1 if
+        it does not overlap any.
+    np.ndarray
+        Number of overlapping voxels with the matched true cluster.
+    """
+    num_predicted, num_true = len(predicted_clusters), len(true_clusters)
+    matches = -np.ones(num_predicted, dtype=np.int64)
+    overlaps = np.zeros(num_predicted, dtype=np.int64)
+    if not num_predicted or not num_true:
+        return matches, overlaps
+
+    predicted_sizes = [len(c) for c in predicted_clusters]
+    true_sizes = [len(c) for c in true_clusters]
+    coords = np.concatenate([np.reshape(c, (len(c), -1)) for c in predicted_clusters + true_clusters])
+    _, keys = np.unique(coords, axis=0, return_inverse=True)
+    keys = keys.reshape(-1)
+    predicted_keys = keys[:sum(predicted_sizes)]
+    true_keys = keys[sum(predicted_sizes):]
+    predicted_ids = np.repeat(np.arange(num_predicted), predicted_sizes)
+    true_ids = np.repeat(np.arange(num_true), true_sizes)
+
+    # Distinct (voxel, predicted cluster) pairs, joined with the true voxels
+    pairs = np.unique(predicted_keys * num_predicted + predicted_ids)
+    pair_keys, pair_ids = pairs // num_predicted, pairs % num_predicted
+    start = np.searchsorted(pair_keys, true_keys)
+    counts = np.searchsorted(pair_keys, true_keys, side='right') - start
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    predicted = pair_ids[np.repeat(start, counts) + within]
+    true = np.repeat(true_ids, counts)
+    overlap = np.bincount(predicted * num_true + true, minlength=num_predicted * num_true).reshape(num_predicted, num_true)
+
+    overlaps = overlap.max(axis=1)
+    matches = np.where(overlaps > 0, overlap.argmax(axis=1), -1)
+    return matches, overlaps
@@ -0,0 +1,80 @@
+"""
+Union-find and connected components utilities
+
+connected_components groups nodes linked by (thresholded) edges in one
+vectorized call, UnionFind handles ordered merges where the order of the
+unions matters (e.g. persistence diagrams).
+"""
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components as _connected_components
+
+
+def connected_components(edges, n, weights=None, thresh=None):
+    """
+    Labels the connected components of a graph
+    INPUTS:
+        edges   - (E, 2) array of edges (i, j)
+        n       - number of nodes
+        weights - (E) array of edge weights (optional)
+        thresh  - if provided, only edges with weight > thresh connect nodes
+    OUTPUT:
+        labels - (n) array of component labels between 0 and the number of components
+    """
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    if weights is not None and thresh is not None:
+        edges = edges[np.asarray(weights).reshape(-1) > thresh]
+    graph = sp.coo_matrix((np.ones(len(edges), dtype=np.int8), (edges[:,0], edges[:,1])), shape=(n, n))
+    _, labels = _connected_components(graph, directed=False)
+    return labels
+
+
+class UnionFind(object):
+    """
+    Array-based union-find (disjoint sets) with path compression.
+    find is iterative, so there is no recursion limit on the size of a set.
+    """
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        """
+        root of the set containing i, compresses the path from i to the root
+        """
+        parent = self.parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    def link(self, ri, rj):
+        """
+        attaches the set of root rj under the set of root ri
+        """
+        self.parent[rj] = ri
+
+    def union(self, i, j):
+        """
+        merges the sets containing i and j, the root of i's set is kept
+        returns the root of the merged set
+        """
+        ri, rj = self.find(i), self.find(j)
+        if ri != rj:
+            self.link(ri, rj)
+        return ri
+
+    def roots(self):
+        """
+        root of every element, as a numpy array
+        """
+        parent = np.array(self.parent)
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        self.parent = parent.tolist()
+        return parent
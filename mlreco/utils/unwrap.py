@@ -1,4 +1,70 @@
 import numpy as np
+import torch
+
+
+def _is_2d(d):
+    """
+    Whether d is a 2D array, or a 2D tensor (network outputs which have
+    not been copied to host yet, see ResultBlob)
+    """
+    return isinstance(d, (np.ndarray, torch.Tensor)) and len(d.shape) == 2
+
+
+def _column(d, data_dim):
+    """
+    Batch column of an array or tensor, as a numpy array
+    """
+    col = d[:,data_dim]
+    return col.cpu().numpy() if isinstance(col, torch.Tensor) else col
+
+
+def _segments(batch_col, batch_ids=None):
+    """
+    Finds the rows of each batch id with a single stable sort.
+    INPUTS:
+        batch_col: (N,) array of batch ids
+        batch_ids: sorted batch ids to look for, default all the unique ones
+    OUTPUT:
+        tuple (perm, batch_ids, starts, ends) where perm is the permutation
+        which sorts the rows by batch id (None if they already are) and
+        [starts[i], ends[i]) the range of batch_ids[i] in the sorted rows
+    """
+    if len(batch_col) and np.all(batch_col[:-1] <= batch_col[1:]):
+        perm, sorted_col = None, batch_col
+    else:
+        perm = np.argsort(batch_col, kind='stable')
+        sorted_col = batch_col[perm]
+    if batch_ids is None:
+        first = np.ones(len(sorted_col), dtype=bool)
+        first[1:] = sorted_col[1:] != sorted_col[:-1]
+        batch_ids = sorted_col[first]
+    starts = np.searchsorted(sorted_col, batch_ids, side='left')
+    ends   = np.searchsorted(sorted_col, batch_ids, side='right')
+    return perm, batch_ids, starts, ends
+
+
+def _split(d, segments):
+    """
+    Splits the rows of d by batch id given the output of _segments. Rows
+    keep their relative order, and the returned arrays are views of d (of
+    a single sorted copy if d is not sorted by batch id). Tensors are split
+    on their device.
+    """
+    perm, _, starts, ends = segments
+    if perm is not None:
+        d = d[torch.as_tensor(perm, device=d.device)] if isinstance(d, torch.Tensor) else d[perm]
+    return [d[s:e] for s, e in zip(starts, ends)]
+
+
+def is_event_output(values):
+    """
+    Whether the entries of an output are split by event by unwrap_scn (2D
+    arrays or tensors, or lists of them). Other outputs (e.g. losses) keep
+    one entry per minibatch.
+    """
+    return len(values) > 0 and all(_is_2d(v) or (isinstance(v, list) and len(v) > 0 and _is_2d(v[0]))
+                                   for v in values)
+
 
 def unwrap_2d_scn(data_blob, outputs, main_key=None, data_keys=None, output_keys=None):
     """
@@ -33,15 +99,15 @@ def unwrap_scn(data_blob, outputs, data_dim, main_key=None, data_keys=None, outp
 
     # Handle data
     result_data = {}
-    unwrap_map  = {} # dict of [#pts][batch_id] = where
+    unwrap_map  = {} # dict of [#pts] = segments, see _segments
     # a-0) Find the target keys
     target_array_keys = []
     target_list_keys  = []
     for key,data in data_blob.items():
         if not key in result_data: result_data[key]=[]
-        if isinstance(data[0],np.ndarray) and len(data[0].shape) == 2:
+        if _is_2d(data[0]):
             target_array_keys.append(key)
-        elif isinstance(data[0],list) and isinstance(data[0][0],np.ndarray) and len(data[0][0].shape) == 2:
+        elif isinstance(data[0],list) and _is_2d(data[0][0]):
             target_list_keys.append(key)
         elif isinstance(data[0],list):
             for d in data: result_data[key].extend(d)
@@ -56,15 +122,8 @@ def unwrap_scn(data_blob, outputs, data_dim, main_key=None, data_keys=None, outp
         for d in data:
             # check if batch map is available, and create if not
             if not d.shape[0] in unwrap_map:
-                batch_map = {}
-                batch_idx = np.unique(d[:,data_dim])
-                for b in batch_idx:
-                    batch_map[b] = d[:,data_dim] == b
-                unwrap_map[d.shape[0]]=batch_map
-
-            batch_map = unwrap_map[d.shape[0]]
-            for where in batch_map.values():
-                result_data[target].append(d[where])
+                unwrap_map[d.shape[0]] = _segments(_column(d, data_dim))
+            result_data[target].extend(_split(d, unwrap_map[d.shape[0]]))
 
     # a-2) Handle the list of list of ndarrays
     #for target in target_list_keys:
@@ -91,12 +150,9 @@ def unwrap_scn(data_blob, outputs, data_dim, main_key=None, data_keys=None, outp
         data = data_blob[target]
         for dlist in data:
             # construct a list of batch ids
-            batch_ids = []
-            for d in dlist:
-                batch_ids.extend([n for n in np.unique(d[:,data_dim]) if not n in batch_ids])
-            batch_ids.sort()
-            for b in batch_ids:
-                result_data[target].append([ d[d[:,data_dim] == b] for d in dlist ])
+            batch_ids = np.unique(np.concatenate([_column(d, data_dim) for d in dlist]))
+            split = [_split(d, _segments(_column(d, data_dim), batch_ids)) for d in dlist]
+            result_data[target].extend([list(x) for x in zip(*split)])
 
     # Handle output
     result_outputs = {}
@@ -106,9 +162,9 @@ def unwrap_scn(data_blob, outputs, data_dim, main_key=None, data_keys=None, outp
     for key, data in outputs.items():
         if not key in result_outputs: result_outputs[key]=[]
         if not isinstance(data,list): result_outputs[key].append(data)
-        elif isinstance(data[0],np.ndarray) and len(data[0].shape)==2:
+        elif _is_2d(data[0]):
             target_array_keys.append(key)
-        elif isinstance(data[0],list) and isinstance(data[0][0],np.ndarray) and len(data[0][0].shape)==2:
+        elif isinstance(data[0],list) and _is_2d(data[0][0]):
             target_list_keys.append(key)
         elif isinstance(data[0],list):
             for d in data: result_outputs[key].extend(d)
@@ -129,18 +185,12 @@ def unwrap_scn(data_blob, outputs, data_dim, main_key=None, data_keys=None, outp
         for d in data:
             # check if batch map is available, and create if not
             if not d.shape[0] in unwrap_map:
-                batch_map = {}
-                batch_idx = np.unique(d[:,data_dim])
+                segments = _segments(_column(d, data_dim))
                 # ensure these are integer values
-                # print(batch_idx)
+                batch_idx = segments[1]
                 assert(len(batch_idx) == len(np.unique(batch_idx.astype(np.int32))))
-                for b in batch_idx:
-                    batch_map[b] = d[:,data_dim] == b
-                unwrap_map[d.shape[0]]=batch_map
-
-            batch_map = unwrap_map[d.shape[0]]
-            for where in batch_map.values():
-                result_outputs[target].append(d[where])
+                unwrap_map[d.shape[0]] = segments
+            result_outputs[target].extend(_split(d, unwrap_map[d.shape[0]]))
 
     # b-2) Handle the list of list of ndarrays
     #for target in target_list_keys:
@@ -181,11 +231,11 @@ def unwrap_scn(data_blob, outputs, data_dim, main_key=None, data_keys=None, outp
             dlist = outputs[target][data_index]
             for d in dlist:
                 if not d.shape[0] in element_map:
-                    batch_idx = np.unique(d[:,data_dim])
+                    batch_col = _column(d, data_dim)
+                    batch_idx = np.unique(batch_col)
                     batch_ctrs.append(int(np.max(batch_idx)+1))
                     assert(len(batch_idx) == len(np.unique(batch_idx.astype(np.int32))))
-                    where = [d[:,data_dim] == b for b in range(batch_ctrs[-1])]
-                    element_map[d.shape[0]] = where
+                    element_map[d.shape[0]] = _segments(batch_col, np.arange(batch_ctrs[-1]))
         assert len(np.unique(batch_ctrs)) == 1
         list_unwrap_map.append(element_map)
         list_batch_ctrs.append(batch_ctrs[0])
@@ -195,8 +245,8 @@ def unwrap_scn(data_blob, outputs, data_dim, main_key=None, data_keys=None, outp
         for data_index, dlist in enumerate(data):
             batch_ctrs  = list_batch_ctrs[data_index]
             element_map = list_unwrap_map[data_index]
-            for b in range(batch_ctrs):
-                result_outputs[target].append([ d[element_map[d.shape[0]][b]] for d in dlist])
+            split = [_split(d, element_map[d.shape[0]]) for d in dlist]
+            result_outputs[target].extend([list(x) for x in zip(*split)])
 
     return result_data, result_outputs
 
@@ -5,6 +5,11 @@ import numpy as np
 import torch
 import sparseconvnet as scn
 import time
+import os
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
 def to_numpy(s):
     if isinstance(s, torch.Tensor):
@@ -15,6 +20,152 @@ def to_numpy(s):
         raise TypeError("Unknown return type %s" % type(s))
 
 
+def detach(s):
+    """
+    Detaches a network output from the graph without copying it to host.
+    SparseConvNetTensors are turned into a single (N, dim+1+F) tensor of
+    coordinates and features, as in to_numpy.
+    """
+    if isinstance(s, torch.Tensor):
+        return s.detach()
+    elif isinstance(s, scn.SparseConvNetTensor):
+        return torch.cat([s.get_spatial_locations().float(), s.features.cpu()], dim=1).detach()
+    elif isinstance(s, list):
+        return [detach(x) for x in s]
+    else:
+        raise TypeError("Unknown return type %s" % type(s))
+
+
+def _to_numpy_list(values):
+    """
+    Converts a list of tensors (or lists of tensors) to numpy. Tensors of
+    the same trailing shape on the same device are copied in a single
+    transfer, and returned as views of the host copy.
+    """
+    tensors = [v for v in values if isinstance(v, torch.Tensor)]
+    if len(tensors) > 1 and len(tensors) == len(values) \
+            and all(t.dim() > 0 and t.shape[1:] == tensors[0].shape[1:] and t.device == tensors[0].device
+                    and t.dtype == tensors[0].dtype for t in tensors):
+        host = torch.cat(tensors).detach().cpu().numpy()
+        bounds = np.cumsum([len(t) for t in tensors])[:-1]
+        return np.split(host, bounds)
+    return [_to_numpy_list(v) if isinstance(v, list) else
+            to_numpy(v) if isinstance(v, torch.Tensor) else v for v in values]
+
+
+class ResultBlob(MutableMapping):
+    """
+    Results of trainval.forward. Maps each key to a list with one entry per
+    minibatch (or per event if an unwrapper is used), like a dictionary.
+
+    Network outputs are kept as tensors (on device) until a key is
+    accessed, and only then converted to numpy arrays. The conversion is
+    cached, so outputs that are never read (e.g. intermediate PPN layers
+    in production inference) are never copied to host. Scalar results
+    (losses, accuracies) are stored as is.
+
+    This is a Mapping rather than a dict subclass, so that every accessor
+    (dict(blob), {**blob}, copy(), pop(), setdefault(), ...) goes through
+    __getitem__ and returns converted entries.
+    """
+    def __init__(self, *args, **kwargs):
+        self._data = {}
+        self._converted = set()
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        values = self._data[key]
+        if key not in self._converted:
+            values = _to_numpy_list(values)
+            self._data[key] = values
+            self._converted.add(key)
+        return values
+
+    def __setitem__(self, key, values):
+        self._data[key] = values
+        self._converted.discard(key)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._converted.discard(key)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, sorted(self._data))
+
+    def copy(self):
+        """
+        Dictionary of the converted entries
+        """
+        return dict(self)
+
+    def raw(self, key):
+        """
+        Entries of a key as stored (tensors if not converted yet)
+        """
+        return self._data[key]
+
+    def is_scalar(self, key):
+        """
+        Whether a key holds scalar results (python numbers), without
+        converting it
+        """
+        values = self.raw(key)
+        return len(values) > 0 and all(isinstance(v, (float, int)) for v in values)
+
+    def extend(self, other):
+        """
+        Appends the entries of another dictionary of lists, e.g. the
+        results of one more minibatch. Nothing is converted.
+        """
+        for key in other:
+            values = other.raw(key) if isinstance(other, ResultBlob) else other[key]
+            if key not in self:
+                self[key] = []
+            self.raw(key).extend(values)
+            if not isinstance(other, ResultBlob) or key not in other._converted:
+                self._converted.discard(key)
+
+    def event(self, index):
+        """
+        View of the results of one entry (event), keys are converted on
+        access
+        """
+        return ResultBlobView(self, index)
+
+
+class ResultBlobView(object):
+    """
+    Results of one event of a ResultBlob, see ResultBlob.event
+    """
+    def __init__(self, blob, index):
+        self._blob  = blob
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._blob[key][self._index]
+
+    def __contains__(self, key):
+        return key in self._blob
+
+    def __iter__(self):
+        return iter(self._blob)
+
+    def keys(self):
+        return self._blob.keys()
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
 def round_decimals(val, digits):
     factor = float(np.power(10, digits))
     return int(val * factor+0.5) / factor
@@ -97,30 +248,53 @@ class stopwatch(object):
 # Dumb class to organize output csv file
 class CSVData:
 
-    def __init__(self,fout):
+    def __init__(self,fout,sink=None):
         self.name  = fout
         self._fout = None
+        self._sink = sink  # File object to write to instead of fout
         self._str  = None
+        self._keys = None
         self._dict = {}
+        self.num_rows = 0
 
     def record(self, keys, vals):
         for i, key in enumerate(keys):
             self._dict[key] = vals[i]
 
+    def _write_header(self, keys):
+        self._fout=open(self.name,'w') if self._sink is None else self._sink
+        self._keys=list(keys)
+        self._str=''
+        for i,key in enumerate(self._keys):
+            if i:
+                self._fout.write(',')
+                self._str += ','
+            self._fout.write(key)
+            self._str+='{:f}'
+        self._fout.write('\n')
+        self._str+='\n'
+
     def write(self):
         if self._str is None:
-            self._fout=open(self.name,'w')
-            self._str=''
-            for i,key in enumerate(self._dict.keys()):
-                if i:
-                    self._fout.write(',')
-                    self._str += ','
-                self._fout.write(key)
-                self._str+='{:f}'
-            self._fout.write('\n')
-            self._str+='\n'
+            self._write_header(self._dict.keys())
 
         self._fout.write(self._str.format(*(self._dict.values())))
+        self.num_rows += 1
+
+    def write_arrays(self, **columns):
+        """
+        Writes a block of rows at once, given as one array (or scalar,
+        repeated for all the rows) per column
+        """
+        if self._str is None:
+            self._write_header(columns.keys())
+        if set(columns.keys()) != set(self._keys):
+            raise ValueError('%s has columns %s, got %s' % (self.name, self._keys, list(columns.keys())))
+        arrays = [np.asarray(columns[key]) for key in self._keys]
+        num_rows = max([len(a) for a in arrays if a.ndim > 0] or [1])
+        block = np.column_stack([np.broadcast_to(a, (num_rows,)) for a in arrays])
+        np.savetxt(self._fout, block, fmt='%f', delimiter=',')
+        self.num_rows += num_rows
 
     def flush(self):
         if self._fout: self._fout.flush()
@@ -128,3 +302,12 @@ class CSVData:
     def close(self):
         if self._str is not None:
             self._fout.close()
+
+    @property
+    def num_bytes(self):
+        """
+        Number of bytes written so far
+        """
+        if self._sink is not None:
+            return self._sink.num_bytes
+        return os.path.getsize(self.name) if self._str is not None and os.path.exists(self.name) else 0
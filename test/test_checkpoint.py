@@ -0,0 +1,124 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import os
+import pytest
+import torch
+
+
+class Chain(torch.nn.Module):
+    """
+    Two modules of a chain, with layer names that start with a module name.
+    """
+    def __init__(self):
+        super(Chain, self).__init__()
+        self.uresnet = torch.nn.Sequential(torch.nn.Linear(3, 4), torch.nn.BatchNorm1d(4))
+        self.ppn = torch.nn.Module()
+        self.ppn.ppn1_conv = torch.nn.Linear(4, 2)
+        self.ppn.conv = torch.nn.Linear(4, 2)
+
+
+def module_checkpoint(path, module, **kwargs):
+    """
+    Saves a module as a model of its own (wrapped in DataParallel)
+    """
+    state_dict = {'module.' + name: value for name, value in module.state_dict().items()}
+    torch.save({'state_dict': state_dict, 'global_step': 9}, str(path), **kwargs)
+
+
+def test_module_key_map():
+    """
+    Only the module component is removed from the names, other names which
+    start with the module name are left alone.
+    """
+    from mlreco.utils.checkpoint import module_key_map, remap_state_dict
+
+    net = torch.nn.DataParallel(Chain())
+    names = net.state_dict().keys()
+    key_map = module_key_map(names, 'ppn')
+    assert key_map == {'module.ppn1_conv.weight': 'module.ppn.ppn1_conv.weight',
+                       'module.ppn1_conv.bias': 'module.ppn.ppn1_conv.bias',
+                       'module.conv.weight': 'module.ppn.conv.weight',
+                       'module.conv.bias': 'module.ppn.conv.bias'}
+    assert module_key_map(names, '') == {}
+    # Nested modules, given with dots
+    names = ['module.uresnet.ppn.conv.weight', 'module.uresnet.ppn_conv.weight', 'module.ppn.conv.bias']
+    assert module_key_map(names, 'uresnet.ppn') == {'module.conv.weight': 'module.uresnet.ppn.conv.weight'}
+    assert module_key_map(names, 'ppn') == {'module.uresnet.conv.weight': 'module.uresnet.ppn.conv.weight',
+                                            'module.conv.bias': 'module.ppn.conv.bias'}
+    assert remap_state_dict({'module.conv.bias': 1, 'module.ppn.conv.bias': 2, 'other': 3}, key_map) == \
+        {'module.ppn.conv.bias': 1, 'other': 3}
+
+
+@pytest.mark.parametrize('zipfile', [True, False])
+def test_load_checkpoint(tmp_path, zipfile):
+    """
+    Memory-mapped and legacy checkpoints load the same weights.
+    """
+    from mlreco.utils.checkpoint import load_checkpoint, module_key_map, remap_state_dict
+
+    source = Chain()
+    module_checkpoint(tmp_path / 'ppn.ckpt', source.ppn, _use_new_zipfile_serialization=zipfile)
+    net = torch.nn.DataParallel(Chain())
+    state_dict = load_checkpoint(str(tmp_path / 'ppn.ckpt'))['state_dict']
+    net.load_state_dict(remap_state_dict(state_dict, module_key_map(net.state_dict().keys(), 'ppn')), strict=False)
+    assert torch.equal(net.module.ppn.ppn1_conv.weight, source.ppn.ppn1_conv.weight)
+    assert torch.equal(net.module.ppn.conv.bias, source.ppn.conv.bias)
+
+
+def test_chain_snapshot(tmp_path):
+    """
+    A snapshot is only used with the checkpoint files it was made from.
+    """
+    from mlreco.utils.checkpoint import checkpoint_sources, save_chain_snapshot, load_chain_snapshot
+
+    source = Chain()
+    module_checkpoint(tmp_path / 'uresnet.ckpt', source.uresnet)
+    module_checkpoint(tmp_path / 'ppn.ckpt', source.ppn)
+    model_paths = [('uresnet', str(tmp_path / 'uresnet.ckpt')), ('ppn', str(tmp_path / 'ppn.ckpt'))]
+    sources = checkpoint_sources(model_paths)
+    path = str(tmp_path / 'snapshots' / 'chain.ckpt')
+    assert load_chain_snapshot(path, sources) is None
+
+    state_dict = {'module.' + name: value for name, value in source.state_dict().items()}
+    save_chain_snapshot(path, state_dict, sources, global_step=9)
+    snapshot = load_chain_snapshot(path, checkpoint_sources(model_paths))
+    assert snapshot['global_step'] == 9
+    net = torch.nn.DataParallel(Chain())
+    net.load_state_dict(snapshot['state_dict'])
+    assert torch.equal(net.module.uresnet[1].running_var, source.uresnet[1].running_var)
+
+    # A snapshot made for inference has no optimizer state, it is not used for training
+    assert load_chain_snapshot(path, sources, train=True) is None
+    save_chain_snapshot(path, state_dict, sources, global_step=9, optimizer={'state': {}}, train=True)
+    assert load_chain_snapshot(path, sources, train=True)['optimizer'] == {'state': {}}
+    assert load_chain_snapshot(path, sources) is not None
+
+    module_checkpoint(tmp_path / 'ppn.ckpt', Chain().ppn)
+    os.utime(str(tmp_path / 'ppn.ckpt'), ns=(0, 0))
+    assert load_chain_snapshot(path, checkpoint_sources(model_paths)) is None
+
+
+def test_restore(tmp_path, capsys):
+    """
+    trainval restores each module from its checkpoint, then from the chain
+    snapshot in one read.
+    """
+    from mlreco.trainval import trainval
+
+    source = Chain()
+    module_checkpoint(tmp_path / 'uresnet.ckpt', source.uresnet)
+    module_checkpoint(tmp_path / 'ppn.ckpt', source.ppn)
+    cfg = {'model': {'modules': {'uresnet': {'model_path': str(tmp_path / 'uresnet.ckpt')},
+                                 'ppn': {'model_path': str(tmp_path / 'ppn.ckpt')}}},
+           'trainval': {'train': False, 'chain_snapshot': str(tmp_path / 'chain.ckpt')},
+           'iotool': {}}
+    for _ in range(2):
+        trainer = trainval(cfg)
+        trainer._net = torch.nn.DataParallel(Chain())
+        assert trainer.restore() == 0
+        for name, value in source.state_dict().items():
+            assert torch.equal(trainer._net.module.state_dict()[name], value)
+    out = capsys.readouterr().out
+    assert 'Saved chain snapshot' in out and 'Restoring weights from chain snapshot' in out
+    assert 'INCOMPATIBLE KEYS!' not in out
@@ -0,0 +1,72 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import os
+import numpy as np
+import pytest
+
+
+class ScaleTrainer(object):
+    """
+    Stands for trainval: the network multiplies its input by a weight read
+    from the checkpoint file.
+    """
+    def __init__(self):
+        self.weight = 0.
+        self.tspent_sum = {'io': 0., 'forward': 0.}
+
+    def restore(self, model_path=None):
+        self.weight = float(open(model_path).read())
+        return int(self.weight)
+
+    def get_weights(self):
+        return {'weight': self.weight}
+
+    def set_weights(self, weights):
+        self.weight = weights['weight']
+
+    def forward(self, data_iter):
+        from mlreco.utils import ResultBlob
+        data_blob = next(data_iter)
+        return data_blob, ResultBlob(output=[float(self.weight * data_blob['input_data'].sum())])
+
+
+def reader(num_batches, reads):
+    for i in range(num_batches):
+        reads.append(i)
+        yield {'index': [i], 'input_data': np.full(2, i + 1.)}
+
+
+@pytest.mark.parametrize('mode', ['data', 'weights'])
+def test_checkpoint_sweep(tmp_path, mode):
+    """
+    Each minibatch is read once, and each checkpoint logs the same
+    iterations as a run of its own in log_dir/<checkpoint name>.
+    """
+    from mlreco.main_funcs import Handlers, inference_loop
+    from mlreco.utils import stopwatch
+
+    for weight in (1, 2, 3):
+        (tmp_path / ('snapshot-%d.ckpt' % weight)).write_text(str(weight))
+    cfg = {'trainval': {'model_path': str(tmp_path / 'snapshot-*.ckpt'), 'log_dir': str(tmp_path),
+                        'iterations': 4, 'report_step': 0, 'train': False, 'checkpoint_sweep': mode}}
+    reads = []
+    handlers = Handlers()
+    handlers.trainer = ScaleTrainer()
+    handlers.watch = stopwatch()
+    handlers.data_io = range(4)
+    handlers.data_io_iter = reader(4, reads)
+    inference_loop(cfg, handlers)
+
+    assert reads == [0, 1, 2, 3]
+    for weight in (1, 2, 3):
+        log = os.path.join(str(tmp_path), 'snapshot-%d' % weight, 'inference_log-%07d.csv' % weight)
+        lines = open(log).read().split('\n')
+        header = lines[0].split(',')
+        rows = [dict(zip(header, line.split(','))) for line in lines[1:] if line]
+        assert [float(row['iter']) for row in rows] == [0, 1, 2, 3]
+        assert [float(row['output']) for row in rows] == [2. * weight * (i + 1) for i in range(4)]
+
+    cfg['trainval']['checkpoint_sweep'] = 'events'
+    with pytest.raises(ValueError):
+        inference_loop(cfg, handlers)
@@ -0,0 +1,89 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import time
+import numpy as np
+import pytest
+import torch
+
+
+def loop_pool(features, clusts, pooltype, p=2):
+    """
+    Reference implementation: one reduction per cluster.
+    """
+    pools = []
+    for c in clusts:
+        x = features[torch.as_tensor(c)]
+        if pooltype == 'max':
+            pools.append(torch.max(x, 0)[0])
+        elif pooltype == 'sum':
+            pools.append(torch.sum(x, 0))
+        elif pooltype == 'average':
+            pools.append(torch.mean(x, 0))
+        elif pooltype == 'pnorm':
+            pools.append(torch.norm(x, p=p, dim=0))
+    return torch.stack(pools)
+
+
+def random_clusters(num_points, num_clusters, num_batches=1):
+    """
+    Per-point cluster ids local to each batch (-1 = no cluster).
+    """
+    batch = np.sort(np.random.randint(num_batches, size=num_points))
+    clusts = np.random.randint(-1, num_clusters, size=num_points)
+    return torch.tensor(clusts), torch.tensor(batch)
+
+
+@pytest.mark.parametrize("pooltype", ['max', 'sum', 'average', 'pnorm'])
+def test_cluster_pool(pooltype):
+    from mlreco.models.layers.cluster_pool import ClusterPool
+    pool = ClusterPool(pooltype=pooltype)
+    clusts, batch = random_clusters(500, 20, num_batches=3)
+
+    # Reference clusters, in (batch, cluster id) order
+    ref_clusts = []
+    for b in np.unique(batch.numpy()):
+        for c in np.unique(clusts[batch == b].numpy()):
+            if c > -1:
+                ref_clusts.append(np.where((batch.numpy() == b) & (clusts.numpy() == c))[0])
+
+    features = torch.randn(500, 8, dtype=torch.double, requires_grad=True)
+    out = pool(features, clusts, batch)
+    grad = torch.autograd.grad(out.sum(), features)[0]
+
+    ref = loop_pool(features, ref_clusts, pooltype)
+    ref_grad = torch.autograd.grad(ref.sum(), features)[0]
+    assert torch.allclose(out, ref)
+    assert torch.allclose(grad, ref_grad)
+
+    # List of clusters input
+    out = pool(features, ref_clusts)
+    assert torch.allclose(out, ref)
+
+    _, _, ids = ClusterPool.flat_index(clusts, batch)
+    assert len(ids) == len(ref_clusts)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("pooltype", ['max', 'average'])
+def test_cluster_pool_benchmark(pooltype, num_points=100000, num_clusters=10000):
+    from mlreco.models.layers.cluster_pool import ClusterPool
+    pool = ClusterPool(pooltype=pooltype)
+    clusts, _ = random_clusters(num_points, num_clusters)
+    features = torch.randn(num_points, 8, requires_grad=True)
+
+    t = time.time()
+    out = pool(features, clusts)
+    out.sum().backward()
+    t_scatter = time.time() - t
+
+    ref_clusts = np.split(np.argsort(clusts.numpy(), kind='stable'),
+                          np.cumsum(np.bincount(clusts.numpy() + 1)))[1:-1]
+    ref_clusts = [c for c in ref_clusts if len(c)]
+    t = time.time()
+    ref = loop_pool(features, ref_clusts, pooltype)
+    ref.sum().backward()
+    t_loop = time.time() - t
+
+    print('%d clusters: scatter %.3f s, loop %.3f s' % (num_clusters, t_scatter, t_loop))
+    assert torch.allclose(out, ref, atol=1e-6)
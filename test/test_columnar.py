@@ -0,0 +1,70 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import os
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("chunk_size", [4, 1000])
+def test_columnar(tmp_path, chunk_size):
+    """
+    ColumnarData reads back the rows of record/write and write_arrays in
+    order, and converts to the same CSV as CSVData.
+    """
+    from mlreco.utils.utils import CSVData
+    from mlreco.utils.columnar import ColumnarData, read_columnar, columnar_to_csv
+
+    csv_name = os.path.join(str(tmp_path), 'out.csv')
+    npz_name = os.path.join(str(tmp_path), 'out.npz')
+    csv, npz = CSVData(csv_name), ColumnarData(npz_name, chunk_size=chunk_size)
+    x = np.random.rand(10)
+    for fout in (csv, npz):
+        for i in range(3):
+            fout.record(('idx', 'x', 'type'), (i, 0.5 * i, 1))
+            fout.write()
+        fout.write_arrays(idx=7, x=x, type=np.arange(10))
+        fout.record(('x',), (2.,))
+        fout.write()
+        fout.close()
+
+    columns = read_columnar(npz_name)
+    assert list(columns.keys()) == ['idx', 'x', 'type']
+    assert np.array_equal(columns['idx'], [0, 1, 2] + [7] * 10 + [2])
+    assert np.array_equal(columns['x'], np.concatenate([[0., 0.5, 1.], x, [2.]]))
+    assert np.array_equal(columns['type'], [1, 1, 1] + list(range(10)) + [1])
+
+    converted = columnar_to_csv(npz_name, os.path.join(str(tmp_path), 'converted.csv'))
+    assert open(converted).read() == open(csv_name).read()
+
+    with pytest.raises(ValueError):
+        ColumnarData(npz_name).write_arrays(idx=[1, 2], x=[1.])
+
+
+@pytest.mark.parametrize("output_format", ["csv", "npz"])
+def test_dry_run(tmp_path, output_format):
+    """
+    Writers opened in dry_run write nothing, and count the rows and bytes
+    of the file they would have written.
+    """
+    from mlreco.utils.columnar import open_writer, dry_run
+
+    def write(path):
+        fout = open_writer(path, output_format)
+        fout.write_arrays(idx=1, x=np.arange(100) / 7., type=3)
+        fout.record(('idx', 'x', 'type'), (2, 0.5, 4))
+        fout.write()
+        fout.close()
+        return fout
+
+    real = write(os.path.join(str(tmp_path), 'real.csv'))
+    with dry_run() as writers:
+        write(os.path.join(str(tmp_path), 'dry.csv'))
+    assert os.listdir(str(tmp_path)) == ['real.%s' % output_format]
+    assert len(writers) == 1
+    assert writers[0].num_rows == real.num_rows == 101
+    if output_format == 'csv':
+        assert writers[0].num_bytes == real.num_bytes
+    else:
+        # Same entries, plus the data descriptors of an unseekable zip file
+        assert abs(writers[0].num_bytes - real.num_bytes) < 0.2 * real.num_bytes
@@ -0,0 +1,25 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+from sklearn.metrics import confusion_matrix
+
+
+def test_confusion_matrix():
+    """
+    Per-event matrices and accuracies match sklearn on each event.
+    """
+    from mlreco.utils.confusion import ConfusionMatrix
+    rng = np.random.default_rng(0)
+    truth = [rng.integers(0, 6, n) for n in rng.integers(0, 200, 5)]
+    pred = [rng.integers(0, 5, len(t)) for t in truth]
+    confusion = ConfusionMatrix.from_events(truth, pred, num_truth=6, num_pred=5)
+    assert confusion.counts.shape == (5, 6, 5)
+    for e, (t, p) in enumerate(zip(truth, pred)):
+        np.testing.assert_array_equal(confusion.event(e), confusion_matrix(t, p, labels=np.arange(6))[:, :5])
+        if len(t):
+            assert np.isclose(confusion.accuracy()[e], np.mean(t == p))
+        for c in range(5):
+            expected = np.mean(p[t == c] == c) if np.any(t == c) else np.nan
+            np.testing.assert_equal(confusion.class_accuracy()[e, c], expected)
+    np.testing.assert_allclose(confusion.fractions().sum(axis=2)[confusion.true_counts() > 0], 1)
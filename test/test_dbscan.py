@@ -0,0 +1,25 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+import pytest
+from sklearn.cluster import DBSCAN
+
+
+@pytest.mark.parametrize("epsilon", [1.01, 1.99, 5])
+@pytest.mark.parametrize("minpts", [1, 3])
+def test_dbscan_labels(epsilon, minpts):
+    """
+    Grouped DBSCAN gives the labels of sklearn run on each group.
+    """
+    from mlreco.utils.dbscan import dbscan_labels
+    rng = np.random.default_rng(0)
+    voxels = np.floor(rng.uniform(0, 15, (400, 3)))
+    groups = rng.integers(0, 3, 400)
+    labels = dbscan_labels(voxels, epsilon, minpts, groups=groups)
+    for g in range(3):
+        select = groups == g
+        ref = DBSCAN(eps=epsilon, min_samples=minpts).fit(voxels[select]).labels_
+        local = labels[select]
+        _, local[local > -1] = np.unique(local[local > -1], return_inverse=True)
+        assert np.array_equal(local, ref)
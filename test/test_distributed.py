@@ -0,0 +1,172 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import os
+import socket
+import pytest
+import torch
+
+
+class Net(torch.nn.Module):
+    def __init__(self, cfg):
+        super(Net, self).__init__()
+        torch.manual_seed(0)
+        self.linear = torch.nn.Linear(3, 2)
+
+    def forward(self, x):
+        return {'output': [self.linear(x[0])]}
+
+
+class Loss(torch.nn.Module):
+    def __init__(self, cfg):
+        super(Loss, self).__init__()
+
+    def forward(self, result, label):
+        loss = ((result['output'][0] - label[0])**2).mean()
+        return {'loss': loss, 'count': 1}
+
+
+def make_trainval():
+    import mlreco.trainval
+    mlreco.trainval.construct = lambda name: (Net, Loss)
+    cfg = {
+        'model': {'name': 'test', 'modules': {}, 'network_input': ['input'], 'loss_input': ['label']},
+        'trainval': {'gpus': [], 'train': True, 'optimizer': {'name': 'SGD', 'args': {'lr': 0.1}}},
+        'iotool': {'batch_size': 4, 'minibatch_size': 1}
+    }
+    trainer = mlreco.trainval.trainval(cfg)
+    trainer.initialize()
+    return trainer
+
+
+def make_data():
+    generator = torch.Generator().manual_seed(1)
+    return [{'input': torch.randn(5, 3, generator=generator),
+             'label': torch.randn(5, 2, generator=generator),
+             'index': [i]} for i in range(4)]
+
+
+def train_worker(rank, world_size, port, output):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    trainer = make_trainval()
+    _, res = trainer.train_step(iter(make_data()[rank::world_size]))
+    if rank == 0:
+        torch.save({'parameters': [p.detach() for p in trainer._net.parameters()],
+                    'loss': res['loss'], 'count': res['count']}, output)
+    torch.distributed.destroy_process_group()
+
+
+@pytest.mark.parametrize("world_size", [2])
+def test_distributed_train_step(tmp_path, world_size):
+    """
+    One training step on 2 CPU processes (gloo) gives the same weights and
+    losses as on a single process.
+    """
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]
+    output = os.path.join(str(tmp_path), 'rank0.pth')
+    torch.multiprocessing.spawn(train_worker, args=(world_size, port, output), nprocs=world_size, join=True)
+    distributed = torch.load(output)
+
+    trainer = make_trainval()
+    _, res = trainer.train_step(iter(make_data()))
+    for p, q in zip(trainer._net.parameters(), distributed['parameters']):
+        assert torch.allclose(p, q)
+    assert sorted(res['loss']) == pytest.approx(sorted(distributed['loss']))
+    assert distributed['count'] == [1] * 4
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+class IndexTrainer(object):
+    """
+    Stands for trainval in inference, returns the event index as output
+    """
+    def __init__(self):
+        self.tspent_sum = {'io': 0., 'forward': 0.}
+
+    def restore(self, model_path=None):
+        return 0
+
+    def forward(self, data_iter):
+        from mlreco.utils import ResultBlob
+        data_blob = next(data_iter)
+        return data_blob, ResultBlob(output=[float(data_blob['index'][0])])
+
+
+def write_index(cfg, data_blob, res, logdir, iteration):
+    for index in data_blob['index']:
+        open(os.path.join(logdir, 'event-%d' % index), 'w').close()
+
+
+def inference_worker(rank, world_size, port, log_dir):
+    from mlreco.main_funcs import Handlers, inference_loop
+    from mlreco.post_processing.executor import PostProcessingExecutor
+    from mlreco.utils import stopwatch
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    (open(os.path.join(log_dir, 'model.ckpt'), 'w')).close()
+    cfg = {'trainval': {'model_path': os.path.join(log_dir, 'model.ckpt'), 'log_dir': log_dir,
+                        'iterations': 3, 'report_step': 0, 'train': False}}
+    handlers = Handlers()
+    handlers.trainer = IndexTrainer()
+    handlers.watch = stopwatch()
+    handlers.data_io = range(3)
+    # Shard of this process
+    handlers.data_io_iter = iter([{'index': [i]} for i in range(6)][rank::world_size])
+    handlers.post_processor = PostProcessingExecutor({}, processors=[write_index])
+    inference_loop(cfg, handlers)
+    torch.distributed.destroy_process_group()
+
+
+def test_distributed_post_processing(tmp_path):
+    """
+    Every process post-processes the events of its shard, in its own
+    directory.
+    """
+    world_size = 2
+    torch.multiprocessing.spawn(inference_worker, args=(world_size, free_port(), str(tmp_path)),
+                                nprocs=world_size, join=True)
+    files = [sorted(os.listdir(str(tmp_path / ('rank%d' % rank)))) for rank in range(world_size)]
+    assert files == [['event-0', 'event-2', 'event-4'], ['event-1', 'event-3', 'event-5']]
+
+
+def reduce_worker(rank, world_size, port, output):
+    from mlreco.utils import ResultBlob
+    from mlreco.utils.distributed import reduce_metrics
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    # Rank 1 has one more minibatch, and only rank 0 reports the accuracy
+    res = ResultBlob(loss=[0.5, 1.5], count=[1, 2], output=[torch.ones(2)])
+    if rank == 0:
+        res['accuracy'] = [0.25, 0.75]
+    else:
+        res.extend({'loss': [2.5], 'count': [3]})
+    res = reduce_metrics(res)
+    torch.save({key: res[key] for key in res if key != 'output'}, output % rank)
+    torch.distributed.destroy_process_group()
+
+
+def test_reduce_metrics(tmp_path):
+    """
+    Processes with different scalar keys and numbers of entries gather the
+    entries which were reported.
+    """
+    world_size = 2
+    output = os.path.join(str(tmp_path), 'rank%d.pth')
+    torch.multiprocessing.spawn(reduce_worker, args=(world_size, free_port(), output),
+                                nprocs=world_size, join=True)
+    for rank in range(world_size):
+        res = torch.load(output % rank)
+        assert res['loss'] == [0.5, 1.5, 0.5, 1.5, 2.5]
+        assert res['accuracy'] == [0.25, 0.75]
+    assert torch.load(output % 0)['count'] == [1, 2, 1, 2, 3]
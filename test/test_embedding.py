@@ -0,0 +1,40 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+import pytest
+from sklearn.cluster import DBSCAN
+from sklearn.decomposition import PCA
+
+
+@pytest.mark.parametrize("spread", [1., 10.])
+def test_radius_clusters(spread):
+    """
+    Clusters match DBSCAN(min_samples=1) on each group, for dense (leaders)
+    and sparse (all pairs) embeddings.
+    """
+    from mlreco.utils.embedding import radius_clusters
+    rng = np.random.default_rng(0)
+    centers = rng.normal(scale=50, size=(20, 8))
+    x = centers[rng.integers(0, 20, 2000)] + rng.normal(scale=spread, size=(2000, 8))
+    groups = np.sort(rng.integers(0, 3, 2000))
+    labels = radius_clusters(x, 20, groups=groups)
+    offset = 0
+    for g in range(3):
+        ref = DBSCAN(eps=20, min_samples=1).fit(x[groups == g]).labels_
+        np.testing.assert_array_equal(labels[groups == g], ref + offset)
+        offset += ref.max() + 1
+
+
+def test_pca():
+    """
+    Projection of each group matches sklearn PCA, up to the sign of the axes.
+    """
+    from mlreco.utils.embedding import pca
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(300, 6)) * np.arange(1, 7)
+    groups = rng.integers(0, 2, 300)
+    projection = pca(x, 2, groups=groups)
+    for g in range(2):
+        ref = PCA(n_components=2).fit_transform(x[groups == g])
+        np.testing.assert_allclose(np.abs(projection[groups == g]), np.abs(ref), atol=1e-8)
@@ -0,0 +1,77 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+import pytest
+import torch
+
+
+class FeatureMap(object):
+    """
+    Stands for a sparseconvnet tensor: features at spatial locations
+    (x, y, z, batch id)
+    """
+    metadata = None
+    spatial_size = None
+
+    def __init__(self, locations, features):
+        self._locations = torch.as_tensor(locations, dtype=torch.long)
+        self.features = features
+
+    def get_spatial_locations(self):
+        return self._locations
+
+
+def numpy_ghost_mask(ghost_mask, coords, ppn1_coords, factor, data_dim=3):
+    """
+    Previous implementation of GhostMask (numpy, lexsorts), which assumes
+    that the feature map locations are exactly the downsampled cells
+    """
+    coords = np.concatenate([coords, ghost_mask[:, None].numpy()], axis=1)
+    scale_coords, unique_indices = np.unique(np.concatenate([np.floor(coords[:, :data_dim]/2**factor), coords[:, data_dim:]], axis=1), axis=0, return_index=True)
+    keep = np.concatenate([np.where(scale_coords[:, -1] == 1)[0], np.where(scale_coords[:, -1] == 0)[0]], axis=0)
+    scale_coords2, unique_indices2 = np.unique(scale_coords[keep][:, :data_dim+1], axis=0, return_index=True)
+    perm2 = np.lexsort((scale_coords2[:, 0], scale_coords2[:, 1], scale_coords2[:, 2], scale_coords2[:, 3]))
+    scale_ghost_mask = ghost_mask[unique_indices][keep][unique_indices2][perm2]
+    perm = np.lexsort((ppn1_coords[:, 0], ppn1_coords[:, 1], ppn1_coords[:, 2], ppn1_coords[:, 3]))
+    return scale_ghost_mask[:, None][np.argsort(perm)].float()
+
+
+@pytest.mark.parametrize('factor', [0, 1, 2, 3])
+def test_ghost_mask(factor):
+    """
+    Same mask as the numpy implementation on random coordinates, feature map
+    locations in random order
+    """
+    from mlreco.models.layers.extract_feature_map import GhostMask
+
+    rng = np.random.RandomState(factor)
+    for _ in range(5):
+        coords = np.unique(np.column_stack([rng.randint(0, 32, (300, 3)), rng.randint(0, 3, 300)]), axis=0)
+        coords = coords[rng.permutation(len(coords))].astype(np.float64)
+        ghost_mask = torch.tensor(rng.uniform(size=len(coords)) < 0.3, dtype=torch.long)
+        cells = np.unique(np.column_stack([np.floor(coords[:, :3] / 2**factor), coords[:, 3]]), axis=0)
+        cells = cells[rng.permutation(len(cells))]
+        feature_map = FeatureMap(cells, torch.randn(len(cells), 4))
+
+        output, mask = GhostMask(3)(ghost_mask, coords, feature_map, factor=factor)
+        expected = numpy_ghost_mask(ghost_mask, coords, cells, factor)
+        assert torch.equal(mask, expected)
+        assert torch.equal(output.features, feature_map.features * expected)
+
+
+def test_add_labels():
+    """
+    Locations holding a label are set to 1, the others keep their attention
+    """
+    from mlreco.models.layers.extract_feature_map import AddLabels
+
+    rng = np.random.RandomState(0)
+    locations = np.unique(np.column_stack([rng.randint(0, 16, (200, 3)), rng.randint(0, 2, 200)]), axis=0)
+    attention = FeatureMap(locations, torch.rand(len(locations), 1))
+    label = torch.tensor(np.vstack([locations[rng.choice(len(locations), 20)], [[100, 100, 100, 0]]]))
+    output = AddLabels()(attention, label)
+    expected = attention.features.clone()
+    for l in label:
+        expected[(attention.get_spatial_locations() == l).all(dim=1)] = 1.0
+    assert torch.equal(output.features, expected)
@@ -0,0 +1,37 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+import torch
+
+
+def test_edge_feature_cache():
+    """
+    Features of the bipartite edges selected over the iterations of the
+    iterative GNN, looked up in the cache (and flipped for reversed pairs),
+    are the ones computed for these edges directly. Only the pairs that
+    were selected are computed.
+    """
+    from mlreco.utils.gnn.data import EdgeFeatureCache, cluster_edge_features
+    from mlreco.utils.gnn.network import complete_graph
+
+    rng = np.random.RandomState(0)
+    sizes = rng.randint(1, 6, size=12)
+    data = np.column_stack([rng.uniform(0, 20, size=(sizes.sum(), 3)), np.repeat(np.arange(12) // 6, sizes)])
+    clusts = np.split(np.arange(sizes.sum()), np.cumsum(sizes)[:-1])
+    batch = np.arange(12) // 6
+
+    cache = EdgeFeatureCache(data, clusts, complete_graph(batch, cuda=False))
+    full_index = cache.edge_index()
+    assigned = torch.zeros(12, dtype=torch.bool)
+    assigned[[0, 7]] = True
+    for newly_assigned in ([3, 9], [4, 5, 11]):
+        edge_ids = torch.nonzero(assigned[full_index[0]] & ~assigned[full_index[1]]).flatten()
+        edge_index = full_index[:, edge_ids]
+        expected = cluster_edge_features(data, clusts, edge_index, cuda=False)
+        assert torch.allclose(cache(edge_ids), expected, atol=1e-6)
+        assigned[newly_assigned] = True
+
+    # Pairs between two unassigned clusters of the last iteration are never computed
+    assert not cache._computed.all()
+    assert cache._computed.sum() < len(full_index[0]) // 2
@@ -0,0 +1,66 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import warnings
+import numpy as np
+
+
+def test_voxel_efficiency_per_event():
+    """
+    One value per event, including events without secondaries (nan, no
+    warning) and events after the last one with secondaries.
+    """
+    from mlreco.utils.gnn.evaluation import _voxel_efficiency
+
+    sizes = np.array([2., 3., 5.])
+    batch = np.array([0, 1, 2])
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        eff = _voxel_efficiency(np.array([True, False]), np.array([0, 1]), sizes, batch)
+        np.testing.assert_array_equal(eff, [1., 0., np.nan])
+        eff = _voxel_efficiency(np.array([True, False]), np.array([0, 2]), sizes, batch)
+        np.testing.assert_array_equal(eff, [1., np.nan, 0.])
+    assert _voxel_efficiency(np.array([True, False]), np.array([0, 2]), sizes) == 2. / 7.
+
+
+def test_secondary_matching_vox_efficiency2():
+    """
+    Secondary voxels matched to a primary of their group, per event
+    """
+    from mlreco.utils.gnn.evaluation import secondary_matching_vox_efficiency2
+
+    # event 0: clusters 0 (primary), 1, 2; event 1: clusters 3 (primary), 4
+    clusters = [np.arange(2), np.arange(2, 5), np.arange(5, 6), np.arange(6, 8), np.arange(8, 12)]
+    group = np.array([0, 0, 1, 3, 3])
+    matched = np.array([0, 0, 0, 3, -1])
+    batch = np.array([0, 0, 0, 1, 1])
+    eff = secondary_matching_vox_efficiency2(matched, group, [0, 3], clusters, batch=batch)
+    np.testing.assert_allclose(eff, [3. / 4., 0.])
+    assert np.isclose(secondary_matching_vox_efficiency2(matched, group, [0, 3], clusters), 3. / 8.)
+
+
+def test_metrics_step():
+    """
+    With metrics_step, training calls of the edge loss skip the metrics on
+    some steps and leave their keys out, evaluation calls always compute
+    them.
+    """
+    import torch
+    from mlreco.models.cluster_edge_gnn import EdgeChannelLoss
+    from mlreco.utils.gnn.network import complete_graph
+
+    rng = np.random.RandomState(0)
+    cluster_ids = np.repeat(np.arange(4), 3)
+    data = np.column_stack([rng.uniform(0, 10, size=(12, 3)), np.zeros(12), cluster_ids])
+    groups = np.column_stack([data[:, :4], cluster_ids // 2])
+    num_edges = complete_graph(np.zeros(4), cuda=False).shape[1]
+    out = {'edge_pred': [torch.tensor(rng.normal(size=(num_edges, 2)), dtype=torch.float)]}
+    loss = EdgeChannelLoss({'modules': {'clust_edge_model': {'remove_compton': False, 'metrics_step': 2}}})
+
+    metrics = ['ARI', 'AMI', 'SBD', 'purity', 'efficiency', 'accuracy']
+    results = [loss(out, [torch.tensor(data)], [torch.tensor(groups)]) for _ in range(3)]
+    assert [all(key in res for key in metrics) for res in results] == [True, False, True]
+    assert all('loss' in res and 'edge_count' in res for res in results)
+    loss.eval()
+    results = [loss(out, [torch.tensor(data)], [torch.tensor(groups)]) for _ in range(2)]
+    assert all(all(np.isfinite(float(res[key])) for key in metrics) for res in results)
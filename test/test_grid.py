@@ -0,0 +1,31 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+
+
+@pytest.mark.parametrize("radius", [0., 1.99, 5.])
+@pytest.mark.parametrize("strict", [False, True])
+def test_radius_pairs(radius, strict):
+    """
+    Spatial hash finds the same pairs as a dense distance matrix.
+    """
+    from mlreco.utils.grid import radius_pairs
+    rng = np.random.default_rng(0)
+    x = np.floor(rng.uniform(0, 20, (300, 3)))
+    y = rng.uniform(-5, 25, (100, 3))
+    x_batch = rng.integers(0, 3, 300)
+    y_batch = rng.integers(0, 3, 100)
+
+    d = cdist(x, y)
+    close = (d < radius if strict else d <= radius) & (x_batch[:, None] == y_batch[None, :])
+    i, j = radius_pairs(x, radius, y, x_batch=x_batch, y_batch=y_batch, strict=strict)
+    assert sorted(zip(i, j)) == sorted(zip(*np.where(close)))
+
+    # Pairs within x are found once, without (i, i)
+    d = cdist(x, x)
+    close = (d < radius if strict else d <= radius) & (x_batch[:, None] == x_batch[None, :])
+    i, j = radius_pairs(x, radius, x_batch=x_batch, strict=strict)
+    assert sorted(zip(np.minimum(i, j), np.maximum(i, j))) == sorted(zip(*np.where(np.triu(close, 1))))
@@ -0,0 +1,74 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+import pytest
+
+
+def events():
+    """
+    Random (pred, truth) clusterings of events of various sizes, plus limit
+    cases: one entry, a single cluster, all singletons, both.
+    """
+    rng = np.random.RandomState(0)
+    out = []
+    for size in (2, 5, 17, 60, 200):
+        out.append((rng.randint(0, 4, size), rng.randint(0, 6, size)))
+    out.append((np.array([3]), np.array([1])))
+    out.append((np.zeros(8, dtype=np.int64), np.zeros(8, dtype=np.int64)))
+    out.append((np.zeros(8, dtype=np.int64), np.arange(8)))
+    out.append((np.arange(8), np.arange(8)[::-1]))
+    out.append((np.arange(8), rng.randint(0, 3, 8)))
+    # many singletons along with larger clusters
+    out.append((np.r_[np.zeros(10, dtype=np.int64), np.arange(1, 11)], np.r_[np.arange(10), np.zeros(10, dtype=np.int64)]))
+    return out
+
+
+def test_clustering_metrics_sklearn():
+    """
+    ARI and AMI match scikit-learn for each event, computed one event at a
+    time or all at once with batch ids.
+    """
+    sklearn_metrics = pytest.importorskip('sklearn.metrics')
+    from mlreco.utils.metrics import clustering_metrics, ARI, AMI
+
+    evs = events()
+    expected_ari = [sklearn_metrics.adjusted_rand_score(t, p) for p, t in evs]
+    expected_ami = [sklearn_metrics.adjusted_mutual_info_score(t, p) for p, t in evs]
+    for (pred, truth), ari, ami in zip(evs, expected_ari, expected_ami):
+        assert np.isclose(ARI(pred, truth), ari)
+        assert np.isclose(AMI(pred, truth), ami)
+        metrics = clustering_metrics(pred, truth)
+        assert np.isclose(metrics[0], ari) and np.isclose(metrics[1], ami)
+
+    # Shuffled entries of all the events, with labels shared across events
+    bid = np.concatenate([np.full(len(p), 2 * i) for i, (p, t) in enumerate(evs)])
+    pred = np.concatenate([p for p, t in evs])
+    truth = np.concatenate([t for p, t in evs])
+    order = np.random.RandomState(1).permutation(len(bid))
+    batched = clustering_metrics(pred[order], truth[order], bid[order])
+    np.testing.assert_allclose(batched[0], expected_ari)
+    np.testing.assert_allclose(batched[1], expected_ami, atol=1e-10)
+    for i, (p, t) in enumerate(evs):
+        single = clustering_metrics(p, t)
+        np.testing.assert_allclose([m[i] for m in batched], single)
+
+
+def test_purity_efficiency():
+    """
+    Purity and efficiency of singleton clusters, and the contingency table
+    with the default sizes (largest label + 1) or larger ones (empty rows).
+    """
+    from mlreco.utils.metrics import purity_efficiency, contingency_table
+
+    pred = np.array([0, 0, 1, 2, 2, 2])
+    truth = np.array([0, 1, 1, 2, 2, 0])
+    pur, eff = purity_efficiency(pred, truth)
+    assert np.isclose(pur, (1 / 2. + 1 + 2 / 3.) / 3)
+    assert np.isclose(eff, (1 / 2. + 1 / 2. + 1) / 3)
+
+    table = contingency_table(pred, truth)
+    assert table.shape == (3, 3) and table.sum() == 6
+    assert table[2, 2] == 2 and table[0, 1] == 1
+    table = contingency_table(pred, truth, na=5, nb=4)
+    assert table.shape == (5, 4) and not table[3:].any() and not table[:, 3].any()
@@ -0,0 +1,54 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+from scipy.spatial.distance import cdist
+from sklearn.cluster import DBSCAN
+
+
+def test_voxel_index():
+    """
+    Nearest voxels and ties match np.argmin on the distance matrix.
+    """
+    from mlreco.utils.michel import VoxelIndex
+    rng = np.random.default_rng(0)
+    voxels = np.floor(rng.uniform(0, 10, (200, 3)))
+    points = np.floor(rng.uniform(-2, 12, (100, 3)))
+    index = VoxelIndex(voxels)
+    d, closest = index.nearest(points)
+    distances = cdist(points, voxels)
+    np.testing.assert_allclose(d, distances.min(axis=1))
+    np.testing.assert_array_equal(closest, distances.argmin(axis=1))
+    np.testing.assert_array_equal(index.count_within(points, 2), (distances < 2).sum(axis=1))
+
+    d, closest = VoxelIndex(np.empty((0, 3))).nearest(points)
+    assert np.isinf(d).all() and (closest == 0).all()
+
+
+def test_neighbour_graph():
+    """
+    DBSCAN of subsets from one neighbour graph matches sklearn.
+    """
+    from mlreco.utils.michel import NeighbourGraph
+    rng = np.random.default_rng(1)
+    voxels = np.floor(rng.uniform(0, 30, (400, 2)))
+    graph = NeighbourGraph(voxels, 2)
+    for _ in range(5):
+        index = np.sort(rng.choice(len(voxels), 250, replace=False))
+        labels = graph.dbscan(4, index)
+        ref = DBSCAN(eps=2, min_samples=4).fit(voxels[index]).labels_
+        np.testing.assert_array_equal(labels, ref)
+        assert graph.num_clusters(4, index) == len(np.unique(ref[ref > -1]))
+
+
+def test_is_at_edge():
+    """
+    A track is broken in two by a disc around its middle, not its end.
+    """
+    from mlreco.utils.michel import NeighbourGraph, is_at_edge
+    track = np.column_stack([np.arange(50), np.zeros(50)])
+    graph = NeighbourGraph(track, 5)
+    index = np.arange(50)
+    assert is_at_edge(graph, index, track[0], radius=10)
+    assert not is_at_edge(graph, index, track[25], radius=10)
+    assert is_at_edge(graph, index, track[25], radius=30)
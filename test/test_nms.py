@@ -0,0 +1,92 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+import pytest
+import torch
+
+
+def greedy_nms(points, scores, threshold, size):
+    """
+    Reference: sequential greedy NMS with square boxes of half side size.
+    """
+    order = list(np.argsort(scores, kind='stable')[::-1])
+    area = (2 * size + 1)**points.shape[1]
+    keep = []
+    while len(order):
+        i = order.pop(0)
+        keep.append(i)
+        inter = np.prod(np.maximum(0, 2 * size + 1 - np.abs(points[order] - points[i])), axis=1)
+        order = [j for j, o in zip(order, inter / (2 * area - inter)) if o <= threshold]
+    return keep
+
+
+@pytest.mark.parametrize("dim", [2, 3])
+@pytest.mark.parametrize("size", [1, 3, 2.5])
+def test_nms(dim, size):
+    """
+    Grid NMS keeps the same points as the greedy loop, for each batch id.
+    """
+    from mlreco.utils.nms import nms, nms_torch
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 40, (300, dim))
+    scores = rng.uniform(size=300)
+    batch = rng.integers(0, 3, 300)
+
+    assert list(nms(points, scores, 0.3, size)) == greedy_nms(points, scores, 0.3, size)
+
+    keep = nms(points, scores, 0.3, size, batch=batch)
+    ref = []
+    for b in range(3):
+        index = np.where(batch == b)[0]
+        ref.extend(index[greedy_nms(points[index], scores[index], 0.3, size)])
+    assert sorted(keep) == sorted(ref)
+    assert (np.diff(scores[keep]) <= 0).all()
+
+    keep_torch = nms_torch(torch.tensor(points), torch.tensor(scores), 0.3, size, batch=torch.tensor(batch))
+    assert np.array_equal(keep_torch.numpy(), keep)
+    assert len(nms(points[:0], scores[:0], 0.3, size)) == 0
+
+
+def track(num_points, decreasing=True):
+    """
+    Points spaced 1 apart along x, scores monotone along the track
+    """
+    points = np.column_stack([np.arange(num_points, dtype=np.float64), np.zeros(num_points), np.zeros(num_points)])
+    scores = np.linspace(1, 0, num_points)
+    return points, scores if decreasing else scores[::-1]
+
+
+@pytest.mark.parametrize("min_pass_fraction", [0., 0.25, 1.])
+def test_nms_chains(monkeypatch, min_pass_fraction):
+    """
+    Chains of overlapping points with monotone scores, zigzag scores or
+    random points give the greedy result, whether the passes are all
+    parallel (0), settled sequentially early (1) or by default.
+    """
+    import mlreco.utils.nms
+    monkeypatch.setattr(mlreco.utils.nms, 'MIN_PASS_FRACTION', min_pass_fraction)
+    rng = np.random.default_rng(1)
+    cases = [track(300), track(300, decreasing=False)]
+    points, scores = track(300)
+    cases.append((points, np.where(np.arange(300) % 2, scores, scores[::-1])))
+    cases.append((rng.uniform(0, 30, (400, 3)), rng.uniform(size=400)))
+    for points, scores in cases:
+        for threshold in (0.1, 0.5):
+            keep = mlreco.utils.nms.nms(points, scores, threshold, 3)
+            assert list(keep) == greedy_nms(points, scores, threshold, 3)
+
+
+@pytest.mark.slow
+def test_nms_track_benchmark(num_points=20000):
+    """
+    A track of decreasing scores keeps every third point, each pass of the
+    parallel resolution would only settle the head of the chain.
+    """
+    import time
+    from mlreco.utils.nms import nms
+    points, scores = track(num_points)
+    t = time.time()
+    keep = nms(points, scores, 0.5, 3)
+    print('%d points along a track: %.3f s' % (num_points, time.time() - t))
+    assert np.array_equal(keep, np.arange(0, num_points, 3))
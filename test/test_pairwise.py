@@ -0,0 +1,42 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import pytest
+import torch
+
+
+@pytest.mark.parametrize("max_memory", [2**28, 64])
+@pytest.mark.parametrize("batched", [False, True])
+def test_pairwise(max_memory, batched):
+    """
+    Chunked kernels agree with a dense distance matrix.
+    """
+    from mlreco.utils.pairwise import nearest, radius_count
+    torch.manual_seed(0)
+    x = torch.randint(0, 10, (200, 3)).double()
+    y = torch.randint(0, 10, (50, 3)).double()
+    x_batch = torch.randint(0, 3, (200,)) if batched else torch.zeros(200, dtype=torch.long)
+    y_batch = torch.randint(0, 2, (50,)) if batched else torch.zeros(50, dtype=torch.long)
+    x_label = torch.randint(0, 4, (200,))
+    y_label = torch.randint(0, 4, (50,))
+
+    d = torch.cdist(x, y)
+    d[x_batch[:, None] != y_batch[None, :]] = float('inf')
+    ref_dist, _ = torch.min(d, dim=1)
+
+    kwargs = dict(x_batch=x_batch, y_batch=y_batch) if batched else {}
+    dist, index = nearest(x, y, max_memory=max_memory, **kwargs)
+    found = ~torch.isinf(ref_dist)
+    assert torch.equal(found, ~torch.isinf(dist))
+    assert torch.allclose(dist[found], ref_dist[found])
+    assert torch.allclose(d[found, index[found]], ref_dist[found])
+    assert (index[~found] == -1).all()
+
+    radius = [1.5, 3.]
+    count = radius_count(x, y, radius, max_memory=max_memory, **kwargs)
+    same, other = radius_count(x, y, radius, x_label=x_label, y_label=y_label, max_memory=max_memory, **kwargs)
+    match = x_label[:, None] == y_label[None, :]
+    for k, r in enumerate(radius):
+        assert torch.equal(count[:, k], (d < r).sum(dim=1))
+        assert torch.equal(same[:, k], ((d < r) & match).sum(dim=1))
+        assert torch.equal(other[:, k], ((d < r) & ~match).sum(dim=1))
@@ -0,0 +1,196 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import os
+import time
+import numpy as np
+import pytest
+
+
+def write_sum(cfg, data_blob, res, logdir, iteration):
+    # Later iterations finish first if run in parallel
+    time.sleep(0.05 * (3 - iteration % 4))
+    np.save(os.path.join(logdir, 'sum-%d.npy' % iteration), data_blob['input_data'][0].sum() + res['loss'][0])
+
+
+def fail(cfg, data_blob, res, logdir, iteration):
+    if iteration == 2:
+        raise ValueError('post-processing failed')
+
+
+def write_rows(cfg, data_blob, res, logdir, iteration):
+    from mlreco.utils import open_writer
+    fout = open_writer(os.path.join(logdir, 'rows-%d.csv' % iteration))
+    fout.write_arrays(idx=iteration, value=data_blob['input_data'][0])
+    fout.close()
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_post_processing_executor(tmp_path, num_workers):
+    """
+    All the iterations are post-processed, and errors reach the main process.
+    """
+    from mlreco.post_processing.executor import PostProcessingExecutor
+
+    executor = PostProcessingExecutor({}, num_workers=num_workers, max_queue=2, processors=[write_sum])
+    for iteration in range(6):
+        executor.submit({'input_data': [np.full(3, iteration)]}, {'loss': [0.5]}, str(tmp_path), iteration)
+    executor.close()
+    for iteration in range(6):
+        assert np.load(os.path.join(str(tmp_path), 'sum-%d.npy' % iteration)) == 3 * iteration + 0.5
+
+    executor = PostProcessingExecutor({}, num_workers=num_workers, max_queue=2, processors=[fail])
+    with pytest.raises(ValueError):
+        for iteration in range(6):
+            executor.submit({}, {}, str(tmp_path), iteration)
+        executor.flush()
+    executor.close()
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_event_map(num_workers):
+    """
+    Per-event results come back in order.
+    """
+    from mlreco.post_processing.executor import event_map
+    events = [(np.full(3, i), i) for i in range(5)]
+    assert event_map(np.multiply, events, num_workers=num_workers)[3].tolist() == [9, 9, 9]
+    assert [r.sum() for r in event_map(np.multiply, events, num_workers=num_workers)] == [3 * i * i for i in range(5)]
+
+
+def test_event_map_shutdown():
+    """
+    Closing the executor stops the pools of event_map.
+    """
+    from mlreco.post_processing import executor as post_processing_executor
+    post_processing_executor.event_map(np.multiply, [(np.ones(2), 2)], num_workers=1)
+    pool = post_processing_executor._EVENT_POOLS[1]
+    post_processing_executor.PostProcessingExecutor({}, processors=[write_sum]).close()
+    assert not len(post_processing_executor._EVENT_POOLS)
+    with pytest.raises(RuntimeError):
+        pool.submit(np.multiply, 1, 2)
+
+
+@pytest.mark.parametrize("projection,projection_dim", [('pca', 2), ('pca', 3), ('tsne', 3)])
+def test_instance_clustering_projection(projection, projection_dim):
+    """
+    Projected embeddings follow the points of each class, except for the
+    classes with a single point.
+    """
+    pytest.importorskip('sklearn')
+    from mlreco.post_processing.instance_clustering import instance_clustering_event
+
+    rng = np.random.RandomState(0)
+    classes = np.array([0] * 40 + [1] + [2] * 35)
+    coords = rng.randint(0, 50, size=(len(classes), 3)).astype(np.float64)
+    perm = np.lexsort((coords[:, 2], coords[:, 1], coords[:, 0]))
+    coords, classes = coords[perm], classes[perm]
+    feature_map = np.column_stack([coords, rng.normal(size=(len(classes), 4))])
+    label = np.column_stack([coords, np.zeros(len(classes)), classes])
+    cluster_label = np.column_stack([coords, np.zeros(len(classes)), rng.randint(0, 3, len(classes))])
+    data = np.column_stack([coords, np.zeros(len(classes)), np.ones(len(classes))])
+    cluster_rows, _ = instance_clustering_event(0, 7, data, rng.uniform(size=(len(classes), 3)), [label],
+                                                [cluster_label], [feature_map], depth=1, num_classes=3,
+                                                projection=projection, projection_dim=projection_dim)
+    rows = cluster_rows[0]
+    projected = rows['type'] == 2
+    assert np.count_nonzero(rows['type'] == 1) == len(classes)
+    assert sorted(np.bincount(rows['true_class'][projected].astype(np.int64)).tolist()) == [0, 35, 40]
+    # Each class is followed by its projection
+    types = rows['type'][np.argsort(rows['true_class'], kind='stable')]
+    assert types.tolist() == [1.] * 40 + [2.] * 40 + [1.] + [1.] * 35 + [2.] * 35
+    assert (rows['z'][projected] != -1).any() == (projection_dim > 2)
+
+
+def test_dry_run(tmp_path):
+    """
+    A dry run writes nothing and reports the rows and bytes of each function.
+    """
+    from mlreco.post_processing.executor import run_post_processing
+    stats = run_post_processing([write_rows], {}, {'input_data': [np.arange(3)]}, {}, str(tmp_path), 0, dry_run=True)
+    assert not os.listdir(str(tmp_path))
+    assert [s[:3] for s in stats] == [('write_rows', 3, len('idx,value\n') + 3 * len('0.000000,0.000000\n'))]
+
+
+class Particle(object):
+    def energy_init(self):
+        return 30.
+
+
+def processor_inputs(name):
+    """
+    Configuration, data blob and network results of one event for a
+    post-processing function: a track (class 1) ending with a Michel
+    electron (class 2), with every result key any of them reads.
+    """
+    rng = np.random.RandomState(0)
+    track = np.column_stack([np.arange(30), np.full(30, 10), np.full(30, 10)])
+    michel = np.column_stack([np.full(8, 30), 11 + np.arange(8), np.full(8, 10)])
+    coords = np.concatenate([track, michel]).astype(np.float64)
+    classes = np.r_[np.ones(30), np.full(8, 2.)]
+    num = len(coords)
+    segmentation = rng.uniform(size=(num, 5))
+    segmentation[np.arange(num), classes.astype(np.int64)] += 1.
+    cluster_ids = np.r_[np.zeros(30), np.ones(8)]
+    cfg = {'post_processing': {name: {}},
+           'model': {'modules': {'dbscan': {'data_dim': 3, 'minPoints': 1},
+                                 'uresnet_clustering': {'data_dim': 3, 'num_strides': 1, 'num_classes': 5}}}}
+    data_blob = {
+        'index': [0],
+        'input_data': [np.column_stack([coords, np.zeros(num), np.ones(num)])],
+        'segment_label': [np.column_stack([coords, np.zeros(num), classes])],
+        'sparse3d_pcluster_semantics': [np.column_stack([coords, np.zeros(num), classes])],
+        'clusters_label': [np.column_stack([coords, np.zeros(num), np.ones(num), cluster_ids, classes])],
+        'particles_label': [np.array([[0., 10., 10., 0., 1.], [30., 10., 10., 0., 2.]])],
+    }
+    res = {
+        'segmentation': [segmentation],
+        'ghost': [np.column_stack([np.ones(num), np.zeros(num)])],
+        'points': [np.column_stack([rng.uniform(-0.5, 0.5, size=(num, 3)), rng.normal(size=(num, 2)),
+                                    rng.normal(size=(num, 5))])],
+        'mask_ppn2': [np.ones((num, 1))],
+        'ppn1': [np.column_stack([coords[::4], rng.normal(size=(len(coords[::4]), 2))])],
+        'ppn2': [np.column_stack([coords[::2], rng.normal(size=(len(coords[::2]), 2))])],
+        'final': [np.column_stack([coords, cluster_ids])],
+        'cluster_feature': [[np.column_stack([coords, rng.normal(size=(num, 4))])]],
+    }
+    if name == 'deghosting_metrics':
+        cfg['post_processing'][name]['method'] = '5+2'
+    elif name == 'michel_reconstruction':
+        data_blob['particles_label'] = [[Particle(), Particle()]]
+    elif name == 'michel_reconstruction_2d':
+        # 2D, MIP is class 0 and Michel class 3
+        classes_2d = np.where(classes == 1, 0., 3.)
+        data_blob['input_data'] = [np.column_stack([coords[:, :2], np.zeros(num), np.ones(num)])]
+        data_blob['segment_label'] = [np.column_stack([coords[:, :2], np.zeros(num), classes_2d])]
+        data_blob['meta'] = [np.array([0., 0., 64., 64., 1., 1.])]
+        segmentation = rng.uniform(size=(num, 5))
+        segmentation[np.arange(num), classes_2d.astype(np.int64)] += 1.
+        res['segmentation'] = [segmentation]
+    elif name == 'track_clustering':
+        data_blob['clusters_label'] = [np.column_stack([coords, np.zeros(num), cluster_ids])]
+    elif name == 'instance_clustering':
+        data_blob['segment_label'] = [[data_blob['segment_label'][0]]]
+        data_blob['cluster_label'] = [[np.column_stack([coords, np.zeros(num), cluster_ids])]]
+    return cfg, data_blob, res
+
+
+def test_processor_result_keys(tmp_path):
+    """
+    Each post-processing function runs on the results restricted to the
+    keys it declares in result_keys.
+    """
+    pytest.importorskip('sklearn')
+    import mlreco.post_processing as post_processing
+
+    names = [name for name in dir(post_processing) if callable(getattr(post_processing, name))]
+    assert len(names) == 9
+    for name in names:
+        processor = getattr(post_processing, name)
+        cfg, data_blob, res = processor_inputs(name)
+        assert set(processor.result_keys) <= set(res)
+        res = {key: res[key] for key in processor.result_keys}
+        logdir = tmp_path / name
+        logdir.mkdir()
+        processor(cfg, data_blob, res, str(logdir), 0)
+        assert len(os.listdir(str(logdir)))
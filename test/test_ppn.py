@@ -0,0 +1,142 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+
+
+def make_output(n, num_batches, rng):
+    data = np.column_stack([rng.integers(0, 20, (n, 3)), np.sort(rng.integers(0, num_batches, n)),
+                            rng.uniform(size=n)]).astype(np.float64)
+    out = {'points': [rng.normal(size=(n, 10))],
+           'mask_ppn2': [rng.integers(0, 2, (n, 1))],
+           'segmentation': [rng.normal(size=(n, 5))]}
+    return data, out
+
+
+def test_uresnet_ppn_type_point_selector():
+    """
+    The whole minibatch gives the same points as one event at a time, and
+    points of the same type closer than 1.99 are merged.
+    """
+    from mlreco.utils.ppn import uresnet_ppn_type_point_selector
+    rng = np.random.default_rng(0)
+    data, out = make_output(500, 3, rng)
+    points = uresnet_ppn_type_point_selector(data, out, type_threshold=2)
+    assert points.shape[1] == 5 and len(points)
+    for b in range(3):
+        select = data[:, 3] == b
+        event = uresnet_ppn_type_point_selector(data[select], {key: [value[0][select]] for key, value in out.items()}, type_threshold=2)
+        assert np.allclose(points[points[:, 3] == b], event)
+
+    # Two points of type 1 on voxels of class 1, one of type 1 far away
+    data = np.array([[0, 0, 0, 0, 1], [1, 0, 0, 0, 1], [10, 0, 0, 0, 1]], dtype=np.float64)
+    points = np.zeros((3, 10))
+    points[:, 4] = 5
+    points[:, 6] = 5
+    segmentation = np.zeros((3, 5))
+    segmentation[:, 1] = 1
+    out = {'points': [points], 'mask_ppn2': [np.ones((3, 1))], 'segmentation': [segmentation]}
+    selected = uresnet_ppn_type_point_selector(data, out, type_threshold=2)
+    assert np.allclose(selected, [[1., .5, .5, 0, 1], [10.5, .5, .5, 0, 1]])
+
+
+def per_event_ppn_loss(loss, result, label, particles, weight=None):
+    """
+    Previous implementation of uresnet_ppn.SegmentationLoss: one event at a
+    time, dense distance matrices.
+    """
+    import torch
+    def distances(v1, v2):
+        return torch.cdist(v1.double(), v2.double())
+    keys = ['uresnet_loss', 'uresnet_acc', 'ppn_loss', 'ppn_acc', 'loss_class', 'loss_distance',
+            'loss_ppn1', 'loss_ppn2', 'acc_ppn1', 'acc_ppn2']
+    totals = dict.fromkeys(keys, 0.)
+    ppn_count = 0
+    dim, num_strides = loss._dimension, loss._num_strides
+    for i in range(len(label)):
+        batch_ids = label[i][:, -2]
+        for b in batch_ids.unique():
+            index = batch_ids == b
+            ppn1_index = result['ppn1'][i][:, -3] == b
+            ppn2_index = result['ppn2'][i][:, -3] == b
+            data = label[i][index][:, :dim]
+            pixel_pred = result['points'][i][index][:, :dim] + data + 0.5
+            scores = result['points'][i][index][:, dim:dim + 2]
+            seg_label = label[i][index][:, -1].long()
+            seg = loss.cross_entropy(result['segmentation'][i][index], seg_label)
+            if weight is not None:
+                seg = seg * weight[i][index][:, 0]
+            totals['uresnet_loss'] += seg.mean()
+            totals['uresnet_acc'] += (result['segmentation'][i][index].argmax(-1) == seg_label).float().mean().item()
+            gt = particles[i][particles[i][:, -2] == b][:, :-2]
+            if not len(gt):
+                continue
+            mask = (result['mask_ppn2'][i][index] != 0).any(dim=1)
+            pixel_pred, scores, data = pixel_pred[mask], scores[mask], data[mask]
+            ppn2_mask = (result['mask_ppn1'][i][ppn2_index] != 0).any(dim=1)
+            ppn1_data, ppn1_scores = result['ppn1'][i][ppn1_index][:, :-3], result['ppn1'][i][ppn1_index][:, -2:]
+            ppn2_data, ppn2_scores = result['ppn2'][i][ppn2_index][ppn2_mask][:, :-3], result['ppn2'][i][ppn2_index][ppn2_mask][:, -2:]
+            d = distances(gt, pixel_pred)
+            positives = (distances(gt, data) < 5).any(dim=0)
+            if not len(positives):
+                continue
+            loss_class = loss.cross_entropy(scores.double(), positives.long()).mean()
+            acc = (scores.argmax(-1) == positives.long()).float().mean().item()
+            pos1 = (distances(torch.floor(gt / 2**(num_strides - 1)), ppn1_data) < 1).any(dim=0)
+            pos2 = (distances(torch.floor(gt / 2**int(num_strides / 2)), ppn2_data) < 1).any(dim=0)
+            loss1 = loss.cross_entropy(ppn1_scores.double(), pos1.long()).mean()
+            loss2 = loss.cross_entropy(ppn2_scores.double(), pos2.long()).mean()
+            distance = d[:, positives].min(dim=0)[0].mean() if positives.any() else 0.
+            totals['loss_class'] += loss_class
+            totals['loss_distance'] += distance
+            totals['loss_ppn1'] += loss1
+            totals['loss_ppn2'] += loss2
+            totals['acc_ppn1'] += (ppn1_scores.argmax(-1) == pos1.long()).float().mean().item()
+            totals['acc_ppn2'] += (ppn2_scores.argmax(-1) == pos2.long()).float().mean().item()
+            totals['ppn_loss'] += (loss_class + distance + loss1 + loss2).float()
+            totals['ppn_acc'] += acc
+            ppn_count += 1
+    totals['loss'] = totals['uresnet_loss'] + totals['ppn_loss']
+    return {key: value / ppn_count for key, value in totals.items()}
+
+
+def test_uresnet_ppn_loss():
+    """
+    The minibatch loss matches the per-event loss (values and gradients),
+    with an event without particles, which is reported once per minibatch.
+    """
+    import pytest
+    import torch
+    from mlreco.models.uresnet_ppn import SegmentationLoss
+
+    rng = np.random.default_rng(1)
+    torch.manual_seed(1)
+    cfg = {'modules': {'uresnet_ppn': {'data_dim': 3, 'num_strides': 3}}}
+    loss = SegmentationLoss(cfg)
+    label, particles, result, weight = [], [], {key: [] for key in ('points', 'segmentation', 'mask_ppn1', 'mask_ppn2', 'ppn1', 'ppn2')}, []
+    for gpu in range(2):
+        n, batch = 120, np.sort(rng.integers(0, 4, 120))
+        label.append(torch.tensor(np.column_stack([rng.integers(0, 16, (n, 3)), batch, rng.integers(0, 5, n)]), dtype=torch.float))
+        points = rng.integers(0, 16, (8, 3))
+        particle_batch = rng.choice([0, 1, 2], 8)  # no particle in event 3
+        particles.append(torch.tensor(np.column_stack([points, particle_batch, np.zeros(8)]), dtype=torch.float))
+        result['points'].append(torch.randn(n, 5, requires_grad=True))
+        result['segmentation'].append(torch.randn(n, 5, requires_grad=True))
+        result['mask_ppn2'].append(torch.tensor(rng.integers(0, 2, (n, 1)) | (rng.uniform(size=(n, 1)) < .3)))
+        for key, size, scale in (('ppn1', 30, 4), ('ppn2', 60, 8)):
+            ppn_batch = np.sort(rng.integers(0, 4, size))
+            scores = torch.randn(size, 2, requires_grad=True)
+            result[key].append(torch.cat([torch.tensor(np.column_stack([rng.integers(0, scale, (size, 3)), ppn_batch]), dtype=torch.float), scores], dim=1))
+        result['mask_ppn1'].append(torch.tensor(rng.integers(0, 2, (60, 1))))
+        weight.append(torch.tensor(rng.uniform(size=(n, 1)), dtype=torch.float))
+
+    for w in (None, weight):
+        with pytest.warns(UserWarning, match='1 event\\(s\\) without particles'):
+            res = loss(result, label, particles, w)
+        expected = per_event_ppn_loss(loss, result, label, particles, w)
+        for key, value in expected.items():
+            assert np.isclose(float(res[key].detach()), float(torch.as_tensor(value).detach())), key
+        grads = torch.autograd.grad(res['loss'], [result['points'][0], result['segmentation'][1]])
+        expected_grads = torch.autograd.grad(expected['loss'], [result['points'][0], result['segmentation'][1]])
+        for g, e in zip(grads, expected_grads):
+            assert torch.allclose(g.float(), e.float(), atol=1e-6)
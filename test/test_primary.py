@@ -0,0 +1,73 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+
+
+def greedy_primaries(primaries, clusts, data, use_labels=False, max_dist=None):
+    """
+    Previous implementation: closest cluster (np.argmin) of each primary
+    among the clusters of its batch (and label), one primary at a time.
+    Also returns the unique assignment, where a later primary only takes a
+    cluster from an earlier one if it is strictly closer.
+    """
+    batches = np.array([np.bincount(data[c, 3].astype(np.int64)).argmax() for c in clusts])
+    labels = np.array([np.bincount(data[c, 4].astype(np.int64)).argmax() for c in clusts])
+    assn, unique, unique_scores = [], -np.ones(len(primaries)), -np.ones(len(primaries))
+    for i, primary in enumerate(primaries):
+        pselection = batches == primary[-2]
+        if use_labels:
+            pselection &= labels == primary[-1]
+        pinds = np.where(pselection)[0]
+        if not len(pinds):
+            continue
+        scores = np.array([cdist([primary[:3]], data[clusts[p], :3]).min() for p in pinds])
+        ind = np.argmin(scores)
+        if not max_dist or scores[ind] <= max_dist:
+            assn.append(pinds[ind])
+        already_assigned = np.where(unique == pinds[ind])[0]
+        if len(already_assigned):
+            if scores[ind] < unique_scores[already_assigned][0]:
+                unique[already_assigned] = unique_scores[already_assigned] = -1
+            else:
+                continue
+        unique[i], unique_scores[i] = pinds[ind], scores[ind]
+    return np.unique(assn), unique
+
+
+@pytest.mark.parametrize('use_labels', [False, True])
+@pytest.mark.parametrize('max_dist', [None, 4.])
+def test_assign_primaries(use_labels, max_dist):
+    """
+    Same assignments as the previous implementation on integer coordinates
+    (many ties), including primaries of a batch without clusters.
+    """
+    from mlreco.utils.gnn.primary import assign_primaries, assign_primaries_unique, nearest_clusters
+
+    rng = np.random.RandomState(1)
+    for _ in range(20):
+        num_clusts = rng.randint(1, 15)
+        sizes = rng.randint(1, 8, size=num_clusts)
+        clust_batch = rng.randint(0, 3, size=num_clusts)
+        clust_label = rng.randint(0, 2, size=num_clusts)
+        data = np.column_stack([rng.randint(0, 10, size=(sizes.sum(), 3)),
+                                np.repeat(clust_batch, sizes), np.repeat(clust_label, sizes)]).astype(np.float64)
+        clusts = np.empty(num_clusts, dtype=object)
+        clusts[:] = np.split(np.arange(sizes.sum()), np.cumsum(sizes)[:-1])
+        num_primaries = rng.randint(1, 8)
+        primaries = np.column_stack([rng.randint(0, 10, size=(num_primaries, 3)),
+                                     rng.randint(0, 4, size=num_primaries),
+                                     rng.randint(0, 2, size=num_primaries)]).astype(np.float64)
+
+        expected, expected_unique = greedy_primaries(primaries, clusts, data, use_labels, max_dist)
+        assn = assign_primaries(primaries, clusts, data, use_labels=use_labels, max_dist=max_dist)
+        np.testing.assert_array_equal(assn, expected)
+        np.testing.assert_array_equal(assign_primaries_unique(primaries, clusts, data, use_labels=use_labels),
+                                      expected_unique)
+
+        # Batch 3 has no cluster: nothing is found beyond the scale/2 cutoff
+        inds, dists = nearest_clusters(primaries, clusts, data, use_labels=use_labels)
+        assert (inds[primaries[:, -2] == 3] == -1).all()
+        assert np.isinf(dists[inds == -1]).all()
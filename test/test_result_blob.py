@@ -0,0 +1,78 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+import torch
+
+
+def test_result_blob():
+    """
+    Tensors are converted to numpy on access only, and scalars are kept.
+    """
+    from mlreco.utils.utils import ResultBlob
+
+    res = ResultBlob()
+    res.extend({'loss': [0.5], 'segmentation': [torch.arange(6.).reshape(3, 2)]})
+    res.extend({'loss': [1.5], 'segmentation': [torch.arange(4.).reshape(2, 2)],
+                'points': [[torch.zeros(2, 4), torch.ones(1, 4)]]})
+    assert res.is_scalar('loss') and not res.is_scalar('segmentation')
+    assert isinstance(res.raw('segmentation')[0], torch.Tensor)
+
+    segmentation = res['segmentation']
+    assert all(isinstance(s, np.ndarray) for s in segmentation)
+    assert [s.shape for s in segmentation] == [(3, 2), (2, 2)]
+    assert np.array_equal(segmentation[1], np.arange(4.).reshape(2, 2))
+    assert res['segmentation'] is segmentation
+    assert isinstance(res.get('points')[0][1], np.ndarray)
+    assert res.get('ppn1') is None
+
+    event = res.event(1)
+    assert event['loss'] == 1.5
+    assert np.array_equal(event['segmentation'], segmentation[1])
+
+
+def test_result_blob_accessors():
+    """
+    Copies and accessors of dict (dict(), unpacking, copy, pop, setdefault,
+    values, items) return converted entries.
+    """
+    from mlreco.utils.utils import ResultBlob
+
+    def blob():
+        res = ResultBlob()
+        res.extend({'loss': [0.5], 'segmentation': [torch.ones(3, 2)], 'ghost': [torch.zeros(3, 2)]})
+        return res
+
+    res = blob()
+    for copy in (dict(res), {**res}, res.copy()):
+        assert type(copy) is dict and sorted(copy) == ['ghost', 'loss', 'segmentation']
+        assert isinstance(copy['segmentation'][0], np.ndarray) and copy['loss'] == [0.5]
+    res = blob()
+    assert isinstance(res.pop('segmentation')[0], np.ndarray) and 'segmentation' not in res
+    assert isinstance(res.setdefault('ghost', [])[0], np.ndarray)
+    res = blob()
+    assert all(isinstance(v[0], (np.ndarray, float)) for v in res.values())
+    assert all(isinstance(v[0], (np.ndarray, float)) for _, v in res.items())
+    assert len(res) == 3 and res.get('ppn1', 1) == 1
+
+
+def test_post_processing_result_keys():
+    """
+    Only the keys read by the post-processors are converted before being
+    submitted to the workers.
+    """
+    from mlreco.utils.utils import ResultBlob
+    from mlreco.post_processing.executor import result_keys
+    from mlreco.post_processing import store_uresnet, store_input
+
+    res = ResultBlob()
+    res.extend({'loss': [0.5], 'segmentation': [torch.ones(3, 2)], 'ppn1': [torch.zeros(3, 2)]})
+    keys = result_keys([store_uresnet, store_input], res)
+    assert keys == ['segmentation']
+    submitted = {key: res[key] for key in keys}
+    assert isinstance(submitted['segmentation'][0], np.ndarray)
+    assert isinstance(res.raw('ppn1')[0], torch.Tensor)
+
+    def custom(cfg, data_blob, res, logdir, iteration):
+        pass
+    assert result_keys([store_uresnet, custom], res) == ['loss', 'segmentation', 'ppn1']
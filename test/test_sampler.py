@@ -31,3 +31,23 @@ def test_sampler(data_size, minibatch_size):
     print('...max reuse:', used2.max(), 'for', used2.argmax())
     print('...average:', used3[np.where(used > 0)].mean())
     return True
+
+
+@pytest.mark.parametrize("world_size", [1, 2, 3])
+def test_sharded_sampler(world_size):
+    """
+    Tests that ShardedSampler splits the minibatches between processes.
+    """
+    from mlreco.iotools.samplers import ShardedSampler, SequentialBatchSampler
+    import numpy as np
+
+    base = SequentialBatchSampler(100, 5)
+    shards = [list(ShardedSampler(base, 5, rank, world_size)) for rank in range(world_size)]
+    for shard in shards:
+        assert len(shard) == len(shards[0])
+    used = np.concatenate(shards)
+    assert len(np.unique(used)) == len(used)
+    full = list(base)
+    assert np.isin(used, full).all()
+    assert len(full) - len(used) < 5 * world_size
+    assert np.array_equal(shards[0][:5], full[:5])
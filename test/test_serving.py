@@ -0,0 +1,133 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import os
+import time
+import numpy as np
+import pytest
+
+
+CFG = {
+    'iotool': {'batch_size': 4, 'minibatch_size': 4, 'collate_fn': 'CollateSparse'},
+    'trainval': {'gpus': [], 'log_dir': '.', 'unwrapper': 'unwrap_3d_scn'},
+    'serving': {'max_batch_size': 4, 'max_latency': 0.05},
+}
+
+
+class SumTrainer(object):
+    """
+    Stands for trainval with an unwrapper: one (1, 1) array per event of the
+    minibatch, plus scalars of the minibatch (its size, and one score per
+    event which must not be split by event).
+    """
+    def __init__(self, delay=0.):
+        self.delay = delay
+        self.batch_sizes = []
+
+    def forward(self, data_iter):
+        data_blob = next(data_iter)
+        data = data_blob['input_data']
+        if np.any(data[:, 0] < 0):
+            raise ValueError('negative input')
+        time.sleep(self.delay)
+        batch_ids = np.unique(data[:, -1])
+        self.batch_sizes.append(len(batch_ids))
+        res = {'total': [np.full((1, 1), data[data[:, -1] == b, 0].sum()) for b in batch_ids],
+               'batch_size': [len(batch_ids)], 'scores': [float(b) for b in batch_ids]}
+        return data_blob, res
+
+
+def event(i):
+    return {'input_data': np.column_stack([np.full(i + 1, i, dtype=np.float32), np.zeros(i + 1)])}
+
+
+def write_index(cfg, data_blob, res, logdir, iteration):
+    for index in data_blob['index']:
+        open(os.path.join(logdir, 'event-%d' % index), 'w').close()
+
+
+def test_local_client(tmp_path):
+    """
+    Results come back in order, events are batched within the latency
+    budget, post-processors run on each batch, and errors reach the client.
+    """
+    from mlreco.serving import InferenceServer, LocalClient
+
+    trainer = SumTrainer(delay=0.02)
+    with InferenceServer(CFG, trainer=trainer, processors=[write_index], logdir=str(tmp_path)) as server:
+        client = LocalClient(server)
+        results = list(client.stream(event(i) for i in range(10)))
+        assert [r['total'][0, 0] for r in results] == [i * (i + 1) for i in range(10)]
+        assert max(trainer.batch_sizes) <= 4 and len(trainer.batch_sizes) < 10
+        assert results[0]['batch_size'] == [trainer.batch_sizes[0]]
+        # Scalars of the micro-batch are not split, even with one per event
+        assert results[0]['scores'] == [float(b) for b in range(trainer.batch_sizes[0])]
+
+        # A lone event waits at most max_latency for more
+        start = time.time()
+        assert client.infer(event(3))['total'][0, 0] == 12
+        assert time.time() - start < 1.
+
+        with pytest.raises(ValueError):
+            client.infer({'input_data': -np.ones((2, 2))})
+
+        stats = server.stats()
+        assert stats['num_events'] == 11
+        assert stats['num_batches'] == len(trainer.batch_sizes)
+        assert 0 < stats['latency_p50'] <= stats['latency_p99']
+        assert stats['throughput'] > 0
+    assert len(os.listdir(str(tmp_path))) == 11
+
+
+def test_socket_client():
+    """
+    Same results through a local socket.
+    """
+    from mlreco.serving import InferenceServer, SocketClient
+
+    with InferenceServer(CFG, trainer=SumTrainer(), processors=[]) as server:
+        address = server.listen(authkey=b'test')
+        client = SocketClient(address, authkey=b'test')
+        assert [r['total'][0, 0] for r in client.stream(event(i) for i in range(6))] == [i * (i + 1) for i in range(6)]
+        with pytest.raises(RuntimeError):
+            client.infer({'input_data': -np.ones((2, 2))}, timeout=10)
+        client.close()
+
+
+def test_socket_client_close():
+    """
+    Closing a client right after submitting events still delivers all their
+    results: the server replies to every request before closing.
+    """
+    from mlreco.serving import InferenceServer, SocketClient
+
+    with InferenceServer(CFG, trainer=SumTrainer(delay=0.05), processors=[]) as server:
+        client = SocketClient(server.listen())
+        futures = [client.submit(event(i)) for i in range(9)]
+        client.close()
+        assert all(future.done() for future in futures)
+        assert [future.result()['total'][0, 0] for future in futures] == [i * (i + 1) for i in range(9)]
+
+
+def test_bad_request():
+    """
+    A request which cannot be loaded fails alone, the other events of its
+    micro-batch are processed. Serving without an unwrapper is refused.
+    """
+    import copy
+    from mlreco.serving import InferenceServer, LocalClient
+
+    trainer = SumTrainer()
+    with InferenceServer(CFG, trainer=trainer, processors=[]) as server:
+        server._dataset = [event(i) for i in range(3)]
+        client = LocalClient(server)
+        futures = [client.submit(i) for i in (0, 1, 7, 2)]
+        with pytest.raises(IndexError):
+            futures[2].result(timeout=10)
+        assert [futures[i].result(timeout=10)['total'][0, 0] for i in (0, 1, 3)] == [0, 2, 6]
+        assert trainer.batch_sizes == [3]
+
+    cfg = copy.deepcopy(CFG)
+    del cfg['trainval']['unwrapper']
+    with pytest.raises(ValueError):
+        InferenceServer(cfg, trainer=SumTrainer(), processors=[])
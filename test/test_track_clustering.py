@@ -0,0 +1,43 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+from scipy.spatial.distance import cdist
+
+
+def test_break_clusters():
+    """
+    A cluster made of two tracks meeting at a point is broken at the point.
+    """
+    from mlreco.utils.track_clustering import break_clusters
+    first = np.column_stack([np.arange(20), np.zeros(20), np.zeros(20)])
+    second = np.column_stack([np.full(20, 19), np.arange(1, 21), np.zeros(20)])
+    other = np.array([[50, 50, 50], [51, 50, 50]])
+    clusters = np.column_stack([np.concatenate([first, second, other]), np.r_[np.zeros(40), np.ones(2)]])
+
+    # No point: clusters are left as they are
+    unbroken = break_clusters(clusters, np.empty((0, 3)), exclusion_radius=2, min_samples=1)
+    assert [len(c) for c in unbroken] == [40, 2]
+
+    broken = break_clusters(clusters, np.array([[19.5, 0.5, 0.5]]), exclusion_radius=2, min_samples=1)
+    assert len(broken) == 3
+    for cluster, ref in zip(broken, [first, second, other]):
+        assert sorted(map(tuple, cluster)) == sorted(map(tuple, ref))
+
+
+def test_match_clusters():
+    """
+    Overlaps from the voxel contingency table match distance-based ones.
+    """
+    from mlreco.utils.track_clustering import match_clusters
+    rng = np.random.default_rng(0)
+    voxels = np.floor(rng.uniform(0, 10, (300, 3)))
+    predicted = [voxels[rng.integers(0, 300, n)] for n in rng.integers(1, 50, 8)]
+    true = [voxels[rng.integers(0, 300, n)] for n in rng.integers(1, 50, 6)]
+    matches, overlaps = match_clusters(predicted, true)
+    for i, p in enumerate(predicted):
+        overlap = np.array([np.count_nonzero((cdist(p, t) < 1).any(axis=0)) for t in true])
+        assert overlaps[i] == overlap.max()
+        assert matches[i] == (overlap.argmax() if overlap.max() > 0 else -1)
+    matches, overlaps = match_clusters(predicted, [])
+    assert (matches == -1).all()
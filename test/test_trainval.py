@@ -0,0 +1,55 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import copy
+import warnings
+import pytest
+import torch
+
+
+class LinearModel(torch.nn.Module):
+    def __init__(self, cfg):
+        super(LinearModel, self).__init__()
+        torch.manual_seed(0)
+        self.linear = torch.nn.Linear(3, 2)
+
+    def forward(self, input):
+        return {'output': [self.linear(input[0])]}
+
+
+class MeanSquaredLoss(torch.nn.Module):
+    def __init__(self, cfg):
+        super(MeanSquaredLoss, self).__init__()
+
+    def forward(self, result, label):
+        loss = ((result['output'][0] - label[0])**2).mean()
+        return {'loss': loss, 'accuracy': 0.}
+
+
+@pytest.mark.parametrize('accumulate_gradients', [True, False])
+def test_gradient_accumulation(monkeypatch, accumulate_gradients):
+    """
+    One training iteration over 4 minibatches gives the same weight update
+    as a single backward of the mean loss over the whole batch.
+    """
+    import mlreco.trainval
+    monkeypatch.setattr(mlreco.trainval, 'construct', lambda name: (LinearModel, MeanSquaredLoss))
+    cfg = {'model': {'name': 'linear', 'modules': {}, 'network_input': ['input_data'], 'loss_input': ['label']},
+           'trainval': {'gpus': [], 'train': True, 'accumulate_gradients': accumulate_gradients,
+                        'optimizer': {'name': 'SGD', 'args': {'lr': 0.1}}},
+           'iotool': {'batch_size': 8, 'minibatch_size': 2}}
+    trainer = mlreco.trainval.trainval(cfg)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', FutureWarning)
+        trainer.initialize()
+
+    x, y = torch.randn(8, 3), torch.randn(8, 2)
+    reference = copy.deepcopy(trainer._net.module.linear)
+    ((reference(x) - y)**2).mean().backward()
+    expected = [p - 0.1 * p.grad for p in reference.parameters()]
+
+    data_iter = iter([{'input_data': x[i:i+2], 'label': y[i:i+2]} for i in range(0, 8, 2)])
+    _, res = trainer.train_step(data_iter)
+    assert len(res['loss']) == 4
+    for p, e in zip(trainer._net.module.linear.parameters(), expected):
+        assert torch.allclose(p, e, atol=1e-6)
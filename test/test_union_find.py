@@ -0,0 +1,75 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+
+
+def same_partition(a, b):
+    """
+    Whether two label arrays group the entries the same way
+    """
+    a, b = np.asarray(a), np.asarray(b)
+    return len(a) == len(b) and len(np.unique(np.stack([a, b]), axis=1)[0]) == len(np.unique(a)) == len(np.unique(b))
+
+
+def test_union_find():
+    """
+    Unions keep the root of the first set, find compresses paths without
+    recursion, roots matches find for every element.
+    """
+    from mlreco.utils.union_find import UnionFind
+
+    uf = UnionFind(6)
+    assert uf.union(0, 1) == 0
+    assert uf.union(2, 1) == 2
+    assert uf.union(3, 4) == 3
+    assert uf.find(0) == uf.find(1) == 2
+    assert uf.find(5) == 5
+    np.testing.assert_array_equal(uf.roots(), [uf.find(i) for i in range(6)])
+
+    # Long chain, deeper than the recursion limit
+    n = 100000
+    uf = UnionFind(n)
+    for i in range(n - 1):
+        uf.link(i + 1, i)
+    assert uf.find(0) == n - 1
+    assert uf.parent[0] == n - 1
+    assert (uf.roots() == n - 1).all()
+
+
+def test_connected_components():
+    """
+    Same components as union-find over the edges above threshold
+    """
+    from mlreco.utils.union_find import UnionFind, connected_components
+
+    rng = np.random.RandomState(0)
+    n = 50
+    edges = rng.randint(0, n, size=(60, 2))
+    weights = rng.uniform(size=60)
+    uf = UnionFind(n)
+    for (i, j), w in zip(edges, weights):
+        if w > 0.3:
+            uf.union(i, j)
+    labels = connected_components(edges, n, weights=weights, thresh=0.3)
+    assert same_partition(labels, uf.roots())
+    assert labels.max() == len(np.unique(labels)) - 1
+    assert len(np.unique(connected_components(edges, n))) <= len(np.unique(labels))
+    np.testing.assert_array_equal(connected_components(np.empty((0, 2)), 3), [0, 1, 2])
+
+
+def test_edge_labels_to_node_labels():
+    """
+    One component label per node, node_len (or len(positions)) nodes,
+    extended to the nodes of the edges
+    """
+    from mlreco.utils.gnn.features.utils import edge_labels_to_node_labels
+
+    edges = np.array([[0, 1], [1, 2], [3, 4], [2, 3]])
+    edge_labels = np.array([1, 1, 1, 0])
+    labels = edge_labels_to_node_labels(np.zeros((6, 3)), edges, edge_labels)
+    assert same_partition(labels, [0, 0, 0, 1, 1, 2])
+    labels = edge_labels_to_node_labels(None, edges, edge_labels, node_len=7)
+    assert same_partition(labels, [0, 0, 0, 1, 1, 2, 3])
+    labels = edge_labels_to_node_labels(None, edges, edge_labels, threshold=0.5, node_len=4)
+    assert same_partition(labels, [0, 0, 0, 1, 1])
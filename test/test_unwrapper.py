@@ -32,6 +32,39 @@ def test_unwrap_scn(dim, num_device=4, minibatch_size=8):
     assert(len(data_blob['x']) == len(outputs['y']))
     assert(data_blob['x'][0].mean() == outputs['y'][0].mean())
 
+
+@pytest.mark.parametrize("tensors", [False, True])
+def test_unwrap_scn_unsorted(tensors, dim=3, num_events=5, num_points=100):
+    """
+    Events are split the same way as with a boolean mask per batch id, also
+    when the rows are not sorted by batch id, and for outputs which are
+    still tensors.
+    """
+    from mlreco.utils import unwrap_3d_scn
+
+    np.random.seed(0)
+    x = np.random.rand(num_points, dim+2)
+    x[:, dim] = np.random.randint(0, num_events, num_points)
+    scores = np.random.rand(num_points, 5)
+    points = [np.random.rand(n, dim+2) for n in (20, 30)]
+    for p in points:
+        p[:, dim] = np.random.randint(0, num_events, len(p))
+        p[:num_events, dim] = np.arange(num_events)
+
+    output_scores, output_points = scores, points
+    if tensors:
+        import torch
+        output_scores = torch.as_tensor(scores)
+        output_points = [torch.as_tensor(p) for p in points]
+    data_blob, outputs = unwrap_3d_scn({'x': [x]}, {'scores': [output_scores], 'points': [output_points]})
+    assert len(data_blob['x']) == len(outputs['scores']) == len(outputs['points']) == num_events
+    for b in range(num_events):
+        mask = x[:, dim] == b
+        assert np.array_equal(data_blob['x'][b], x[mask])
+        assert np.array_equal(np.asarray(outputs['scores'][b]), scores[mask])
+        for p, q in zip(outputs['points'][b], points):
+            assert np.array_equal(np.asarray(p), q[q[:, dim] == b])
+
 if __name__ == '__main__':
     test_unwrap_scn(2)
     test_unwrap_scn(3)